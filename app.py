@@ -40,8 +40,18 @@ with app.app_context():
     # Create database tables
     db.create_all()
     
+    # Add columns introduced since the tables were created
+    from utils.db_schema import upgrade_schema
+    upgrade_schema()
+    
     # Import and register routes
     from routes import register_routes
     register_routes(app)
     
+    # Start background ingestion workers and resume unfinished jobs
+    from utils.config import is_ingestion_queue_enabled
+    if is_ingestion_queue_enabled():
+        from utils.job_queue import init_job_queue
+        init_job_queue(app)
+    
     logger.info("Application initialized successfully")
@@ -7,6 +7,8 @@ This package provides the core RAG functionality for the application.
 from app.rag.api import (
     query_rag_system,
     add_document_to_rag,
+    replace_document_in_rag,
+    delete_document_from_rag,
     get_rag_system_status,
     reset_rag_system
 )
@@ -14,6 +16,8 @@ from app.rag.api import (
 __all__ = [
     'query_rag_system',
     'add_document_to_rag',
+    'replace_document_in_rag',
+    'delete_document_from_rag',
     'get_rag_system_status',
     'reset_rag_system'
 ]
\ No newline at end of file
@@ -6,6 +6,7 @@ This module provides the main entry points to the RAG system.
 
 import logging
 import os
+import time
 from typing import List, Dict, Any, Optional, Union
 from langchain.docstore.document import Document as LangchainDocument
 
@@ -15,12 +16,14 @@ from app.rag.vectorstores import get_chroma_store
 
 logger = logging.getLogger(__name__)
 
-def query_rag_system(question: str) -> Dict[str, Any]:
+def query_rag_system(question: str, search_filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     Query the RAG system with a question
     
     Args:
         question: The question to ask
+        search_filter: Optional filter restricting which documents are searched
+            (see utils.search_filter.parse_search_filter)
         
     Returns:
         A dictionary containing the answer and sources
@@ -38,7 +41,7 @@ def query_rag_system(question: str) -> Dict[str, Any]:
     
     try:
         pipeline = get_rag_pipeline()
-        return pipeline.query(question)
+        return pipeline.query(question, search_filter)
     
     except Exception as e:
         logger.error(f"Error querying RAG system: {str(e)}")
@@ -52,11 +55,29 @@ def query_rag_system(question: str) -> Dict[str, Any]:
             }
         }
 
+def _filter_metadata(
+    metadata: Optional[Dict[str, Any]],
+    document_id: Optional[int],
+    user_id: Optional[int],
+    document_title: Optional[str]
+) -> Dict[str, Any]:
+    """Document metadata with the fields searches filter on (see utils.search_filter)"""
+    metadata = {**(metadata or {})}
+    for field, value in (("document_id", document_id), ("user_id", user_id), ("document_title", document_title)):
+        if value is not None:
+            metadata[field] = value
+    # Record when the document was added
+    metadata.setdefault("uploaded_at", time.time())
+    return metadata
+
 def add_document_to_rag(
     document_content: Union[str, bytes],
     metadata: Optional[Dict[str, Any]] = None,
     file_path: Optional[str] = None,
-    document_type: str = "text"
+    document_type: str = "text",
+    document_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    document_title: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Add a document to the RAG system
@@ -66,11 +87,16 @@ def add_document_to_rag(
         metadata: Additional metadata for the document
         file_path: Path to the file (if applicable)
         document_type: Type of document (text, file, etc.)
+        document_id: Id of the document, for search filters
+        user_id: Id of the user who uploaded the document, for search filters
+        document_title: Title of the document, for search filters
         
     Returns:
         Status of the document addition
     """
     try:
+        metadata = _filter_metadata(metadata, document_id, user_id, document_title)
+        
         # Process the document based on type
         if document_type == "file" and file_path:
             documents = process_file(file_path, metadata)
@@ -108,6 +134,92 @@ def add_document_to_rag(
             "document_count": 0
         }
 
+def replace_document_in_rag(
+    file_path: str,
+    metadata: Optional[Dict[str, Any]] = None,
+    document_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    document_title: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Replace a file's chunks in the RAG system with those of its current version
+    
+    Only chunks whose content changed are embedded; chunks that were removed
+    from the file are deleted from the vector store.
+    
+    Args:
+        file_path: Path to the revised file (its path identifies the source)
+        metadata: Additional metadata for the document
+        document_id: Id of the document, for search filters
+        user_id: Id of the user who uploaded the document, for search filters
+        document_title: Title of the document, for search filters
+        
+    Returns:
+        Status of the replacement, with reused/added/deleted chunk counts
+    """
+    try:
+        metadata = _filter_metadata(metadata, document_id, user_id, document_title)
+        documents = process_file(file_path, metadata)
+        if not documents:
+            return {
+                "success": False,
+                "message": "Failed to process document into chunks",
+                "document_count": 0
+            }
+        
+        pipeline = get_rag_pipeline()
+        result = pipeline.replace_documents(documents[0].metadata.get("source", file_path), documents)
+        if result is None:
+            return {
+                "success": False,
+                "message": "Failed to replace document",
+                "document_count": 0
+            }
+        
+        return {
+            "success": True,
+            "message": f"Replaced document: {result['reused']} chunks reused, {result['added']} added, {result['deleted']} deleted",
+            "document_count": len(documents),
+            "chunks_reused": result["reused"],
+            "chunks_added": result["added"],
+            "chunks_deleted": result["deleted"]
+        }
+    
+    except Exception as e:
+        logger.error(f"Error replacing document in RAG system: {str(e)}")
+        return {
+            "success": False,
+            "message": f"Error: {str(e)}",
+            "document_count": 0
+        }
+
+def delete_document_from_rag(source: str) -> Dict[str, Any]:
+    """
+    Delete a document's chunks from the RAG system
+    
+    Chunks whose content another document also contains are kept for that document.
+    
+    Args:
+        source: The document's source (the file path it was added from)
+        
+    Returns:
+        Status of the deletion, with the number of chunks removed
+    """
+    pipeline = get_rag_pipeline()
+    deleted = pipeline.delete_documents(source)
+    if deleted is None:
+        return {
+            "success": False,
+            "message": "Failed to delete document",
+            "chunks_deleted": 0
+        }
+    
+    return {
+        "success": True,
+        "message": f"Deleted document: {deleted} chunks removed",
+        "chunks_deleted": deleted
+    }
+
 def get_rag_system_status() -> Dict[str, Any]:
     """Get the status of the RAG system"""
     try:
@@ -121,9 +233,16 @@ def get_rag_system_status() -> Dict[str, Any]:
                 "collection": stats.get("collection_name"),
                 "document_count": stats.get("document_count", 0)
             },
+            "deduplication": {
+                "embeddings_saved": stats.get("embeddings_saved", 0),
+                "index_bytes_saved": stats.get("index_bytes_saved", 0)
+            },
             "embeddings": {
-                "type": "simple" if "OpenAIEmbeddings" not in str(type(chroma_store.embeddings)) else "openai"
+                # Look through the caching wrapper, if any, at the model it wraps
+                "type": "simple" if "OpenAIEmbedding" not in str(type(getattr(chroma_store.embeddings, "embeddings", chroma_store.embeddings))) else "openai",
+                "cached": hasattr(chroma_store.embeddings, "cache")
             },
+            "answer_cache": get_rag_pipeline().answer_cache.get_stats(),
             "timestamp": __import__("datetime").datetime.now().isoformat()
         }
     
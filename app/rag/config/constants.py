@@ -18,7 +18,7 @@ Path(CHROMA_PERSIST_DIRECTORY).mkdir(exist_ok=True, parents=True)
 # Document processing
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
-MAX_DOCUMENT_SIZE_MB = 10
+MAX_DOCUMENT_SIZE_MB = int(os.environ.get("MAX_DOCUMENT_SIZE_MB", 10))
 
 # API Settings
-EMBEDDING_API_TIMEOUT = 60  # seconds
\ No newline at end of file
+EMBEDDING_API_TIMEOUT = int(os.environ.get("EMBEDDING_API_TIMEOUT", 60))  # seconds per request, including retries
\ No newline at end of file
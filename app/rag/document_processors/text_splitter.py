@@ -4,52 +4,52 @@ Text splitter for the RAG system.
 This module provides functionality to split documents into chunks for processing.
 """
 
+import copy
 import logging
 from typing import List, Dict, Any, Optional
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document as LangchainDocument
 
 from app.rag.config.constants import CHUNK_SIZE, CHUNK_OVERLAP
+from utils.text_splitter import get_text_splitter
 
 logger = logging.getLogger(__name__)
 
+# Separators tried in order; sentence breaks are preferred over plain spaces
+SEPARATORS = ["\n\n", "\n", ". ", " ", ""]
+
 def split_text(text: str, metadata: Optional[Dict[str, Any]] = None) -> List[LangchainDocument]:
     """Split text into chunks suitable for embedding and storage"""
     if not text:
         logger.warning("Empty text provided to split_text")
         return []
-    
+
     try:
-        # Create a text splitter
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP,
-            length_function=len,
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
-        
-        # If metadata is provided, create a Document first
+        # The shared splitter for this configuration is built once per process
+        text_splitter = get_text_splitter(CHUNK_SIZE, CHUNK_OVERLAP, SEPARATORS)
+        chunk_texts = text_splitter.split_text(text)
+
         if metadata:
-            doc = LangchainDocument(page_content=text, metadata=metadata)
-            chunks = text_splitter.split_documents([doc])
+            # Every chunk gets its own copy of the document's metadata
+            chunks = [
+                LangchainDocument(page_content=chunk, metadata=copy.deepcopy(metadata))
+                for chunk in chunk_texts
+            ]
         else:
-            # Split the raw text and then convert to Documents
-            chunk_texts = text_splitter.split_text(text)
             chunks = [
                 LangchainDocument(
                     page_content=chunk,
-                    metadata=metadata or {"chunk_index": i}
+                    metadata={"chunk_index": i}
                 )
                 for i, chunk in enumerate(chunk_texts)
             ]
-        
+
         logger.info(f"Split text into {len(chunks)} chunks")
         return chunks
-    
+
     except Exception as e:
         logger.error(f"Error splitting text: {str(e)}")
         # Return a single chunk as fallback
         return [LangchainDocument(
             page_content=text[:CHUNK_SIZE] if len(text) > CHUNK_SIZE else text,
             metadata=metadata or {"chunk_index": 0, "error": "Failed to split properly"}
-        )]
\ No newline at end of file
+        )]
@@ -8,7 +8,8 @@ import logging
 import numpy as np
 from typing import List
 from langchain.embeddings.base import Embeddings
-from app.rag.config.constants import EMBEDDINGS_DIMENSION
+from app.rag.config.constants import EMBEDDINGS_DIMENSION, EMBEDDING_API_TIMEOUT
+from utils.embedding import hash_vectors
 
 logger = logging.getLogger(__name__)
 
@@ -20,31 +21,23 @@ class SimpleEmbeddings(Embeddings):
         self.embedding_size = embedding_size
         logger.info("Using simple deterministic embeddings as fallback")
     
-    def _hash_text(self, text):
-        """Create a simple hash of text within numpy's random seed range (0 to 2^32-1)"""
-        import hashlib
-        return int(hashlib.md5(text.encode('utf-8')).hexdigest(), 16) % (2**32 - 1)
-    
-    def _text_to_vector(self, text):
-        """Convert text to a deterministic embedding vector"""
-        # Set a deterministic seed based on the text hash
-        np.random.seed(self._hash_text(text))
-        
-        # Generate a deterministic random vector
-        vector = np.random.normal(size=self.embedding_size)
-        
-        # Normalize to unit length
-        vector = vector / np.linalg.norm(vector)
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Generate embeddings for multiple texts as a float32 matrix
         
-        return vector.tolist()
+        Components are normally distributed and derived from a hash of the text,
+        so the vectors are the same on every thread and no global RNG state is used.
+        """
+        if not texts:
+            return np.zeros((0, self.embedding_size), dtype=np.float32)
+        return hash_vectors(texts, self.embedding_size, distribution="normal")
     
     def embed_query(self, text: str) -> List[float]:
         """Generate an embedding for a single text"""
-        return self._text_to_vector(text)
+        return self.embed_documents_array([text])[0].tolist()
     
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Generate embeddings for multiple texts"""
-        return [self._text_to_vector(text) for text in texts]
+        return self.embed_documents_array(texts).tolist()
 
 def get_embeddings() -> Embeddings:
     """Get or create an embedding model instance"""
@@ -54,9 +47,14 @@ def get_embeddings() -> Embeddings:
         openai_key = os.environ.get("OPENAI_API_KEY")
         
         if openai_key:
-            from langchain.embeddings import OpenAIEmbeddings
+            from utils.embedding_client import OpenAIEmbeddingClient
+            from utils.embedding_cache import CachedEmbeddings, EMBEDDING_CACHE_ENABLED
             logger.info("Using OpenAI embeddings")
-            return OpenAIEmbeddings()
+            embeddings = OpenAIEmbeddingClient(api_key=openai_key, timeout=EMBEDDING_API_TIMEOUT)
+            if EMBEDDING_CACHE_ENABLED:
+                # Share the persistent embedding cache with the main application
+                return CachedEmbeddings(embeddings, model_name=embeddings.model, dimension=EMBEDDINGS_DIMENSION)
+            return embeddings
     except ImportError:
         logger.warning("OpenAI package not available, falling back to simple embeddings")
     except Exception as e:
@@ -4,15 +4,19 @@ RAG pipeline for the AI Market Matching Tool.
 This module provides the main Retrieval Augmented Generation pipeline.
 """
 
+import json
+import time
 import logging
 from typing import List, Dict, Any, Optional, Tuple
 from langchain.docstore.document import Document as LangchainDocument
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
 from langchain.llms.fake import FakeListLLM
 
 from app.rag.vectorstores import get_chroma_store
 from app.rag.embeddings import get_embeddings
+from utils.config import is_answer_cache_enabled
+from utils.answer_cache import AnswerCache
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +46,10 @@ class RAGPipeline:
         self.chroma_store = get_chroma_store()
         self.embeddings = get_embeddings()
         self._pipeline = None
+        self._llm_generates = False
+        # Answers are cached until this pipeline next changes its vector store
+        self.answer_cache = AnswerCache()
+        self._corpus_version = 0
         logger.info("Initialized RAG pipeline")
     
     def _initialize_llm(self):
@@ -72,7 +80,11 @@ class RAGPipeline:
         )
     
     def _get_or_create_pipeline(self):
-        """Get or create the RAG pipeline"""
+        """Get or create the chain answering from retrieved documents
+
+        It has no retriever of its own, so it is built once and outlives changes
+        to the vector store.
+        """
         if self._pipeline is None:
             try:
                 # Create prompt
@@ -81,19 +93,12 @@ class RAGPipeline:
                     input_variables=["context", "question"]
                 )
                 
-                # Get the vector store
-                vector_store = self.chroma_store._get_or_create_store()
-                
-                # Initialize LLM
+                # Initialize LLM; answers of the fake one aren't worth caching
                 llm = self._initialize_llm()
+                self._llm_generates = not isinstance(llm, FakeListLLM)
                 
                 # Create the chain
-                self._pipeline = RetrievalQA.from_chain_type(
-                    llm=llm,
-                    chain_type="stuff",
-                    retriever=vector_store.as_retriever(search_kwargs={"k": 5}),
-                    chain_type_kwargs={"prompt": prompt}
-                )
+                self._pipeline = load_qa_chain(llm, chain_type="stuff", prompt=prompt)
                 
                 logger.info("Created RAG pipeline")
             
@@ -103,42 +108,85 @@ class RAGPipeline:
         
         return self._pipeline
     
-    def query(self, question: str) -> Dict[str, Any]:
+    def query(self, question: str, search_filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Process a query through the RAG pipeline
         
+        search_filter (see utils.search_filter) restricts retrieval to chunks of
+        matching documents; the Chroma store checks it against each source of a chunk.
+        
         Returns a dictionary with:
         - answer: The generated answer
         - sources: List of source documents used
-        - metadata: Additional information about the query
+        - metadata: Additional information about the query, including the time
+          of each stage (embed, cache, search, generate) in milliseconds and
+          whether the answer came from the answer cache
         """
         try:
             logger.info(f"Processing query: '{question}'")
             
             # Get the pipeline
             pipeline = self._get_or_create_pipeline()
+            timings = {}
             
-            # First get the relevant documents for sources
-            vector_store = self.chroma_store._get_or_create_store()
-            docs_and_scores = vector_store.similarity_search_with_score(question, k=5)
+            # Retrieve once; the answer is generated from the same documents returned as sources
+            start_time = time.perf_counter()
+            embedding = self.embeddings.embed_query(question)
+            timings["embed"] = round((time.perf_counter() - start_time) * 1000, 2)
             
-            # Run the pipeline
-            result = pipeline({"query": question})
+            # A near-identical earlier question is answered without searching or generating
+            use_cache = is_answer_cache_enabled()
+            corpus_version = self._corpus_version
+            if use_cache:
+                start_time = time.perf_counter()
+                cached = self.answer_cache.lookup(embedding, corpus_version, search_filter)
+                timings["cache"] = round((time.perf_counter() - start_time) * 1000, 2)
+                if cached is not None:
+                    answer, sources, similarity = cached
+                    logger.info(f"Answered query from the answer cache (similarity {similarity:.4f})")
+                    return {
+                        "query": question,
+                        "answer": answer,
+                        "sources": sources,
+                        "metadata": {
+                            "document_count": len(sources),
+                            "timings_ms": timings,
+                            "cache": {"hit": True, "similarity": round(similarity, 4)},
+                            "timestamp": __import__("datetime").datetime.now().isoformat()
+                        }
+                    }
+            
+            start_time = time.perf_counter()
+            docs_and_scores = self.chroma_store.similarity_search_by_vector_with_score(
+                embedding, k=5, search_filter=search_filter
+            )
+            timings["search"] = round((time.perf_counter() - start_time) * 1000, 2)
+            
+            start_time = time.perf_counter()
+            answer = pipeline.run(input_documents=[doc for doc, _ in docs_and_scores], question=question)
+            timings["generate"] = round((time.perf_counter() - start_time) * 1000, 2)
             
             # Format the response
+            sources = [
+                {
+                    "content": doc.page_content,
+                    "metadata": doc.metadata,
+                    # Deduplicated content is stored once; list every source it came from
+                    "source_documents": json.loads(doc.metadata.get("sources", "[]")),
+                    "relevance_score": score
+                }
+                for doc, score in docs_and_scores
+            ]
+            if use_cache and answer and self._llm_generates:
+                self.answer_cache.store(embedding, answer, sources, corpus_version, search_filter)
             response = {
                 "query": question,
-                "answer": result.get("result", "No answer generated"),
-                "sources": [
-                    {
-                        "content": doc.page_content,
-                        "metadata": doc.metadata,
-                        "relevance_score": score
-                    }
-                    for doc, score in docs_and_scores
-                ],
+                "answer": answer or "No answer generated",
+                "sources": sources,
                 "metadata": {
                     "document_count": len(docs_and_scores),
+                    "timings_ms": timings,
+                    "cache": {"hit": False},
                     "timestamp": __import__("datetime").datetime.now().isoformat()
                 }
             }
@@ -162,9 +210,8 @@ class RAGPipeline:
         """Add a document to the RAG pipeline's vector store"""
         try:
             self.chroma_store.add_documents([document])
+            self._corpus_version += 1
             logger.info(f"Added document to RAG pipeline: {document.metadata.get('source', 'unknown')}")
-            # Reset the pipeline to use updated retriever
-            self._pipeline = None
             return True
         except Exception as e:
             logger.error(f"Error adding document to RAG pipeline: {str(e)}")
@@ -178,19 +225,39 @@ class RAGPipeline:
         
         try:
             self.chroma_store.add_documents(documents)
+            self._corpus_version += 1
             logger.info(f"Added {len(documents)} documents to RAG pipeline")
-            # Reset the pipeline to use updated retriever
-            self._pipeline = None
             return True
         except Exception as e:
             logger.error(f"Error adding documents to RAG pipeline: {str(e)}")
             return False
     
+    def replace_documents(self, source: str, documents: List[LangchainDocument]) -> Optional[Dict[str, int]]:
+        """Replace a source's chunks with a new version; returns the reused/added/deleted counts"""
+        try:
+            result = self.chroma_store.replace_source(source, documents)
+            self._corpus_version += 1
+            return result
+        except Exception as e:
+            logger.error(f"Error replacing documents in RAG pipeline: {str(e)}")
+            return None
+    
+    def delete_documents(self, source: str) -> Optional[int]:
+        """Delete a source's chunks; returns how many chunks it was removed from"""
+        try:
+            deleted = self.chroma_store.delete_source(source)
+            self._corpus_version += 1
+            return deleted
+        except Exception as e:
+            logger.error(f"Error deleting documents from RAG pipeline: {str(e)}")
+            return None
+    
     def reset(self) -> bool:
         """Reset the pipeline and its vector store"""
         try:
             self.chroma_store.delete_collection()
             self._pipeline = None
+            self._corpus_version += 1
             logger.info("Reset RAG pipeline")
             return True
         except Exception as e:
@@ -4,17 +4,119 @@ ChromaDB vector store implementation for the RAG system.
 This module provides ChromaDB vector store functionality.
 """
 
+import json
+import hashlib
 import logging
 import chromadb
 from langchain_community.vectorstores import Chroma
 from langchain.docstore.document import Document as LangchainDocument
 from typing import List, Dict, Any, Tuple, Optional
 
-from app.rag.config.constants import CHROMA_PERSIST_DIRECTORY
+from app.rag.config.constants import CHROMA_PERSIST_DIRECTORY, EMBEDDINGS_DIMENSION
 from app.rag.embeddings import get_embeddings
+from utils.search_filter import matches_metadata, upload_bounds
 
 logger = logging.getLogger(__name__)
 
+# Collection metadata key holding the version of the keys its chunks carry:
+# 1 for source keys, 2 for filter keys as well
+SOURCE_KEYS_MARKER = "source_keys"
+SOURCE_KEYS_VERSION = 2
+
+# Document fields kept for each source of a chunk, for search filters
+FILTER_FIELDS = ("document_id", "document_title", "user_id", "uploaded_at")
+KEYED_FILTER_FIELDS = ("document_id", "document_title", "user_id")
+
+def _attribute_key(field: str, value: Any) -> str:
+    """Metadata key set to True on every chunk with a source whose field has the value,
+    so those chunks can be found with a where filter"""
+    return f"{field}:" + hashlib.sha256(str(value).encode('utf-8')).hexdigest()[:32]
+
+def _source_key(source: str) -> str:
+    """Metadata key set to True on every chunk of a source"""
+    return _attribute_key("source", source)
+
+def _chunk_sources(metadata: Dict[str, Any]) -> List[str]:
+    """The sources a stored chunk is attributed to"""
+    if "sources" in metadata:
+        return json.loads(metadata["sources"])
+    return [metadata["source"]] if "source" in metadata else []
+
+def _source_fields(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """The filter fields of a document's metadata"""
+    return {field: metadata[field] for field in FILTER_FIELDS if metadata.get(field) is not None}
+
+def _chunk_source_fields(metadata: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """The filter fields of each source a stored chunk is attributed to
+
+    Chunks stored before the fields were kept per source only know those of
+    their primary source.
+    """
+    if "source_fields" in metadata:
+        return json.loads(metadata["source_fields"])
+    primary = metadata.get("source")
+    return {source: _source_fields(metadata) if source == primary else {} for source in _chunk_sources(metadata)}
+
+def _attribute_keys(source_fields: Dict[str, Dict[str, Any]]) -> set:
+    """The keys set to True on a chunk attributed to the given sources"""
+    keys = set()
+    for source, fields in source_fields.items():
+        keys.add(_source_key(source))
+        keys.update(_attribute_key(field, fields[field]) for field in KEYED_FILTER_FIELDS if field in fields)
+    return keys
+
+def _attributed_metadata(
+    metadata: Dict[str, Any],
+    source_fields: Dict[str, Dict[str, Any]],
+    previous_fields: Optional[Dict[str, Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """A chunk's metadata attributed to the given sources and their filter fields
+
+    The chunk keeps its primary source while it still has it, and carries that
+    source's fields. Keys that only applied to previous_fields are set to False,
+    since an update can't remove them.
+    """
+    primary = metadata.get("source") if metadata.get("source") in source_fields else next(iter(source_fields))
+    keys = _attribute_keys(source_fields)
+    attributed = {
+        **metadata,
+        **source_fields[primary],
+        "source": primary,
+        "sources": json.dumps(list(source_fields)),
+        "source_fields": json.dumps(source_fields),
+        **{key: False for key in _attribute_keys(previous_fields or {}) - keys},
+        **{key: True for key in keys}
+    }
+    # Upload date bounds over all sources, for the where filter
+    uploaded = [fields["uploaded_at"] for fields in source_fields.values() if "uploaded_at" in fields]
+    if uploaded:
+        attributed["uploaded_first"], attributed["uploaded_last"] = min(uploaded), max(uploaded)
+    return attributed
+
+def _where_filter(search_filter: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """A where filter passing every chunk with a source that matches a search filter
+
+    It also passes chunks that match only across different sources (one source's
+    id, another's upload date), so results are checked per source afterwards.
+    """
+    conditions = []
+    for field in KEYED_FILTER_FIELDS:
+        if field in search_filter:
+            keys = [{_attribute_key(field, value): True} for value in search_filter[field]]
+            conditions.append(keys[0] if len(keys) == 1 else {"$or": keys})
+    after, before = upload_bounds(search_filter)
+    if after is not None:
+        conditions.append({"uploaded_last": {"$gte": after}})
+    if before is not None:
+        conditions.append({"uploaded_first": {"$lt": before}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def _matches_filter(metadata: Dict[str, Any], search_filter: Dict[str, Any]) -> bool:
+    """Whether any source of a stored chunk matches a search filter"""
+    return any(matches_metadata(search_filter, fields) for fields in _chunk_source_fields(metadata).values())
+
 class ChromaStore:
     """ChromaDB vector store for the AI Market Matching Tool"""
     
@@ -24,6 +126,7 @@ class ChromaStore:
         self.embeddings = get_embeddings()
         self.persist_directory = CHROMA_PERSIST_DIRECTORY
         self._vector_store = None
+        self.embeddings_saved = 0
         logger.info(f"Initialized ChromaStore with collection: {collection_name}")
     
     def _get_or_create_store(self):
@@ -52,9 +155,38 @@ class ChromaStore:
                     persist_directory=self.persist_directory
                 )
                 logger.info(f"Created new ChromaDB collection: {self.collection_name}")
+            self._add_source_keys(self._vector_store)
         
         return self._vector_store
     
+    def _add_source_keys(self, store):
+        """Give the chunks of a collection written before chunks carried source and
+        filter keys their keys, once"""
+        collection = store._collection
+        collection_metadata = collection.metadata or {}
+        if collection_metadata.get(SOURCE_KEYS_MARKER, 0) >= SOURCE_KEYS_VERSION:
+            return
+        offset = 0
+        while True:
+            page = collection.get(include=["metadatas"], limit=1000, offset=offset)
+            update_ids, update_metadatas = [], []
+            for chunk_id, metadata in zip(page["ids"], page["metadatas"]):
+                source_fields = _chunk_source_fields(metadata or {})
+                if source_fields:
+                    update_ids.append(chunk_id)
+                    update_metadatas.append(_attributed_metadata(metadata, source_fields))
+            if update_ids:
+                collection.update(ids=update_ids, metadatas=update_metadatas)
+            if len(page["ids"]) < 1000:
+                break
+            offset += 1000
+        # The distance function can't be passed to modify, even unchanged
+        collection.modify(metadata={
+            **{key: value for key, value in collection_metadata.items() if not key.startswith("hnsw:")},
+            SOURCE_KEYS_MARKER: SOURCE_KEYS_VERSION
+        })
+        logger.info(f"Added source keys to the chunks of ChromaDB collection {self.collection_name}")
+    
     def add_texts(self, texts: List[str], metadatas: List[Dict[str, Any]]) -> List[str]:
         """Add texts to the vector store"""
         store = self._get_or_create_store()
@@ -68,30 +200,189 @@ class ChromaStore:
             raise
     
     def add_documents(self, documents: List[LangchainDocument]) -> List[str]:
-        """Add LangChain documents to the vector store"""
+        """Add LangChain documents to the vector store
+
+        Documents are stored under the hash of their content. Content that is already
+        in the collection is not embedded again; its "sources" metadata (a JSON list)
+        is extended instead so every source document stays attributed. The filter
+        fields of each source are kept in "source_fields", and each source and field
+        value sets its own key (see _attribute_key) on the chunk.
+        """
         store = self._get_or_create_store()
         try:
-            ids = store.add_documents(documents=documents)
+            doc_hashes = [hashlib.sha256(doc.page_content.encode('utf-8')).hexdigest() for doc in documents]
+            
+            # Group the documents by content hash, keeping the first copy of each
+            by_hash = {}
+            for doc, content_hash in zip(documents, doc_hashes):
+                source = doc.metadata.get("source", "unknown")
+                if content_hash not in by_hash:
+                    by_hash[content_hash] = (doc, {})
+                by_hash[content_hash][1].setdefault(source, _source_fields(doc.metadata))
+            
+            hashes = list(by_hash.keys())
+            existing = store.get(ids=hashes, include=["metadatas"])
+            existing_metadata = dict(zip(existing["ids"], existing["metadatas"]))
+            
+            # Known content: only record the additional sources
+            update_ids, update_metadatas = [], []
+            for content_hash, metadata in existing_metadata.items():
+                source_fields = _chunk_source_fields(metadata or {})
+                # A source added again takes its new fields
+                update_ids.append(content_hash)
+                update_metadatas.append(_attributed_metadata(
+                    metadata or {}, {**source_fields, **by_hash[content_hash][1]}, source_fields
+                ))
+            if update_ids:
+                store._collection.update(ids=update_ids, metadatas=update_metadatas)
+            
+            # New content: embed and add it once
+            new_hashes = [h for h in hashes if h not in existing_metadata]
+            if new_hashes:
+                store.add_texts(
+                    texts=[by_hash[h][0].page_content for h in new_hashes],
+                    metadatas=[
+                        _attributed_metadata({**by_hash[h][0].metadata, "content_hash": h}, by_hash[h][1])
+                        for h in new_hashes
+                    ],
+                    ids=new_hashes
+                )
             store.persist()
-            logger.info(f"Added {len(documents)} documents to ChromaDB")
-            return ids
+            
+            saved = len(documents) - len(new_hashes)
+            self.embeddings_saved += saved
+            logger.info(f"Added {len(new_hashes)} documents to ChromaDB ({saved} duplicates reused)")
+            return doc_hashes
         except Exception as e:
             logger.error(f"Error adding documents to ChromaDB: {str(e)}")
             raise
     
+    def _get_source_hashes(self, store, source: str) -> Dict[str, Dict[str, Any]]:
+        """Get the metadata of every stored chunk attributed to a source, keyed by content hash"""
+        found = store._collection.get(where={_source_key(source): True}, include=["metadatas"])
+        return dict(zip(found["ids"], found["metadatas"]))
+    
+    def replace_source(self, source: str, documents: List[LangchainDocument]) -> Dict[str, int]:
+        """Replace the chunks of a source with a new version, embedding only what changed
+
+        Chunks whose content is unchanged keep their embedding and take the new
+        version's filter fields. The source is removed from the chunks it no longer
+        contains, and chunks left with no sources at all are deleted. Returns the
+        number of chunks reused, added and deleted.
+        """
+        store = self._get_or_create_store()
+        try:
+            old_chunks = self._get_source_hashes(store, source)
+            new_fields = {
+                hashlib.sha256(doc.page_content.encode('utf-8')).hexdigest(): _source_fields(doc.metadata)
+                for doc in documents
+            }
+            
+            # Detach the source from chunks it no longer contains
+            delete_ids, update_ids, update_metadatas = [], [], []
+            refresh_ids, refresh_metadatas = [], []
+            for content_hash, metadata in old_chunks.items():
+                source_fields = _chunk_source_fields(metadata)
+                if content_hash in new_fields:
+                    if source_fields.get(source) != new_fields[content_hash]:
+                        refresh_ids.append(content_hash)
+                        refresh_metadatas.append(_attributed_metadata(
+                            metadata, {**source_fields, source: new_fields[content_hash]}, source_fields
+                        ))
+                    continue
+                remaining = {s: fields for s, fields in source_fields.items() if s != source}
+                if remaining:
+                    # The chunk is now attributed to the sources that still contain it
+                    update_ids.append(content_hash)
+                    update_metadatas.append(_attributed_metadata(metadata, remaining, source_fields))
+                else:
+                    delete_ids.append(content_hash)
+            if update_ids or refresh_ids:
+                store._collection.update(ids=update_ids + refresh_ids, metadatas=update_metadatas + refresh_metadatas)
+            if delete_ids:
+                store._collection.delete(ids=delete_ids)
+            
+            # Only chunks the source didn't have before need adding
+            added = [
+                doc for doc in documents
+                if hashlib.sha256(doc.page_content.encode('utf-8')).hexdigest() not in old_chunks
+            ]
+            if added:
+                self.add_documents(added)
+            else:
+                store.persist()
+            
+            result = {
+                "reused": len(documents) - len(added),
+                "added": len(added),
+                "deleted": len(delete_ids) + len(update_ids)
+            }
+            logger.info(f"Replaced {source} in ChromaDB: {result}")
+            return result
+        except Exception as e:
+            logger.error(f"Error replacing {source} in ChromaDB: {str(e)}")
+            raise
+    
+    def delete_source(self, source: str) -> int:
+        """Remove a source from the collection; chunks no other source shares are deleted
+
+        Returns the number of chunks the source was removed from.
+        """
+        return self.replace_source(source, [])["deleted"]
+    
+    def _search_filtered(self, search, k: int, search_filter: Optional[Dict[str, Any]]):
+        """Run search(fetch_k, where) for the k best results with a source matching a search filter
+
+        The where filter leaves out chunks with no matching source; results that
+        only match across sources are dropped, fetching more while too few are left.
+        """
+        if not search_filter:
+            return search(k, None)
+        where = _where_filter(search_filter)
+        fetch_k = k
+        while True:
+            results = search(fetch_k, where)
+            matching = [(doc, score) for doc, score in results if _matches_filter(doc.metadata, search_filter)]
+            if len(matching) >= k or len(results) < fetch_k:
+                return matching[:k]
+            fetch_k *= 4
+    
     def similarity_search_with_score(
-        self, query: str, k: int = 5
+        self, query: str, k: int = 5, search_filter: Optional[Dict[str, Any]] = None
     ) -> List[Tuple[LangchainDocument, float]]:
-        """Search for similar documents"""
+        """Search for similar documents, optionally only those of documents matching
+        search_filter (see utils.search_filter)"""
         store = self._get_or_create_store()
         try:
-            results = store.similarity_search_with_score(query, k=k)
+            results = self._search_filtered(
+                lambda fetch_k, where: store.similarity_search_with_score(query, k=fetch_k, filter=where),
+                k, search_filter
+            )
             logger.info(f"Found {len(results)} results for query: '{query}'")
             return results
         except Exception as e:
             logger.error(f"Error searching ChromaDB: {str(e)}")
             return []
     
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 5, search_filter: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[LangchainDocument, float]]:
+        """Search for the documents nearest to a query embedding, optionally only those
+        of documents matching search_filter (see utils.search_filter)"""
+        store = self._get_or_create_store()
+        try:
+            results = self._search_filtered(
+                lambda fetch_k, where: store.similarity_search_by_vector_with_relevance_scores(
+                    embedding, k=fetch_k, filter=where
+                ),
+                k, search_filter
+            )
+            logger.info(f"Found {len(results)} results for query embedding")
+            return results
+        except Exception as e:
+            logger.error(f"Error searching ChromaDB: {str(e)}")
+            return []
+    
     def delete_collection(self) -> bool:
         """Delete the entire collection"""
         try:
@@ -113,6 +404,8 @@ class ChromaStore:
             return {
                 "collection_name": self.collection_name,
                 "document_count": count,
+                "embeddings_saved": self.embeddings_saved,
+                "index_bytes_saved": self.embeddings_saved * EMBEDDINGS_DIMENSION * 4,
                 "status": "active"
             }
         except Exception as e:
@@ -0,0 +1,1427 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for the ingestion and retrieval code paths.
+Each command runs a self-contained benchmark on synthetic data and prints the results.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import tempfile
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def print_usage():
+    """Print usage information"""
+    print("Usage: python benchmark.py [command] [options]")
+    print("Commands:")
+    print("  split [--size-mb N] [--repeat N] - Native text splitter versus LangChain's splitter")
+    print("  embed [--texts N] [--concurrency N,N,...] [--rps N] [--error-rate F]")
+    print("         - Embedding client against a local stub API with latency and rate limits")
+    print("  simple-embed [--texts N] [--threads N] - Vectorized SimpleEmbeddings versus per-text seeding")
+    print("  ann [--sizes N,N,...] [--dimension N] [--queries N] - HNSW and IVF latency and recall@5 versus a flat index")
+    print("  filter [--vectors N] [--dimension N] [--selectivity F,F,...]")
+    print("         - Metadata-filtered search: allow-list pre-filter versus over-fetching and discarding")
+    print("  churn [--vectors N] [--dimension N] [--deleted F,F,...]")
+    print("         - Search latency as deleted vectors pile up as tombstones, and the cost of compacting them away")
+    print("  quantize [--vectors N] [--dimension N] [--modes sq8,fp16,pq] [--rescore N,N,...]")
+    print("         - Compressed flat indexes (with and without full-precision re-scoring) versus float32")
+    print("  two-stage [--vectors N] [--dimension N] [--reduced N,N,...] [--candidates N,N,...]")
+    print("         - Two-stage search through a PCA-reduced copy versus single-stage flat search")
+    print("  shared-index [--sizes N,N,...] [--dimension N] [--workers N]")
+    print("         - Per-worker memory with the index shared as mapped segments versus loaded by every worker")
+    print("  shards [--vectors N] [--shards N,N,...] [--clients N]")
+    print("         - Scatter-gather search over shard server processes: throughput and p99 latency by shard count")
+    print("  cold-start [--chunks N] [--dimension N] [--new-chunks N]")
+    print("         - Vector store startup: rebuild from the database versus the FAISS snapshot and vector file")
+    print("  pinecone-sync [--chunks N] [--workers N,N,...] [--latency-ms N] [--new-chunks N]")
+    print("         - Pinecone sync against a local stand-in: full re-upsert versus the incremental sync")
+    print("  batch-query [--queries N] [--chunks N] [--embed-ms N] [--generate-ms N] [--concurrency N,N,...]")
+    print("         - Queries/sec of one /api/query/batch request versus a /api/query request per query")
+    print("  hybrid [--chunks N] [--codes N] [--queries N] [--embed-ms N]")
+    print("         - Lexical index build and load, and latency and exact-term recall@5 of vector, lexical and fused search")
+
+WORDS = (
+    "the of and to in is that for it as with was on be by this are from at or an which "
+    "document retrieval vector embedding chunk index query search answer context model "
+    "language system performance memory throughput latency batch storage result"
+).split()
+
+def generate_text(size_chars, seed=0):
+    """Generate prose-like text with sentences, lines and paragraphs"""
+    rng = random.Random(seed)
+    paragraphs = []
+    total = 0
+    while total < size_chars:
+        lines = []
+        for _ in range(rng.randint(1, 6)):
+            sentences = []
+            for _ in range(rng.randint(1, 5)):
+                words = [rng.choice(WORDS) for _ in range(rng.randint(4, 30))]
+                sentences.append(" ".join(words).capitalize() + ".")
+            lines.append(" ".join(sentences))
+        paragraph = "\n".join(lines)
+        paragraphs.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:size_chars]
+
+def _measure(split, text, repeat):
+    """Best wall time over repeat runs, then the peak traced memory of one more run"""
+    best = float("inf")
+    chunks = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = split(text)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    split(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return chunks, best, peak
+
+def benchmark_split(args):
+    """Compare the native splitter with LangChain's on a large synthetic document"""
+    parser = argparse.ArgumentParser(prog="benchmark.py split")
+    parser.add_argument("--size-mb", type=float, default=20, help="Size of the synthetic document")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per splitter (best is reported)")
+    options = parser.parse_args(args)
+
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from utils.text_splitter import get_text_splitter, CHUNK_SIZE, CHUNK_OVERLAP, DEFAULT_SEPARATORS
+
+    text = generate_text(int(options.size_mb * 1024 * 1024))
+    print(f"Document: {len(text) / (1024 * 1024):.1f}M characters")
+
+    configurations = [
+        ("ingestion", CHUNK_SIZE, CHUNK_OVERLAP, DEFAULT_SEPARATORS),
+        ("rag", 500, 50, ["\n\n", "\n", ". ", " ", ""]),
+    ]
+    for name, chunk_size, chunk_overlap, separators in configurations:
+        langchain_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            separators=separators
+        )
+        native_splitter = get_text_splitter(chunk_size, chunk_overlap, separators)
+
+        expected, langchain_time, langchain_peak = _measure(langchain_splitter.split_text, text, options.repeat)
+        chunks, native_time, native_peak = _measure(native_splitter.split_text, text, options.repeat)
+
+        print(f"\n=== {name} ({chunk_size}/{chunk_overlap}) ===")
+        print(f"Chunks: {len(chunks)} (identical to LangChain: {'Yes' if chunks == expected else 'NO'})")
+        print(f"LangChain: {langchain_time:.3f}s, {len(text) / langchain_time / 1e6:.1f}M chars/s, "
+              f"peak memory {langchain_peak / (1024 * 1024):.1f} MB")
+        print(f"Native:    {native_time:.3f}s, {len(text) / native_time / 1e6:.1f}M chars/s, "
+              f"peak memory {native_peak / (1024 * 1024):.1f} MB")
+        print(f"Speedup: {langchain_time / native_time:.2f}x, "
+              f"memory: {langchain_peak / max(native_peak, 1):.2f}x less")
+
+class StubEmbeddingServer:
+    """Local stand-in for the embeddings API
+
+    Each request takes a fixed latency plus time per token, requests beyond
+    requests_per_second are answered with 429 and a Retry-After header, and a
+    fraction of requests fail with 503. Vectors are derived from the text hash so
+    results can be checked.
+    """
+
+    def __init__(self, base_latency=0.05, seconds_per_token=2e-6, requests_per_second=20,
+                 error_rate=0.02, retry_after=0.2, dimension=8):
+        """Start the server on a free local port"""
+        self.base_latency = base_latency
+        self.seconds_per_token = seconds_per_token
+        self.requests_per_second = requests_per_second
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.dimension = dimension
+        self.lock = threading.Lock()
+        self.recent = []
+        self.counts = {"ok": 0, "rate_limited": 0, "errors": 0}
+        self.rng = random.Random(0)
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, headers, payload = stub.handle(body["input"])
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def vector_for(text, dimension=8):
+        """Deterministic vector for a text"""
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [digest[i] / 255 for i in range(dimension)]
+
+    def handle(self, texts):
+        """Decide the response to one request"""
+        with self.lock:
+            now = time.monotonic()
+            self.recent = [t for t in self.recent if now - t < 1.0]
+            if len(self.recent) >= self.requests_per_second:
+                self.counts["rate_limited"] += 1
+                return 429, {"Retry-After": str(self.retry_after)}, {"error": {"message": "Rate limit reached"}}
+            self.recent.append(now)
+            failed = self.rng.random() < self.error_rate
+
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        time.sleep(self.base_latency + tokens * self.seconds_per_token)
+        if failed:
+            with self.lock:
+                self.counts["errors"] += 1
+            return 503, {}, {"error": {"message": "Service unavailable"}}
+
+        with self.lock:
+            self.counts["ok"] += 1
+        data = [{"object": "embedding", "index": i, "embedding": self.vector_for(text, self.dimension)}
+                for i, text in enumerate(texts)]
+        return 200, {}, {"object": "list", "data": data, "model": "stub"}
+
+    def reset_counts(self):
+        """Clear the response counters and the rate limit window"""
+        with self.lock:
+            self.counts = {"ok": 0, "rate_limited": 0, "errors": 0}
+            self.recent = []
+
+    def close(self):
+        """Stop the server"""
+        self.server.shutdown()
+
+def benchmark_embed(args):
+    """Run the embedding client against the stub API at several concurrency levels"""
+    parser = argparse.ArgumentParser(prog="benchmark.py embed")
+    parser.add_argument("--texts", type=int, default=5000, help="Number of chunk-sized texts to embed")
+    parser.add_argument("--batch-tokens", type=int, default=20000, help="Token budget per request")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--rps", type=int, default=20, help="Requests per second before the stub returns 429")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Fraction of requests that fail with 503")
+    options = parser.parse_args(args)
+
+    from utils.embedding_client import OpenAIEmbeddingClient
+    # Retries are expected here and counted below
+    logging.getLogger("utils.embedding_client").setLevel(logging.ERROR)
+
+    texts = [generate_text(1000, seed=i) for i in range(options.texts)]
+    stub = StubEmbeddingServer(requests_per_second=options.rps, error_rate=options.error_rate)
+    expected = [StubEmbeddingServer.vector_for(text) for text in texts]
+    print(f"Stub API at {stub.url}: {options.rps} requests/s limit, {options.error_rate:.0%} errors")
+    print(f"Embedding {len(texts)} texts with a {options.batch_tokens}-token budget per request\n")
+
+    try:
+        for concurrency in [int(level) for level in options.concurrency.split(",")]:
+            stub.reset_counts()
+            client = OpenAIEmbeddingClient(
+                api_key="stub",
+                model="stub",
+                base_url=stub.url,
+                timeout=120,
+                batch_tokens=options.batch_tokens,
+                concurrency=concurrency
+            )
+            start = time.perf_counter()
+            embeddings = client.embed_documents(texts)
+            elapsed = time.perf_counter() - start
+            stats = client.get_stats()
+            print(f"concurrency={concurrency}: {elapsed:.2f}s, {len(texts) / elapsed:.0f} texts/s, "
+                  f"{stats['requests']} requests ({stub.counts['rate_limited']} rate limited, "
+                  f"{stub.counts['errors']} errors, {stats['retries']} retries), "
+                  f"correct: {'Yes' if embeddings == expected else 'NO'}")
+    finally:
+        stub.close()
+
+def _seeded_vectors(texts, dimension):
+    """The previous SimpleEmbeddings approach: reseed the global RNG for every text"""
+    import numpy as np
+    vectors = []
+    for text in texts:
+        np.random.seed(int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16))
+        vector = np.random.rand(dimension)
+        vectors.append((vector / np.linalg.norm(vector)).tolist())
+    return vectors
+
+def benchmark_simple_embed(args):
+    """Time SimpleEmbeddings against per-text seeding and check results are the same on every thread"""
+    parser = argparse.ArgumentParser(prog="benchmark.py simple-embed")
+    parser.add_argument("--texts", type=int, default=10000, help="Number of chunk-sized texts to embed")
+    parser.add_argument("--threads", type=int, default=8, help="Threads embedding the same texts at once")
+    options = parser.parse_args(args)
+
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.embedding import SimpleEmbeddings, EMBEDDING_DIMENSION
+
+    texts = [generate_text(1000, seed=i) for i in range(options.texts)]
+    embeddings = SimpleEmbeddings()
+
+    start = time.perf_counter()
+    _seeded_vectors(texts, EMBEDDING_DIMENSION)
+    seeded_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings.embed_documents(texts)
+    lists_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matrix = embeddings.embed_documents_array(texts)
+    array_time = time.perf_counter() - start
+
+    print(f"{len(texts)} texts, {EMBEDDING_DIMENSION} dimensions")
+    print(f"Per-text seeding:        {seeded_time:.3f}s ({len(texts) / seeded_time:.0f} texts/s)")
+    print(f"embed_documents:         {lists_time:.3f}s ({len(texts) / lists_time:.0f} texts/s, "
+          f"{seeded_time / lists_time:.1f}x)")
+    print(f"embed_documents_array:   {array_time:.3f}s ({len(texts) / array_time:.0f} texts/s, "
+          f"{seeded_time / array_time:.1f}x)")
+
+    # Embed overlapping slices concurrently; every thread must see the same vectors
+    sample = texts[:1000]
+    with ThreadPoolExecutor(max_workers=options.threads) as executor:
+        results = list(executor.map(embeddings.embed_documents_array, [sample] * options.threads * 4))
+    consistent = all(np.array_equal(result, matrix[:len(sample)]) for result in results)
+
+    # The global-RNG approach under the same load, for comparison
+    expected = _seeded_vectors(sample[:200], EMBEDDING_DIMENSION)
+    with ThreadPoolExecutor(max_workers=options.threads) as executor:
+        seeded_results = list(executor.map(lambda _: _seeded_vectors(sample[:200], EMBEDDING_DIMENSION),
+                                           range(options.threads * 4)))
+    seeded_consistent = all(result == expected for result in seeded_results)
+
+    print(f"Same vectors on {options.threads} threads: SimpleEmbeddings {'Yes' if consistent else 'NO'}, "
+          f"per-text seeding {'Yes' if seeded_consistent else 'NO'}")
+
+def clustered_vectors(count, dimension, seed=0, clusters=1000, spectrum_decay=0.0):
+    """Unit vectors scattered around random centres, loosely like embeddings of a real corpus
+
+    With spectrum_decay the variance falls off across dimensions as a power law, as
+    it does along the principal components of real embeddings.
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    scale = (np.arange(1, dimension + 1, dtype=np.float32) ** -spectrum_decay) if spectrum_decay else None
+    vectors = np.empty((count, dimension), dtype=np.float32)
+    for start in range(0, count, 100000):
+        end = min(start + 100000, count)
+        vectors[start:end] = centres[rng.integers(0, clusters, end - start)]
+        vectors[start:end] += rng.standard_normal((end - start, dimension), dtype=np.float32) * 0.8
+        if scale is not None:
+            vectors[start:end] *= scale
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+def _time_searches(index, queries, k, params=None):
+    """Search one query at a time, as the app does; returns the results and per-query latencies in ms"""
+    import numpy as np
+    results = np.empty((len(queries), k), dtype=np.int64)
+    latencies = []
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, results[i:i + 1] = index.search(queries[i:i + 1], k, params=params)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+def benchmark_ann(args):
+    """Compare HNSW and IVF indexes with the flat index: build time, query latency and recall@5"""
+    parser = argparse.ArgumentParser(prog="benchmark.py ann")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated corpus sizes")
+    parser.add_argument("--dimension", type=int, default=128, help="Vector dimension")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per index")
+    parser.add_argument("--k", type=int, default=5)
+    options = parser.parse_args(args)
+
+    import gc
+    import faiss
+    import numpy as np
+    from utils.ann_index import create_ann_index, train_ivf_index, get_search_parameters
+    from utils.config import get_ann_ivf_nlist
+
+    # Single-threaded search, as for one request
+    faiss.omp_set_num_threads(1)
+    k = options.k
+    print(f"{options.dimension} dimensions, {options.queries} queries, recall@{k} against the flat index\n")
+    print(f"{'vectors':>9}  {'index':<6} {'build':>8}  {'p50 ms':>7} {'p95 ms':>7}  {'recall':>6}")
+
+    for size in [int(value) for value in options.sizes.split(",")]:
+        vectors = clustered_vectors(size, options.dimension)
+        # Queries near (not at) corpus vectors
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.integers(0, size, options.queries)] + \
+            rng.standard_normal((options.queries, options.dimension), dtype=np.float32) * 0.05
+
+        start = time.perf_counter()
+        flat = faiss.IndexFlatL2(options.dimension)
+        flat.add(vectors)
+        builds = {"flat": time.perf_counter() - start}
+        truth, flat_latency = _time_searches(flat, queries, k)
+        del flat
+
+        rows = [("flat", builds["flat"], flat_latency, 1.0)]
+        for index_type in ("hnsw", "ivf"):
+            gc.collect()
+            start = time.perf_counter()
+            if index_type == "hnsw":
+                index = create_ann_index(options.dimension, "hnsw")
+                index.add(vectors)
+            else:
+                index = train_ivf_index(vectors, min(get_ann_ivf_nlist(), size // 39))
+            build_time = time.perf_counter() - start
+            found, latency = _time_searches(index, queries, k, get_search_parameters(index))
+            recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(len(queries))])
+            rows.append((index_type, build_time, latency, recall))
+            del index
+
+        for name, build_time, latency, recall in rows:
+            print(f"{size:>9}  {name:<6} {build_time:>7.1f}s  {np.percentile(latency, 50):>7.3f} "
+                  f"{np.percentile(latency, 95):>7.3f}  {recall:>6.3f}")
+        del vectors
+
+def benchmark_filter(args):
+    """Compare filtered search strategies: allow-list pre-filter, over-fetch with a database check, and the planner"""
+    parser = argparse.ArgumentParser(prog="benchmark.py filter")
+    parser.add_argument("--vectors", type=int, default=100000, help="Chunks in the database and vectors in the index")
+    parser.add_argument("--dimension", type=int, default=128, help="Vector dimension")
+    parser.add_argument("--chunks-per-document", type=int, default=100)
+    parser.add_argument("--selectivity", default="0.001,0.01,0.1,0.5",
+                        help="Comma-separated fractions of the corpus the filter allows")
+    parser.add_argument("--queries", type=int, default=50, help="Queries per case")
+    parser.add_argument("--k", type=int, default=5)
+    options = parser.parse_args(args)
+
+    work_dir = tempfile.mkdtemp(prefix="filter_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+    os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+
+    import faiss
+    import numpy as np
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain.docstore.document import Document as LangchainDocument
+    from app import app, db
+    from models import User, Document, DocumentChunk
+    from utils.ann_index import AnnFAISS, create_ann_index
+    from utils.embedding import SimpleEmbeddings
+    from utils.faiss_store import TombstoneFAISS
+    from utils.vector_store import _search_filtered_by_vector
+    logging.getLogger().setLevel(logging.WARNING)
+    faiss.omp_set_num_threads(1)
+
+    k = options.k
+    with app.app_context():
+        user = User(username="benchmark", email="benchmark@example.com", password_hash="x")
+        db.session.add(user)
+        db.session.commit()
+        _insert_chunks(db, 1, options.vectors, options.chunks_per_document, user.id)
+        rows = db.session.query(DocumentChunk.id, DocumentChunk.document_id).order_by(DocumentChunk.id).all()
+        document_count = db.session.query(Document).count()
+
+    vectors = clustered_vectors(options.vectors, options.dimension)
+    vector_ids = [str(chunk_id) for chunk_id, _ in rows]
+    document_of = np.array([document_id for _, document_id in rows])
+    docs = {
+        vector_id: LangchainDocument(id=vector_id, page_content="", metadata={"document_id": int(document_id)})
+        for vector_id, document_id in zip(vector_ids, document_of)
+    }
+
+    def build(index):
+        index.add(vectors)
+        return index, InMemoryDocstore(dict(docs)), dict(enumerate(vector_ids))
+
+    embeddings = SimpleEmbeddings(options.dimension)
+    stores = {"flat": TombstoneFAISS(embeddings, *build(faiss.IndexFlatL2(options.dimension)))}
+    start = time.perf_counter()
+    stores["hnsw"] = AnnFAISS(embeddings, *build(create_ann_index(options.dimension, "hnsw")))
+    print(f"{options.vectors} vectors of {options.dimension} dimensions in {document_count} documents "
+          f"(HNSW built in {time.perf_counter() - start:.1f}s), {options.queries} queries, "
+          f"recall@{k} against exact filtered search\n")
+    print(f"{'allowed':>8}  {'index':<5} {'strategy':<24} {'p50 ms':>7} {'p95 ms':>7}  {'recall':>6}")
+
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, options.vectors, options.queries)] + \
+        rng.standard_normal((options.queries, options.dimension), dtype=np.float32) * 0.05
+
+    for selectivity in [float(value) for value in options.selectivity.split(",")]:
+        allowed_documents = sorted(set(rng.choice(
+            np.unique(document_of), max(1, round(document_count * selectivity)), replace=False
+        ).tolist()))
+        search_filter = {"document_id": allowed_documents}
+        allowed_positions = np.flatnonzero(np.isin(document_of, allowed_documents))
+
+        truth = []
+        for query in queries:
+            distances = ((vectors[allowed_positions] - query) ** 2).sum(axis=1)
+            truth.append({vector_ids[i] for i in allowed_positions[np.argsort(distances)[:k]]})
+
+        strategies = [("pre-filter (allow-list)", True), ("post-filter (over-fetch)", False), ("planned", None)]
+        with app.app_context():
+            for index_name, store in stores.items():
+                for strategy_name, prefilter in strategies:
+                    latencies, recalls = [], []
+                    for query, expected in zip(queries, truth):
+                        start = time.perf_counter()
+                        results = _search_filtered_by_vector(store, query, k, search_filter, prefilter)
+                        latencies.append((time.perf_counter() - start) * 1000)
+                        recalls.append(len({doc.id for doc, _ in results} & expected) / k)
+                    print(f"{len(allowed_positions):>8}  {index_name:<5} {strategy_name:<24} "
+                          f"{np.percentile(latencies, 50):>7.3f} {np.percentile(latencies, 95):>7.3f}  "
+                          f"{np.mean(recalls):>6.3f}")
+        print()
+
+def benchmark_churn(args):
+    """Time deletes, search latency as tombstones pile up, and compaction, for the flat and HNSW stores"""
+    parser = argparse.ArgumentParser(prog="benchmark.py churn")
+    parser.add_argument("--vectors", type=int, default=50000, help="Vectors in the index")
+    parser.add_argument("--dimension", type=int, default=128, help="Vector dimension")
+    parser.add_argument("--deleted", default="0.1,0.2,0.4,0.6", help="Comma-separated fractions of the index to delete")
+    parser.add_argument("--vectors-per-document", type=int, default=100, help="Vectors deleted together, as one document")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    options = parser.parse_args(args)
+
+    import faiss
+    import numpy as np
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from utils.ann_index import AnnFAISS
+    from utils.embedding import SimpleEmbeddings
+    from utils.faiss_store import TombstoneFAISS
+
+    faiss.omp_set_num_threads(1)
+    k = options.k
+    vectors = clustered_vectors(options.vectors, options.dimension)
+    ids = [str(i) for i in range(options.vectors)]
+    text_embeddings = [("", vector) for vector in vectors]
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, options.vectors, options.queries)] + \
+        rng.standard_normal((options.queries, options.dimension), dtype=np.float32) * 0.05
+    # Whole documents are deleted at a time, in random order
+    documents = rng.permutation(options.vectors // options.vectors_per_document)
+    embeddings = SimpleEmbeddings(options.dimension)
+
+    def search(store):
+        latencies = []
+        found = []
+        for query in queries:
+            start = time.perf_counter()
+            results = store.similarity_search_with_score_by_vector(query, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append({doc.id for doc, _ in results})
+        return found, np.array(latencies)
+
+    def document_ids(document):
+        return ids[document * options.vectors_per_document:(document + 1) * options.vectors_per_document]
+
+    # The previous delete: LangChain's FAISS removes vectors from the flat index and renumbers the rest
+    legacy = FAISS(embeddings, faiss.IndexFlatL2(options.dimension), InMemoryDocstore(), {})
+    legacy.add_embeddings(text_embeddings, ids=ids)
+    deletes = min(20, len(documents))
+    start = time.perf_counter()
+    for document in documents[:deletes]:
+        legacy.delete(ids=document_ids(document))
+    legacy_delete_ms = (time.perf_counter() - start) * 1000 / deletes
+    del legacy
+
+    print(f"{options.vectors} vectors of {options.dimension} dimensions, deleted {options.vectors_per_document} "
+          f"per document, {options.queries} queries, recall@{k} against exact search over the live vectors\n")
+    print(f"Delete of one document, removing vectors from the flat index (previous): {legacy_delete_ms:.2f} ms\n")
+    print(f"{'index':<5} {'deleted':>8} {'delete ms':>10} {'p50 ms':>7} {'p95 ms':>7} {'recall':>7}")
+
+    for name in ("flat", "hnsw"):
+        start = time.perf_counter()
+        if name == "flat":
+            store = TombstoneFAISS.create(embeddings, faiss.IndexFlatL2(options.dimension))
+        else:
+            store = AnnFAISS.create(embeddings, options.dimension, "hnsw")
+        store.add_embeddings(text_embeddings, ids=ids)
+        deleted_documents = 0
+
+        def report(label, delete_ms):
+            live = np.fromiter(sorted(int(i) for i in store.index_to_docstore_id.values()), dtype=np.int64)
+            exact = faiss.IndexFlatL2(options.dimension)
+            exact.add(vectors[live])
+            _, truth = exact.search(queries, k)
+            found, latencies = search(store)
+            recall = np.mean([len(found[i] & {str(live[j]) for j in truth[i]}) / k for i in range(len(queries))])
+            print(f"{name:<5} {label:>8} {delete_ms:>10} {np.percentile(latencies, 50):>7.3f} "
+                  f"{np.percentile(latencies, 95):>7.3f} {recall:>7.3f}")
+
+        report("0%", "")
+        for fraction in [float(value) for value in options.deleted.split(",")]:
+            target = int(len(documents) * fraction)
+            start = time.perf_counter()
+            for document in documents[deleted_documents:target]:
+                store.delete(ids=document_ids(document))
+            delete_ms = (time.perf_counter() - start) * 1000 / max(1, target - deleted_documents)
+            deleted_documents = target
+            report(f"{store.deleted_ratio:.0%}", f"{delete_ms:.2f}")
+
+        start = time.perf_counter()
+        state = store.begin_compaction()
+        read = time.perf_counter() - start
+        index = store.build_compacted_index(state)
+        built = time.perf_counter() - start - read
+        removed = store.finish_compaction(state, index)
+        total = time.perf_counter() - start
+        report("compact", "")
+        print(f"{'':<5} compaction removed {removed} vectors in {total:.2f}s "
+              f"(writes held off for {total - built:.2f}s while reading and swapping)\n")
+
+def benchmark_quantize(args):
+    """Compare compressed flat indexes with the float32 one: memory, query latency and recall@5"""
+    parser = argparse.ArgumentParser(prog="benchmark.py quantize")
+    parser.add_argument("--vectors", type=int, default=20000, help="Vectors in the index")
+    parser.add_argument("--dimension", type=int, default=1536, help="Vector dimension")
+    parser.add_argument("--modes", default="sq8,fp16,pq", help="Comma-separated quantization modes")
+    parser.add_argument("--rescore", default="1,4,8", help="Comma-separated re-scoring factors (1 is off)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    options = parser.parse_args(args)
+
+    import gc
+    import faiss
+    import numpy as np
+    from utils.config import VECTOR_RESCORE_FACTOR_KEY
+    from utils.embedding import SimpleEmbeddings
+    from utils.faiss_store import TombstoneFAISS
+    from utils.quantized_index import QuantizedFAISS
+    from utils.vector_file import VectorFile, _chunk_ids
+
+    faiss.omp_set_num_threads(1)
+    k = options.k
+    vectors = clustered_vectors(options.vectors, options.dimension)
+    ids = [str(i) for i in range(options.vectors)]
+    text_embeddings = [("", vector) for vector in vectors]
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, options.vectors, options.queries)] + \
+        rng.standard_normal((options.queries, options.dimension), dtype=np.float32) * 0.05
+    embeddings = SimpleEmbeddings(options.dimension)
+
+    def search(store):
+        latencies = []
+        found = []
+        for query in queries:
+            start = time.perf_counter()
+            results = store.similarity_search_with_score_by_vector(query, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append({doc.id for doc, _ in results})
+        return found, np.array(latencies)
+
+    def report(name, bytes_per_vector, latencies, recall):
+        print(f"{name:<12} {bytes_per_vector:>6} {bytes_per_vector * options.vectors / 2 ** 20:>8.1f} "
+              f"{np.percentile(latencies, 50):>7.3f} {np.percentile(latencies, 95):>7.3f} {recall:>7.3f}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Full-precision vectors are re-read from a vector file on disk, as in the app
+        vector_file = VectorFile(directory, options.dimension, "benchmark")
+        vector_file.append(np.arange(options.vectors, dtype=np.int64), vectors)
+
+        print(f"{options.vectors} vectors of {options.dimension} dimensions, {options.queries} queries, "
+              f"recall@{k} against the float32 flat index\n")
+        print(f"{'index':<12} {'bytes':>6} {'index MB':>8} {'p50 ms':>7} {'p95 ms':>7} {'recall':>7}")
+
+        flat = TombstoneFAISS.create(embeddings, faiss.IndexFlatL2(options.dimension))
+        flat.add_embeddings(text_embeddings, ids=ids)
+        truth, latencies = search(flat)
+        report("flat", 4 * options.dimension, latencies, 1.0)
+        del flat
+
+        for mode in options.modes.split(","):
+            gc.collect()
+            start = time.perf_counter()
+            store = QuantizedFAISS.create(embeddings, options.dimension, mode)
+            store.add_embeddings(text_embeddings, ids=ids)
+            store.full_precision_source = lambda vector_ids: vector_file.get(_chunk_ids(vector_ids))
+            print(f"{mode} built in {time.perf_counter() - start:.1f}s")
+            for factor in options.rescore.split(","):
+                os.environ[VECTOR_RESCORE_FACTOR_KEY] = factor
+                found, latencies = search(store)
+                recall = np.mean([len(found[i] & truth[i]) / k for i in range(len(queries))])
+                label = mode if factor == "1" else f"{mode} x{factor}"
+                report(label, store.bytes_per_vector, latencies, recall)
+            del store
+        os.environ.pop(VECTOR_RESCORE_FACTOR_KEY, None)
+
+def benchmark_two_stage(args):
+    """Compare two-stage search (PCA-reduced copy, then full-dimension re-ranking) with single-stage flat search"""
+    parser = argparse.ArgumentParser(prog="benchmark.py two-stage")
+    parser.add_argument("--vectors", type=int, default=100000, help="Vectors in the index")
+    parser.add_argument("--dimension", type=int, default=1536, help="Vector dimension")
+    parser.add_argument("--reduced", default="128,256", help="Comma-separated reduced dimensions")
+    parser.add_argument("--candidates", default="10,20,50", help="Comma-separated candidates per result")
+    parser.add_argument("--spectrum-decay", type=float, default=0.5,
+                        help="Power-law fall-off of variance across dimensions (0 is isotropic)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    options = parser.parse_args(args)
+
+    import faiss
+    import numpy as np
+    from utils.config import VECTOR_PREFILTER_CANDIDATES_KEY
+    from utils.embedding import SimpleEmbeddings
+    from utils.reduced_index import ReducedFAISS
+
+    faiss.omp_set_num_threads(1)
+    k = options.k
+    vectors = clustered_vectors(options.vectors, options.dimension, spectrum_decay=options.spectrum_decay)
+    ids = [str(i) for i in range(options.vectors)]
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, options.vectors, options.queries)] + \
+        rng.standard_normal((options.queries, options.dimension), dtype=np.float32) * 0.05
+
+    def search(store):
+        latencies = []
+        found = []
+        for query in queries:
+            start = time.perf_counter()
+            results = store.similarity_search_with_score_by_vector(query, k=k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append({doc.id for doc, _ in results})
+        return found, np.array(latencies)
+
+    store = ReducedFAISS.create(SimpleEmbeddings(options.dimension), options.dimension, "none")
+    store.add_embeddings([("", vector) for vector in vectors], ids=ids)
+    del vectors
+
+    print(f"{options.vectors} vectors of {options.dimension} dimensions (spectrum decay {options.spectrum_decay}), "
+          f"{options.queries} queries, recall@{k} against single-stage search\n")
+    print(f"{'search':<22} {'train':>7} {'p50 ms':>7} {'p95 ms':>7} {'recall':>7}")
+    truth, latencies = search(store)
+    print(f"{'single-stage':<22} {'':>7} {np.percentile(latencies, 50):>7.3f} {np.percentile(latencies, 95):>7.3f} {1.0:>7.3f}")
+
+    for dimension in [int(value) for value in options.reduced.split(",")]:
+        store.prefilter_dimension = dimension
+        start = time.perf_counter()
+        state = store.begin_projection()
+        store.finish_projection(state, store.build_reduced_copy(state))
+        del state
+        train_time = time.perf_counter() - start
+        for candidates in options.candidates.split(","):
+            os.environ[VECTOR_PREFILTER_CANDIDATES_KEY] = candidates
+            found, latencies = search(store)
+            recall = np.mean([len(found[i] & truth[i]) / k for i in range(len(queries))])
+            print(f"{f'{dimension} dims x{candidates}':<22} {train_time:>6.1f}s {np.percentile(latencies, 50):>7.3f} "
+                  f"{np.percentile(latencies, 95):>7.3f} {recall:>7.3f}")
+    os.environ.pop(VECTOR_PREFILTER_CANDIDATES_KEY, None)
+
+def _process_memory_mb():
+    """(private, shared-file, proportional) resident memory of this process in MB, from /proc"""
+    values = {}
+    for path in ("/proc/self/status", "/proc/self/smaps_rollup"):
+        with open(path) as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("RssAnon", "RssFile", "Pss"):
+                    values[key] = int(rest.split()[0]) / 1024
+    return values["RssAnon"], values["RssFile"], values["Pss"]
+
+def _shared_index_worker(mode, directory, queries, k, results):
+    """One worker process of the shared-index benchmark: load or map the index, then search"""
+    import faiss
+    import numpy as np
+    from utils.shared_index import SharedSegmentStore, read_manifest, _segment_path, INDEX_SUFFIX
+
+    faiss.omp_set_num_threads(1)
+    start = time.perf_counter()
+    if mode == "shared":
+        store = SharedSegmentStore(None, directory, None, None, queries.shape[1])
+        store.refresh()
+        search = lambda query: store.search_vector_ids(query, k)
+    else:
+        # What each worker does without sharing: read the whole index into its own memory
+        name = read_manifest(directory)["segments"][0]["name"]
+        index = faiss.read_index(_segment_path(directory, name, INDEX_SUFFIX))
+        search = lambda query: index.search(query[None, :], k)
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    results.put((mode, load_time, float(np.percentile(latencies, 50))) + _process_memory_mb())
+
+def benchmark_shared_index(args):
+    """Per-worker memory and load time with the index shared as mapped segments versus loaded per worker"""
+    parser = argparse.ArgumentParser(prog="benchmark.py shared-index")
+    parser.add_argument("--sizes", default="25000,100000", help="Comma-separated corpus sizes")
+    parser.add_argument("--dimension", type=int, default=1536, help="Vector dimension")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes")
+    parser.add_argument("--queries", type=int, default=50, help="Queries per worker")
+    parser.add_argument("--k", type=int, default=5)
+    options = parser.parse_args(args)
+
+    import multiprocessing
+    import faiss
+    import numpy as np
+    from utils.shared_index import SharedSegmentStore, publish_changes
+
+    # Workers start fresh, as gunicorn workers without --preload do
+    context = multiprocessing.get_context("spawn")
+    print(f"{options.dimension} dimensions, {options.workers} worker processes, {options.queries} queries each; "
+          f"memory per worker in MB (private, mapped file pages, proportional share)\n")
+    print(f"{'vectors':>8} {'index':<8} {'load s':>7} {'p50 ms':>7} {'private':>8} {'file':>7} {'pss':>7}")
+
+    for size in [int(value) for value in options.sizes.split(",")]:
+        vectors = clustered_vectors(size, options.dimension)
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.integers(0, size, options.queries)] + \
+            rng.standard_normal((options.queries, options.dimension), dtype=np.float32) * 0.05
+        with tempfile.TemporaryDirectory() as directory:
+            index = faiss.IndexFlatL2(options.dimension)
+            index.add(vectors)
+            publish_changes(directory, "benchmark", options.dimension, index=index, chunk_ids=np.arange(size))
+            del index, vectors
+
+            for mode in ("private", "shared"):
+                results = context.Queue()
+                workers = [
+                    context.Process(target=_shared_index_worker, args=(mode, directory, queries, options.k, results))
+                    for _ in range(options.workers)
+                ]
+                for worker in workers:
+                    worker.start()
+                rows = [results.get() for _ in workers]
+                for worker in workers:
+                    worker.join()
+                load_time, latency, private, file_pages, pss = np.mean([row[1:] for row in rows], axis=0).tolist()
+                print(f"{size:>8} {mode:<8} {load_time:>7.2f} {latency:>7.2f} {private:>8.0f} {file_pages:>7.0f} {pss:>7.0f}")
+
+            # Publishing a write and a worker picking it up
+            store = SharedSegmentStore(None, directory, None, "benchmark", options.dimension)
+            store.refresh()
+            added = faiss.IndexFlatL2(options.dimension)
+            added.add(queries)
+            start = time.perf_counter()
+            publish_changes(directory, "benchmark", options.dimension, index=added, chunk_ids=np.arange(size, size + len(queries)),
+                            deleted_chunk_ids=np.arange(100))
+            publish_time = time.perf_counter() - start
+            start = time.perf_counter()
+            store.refresh()
+            print(f"{size:>8} publishing {len(queries)} vectors and 100 deletes: {publish_time * 1000:.1f} ms, "
+                  f"picked up by a worker in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+def benchmark_shards(args):
+    """Scatter-gather search over 1 to N shard server processes: throughput and tail latency"""
+    parser = argparse.ArgumentParser(prog="benchmark.py shards")
+    parser.add_argument("--vectors", type=int, default=200000, help="Corpus size")
+    parser.add_argument("--dimension", type=int, default=768, help="Vector dimension")
+    parser.add_argument("--shards", default="1,2,4", help="Comma-separated shard counts")
+    parser.add_argument("--clients", type=int, default=4, help="Threads querying at once")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per shard count")
+    parser.add_argument("--k", type=int, default=5)
+    options = parser.parse_args(args)
+
+    from concurrent.futures import ThreadPoolExecutor
+    import faiss
+    import numpy as np
+    from utils.shared_index import publish_changes
+    from utils.sharded_index import ShardedStore, new_layout, layout_shard_directories, commit_layout, shard_of
+
+    vectors = clustered_vectors(options.vectors, options.dimension)
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, options.vectors, options.queries)] + \
+        rng.standard_normal((options.queries, options.dimension), dtype=np.float32) * 0.05
+    chunk_ids = np.arange(1, options.vectors + 1)
+
+    # Reference: one flat index searched in this process
+    index = faiss.IndexFlatL2(options.dimension)
+    index.add(vectors)
+    _, expected = index.search(queries, options.k)
+    del index
+
+    print(f"{options.vectors} vectors of {options.dimension} dimensions, {options.clients} clients, "
+          f"{options.queries} queries, {os.cpu_count()} CPUs\n")
+    print(f"{'shards':>6} {'queries/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'recall':>7}")
+    for shards in [int(value) for value in options.shards.split(",")]:
+        with tempfile.TemporaryDirectory() as directory:
+            layout = new_layout(shards, "chunk", "benchmark", options.dimension)
+            assignments = np.array([shard_of(chunk_id, shards) for chunk_id in chunk_ids.tolist()])
+            for shard, shard_directory in enumerate(layout_shard_directories(directory, layout)):
+                selected = np.flatnonzero(assignments == shard)
+                shard_index = faiss.IndexFlatL2(options.dimension)
+                shard_index.add(vectors[selected])
+                publish_changes(shard_directory, "benchmark", options.dimension, index=shard_index, chunk_ids=chunk_ids[selected])
+                del shard_index
+            commit_layout(directory, layout)
+
+            store = ShardedStore(None, directory, None, "benchmark", options.dimension)
+            store.search_vector_ids(queries[0], options.k)
+
+            def timed_search(query):
+                start = time.perf_counter()
+                hits = store.search_vector_ids(query, options.k)
+                return (time.perf_counter() - start) * 1000, hits
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(options.clients) as executor:
+                results = list(executor.map(timed_search, queries))
+            elapsed = time.perf_counter() - start
+            store.close()
+
+        latencies = [latency for latency, _ in results]
+        recall = np.mean([
+            len({int(vector_id) for vector_id, _ in hits} & set((expected[row] + 1).tolist())) / options.k
+            for row, (_, hits) in enumerate(results)
+        ])
+        print(f"{shards:>6} {len(queries) / elapsed:>10.1f} {np.percentile(latencies, 50):>8.2f} "
+              f"{np.percentile(latencies, 99):>8.2f} {recall:>7.3f}")
+
+def _legacy_rebuild(embeddings):
+    """The previous startup path: load every chunk, look up its document and re-embed everything"""
+    from langchain_community.vectorstores import FAISS
+    from langchain.docstore.document import Document as LangchainDocument
+    from models import Document, DocumentChunk
+
+    documents = []
+    ids = []
+    seen_vector_ids = set()
+    for chunk in DocumentChunk.query.order_by(DocumentChunk.id).all():
+        vector_id = chunk.embedding_id or str(chunk.id)
+        if vector_id in seen_vector_ids:
+            continue
+        document = Document.query.get(chunk.document_id)
+        if document and chunk.content:
+            seen_vector_ids.add(vector_id)
+            ids.append(vector_id)
+            documents.append(LangchainDocument(
+                page_content=chunk.content,
+                metadata={
+                    "chunk_id": str(chunk.id),
+                    "document_id": str(chunk.document_id),
+                    "document_title": document.title,
+                    "chunk_index": chunk.chunk_index
+                }
+            ))
+    return FAISS.from_documents(documents=documents, embedding=embeddings, ids=ids)
+
+def _insert_chunks(db, first_id, count, chunks_per_document, user_id):
+    """Bulk-insert documents and synthetic chunks with ids first_id..first_id+count-1"""
+    from models import Document, DocumentChunk
+    from utils.document_processor import hash_chunk_content
+
+    # Overlapping windows of one long text, so every chunk is distinct
+    text = generate_text(count * 200 + 1000, seed=first_id)
+    for start in range(0, count, 10000):
+        rows = []
+        for offset in range(start, min(start + 10000, count)):
+            if offset % chunks_per_document == 0:
+                document = Document(filename=f"doc-{first_id + offset}.txt", title=f"Document {first_id + offset}",
+                                    content_type="text/plain", processed=True, user_id=user_id)
+                db.session.add(document)
+                db.session.flush()
+            content = text[offset * 200:offset * 200 + 1000]
+            chunk_id = first_id + offset
+            rows.append({
+                "id": chunk_id,
+                "content": content,
+                "chunk_index": offset % chunks_per_document,
+                "content_hash": hash_chunk_content(content),
+                "embedding_id": str(chunk_id),
+                "document_id": document.id
+            })
+        db.session.bulk_insert_mappings(DocumentChunk, rows)
+        db.session.commit()
+
+def benchmark_cold_start(args):
+    """Time vector store startup with and without a FAISS snapshot"""
+    parser = argparse.ArgumentParser(prog="benchmark.py cold-start")
+    parser.add_argument("--chunks", type=int, default=100000, help="Chunks in the database")
+    parser.add_argument("--dimension", type=int, default=1536, help="Embedding dimension")
+    parser.add_argument("--new-chunks", type=int, default=1000,
+                        help="Chunks added after the snapshot was taken, for the catch-up case")
+    parser.add_argument("--chunks-per-document", type=int, default=100)
+    options = parser.parse_args(args)
+
+    work_dir = tempfile.mkdtemp(prefix="cold_start_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+    os.environ["FAISS_SNAPSHOT_DIR"] = os.path.join(work_dir, "faiss_index")
+    os.environ["VECTOR_FILE_DIR"] = os.path.join(work_dir, "vector_data")
+    os.environ["VECTOR_STORE_TYPE"] = "faiss"
+    os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+    os.environ.pop("OPENAI_API_KEY", None)
+
+    import gc
+    import shutil
+    import utils.embedding
+    from app import app, db
+    from models import User
+    from utils.embedding import SimpleEmbeddings
+    from utils.vector_store import get_vector_store, reset_vector_store
+    logging.getLogger().setLevel(logging.WARNING)
+
+    class CountingEmbeddings(SimpleEmbeddings):
+        """SimpleEmbeddings that counts the texts it embeds (embed_documents goes through the array method)"""
+        texts = 0
+
+        def embed_documents_array(self, texts):
+            CountingEmbeddings.texts += len(texts)
+            return super().embed_documents_array(texts)
+
+    # Stands in for the API so the timings show the work done, not the network
+    embeddings = CountingEmbeddings(options.dimension)
+    utils.embedding._embedding_instance = embeddings
+
+    def timed(label, startup):
+        CountingEmbeddings.texts = 0
+        db.session.remove()
+        gc.collect()
+        start = time.perf_counter()
+        vector_store = startup()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<40} {elapsed:8.2f}s  {vector_store.index.ntotal:>8} vectors  "
+              f"{CountingEmbeddings.texts:>8} texts embedded")
+        return elapsed
+
+    def new_startup():
+        reset_vector_store()
+        return get_vector_store()
+
+    try:
+        with app.app_context():
+            user = User(username="benchmark", email="benchmark@example.com")
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            _insert_chunks(db, 1, options.chunks, options.chunks_per_document, user_id)
+            print(f"{options.chunks} chunks, {options.dimension} dimensions\n")
+
+            legacy = timed("Rebuild from database (previous)", lambda: _legacy_rebuild(embeddings))
+            no_snapshot = timed("Startup without a snapshot", new_startup)
+            snapshot = timed("Startup from snapshot", new_startup)
+
+            # An index rebuild, e.g. after a store switch: no snapshot, but the vectors are on disk
+            shutil.rmtree(os.environ["FAISS_SNAPSHOT_DIR"])
+            from_file = timed("Rebuild from the vector file", new_startup)
+
+            _insert_chunks(db, options.chunks + 1, options.new_chunks, options.chunks_per_document, user_id)
+            catch_up = timed(f"Startup from snapshot + {options.new_chunks} new chunks", new_startup)
+
+            snapshot_dir = os.environ["FAISS_SNAPSHOT_DIR"]
+            size = sum(os.path.getsize(os.path.join(snapshot_dir, name)) for name in os.listdir(snapshot_dir))
+            print(f"\nSnapshot size: {size / (1024 * 1024):.1f} MB")
+            print(f"Speedup from snapshot: {legacy / snapshot:.1f}x, with new chunks: {legacy / catch_up:.1f}x, "
+                  f"from the vector file: {legacy / from_file:.1f}x, without either: {legacy / no_snapshot:.1f}x")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+class StubPineconeServer:
+    """Local stand-in for a Pinecone index's data plane
+
+    Handles upsert, stats, query, delete and list requests against an in-memory map of
+    vector ids, with a fixed latency per request. The client reaches it through
+    PINECONE_INDEX_HOST, which skips the control plane.
+    """
+
+    def __init__(self, dimension, latency=0.02):
+        self.dimension = dimension
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.vectors = {}
+        self.requests = 0
+        self.upserted = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                self.respond(*stub.handle(self.path, body))
+
+            def do_GET(self):
+                self.respond(*stub.handle(self.path.split("?")[0], {}))
+
+            def respond(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, path, body):
+        """Respond to one data plane request"""
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if path == "/vectors/upsert":
+                for vector in body["vectors"]:
+                    self.vectors[vector["id"]] = vector["values"]
+                self.upserted += len(body["vectors"])
+                return 200, {"upsertedCount": len(body["vectors"])}
+            if path == "/describe_index_stats":
+                return 200, {"namespaces": {"": {"vectorCount": len(self.vectors)}}, "dimension": self.dimension,
+                             "totalVectorCount": len(self.vectors), "indexFullness": 0}
+            if path == "/query":
+                return 200, {"matches": [], "namespace": ""}
+            if path == "/vectors/delete":
+                for vector_id in body.get("ids", []):
+                    self.vectors.pop(vector_id, None)
+                return 200, {}
+            if path == "/vectors/list":
+                # Every id in one page
+                return 200, {"vectors": [{"id": vector_id} for vector_id in self.vectors], "namespace": "", "usage": {"readUnits": 1}}
+        return 404, {"message": "Not found"}
+
+    def reset_counts(self):
+        """Clear the request counters"""
+        with self.lock:
+            self.requests = 0
+            self.upserted = 0
+
+    def close(self):
+        """Stop the server"""
+        self.server.shutdown()
+
+def benchmark_pinecone_sync(args):
+    """Time Pinecone startup syncs: the previous full re-upsert versus the incremental sync"""
+    parser = argparse.ArgumentParser(prog="benchmark.py pinecone-sync")
+    parser.add_argument("--chunks", type=int, default=20000, help="Chunks in the database")
+    parser.add_argument("--dimension", type=int, default=384, help="Embedding dimension")
+    parser.add_argument("--workers", default="1,2,4,8", help="Comma-separated worker counts for a full sync")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency of each request to the stand-in")
+    parser.add_argument("--new-chunks", type=int, default=1000, help="Chunks added after the first syncs")
+    parser.add_argument("--chunks-per-document", type=int, default=100)
+    options = parser.parse_args(args)
+
+    stub = StubPineconeServer(options.dimension, options.latency_ms / 1000)
+    work_dir = tempfile.mkdtemp(prefix="pinecone_sync_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+    os.environ["VECTOR_FILE_DIR"] = os.path.join(work_dir, "vector_data")
+    os.environ["PINECONE_API_KEY"] = "stub"
+    os.environ["PINECONE_INDEX_HOST"] = stub.url
+    os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+    os.environ.pop("OPENAI_API_KEY", None)
+
+    import shutil
+    import utils.embedding
+    from app import app, db
+    from models import User
+    from utils.embedding import SimpleEmbeddings
+    from utils.pinecone_sync import sync_pinecone
+    from utils.vector_file import load_or_embed_vectors
+    from utils.vector_store import get_pinecone_store, _iter_vector_rows, _upsert_pinecone, batched, VECTOR_ROW_BATCH_SIZE
+    logging.getLogger().setLevel(logging.WARNING)
+
+    embeddings = SimpleEmbeddings(options.dimension)
+    utils.embedding._embedding_instance = embeddings
+
+    def legacy_sync(vector_store):
+        # The previous startup path: every vector, one batch after another
+        for batch in batched(_iter_vector_rows(), VECTOR_ROW_BATCH_SIZE):
+            vector_ids, texts, metadatas = zip(*batch)
+            vectors, _ = load_or_embed_vectors(vector_ids, texts)
+            _upsert_pinecone(vector_store, vector_ids, texts, vectors, metadatas)
+
+    def timed(label, sync):
+        stub.reset_counts()
+        db.session.remove()
+        start = time.perf_counter()
+        sync()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<40} {elapsed:8.2f}s  {stub.upserted:>8} vectors sent  {stub.requests:>6} requests  "
+              f"{stub.upserted / elapsed if elapsed else 0:>8.0f} vectors/s")
+        return elapsed
+
+    try:
+        with app.app_context():
+            user = User(username="benchmark", email="benchmark@example.com")
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            _insert_chunks(db, 1, options.chunks, options.chunks_per_document, user_id)
+            vector_store = get_pinecone_store(embeddings)
+            print(f"{options.chunks} chunks, {options.dimension} dimensions, "
+                  f"{options.latency_ms:.0f} ms per request to the stand-in\n")
+
+            legacy = timed("Full re-upsert (previous)", lambda: legacy_sync(vector_store))
+            full = {}
+            for workers in [int(count) for count in options.workers.split(",")]:
+                full[workers] = timed(f"Full sync, {workers} workers",
+                                      lambda: sync_pinecone(vector_store, full=True, workers=workers))
+            timed("Sync with nothing new", lambda: sync_pinecone(vector_store))
+
+            _insert_chunks(db, options.chunks + 1, options.new_chunks, options.chunks_per_document, user_id)
+            timed(f"Full re-upsert + {options.new_chunks} new chunks", lambda: legacy_sync(vector_store))
+            incremental = timed(f"Sync of {options.new_chunks} new chunks", lambda: sync_pinecone(vector_store))
+
+            expected = options.chunks + options.new_chunks
+            fastest = min(full, key=full.get)
+            print(f"\nVectors in the index: {len(stub.vectors)} (expected {expected}, "
+                  f"no duplicates: {'Yes' if len(stub.vectors) == expected else 'NO'})")
+            print(f"Speedup of a full sync with {fastest} workers: {legacy / full[fastest]:.1f}x, "
+                  f"of a startup with {options.new_chunks} new chunks: {legacy / incremental:.1f}x")
+    finally:
+        stub.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def benchmark_batch_query(args):
+    """Compare queries/sec of the batch query endpoint with one request per query"""
+    parser = argparse.ArgumentParser(prog="benchmark.py batch-query")
+    parser.add_argument("--queries", type=int, default=100, help="Queries to answer")
+    parser.add_argument("--chunks", type=int, default=20000, help="Chunks in the database")
+    parser.add_argument("--dimension", type=int, default=384, help="Embedding dimension")
+    parser.add_argument("--embed-ms", type=float, default=50, help="Latency of each embedding call")
+    parser.add_argument("--generate-ms", type=float, default=200, help="Latency of each answer generation")
+    parser.add_argument("--concurrency", default="1,4,8", help="Comma-separated generation concurrency levels")
+    parser.add_argument("--chunks-per-document", type=int, default=100)
+    options = parser.parse_args(args)
+
+    work_dir = tempfile.mkdtemp(prefix="batch_query_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+    os.environ["FAISS_SNAPSHOT_DIR"] = os.path.join(work_dir, "faiss_index")
+    os.environ["VECTOR_FILE_DIR"] = os.path.join(work_dir, "vector_data")
+    os.environ["VECTOR_STORE_TYPE"] = "faiss"
+    os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+    # Repeated questions would otherwise be answered from the cache
+    os.environ["ANSWER_CACHE_ENABLED"] = "0"
+    # The stand-in embeddings would otherwise make the search lexical only
+    os.environ["SEARCH_MODE"] = "vector"
+    os.environ.pop("OPENAI_API_KEY", None)
+
+    import shutil
+    import utils.embedding
+    from app import app, db
+    from models import User
+    from utils.embedding import SimpleEmbeddings
+    from utils.rag_pipeline import get_query_engine
+    from utils.vector_store import get_vector_store
+    logging.getLogger().setLevel(logging.WARNING)
+
+    class SlowEmbeddings(SimpleEmbeddings):
+        """SimpleEmbeddings with a fixed latency per call, like a round trip to the embeddings API"""
+        calls = 0
+
+        def embed_documents_array(self, texts):
+            SlowEmbeddings.calls += 1
+            time.sleep(options.embed_ms / 1000)
+            return super().embed_documents_array(texts)
+
+    def generate(query_text, documents, timings=None):
+        # Stands in for the LLM: generation time dominates a query and runs in parallel
+        time.sleep(options.generate_ms / 1000)
+        if timings is not None:
+            timings["generate"] = options.generate_ms
+        return f"Answer to {query_text}", True
+
+    utils.embedding._embedding_instance = SlowEmbeddings(options.dimension)
+    get_query_engine().generate = generate
+
+    words = generate_text(options.queries * 60, seed=7).split()
+    queries = [" ".join(words[index * 6:index * 6 + 6]) for index in range(options.queries)]
+
+    def timed(label, run):
+        SlowEmbeddings.calls = 0
+        start = time.perf_counter()
+        answered = run()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<40} {elapsed:8.2f}s  {answered / elapsed:>8.1f} queries/s  "
+              f"{SlowEmbeddings.calls:>6} embedding calls")
+        return answered / elapsed
+
+    def one_by_one():
+        client = app.test_client()
+        return sum(client.post("/api/query", json={"query": query}).status_code == 200 for query in queries)
+
+    def batch(concurrency):
+        os.environ["QUERY_BATCH_CONCURRENCY"] = str(concurrency)
+        response = app.test_client().post("/api/query/batch", json={"queries": queries})
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        return sum(1 for line in lines if "index" in line)
+
+    try:
+        with app.app_context():
+            user = User(username="benchmark", email="benchmark@example.com")
+            db.session.add(user)
+            db.session.commit()
+            _insert_chunks(db, 1, options.chunks, options.chunks_per_document, user.id)
+            get_vector_store()
+            print(f"{options.queries} queries, {options.chunks} chunks, {options.embed_ms:.0f} ms per embedding call, "
+                  f"{options.generate_ms:.0f} ms per generation\n")
+
+            single = timed("/api/query per query", one_by_one)
+            rates = {}
+            for concurrency in [int(level) for level in options.concurrency.split(",")]:
+                rates[concurrency] = timed(f"/api/query/batch, concurrency {concurrency}", lambda: batch(concurrency))
+
+            fastest = max(rates, key=rates.get)
+            print(f"\nSpeedup of the batch endpoint with concurrency {fastest}: {rates[fastest] / single:.1f}x")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def benchmark_hybrid(args):
+    """Time the lexical index and compare vector, lexical and fused search on queries for exact codes and prose"""
+    parser = argparse.ArgumentParser(prog="benchmark.py hybrid")
+    parser.add_argument("--chunks", type=int, default=100000, help="Chunks in the database")
+    parser.add_argument("--dimension", type=int, default=384, help="Embedding dimension")
+    parser.add_argument("--codes", type=int, default=500, help="Chunks given an exact HS code and SKU to find")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per search mode, half for codes and half prose")
+    parser.add_argument("--embed-ms", type=float, default=20, help="Latency of each query embedding")
+    parser.add_argument("--chunks-per-document", type=int, default=100)
+    options = parser.parse_args(args)
+
+    work_dir = tempfile.mkdtemp(prefix="hybrid_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+    os.environ["FAISS_SNAPSHOT_DIR"] = os.path.join(work_dir, "faiss_index")
+    os.environ["VECTOR_FILE_DIR"] = os.path.join(work_dir, "vector_data")
+    os.environ["LEXICAL_INDEX_DIR"] = os.path.join(work_dir, "lexical_index")
+    os.environ["VECTOR_STORE_TYPE"] = "faiss"
+    os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+    os.environ.pop("OPENAI_API_KEY", None)
+
+    import shutil
+    import numpy as np
+    import utils.embedding
+    from app import app, db
+    import utils.lexical_index
+    import utils.vector_store
+    from models import User, DocumentChunk
+    from utils.embedding import SimpleEmbeddings
+    from utils.lexical_index import get_lexical_index
+    from utils.vector_store import get_vector_store, search_vector_store
+    logging.getLogger().setLevel(logging.WARNING)
+
+    class SlowEmbeddings(SimpleEmbeddings):
+        """SimpleEmbeddings with a fixed latency per call, like a round trip to the embeddings API"""
+
+        def embed_documents_array(self, texts):
+            time.sleep(options.embed_ms / 1000)
+            return super().embed_documents_array(texts)
+
+    # Treated as a real embedding model, so the hybrid mode fuses both searches
+    utils.embedding._embedding_instance = SlowEmbeddings(options.dimension)
+    utils.vector_store.has_embedding_provider = lambda embeddings=None: True
+
+    rng = random.Random(11)
+    code_chunks = rng.sample(range(1, options.chunks + 1), min(options.codes, options.chunks))
+    codes = {}
+    for chunk_id in code_chunks:
+        codes[chunk_id] = (f"{rng.randrange(100, 9999):04d}.{rng.randrange(10, 99)}", f"SKU-{rng.randrange(10000, 99999)}")
+
+    words = generate_text(options.queries * 60, seed=7).split()
+    code_queries = [(f"Which shipments use HS code {codes[chunk_id][0]}?", chunk_id)
+                    for chunk_id in rng.choices(code_chunks, k=options.queries // 2)]
+    code_queries += [(f"stock level of {codes[chunk_id][1]}", chunk_id)
+                     for chunk_id in rng.choices(code_chunks, k=options.queries - options.queries // 2)]
+    prose_queries = [" ".join(words[index * 6:index * 6 + 6]) for index in range(options.queries)]
+
+    def timed(label, run):
+        start = time.perf_counter()
+        result = run()
+        print(f"{label:<40} {time.perf_counter() - start:8.2f}s")
+        return result
+
+    def run_queries(search_mode):
+        os.environ["SEARCH_MODE"] = search_mode
+        latencies = []
+        found = 0
+        for query, chunk_id in code_queries + [(query, None) for query in prose_queries]:
+            start = time.perf_counter()
+            results = search_vector_store(query, k=5)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if chunk_id is not None:
+                found += any(doc.metadata.get("chunk_id") == chunk_id for doc, _ in results)
+        return np.percentile(latencies, 50), np.percentile(latencies, 99), found / len(code_queries)
+
+    try:
+        with app.app_context():
+            user = User(username="benchmark", email="benchmark@example.com")
+            db.session.add(user)
+            db.session.commit()
+            _insert_chunks(db, 1, options.chunks, options.chunks_per_document, user.id)
+            for chunk_id, (hs_code, sku) in codes.items():
+                chunk = db.session.get(DocumentChunk, chunk_id)
+                chunk.content += f" Shipped under HS code {hs_code} as {sku}."
+            db.session.commit()
+            print(f"{options.chunks} chunks, {len(codes)} with an exact code, {options.embed_ms:.0f} ms per embedding\n")
+
+            get_vector_store()
+            index = timed("Lexical index build and save", get_lexical_index)
+            utils.lexical_index._lexical_index = None
+            timed("Lexical index load", get_lexical_index)
+
+            index_dir = os.environ["LEXICAL_INDEX_DIR"]
+            size = sum(os.path.getsize(os.path.join(index_dir, name)) for name in os.listdir(index_dir))
+            stats = index.get_stats()
+            print(f"{stats['terms']} terms, {stats['postings']} postings, {size / (1024 * 1024):.1f} MB on disk\n")
+
+            print(f"{'Search mode':<12} {'p50 ms':>8} {'p99 ms':>8} {'code recall@5':>14}")
+            for search_mode in ("vector", "lexical", "hybrid"):
+                p50, p99, recall = run_queries(search_mode)
+                print(f"{search_mode:<12} {p50:8.2f} {p99:8.2f} {recall:14.3f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def main():
+    """Main function"""
+    if len(sys.argv) < 2:
+        print_usage()
+        return
+
+    command = sys.argv[1]
+
+    if command == "split":
+        benchmark_split(sys.argv[2:])
+    elif command == "embed":
+        benchmark_embed(sys.argv[2:])
+    elif command == "simple-embed":
+        benchmark_simple_embed(sys.argv[2:])
+    elif command == "ann":
+        benchmark_ann(sys.argv[2:])
+    elif command == "filter":
+        benchmark_filter(sys.argv[2:])
+    elif command == "churn":
+        benchmark_churn(sys.argv[2:])
+    elif command == "quantize":
+        benchmark_quantize(sys.argv[2:])
+    elif command == "two-stage":
+        benchmark_two_stage(sys.argv[2:])
+    elif command == "shared-index":
+        benchmark_shared_index(sys.argv[2:])
+    elif command == "shards":
+        benchmark_shards(sys.argv[2:])
+    elif command == "cold-start":
+        benchmark_cold_start(sys.argv[2:])
+    elif command == "pinecone-sync":
+        benchmark_pinecone_sync(sys.argv[2:])
+    elif command == "batch-query":
+        benchmark_batch_query(sys.argv[2:])
+    elif command == "hybrid":
+        benchmark_hybrid(sys.argv[2:])
+    else:
+        print(f"Unknown command: {command}")
+        print_usage()
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Management script for the vector store.
-This script can be used to switch between FAISS and Pinecone.
+This script can be used to switch between FAISS, approximate FAISS (ann) and Pinecone.
 """
 
 import os
@@ -11,6 +11,11 @@ import logging
 from utils.config import (
     set_vector_store_type, 
     get_vector_store_type, 
+    set_ann_index_type,
+    get_ann_index_type,
+    set_vector_sharding,
+    get_vector_shard_key,
+    VECTOR_SHARD_KEYS,
     is_pinecone_available, 
     is_openai_available,
     get_system_status
@@ -29,10 +34,19 @@ def print_usage():
     print("Commands:")
     print("  status - Show current vector store status")
     print("  use-faiss - Switch to FAISS vector store")
+    print("  use-ann [hnsw|ivf] - Switch to an approximate (HNSW or IVF) FAISS index")
     print("  use-pinecone - Switch to Pinecone vector store")
     print("  check-pinecone - Check if Pinecone is available")
     print("  check-openai - Check if OpenAI is available")
     print("  check-all - Check status of all components")
+    print("  cache-status - Show embedding cache size and hit/miss counters")
+    print("  cache-clear - Remove all entries from the embedding cache")
+    print("  ingest <dir> [--resume] [--workers N] [--batch-size N] [--checkpoint FILE]")
+    print("         - Parse, embed and index every document under a directory")
+    print("  sync-pinecone [--dry-run] [--full] [--batch-size N] [--workers N]")
+    print("         - Send Pinecone the vectors of chunks added since its last sync")
+    print("  rebalance-shards <shards> [--key chunk|document]")
+    print("         - Repartition the FAISS index into a number of shards (1 turns sharding off)")
 
 def show_status():
     """Show current vector store status"""
@@ -40,6 +54,10 @@ def show_status():
     
     print("=== System Status ===")
     print(f"Current vector store type: {status['vector_store_type']}")
+    if status['vector_store_type'] == 'ann':
+        from utils.ann_index import get_index_description
+        print(f"ANN index: {get_index_description()}")
+    print(f"Search mode: {status['search_mode']}")
     print(f"Pinecone available: {'Yes' if status['pinecone_available'] else 'No'}")
     print(f"OpenAI available: {'Yes' if status['openai_available'] else 'No'}")
     
@@ -56,6 +74,20 @@ def switch_to_faiss():
     else:
         print("Failed to switch to FAISS vector store")
 
+def switch_to_ann(args):
+    """Switch to an approximate FAISS index"""
+    if args and not set_ann_index_type(args[0]):
+        print(f"Unknown ANN index type: {args[0]} (expected hnsw or ivf)")
+        return
+
+    if set_vector_store_type('ann'):
+        print(f"Successfully switched to an approximate FAISS index ({get_ann_index_type()})")
+        # Reset the vector store to force reinitialization
+        from utils.vector_store_reset import reset_vector_store
+        reset_vector_store()
+    else:
+        print("Failed to switch to the approximate FAISS index")
+
 def switch_to_pinecone():
     """Switch to Pinecone vector store"""
     if not is_pinecone_available():
@@ -142,6 +174,151 @@ def check_all():
     else:
         print("✓ Using local FAISS vector store")
 
+def show_cache_status():
+    """Show embedding cache status"""
+    from utils.embedding_cache import get_embedding_cache, EMBEDDING_CACHE_ENABLED
+    
+    stats = get_embedding_cache().get_stats()
+    
+    print("=== Embedding Cache ===")
+    print(f"Enabled: {'Yes' if EMBEDDING_CACHE_ENABLED else 'No'}")
+    print(f"Path: {stats['path']}")
+    print(f"Entries on disk: {stats['disk_entries']}")
+    print(f"Size on disk: {stats['disk_bytes'] / (1024 * 1024):.1f} MB of {stats['max_disk_bytes'] / (1024 * 1024):.0f} MB")
+    print(f"In memory: {stats['memory_entries']} entries, "
+          f"{stats['memory_bytes'] / (1024 * 1024):.1f} MB of {stats['max_memory_bytes'] / (1024 * 1024):.0f} MB")
+    for model in stats['models']:
+        print(f"  {model['model']} ({model['dimension']} dims): {model['entries']} entries")
+
+def clear_cache():
+    """Clear the embedding cache"""
+    from utils.embedding_cache import get_embedding_cache
+    
+    cache = get_embedding_cache()
+    entries = cache.get_stats()['disk_entries']
+    cache.clear()
+    print(f"Cleared {entries} entries from the embedding cache")
+
+def ingest(args):
+    """Bulk-ingest a directory of documents"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog="manage_vector_store.py ingest")
+    parser.add_argument("directory", help="Directory to ingest (searched recursively)")
+    parser.add_argument("--resume", action="store_true", help="Skip files recorded in the checkpoint and redo ones left unfinished")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=1024, help="Chunks per embedding/indexing batch")
+    parser.add_argument("--checkpoint", default="ingest_checkpoint.json", help="Checkpoint file")
+    options = parser.parse_args(args)
+    
+    if not os.path.isdir(options.directory):
+        print(f"ERROR: {options.directory} is not a directory")
+        sys.exit(1)
+    
+    # This process ingests directly; don't start the web app's background job workers
+    os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+    from app import app
+    from utils.bulk_ingest import ingest_directory
+    
+    with app.app_context():
+        report = ingest_directory(
+            options.directory,
+            workers=options.workers,
+            batch_size=options.batch_size,
+            resume=options.resume,
+            checkpoint_path=options.checkpoint
+        )
+    
+    print("=== Ingestion Report ===")
+    print(f"Files: {report['files']} ({report['failed_files']} failed)")
+    print(f"Chunks: {report['chunks']} ({report['embedded_chunks']} embedded, {report['reused_chunks']} duplicates reused)")
+    print(f"Data: {report['megabytes']} MB in {report['elapsed_seconds']} s")
+    print(f"Throughput: {report['files_per_second']} files/s, {report['chunks_per_second']} chunks/s, "
+          f"{report['megabytes_per_second']} MB/s")
+
+def sync_pinecone_command(args):
+    """Send Pinecone the vectors it is missing and report throughput and lag"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog="manage_vector_store.py sync-pinecone")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be sent")
+    parser.add_argument("--full", action="store_true", help="Send every vector, ignoring the high-water mark, and delete vectors no chunk refers to")
+    parser.add_argument("--batch-size", type=int, default=None, help="Vectors per upsert request")
+    parser.add_argument("--workers", type=int, default=None, help="Upsert requests in flight")
+    options = parser.parse_args(args)
+    
+    if not is_pinecone_available():
+        print("ERROR: Pinecone is not available. Please set PINECONE_API_KEY and PINECONE_ENVIRONMENT")
+        sys.exit(1)
+    
+    # This process only syncs; don't start the web app's background job workers
+    os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+    from app import app
+    from utils.vector_store import get_pinecone_store
+    from utils.pinecone_sync import sync_pinecone
+    
+    with app.app_context():
+        report = sync_pinecone(
+            get_pinecone_store(),
+            dry_run=options.dry_run,
+            full=options.full,
+            batch_size=options.batch_size,
+            workers=options.workers
+        )
+    
+    print("=== Pinecone Sync ===")
+    print(f"Target: {report['target']}")
+    print(f"High-water mark: chunk {report['previous_high_water_mark']} of {report['max_chunk_id']}")
+    print(f"Lag: {report['pending_vectors']} vectors pending, oldest from {report['lag_seconds']} s ago")
+    print(f"Deletions: {report['pending_deletions']} logged vector deletions pending")
+    if report['orphaned'] is not None:
+        print(f"Orphaned: {report['orphaned']} vectors in the index that no chunk refers to")
+    if report['dry_run']:
+        print(f"Dry run: would send {report['pending_vectors']} vectors, apply {report['pending_deletions']} "
+              f"logged deletions and delete {report['orphaned'] or 0} orphaned vectors")
+        return
+    print(f"Deleted: {report['deletions_applied']} logged and {report['deleted']} orphaned vectors")
+    print(f"Sent: {report['upserted']} vectors in {report['batches']} batches ({report['embedded']} embedded)")
+    print(f"Throughput: {report['vectors_per_second']} vectors/s over {report['elapsed_seconds']} s")
+    print(f"High-water mark now: chunk {report['high_water_mark']}")
+
+def rebalance_shards_command(args):
+    """Repartition the FAISS index into a new number of shards and keep the setting"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog="manage_vector_store.py rebalance-shards")
+    parser.add_argument("shards", type=int, help="Number of shards; 1 turns sharding off")
+    parser.add_argument("--key", choices=VECTOR_SHARD_KEYS, default=None, help="Shard by chunk id or by document id")
+    options = parser.parse_args(args)
+    shard_key = options.key or get_vector_shard_key()
+    
+    if options.shards < 1:
+        print("ERROR: Need at least 1 shard")
+        sys.exit(1)
+    if options.shards > 1:
+        # This process only rebalances; don't start the web app's background job workers
+        os.environ["INGESTION_QUEUE_ENABLED"] = "0"
+        from app import app
+        from utils.vector_store import rebalance_vector_shards
+        
+        with app.app_context():
+            report = rebalance_vector_shards(options.shards, shard_key)
+        
+        print("=== Shard Rebalance ===")
+        if report['previous_shards']:
+            print(f"Before: {report['previous_shards']} shards by {report['previous_key']}")
+        else:
+            print("Before: not sharded")
+        print(f"After: {report['shards']} shards by {report['key']}")
+        print(f"Vectors per shard: {', '.join(str(size) for size in report['shard_sizes'])} ({report['vectors']} total)")
+        print(f"Embedded: {report['embedded']} vectors missing from the vector file or stored there for other text")
+        print(f"Took {report['elapsed_seconds']} s; running processes switch before their next query")
+    
+    if set_vector_sharding(options.shards, shard_key):
+        print(f"Sharding set to {options.shards} shards by {shard_key} for future startups")
+    else:
+        print("Failed to save the sharding setting")
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print_usage()
@@ -153,6 +330,8 @@ if __name__ == "__main__":
         show_status()
     elif command == "use-faiss":
         switch_to_faiss()
+    elif command == "use-ann":
+        switch_to_ann(sys.argv[2:])
     elif command == "use-pinecone":
         switch_to_pinecone()
     elif command == "check-pinecone":
@@ -161,6 +340,16 @@ if __name__ == "__main__":
         check_openai()
     elif command == "check-all":
         check_all()
+    elif command == "cache-status":
+        show_cache_status()
+    elif command == "cache-clear":
+        clear_cache()
+    elif command == "ingest":
+        ingest(sys.argv[2:])
+    elif command == "sync-pinecone":
+        sync_pinecone_command(sys.argv[2:])
+    elif command == "rebalance-shards":
+        rebalance_shards_command(sys.argv[2:])
     else:
         print(f"Unknown command: {command}")
         print_usage()
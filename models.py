@@ -1,4 +1,6 @@
 from datetime import datetime
+from sqlalchemy import func, cast
+from sqlalchemy.ext.hybrid import hybrid_property
 from app import db
 from flask_login import UserMixin
 
@@ -18,6 +20,7 @@ class Document(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     title = db.Column(db.String(255))
     content = db.Column(db.Text)
+    source_path = db.Column(db.String(512))  # uploaded file, read in blocks instead of storing content
     content_type = db.Column(db.String(64))
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     processed = db.Column(db.Boolean, default=False)
@@ -28,11 +31,24 @@ class Document(db.Model):
         return f'<Document {self.filename}>'
 
 class DocumentChunk(db.Model):
+    # Ids are never handed out twice, so a vector id can't come to name another chunk's text
+    __table_args__ = {'sqlite_autoincrement': True}
+    
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     chunk_index = db.Column(db.Integer, nullable=False)
-    embedding_id = db.Column(db.String(128))
-    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False)
+    embedding_id = db.Column(db.String(128), index=True)
+    content_hash = db.Column(db.String(64), index=True)  # sha256 of content; chunks with the same hash share one vector
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    
+    @hybrid_property
+    def vector_id(self):
+        """Id of the chunk's vector in the vector store (chunks stored before embedding ids were recorded use their own id)"""
+        return self.embedding_id or str(self.id)
+    
+    @vector_id.expression
+    def vector_id(cls):
+        return func.coalesce(cls.embedding_id, cast(cls.id, db.String))
     
     def __repr__(self):
         return f'<DocumentChunk {self.id} from Document {self.document_id}>'
@@ -66,3 +82,54 @@ class ResponseSourceChunk(db.Model):
     
     def __repr__(self):
         return f'<ResponseSourceChunk {self.id}>'
+
+class IngestionJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False)
+    document = db.relationship('Document')
+    mode = db.Column(db.String(16), default='ingest')  # ingest, or reingest to diff a replaced file against its existing chunks
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)  # queued, running, completed, failed
+    stage = db.Column(db.String(32), default='queued')
+    chunks_done = db.Column(db.Integer, default=0)
+    chunks_total = db.Column(db.Integer, default=0)
+    chunks_reused = db.Column(db.Integer, default=0)  # reingest only: unchanged chunks that kept their ids
+    chunks_added = db.Column(db.Integer, default=0)
+    chunks_deleted = db.Column(db.Integer, default=0)
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(128))  # hostname:pid of the process running the job
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<IngestionJob {self.id} for Document {self.document_id} ({self.status})>'
+
+class VectorSyncState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    target = db.Column(db.String(256), unique=True, nullable=False)  # external index and embedding model the vectors were synced to
+    high_water_mark = db.Column(db.Integer, nullable=False, default=0)  # vectors of all chunks up to this id are in the index
+    vectors_synced = db.Column(db.Integer, default=0)  # vectors sent by syncs so far
+    deletion_mark = db.Column(db.Integer, default=0)  # vector deletions up to this id are applied to the index
+    synced_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<VectorSyncState {self.target} at chunk {self.high_water_mark}>'
+
+class VectorDeletion(db.Model):
+    # Logged with the chunk deletion it follows from, so stores that weren't active then can apply it later
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    id = db.Column(db.Integer, primary_key=True)
+    vector_id = db.Column(db.String(64), nullable=False)  # vector no chunk refers to any more
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<VectorDeletion {self.id} of vector {self.vector_id}>'
+
+class CorpusVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)  # incremented by every ingest or delete of chunks
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CorpusVersion {self.version}>'
@@ -1,16 +1,31 @@
 import os
 import json
+import time
 import logging
-from flask import render_template, request, redirect, url_for, flash, jsonify, session
+from flask import render_template, request, redirect, url_for, flash, jsonify, session, stream_with_context
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import uuid
 
 from app import db
-from models import User, Document, DocumentChunk, Query, Response, ResponseSourceChunk
-from utils.document_processor import process_document
-from utils.rag_pipeline import query_rag_pipeline
+from models import User, Document, DocumentChunk, Query, Response, ResponseSourceChunk, IngestionJob
+from utils.config import get_max_document_size_mb, get_query_batch_max_queries
+from utils.answer_cache import get_answer_cache
+from utils.document_processor import (
+    save_upload,
+    get_document_preview,
+    get_chunks_sharing_vector,
+    resolve_source_chunk,
+    get_dedup_stats,
+    delete_document,
+    DocumentTooLargeError
+)
+from utils.job_queue import enqueue_ingestion, has_active_job, retry_job, job_to_dict
+from utils.rag_pipeline import query_rag_pipeline, query_rag_batch, stream_rag_pipeline
+from utils.search_filter import parse_search_filter
+from utils.lexical_index import get_lexical_index_stats
+from utils.vector_store import get_vector_store_stats, get_search_mode_in_effect
 
 logger = logging.getLogger(__name__)
 
@@ -47,14 +62,19 @@ def register_routes(app):
         upload_dir = os.path.join('uploads')
         os.makedirs(upload_dir, exist_ok=True)
         
-        # Save file temporarily
-        file_path = os.path.join(upload_dir, filename)
-        file.save(file_path)
+        # Keep the file for the ingestion job; it is read in blocks instead of being loaded into memory
+        file_path = os.path.join(upload_dir, f"{uuid.uuid4().hex}_{filename}")
         
         try:
-            # Read the content of the file
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            save_upload(file.stream, file_path, get_max_document_size_mb() * 1024 * 1024)
+        except DocumentTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        
+        try:
+            # Uploading a file with the name of an existing document replaces that document
+            existing = Document.query.filter_by(filename=filename).order_by(Document.id.desc()).first()
+            if existing:
+                return replace_document_file(existing, file_path)
             
             # Create a document in the database
             # For MVP, assign to first user or create one if none exists
@@ -67,26 +87,107 @@ def register_routes(app):
             document = Document(
                 filename=filename,
                 title=filename,
-                content=content,
+                source_path=file_path,
                 content_type='text',
                 user_id=user.id
             )
             db.session.add(document)
             db.session.commit()
             
-            # Process the document (create chunks, embeddings, etc.)
-            process_document(document.id)
+            # Queue the document for processing (create chunks, embeddings, etc.)
+            job = enqueue_ingestion(document.id)
             
-            # Remove temporary file
+            return jsonify({
+                'success': True,
+                'document_id': document.id,
+                'filename': filename,
+                'job_id': job.id,
+                'job_url': url_for('get_job', job_id=job.id)
+            }), 202
+        except Exception as e:
+            logger.error(f"Error processing document: {str(e)}")
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return jsonify({'error': str(e)}), 500
+    
+    def replace_document_file(document, file_path):
+        """Point a document at a newly uploaded file and queue a diffing re-ingestion"""
+        if has_active_job(document.id):
             os.remove(file_path)
+            return jsonify({'error': 'Document is still being ingested; try again when its job has finished'}), 409
+        
+        old_path = document.source_path
+        document.source_path = file_path
+        document.content = None
+        document.processed = False
+        document.upload_date = datetime.utcnow()
+        db.session.commit()
+        
+        # The old chunks stay in the database, so the old file is no longer needed
+        if old_path and old_path != file_path and os.path.exists(old_path):
+            os.remove(old_path)
+        
+        job = enqueue_ingestion(document.id, mode='reingest')
+        
+        return jsonify({
+            'success': True,
+            'document_id': document.id,
+            'filename': document.filename,
+            'replaced': True,
+            'job_id': job.id,
+            'job_url': url_for('get_job', job_id=job.id)
+        }), 202
+    
+    @app.route('/api/documents/<int:document_id>', methods=['PUT'])
+    def replace_document(document_id):
+        document = Document.query.get(document_id)
+        if not document:
+            return jsonify({'error': 'Document not found'}), 404
+        
+        if 'document' not in request.files:
+            return jsonify({'error': 'No file part'}), 400
+        
+        file = request.files['document']
+        if file.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+        
+        upload_dir = os.path.join('uploads')
+        os.makedirs(upload_dir, exist_ok=True)
+        file_path = os.path.join(upload_dir, f"{uuid.uuid4().hex}_{secure_filename(file.filename)}")
+        
+        try:
+            save_upload(file.stream, file_path, get_max_document_size_mb() * 1024 * 1024)
+        except DocumentTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        
+        try:
+            return replace_document_file(document, file_path)
+        except Exception as e:
+            logger.error(f"Error replacing document: {str(e)}")
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return jsonify({'error': str(e)}), 500
+    
+    @app.route('/api/documents/<int:document_id>', methods=['DELETE'])
+    def remove_document(document_id):
+        try:
+            document = Document.query.get(document_id)
+            if not document:
+                return jsonify({'error': 'Document not found'}), 404
+            
+            if has_active_job(document.id):
+                return jsonify({'error': 'Document is still being ingested; try again when its job has finished'}), 409
+            
+            result = delete_document(document)
             
             return jsonify({
                 'success': True,
-                'document_id': document.id,
-                'filename': filename
+                'document_id': document_id,
+                'chunks_deleted': result['chunks_deleted'],
+                'vectors_deleted': result['vectors_deleted']
             })
         except Exception as e:
-            logger.error(f"Error processing document: {str(e)}")
+            logger.error(f"Error deleting document: {str(e)}")
             return jsonify({'error': str(e)}), 500
     
     @app.route('/api/documents', methods=['GET'])
@@ -123,7 +224,7 @@ def register_routes(app):
                 'id': document.id,
                 'filename': document.filename,
                 'title': document.title,
-                'content': document.content,
+                'content': get_document_preview(document),
                 'upload_date': document.upload_date.strftime('%Y-%m-%d %H:%M:%S'),
                 'processed': document.processed,
                 'chunks': [{
@@ -141,74 +242,312 @@ def register_routes(app):
             logger.error(f"Error fetching document: {str(e)}")
             return jsonify({'error': str(e)}), 500
     
+    @app.route('/api/jobs/<int:job_id>', methods=['GET'])
+    def get_job(job_id):
+        try:
+            job = IngestionJob.query.get(job_id)
+            if not job:
+                return jsonify({'error': 'Job not found'}), 404
+            
+            return jsonify({
+                'success': True,
+                'job': job_to_dict(job)
+            })
+        except Exception as e:
+            logger.error(f"Error fetching job: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+    
+    @app.route('/api/jobs/<int:job_id>/retry', methods=['POST'])
+    def retry_ingestion_job(job_id):
+        try:
+            job = retry_job(job_id)
+            if not job:
+                return jsonify({'error': 'Job not found'}), 404
+            
+            return jsonify({
+                'success': True,
+                'job': job_to_dict(job)
+            }), 202
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 409
+        except Exception as e:
+            logger.error(f"Error retrying job: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+    
+    def parse_query_request(data):
+        """Get the query text and search filter of a query request; raises ValueError if invalid"""
+        query_text = (data or {}).get('query')
+        if not query_text:
+            raise ValueError('Query text is required')
+        # Optional filter restricting the search to some documents
+        return query_text, parse_search_filter(data.get('filter'))
+    
+    def get_query_user():
+        """For MVP, assign queries to the first user, creating one if none exists"""
+        user = User.query.first()
+        if not user:
+            user = User(username="demo_user", email="demo@example.com", password_hash=generate_password_hash("password"))
+            db.session.add(user)
+            db.session.commit()
+        return user
+    
+    def resolve_sources(source_chunks):
+        """Resolve the hits to chunks; a hit's own chunk may have been replaced by a re-upload"""
+        return [(resolve_source_chunk(chunk_id), score) for chunk_id, score in source_chunks]
+    
+    def add_response(query, response_text, resolved_chunks):
+        """Add a response record with its source chunks, flushed for its id but not committed"""
+        response = Response(
+            content=response_text,
+            query_id=query.id
+        )
+        db.session.add(response)
+        db.session.flush()
+        
+        for chunk, score in resolved_chunks:
+            if chunk:
+                source = ResponseSourceChunk(
+                    document_chunk_id=chunk.id,
+                    relevance_score=score,
+                    response_id=response.id
+                )
+                db.session.add(source)
+        return response
+    
+    def describe_sources(resolved_chunks):
+        """Describe resolved source chunks for an API response"""
+        source_documents = []
+        for chunk, score in resolved_chunks:
+            if chunk:
+                document = Document.query.get(chunk.document_id)
+                # Deduplicated content is indexed once; credit every document containing it
+                copies = get_chunks_sharing_vector(chunk)
+                source_documents.append({
+                    'document_title': document.title,
+                    'document_titles': sorted({copy.document.title for copy in copies}),
+                    'chunk_content': chunk.content,
+                    'relevance_score': score
+                })
+        return source_documents
+    
+    def sse_event(event, data):
+        """Format a Server-Sent Event with a JSON payload"""
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    
     @app.route('/api/query', methods=['POST'])
     def process_query():
         try:
-            data = request.json
-            query_text = data.get('query')
-            
-            if not query_text:
-                return jsonify({'error': 'Query text is required'}), 400
+            try:
+                query_text, search_filter = parse_query_request(request.json)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
             
-            # For MVP, assign to first user or create one if none exists
-            user = User.query.first()
-            if not user:
-                user = User(username="demo_user", email="demo@example.com", password_hash=generate_password_hash("password"))
-                db.session.add(user)
-                db.session.commit()
+            user = get_query_user()
             
             # Create query record
+            persist_start = time.perf_counter()
             query = Query(
                 content=query_text,
                 user_id=user.id
             )
             db.session.add(query)
             db.session.commit()
+            persist_time = time.perf_counter() - persist_start
             
-            # Process the query through RAG pipeline
-            response_text, source_chunks = query_rag_pipeline(query_text)
-            
-            # Create response record
-            response = Response(
-                content=response_text,
-                query_id=query.id
-            )
-            db.session.add(response)
-            db.session.commit()
-            
-            # Add source chunks to the response
-            for chunk_id, score in source_chunks:
-                source = ResponseSourceChunk(
-                    document_chunk_id=chunk_id,
-                    relevance_score=score,
-                    response_id=response.id
-                )
-                db.session.add(source)
+            # Process the query through RAG pipeline; timings gets the time of each stage
+            timings = {}
+            cache_info = {}
+            response_text, source_chunks = query_rag_pipeline(query_text, search_filter, timings, cache_info)
             
+            # Create response record, committed with its sources
+            persist_start = time.perf_counter()
+            resolved_chunks = resolve_sources(source_chunks)
+            add_response(query, response_text, resolved_chunks)
             db.session.commit()
-            
-            # Prepare the response with sources
-            source_documents = []
-            for chunk_id, score in source_chunks:
-                chunk = DocumentChunk.query.get(chunk_id)
-                if chunk:
-                    document = Document.query.get(chunk.document_id)
-                    source_documents.append({
-                        'document_title': document.title,
-                        'chunk_content': chunk.content,
-                        'relevance_score': score
-                    })
+            persist_time += time.perf_counter() - persist_start
+            timings['persist'] = round(persist_time * 1000, 2)
             
             return jsonify({
                 'success': True,
                 'query_id': query.id,
                 'response': response_text,
-                'sources': source_documents
+                'sources': describe_sources(resolved_chunks),
+                'metadata': {'timings_ms': timings, 'cache': cache_info}
             })
         except Exception as e:
             logger.error(f"Error processing query: {str(e)}")
             return jsonify({'error': str(e)}), 500
     
+    @app.route('/api/query/stream', methods=['POST'])
+    def stream_query():
+        """Answer a query as Server-Sent Events
+
+        A "sources" event comes first, then "token" events with the answer as the
+        LLM produces it, then a "done" event with the query id and stage timings
+        (an "error" event if generation fails). The query and response records
+        are saved once the stream closes, with as much of the answer as was
+        generated if the client went away early.
+        """
+        request_start = time.perf_counter()
+        try:
+            try:
+                query_text, search_filter = parse_query_request(request.json)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            user_id = get_query_user().id
+            timings = {}
+            cache_info = {}
+            source_chunks, answer_pieces = stream_rag_pipeline(query_text, search_filter, timings, cache_info)
+            resolved_chunks = resolve_sources(source_chunks)
+            source_documents = describe_sources(resolved_chunks)
+        except Exception as e:
+            logger.error(f"Error processing query: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        
+        def elapsed_ms():
+            return round((time.perf_counter() - request_start) * 1000, 2)
+        
+        def events():
+            answer = []
+            saved = []
+            
+            def save():
+                persist_start = time.perf_counter()
+                query = Query(content=query_text, user_id=user_id)
+                db.session.add(query)
+                db.session.flush()
+                add_response(query, "".join(answer), resolved_chunks)
+                db.session.commit()
+                timings['persist'] = round((time.perf_counter() - persist_start) * 1000, 2)
+                saved.append(query.id)
+                return query.id
+            
+            try:
+                timings['first_byte'] = elapsed_ms()
+                yield sse_event('sources', {'sources': source_documents, 'cache': cache_info})
+                for piece in answer_pieces:
+                    if 'first_token' not in timings:
+                        timings['first_token'] = elapsed_ms()
+                    answer.append(piece)
+                    yield sse_event('token', {'text': piece})
+                
+                query_id = save()
+                timings['total'] = elapsed_ms()
+                yield sse_event('done', {
+                    'success': True,
+                    'query_id': query_id,
+                    'metadata': {'timings_ms': timings, 'cache': cache_info}
+                })
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error streaming query: {str(e)}")
+                yield sse_event('error', {'error': str(e)})
+            finally:
+                # Also reached when the client disconnects mid-stream
+                if not saved and answer:
+                    try:
+                        save()
+                    except Exception as e:
+                        db.session.rollback()
+                        logger.error(f"Error saving streamed query: {str(e)}")
+                logger.info(
+                    f"Streamed query {saved[0] if saved else '(unsaved)'}: first byte {timings.get('first_byte')} ms, "
+                    f"first token {timings.get('first_token')} ms, total {elapsed_ms()} ms"
+                )
+        
+        return app.response_class(
+            stream_with_context(events()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    
+    @app.route('/api/query/batch', methods=['POST'])
+    def process_query_batch():
+        """Answer a batch of queries, returned as NDJSON as each answer completes
+
+        The body is {"queries": [...], "filter": {...}}, the filter applying to
+        every query. Each line is one query's result, with its position in the
+        batch as "index"; a last line with "done" reports the batch's queries per
+        second and embed and search times (an "error" line if it fails).
+        """
+        try:
+            data = request.json or {}
+            queries = data.get('queries')
+            if not isinstance(queries, list) or not queries:
+                return jsonify({'error': 'A non-empty list of queries is required'}), 400
+            if any(not isinstance(query_text, str) or not query_text.strip() for query_text in queries):
+                return jsonify({'error': 'Every query must be a non-empty string'}), 400
+            max_queries = get_query_batch_max_queries()
+            if len(queries) > max_queries:
+                return jsonify({'error': f'At most {max_queries} queries can be sent in one batch'}), 400
+            try:
+                search_filter = parse_search_filter(data.get('filter'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            user_id = get_query_user().id
+        except Exception as e:
+            logger.error(f"Error processing query batch: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+        
+        def lines():
+            batch_start = time.perf_counter()
+            timings = {}
+            completed = 0
+            try:
+                for position, response_text, source_chunks, query_timings, cache_info in query_rag_batch(queries, search_filter, timings):
+                    # Each result is saved before it is sent
+                    persist_start = time.perf_counter()
+                    query = Query(content=queries[position], user_id=user_id)
+                    db.session.add(query)
+                    db.session.flush()
+                    resolved_chunks = resolve_sources(source_chunks)
+                    add_response(query, response_text, resolved_chunks)
+                    db.session.commit()
+                    query_timings['persist'] = round((time.perf_counter() - persist_start) * 1000, 2)
+                    completed += 1
+                    yield json.dumps({
+                        'index': position,
+                        'query_id': query.id,
+                        'query': queries[position],
+                        'response': response_text,
+                        'sources': describe_sources(resolved_chunks),
+                        'metadata': {'timings_ms': query_timings, 'cache': cache_info}
+                    }) + "\n"
+                
+                elapsed = time.perf_counter() - batch_start
+                timings['total'] = round(elapsed * 1000, 2)
+                logger.info(f"Answered a batch of {completed} queries in {elapsed:.2f}s ({completed / elapsed:.1f} queries/s)")
+                yield json.dumps({
+                    'done': True,
+                    'success': True,
+                    'count': completed,
+                    'queries_per_second': round(completed / elapsed, 2),
+                    'metadata': {'timings_ms': timings}
+                }) + "\n"
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error processing query batch: {str(e)}")
+                yield json.dumps({'error': str(e), 'count': completed}) + "\n"
+        
+        return app.response_class(stream_with_context(lines()), mimetype='application/x-ndjson')
+    
+    @app.route('/api/stats', methods=['GET'])
+    def get_stats():
+        try:
+            return jsonify({
+                'success': True,
+                'deduplication': get_dedup_stats(),
+                'vector_store': get_vector_store_stats(),
+                'search_mode': get_search_mode_in_effect(),
+                'lexical_index': get_lexical_index_stats(),
+                'answer_cache': get_answer_cache().get_stats()
+            })
+        except Exception as e:
+            logger.error(f"Error fetching stats: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+    
     @app.route('/api/queries', methods=['GET'])
     def get_queries():
         try:
@@ -35,6 +35,78 @@ function processRagQuery(queryText, successCallback, errorCallback) {
     });
 }
 
+/**
+ * Process a query against the RAG system, streaming the answer as it is generated
+ * @param {string} queryText - The query text
+ * @param {Object} callbacks - Event handlers, all optional:
+ *   onSources(sources, cache) when the sources are known, before any of the answer;
+ *   onToken(text) for each piece of the answer;
+ *   onDone(result) with the query id and metadata once the answer is complete;
+ *   onError(message) if the query fails
+ * @param {Object} filter - Optional filter restricting the search to some documents
+ */
+async function streamRagQuery(queryText, callbacks = {}, filter = null) {
+    const { onSources, onToken, onDone, onError } = callbacks;
+    if (!queryText || queryText.trim() === '') {
+        if (onError) onError('Query text cannot be empty');
+        return;
+    }
+
+    const body = { query: queryText };
+    if (filter) body.filter = filter;
+
+    try {
+        const response = await fetch('/api/query/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+            body: JSON.stringify(body)
+        });
+
+        if (!response.ok) {
+            const data = await response.json().catch(() => ({}));
+            throw new Error(data.error || `Request failed with status ${response.status}`);
+        }
+
+        // Server-Sent Events are separated by a blank line; each has an event and a JSON data line
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        const dispatch = block => {
+            let eventName = 'message';
+            let data = '';
+            block.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (!data) return;
+
+            const payload = JSON.parse(data);
+            if (eventName === 'sources' && onSources) onSources(payload.sources, payload.cache);
+            else if (eventName === 'token' && onToken) onToken(payload.text);
+            else if (eventName === 'done' && onDone) onDone(payload);
+            else if (eventName === 'error' && onError) onError(payload.error);
+        };
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary = buffer.indexOf('\n\n');
+            while (boundary !== -1) {
+                dispatch(buffer.slice(0, boundary));
+                buffer = buffer.slice(boundary + 2);
+                boundary = buffer.indexOf('\n\n');
+            }
+        }
+        if (buffer.trim()) dispatch(buffer);
+    } catch (error) {
+        console.error('Error streaming query:', error);
+        if (onError) onError(error.message || 'Error processing query');
+    }
+}
+
 /**
  * Upload a document to the RAG system
  * @param {File} file - The file to upload
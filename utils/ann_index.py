@@ -0,0 +1,130 @@
+"""
+Approximate nearest neighbour vector store.
+
+AnnFAISS is LangChain's FAISS store over an HNSW graph or an IVF index instead of
+a flat one, so search cost grows sub-linearly with the corpus rather than
+linearly. Recall is traded against latency with ANN_HNSW_EF_SEARCH or
+ANN_IVF_NPROBE, which are read at search time; the graph and cluster settings are
+fixed when the index is built.
+
+Vectors are inserted incrementally. IVF needs data to train its clusters on, so
+until there are IVF_TRAINING_POINTS_PER_LIST vectors per cluster the index stays
+an exact flat index, and it is converted in place once there are.
+
+HNSW graphs can't remove vectors, so deletes are tombstones (see
+utils.faiss_store), cleared by compacting the index.
+"""
+
+import logging
+
+from utils.config import (
+    get_ann_index_type,
+    get_ann_hnsw_m,
+    get_ann_hnsw_ef_construction,
+    get_ann_hnsw_ef_search,
+    get_ann_ivf_nlist,
+    get_ann_ivf_nprobe
+)
+from utils.faiss_store import TombstoneFAISS
+
+logger = logging.getLogger(__name__)
+
+# faiss wants at least this many training vectors per IVF cluster
+IVF_TRAINING_POINTS_PER_LIST = 39
+
+# faiss samples at most this many training vectors per IVF cluster
+IVF_MAX_TRAINING_POINTS_PER_LIST = 256
+
+def get_index_description(index_type=None):
+    """Describe the build-time settings of an approximate index
+
+    A saved index is only reused by a configuration with the same description.
+    """
+    index_type = index_type or get_ann_index_type()
+    if index_type == "ivf":
+        return f"ivf:nlist={get_ann_ivf_nlist()}"
+    return f"hnsw:M={get_ann_hnsw_m()},efConstruction={get_ann_hnsw_ef_construction()}"
+
+def create_ann_index(dimension, index_type=None):
+    """Create an empty index of the configured type
+
+    IVF starts out as a flat index until it has enough vectors to train on.
+    """
+    import faiss
+    index_type = index_type or get_ann_index_type()
+    if index_type == "ivf":
+        return faiss.IndexFlatL2(dimension)
+    index = faiss.IndexHNSWFlat(dimension, get_ann_hnsw_m())
+    index.hnsw.efConstruction = get_ann_hnsw_ef_construction()
+    return index
+
+def train_ivf_index(vectors, nlist=None):
+    """Build a trained IVF index holding vectors, in their current order"""
+    import faiss
+    nlist = nlist or get_ann_ivf_nlist()
+    dimension = vectors.shape[1]
+    index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist)
+    index.train(vectors[:nlist * IVF_MAX_TRAINING_POINTS_PER_LIST])
+    # Lets vectors be read back by position, e.g. to score a filtered allow-list exactly
+    index.make_direct_map()
+    index.add(vectors)
+    return index
+
+def get_search_parameters(index, selector=None):
+    """Search-time recall/latency settings for an index, with an optional ID selector"""
+    import faiss
+    if isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(efSearch=get_ann_hnsw_ef_search())
+    elif isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(nprobe=min(get_ann_ivf_nprobe(), index.nlist))
+    elif isinstance(index, faiss.IndexPQ):
+        # A PQ index rejects the generic parameters
+        params = faiss.SearchParametersPQ()
+    else:
+        params = faiss.SearchParameters()
+    if selector is not None:
+        params.sel = selector
+    return params
+
+class AnnFAISS(TombstoneFAISS):
+    """LangChain FAISS store over an approximate index, with incremental inserts and tombstoned deletes"""
+
+    @classmethod
+    def create(cls, embeddings, dimension, index_type=None):
+        """Create an empty store"""
+        return super().create(embeddings, create_ann_index(dimension, index_type))
+
+    @property
+    def index_type(self):
+        """hnsw or ivf (a flat index is an IVF index that hasn't been trained yet)"""
+        import faiss
+        return "hnsw" if isinstance(self.index, faiss.IndexHNSW) else "ivf"
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        """Add texts with precomputed embeddings, training an IVF index once there are enough"""
+        ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+        self._train_when_ready()
+        return ids
+
+    def _train_when_ready(self):
+        """Convert a flat index to IVF once there are enough vectors to train on"""
+        import faiss
+        if type(self.index) is not faiss.IndexFlatL2:
+            return
+        nlist = get_ann_ivf_nlist()
+        if self.index.ntotal < nlist * IVF_TRAINING_POINTS_PER_LIST:
+            return
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        self.index = train_ivf_index(vectors, nlist)
+        logger.info(f"Trained IVF index with {nlist} clusters on {len(vectors)} vectors")
+
+    def _search_parameters(self, index, selector):
+        """Search-time recall/latency settings for the index, with a selector skipping tombstones"""
+        return get_search_parameters(index, selector)
+
+    def build_compacted_index(self, state):
+        """Build the compacted index, training IVF if the untrained flat index now has enough vectors"""
+        import faiss
+        if type(state["index"]) is faiss.IndexFlatL2 and len(state["vectors"]) >= get_ann_ivf_nlist() * IVF_TRAINING_POINTS_PER_LIST:
+            return train_ivf_index(state["vectors"])
+        return super().build_compacted_index(state)
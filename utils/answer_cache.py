@@ -0,0 +1,221 @@
+"""
+Semantic answer cache.
+
+Answers are cached with the embedding of the query they answered. A new query
+whose embedding has a cosine similarity of at least ANSWER_CACHE_SIMILARITY to
+a cached one (under the same search filter) gets the cached answer and sources
+instead of a search and an LLM generation. The lookup is one matrix-vector
+product over all cached embeddings.
+
+Every entry belongs to a corpus version, a number that grows with any ingest or
+delete; the first lookup or store under a newer version drops all entries.
+Entries also expire after ANSWER_CACHE_TTL_SECONDS, and the least recently
+used one is evicted when the cache is full.
+"""
+
+import json
+import time
+import logging
+import threading
+
+import numpy as np
+
+from utils.config import (
+    get_answer_cache_similarity,
+    get_answer_cache_max_entries,
+    get_answer_cache_ttl_seconds
+)
+
+logger = logging.getLogger(__name__)
+
+# Rows allocated for cached embeddings before the first growth
+_INITIAL_CAPACITY = 64
+
+def filter_cache_key(search_filter):
+    """Key under which answers to queries with a search filter are cached (None without a filter)"""
+    if not search_filter:
+        return None
+    return json.dumps(search_filter, sort_keys=True, default=str)
+
+class AnswerCache:
+    """In-memory store of (query embedding, answer, sources) entries, searched by similarity"""
+
+    def __init__(self, similarity=None, max_entries=None, ttl_seconds=None):
+        """Initialize an empty cache; settings default to the ANSWER_CACHE_* configuration"""
+        self.similarity = get_answer_cache_similarity() if similarity is None else similarity
+        self.max_entries = get_answer_cache_max_entries() if max_entries is None else max_entries
+        self.ttl_seconds = get_answer_cache_ttl_seconds() if ttl_seconds is None else ttl_seconds
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._reset()
+
+    def _reset(self):
+        """Drop every entry; rows 0..size-1 of the arrays are the live entries"""
+        self._size = 0
+        self._vectors = None
+        self._filter_ids = np.zeros(0, dtype=np.int64)
+        self._expires = np.zeros(0, dtype=np.float64)
+        self._last_used = np.zeros(0, dtype=np.float64)
+        self._entries = []
+        # Filters are compared as small integers so the match is vectorized too
+        self._filter_keys = {None: 0}
+
+    def _check_version(self, version):
+        """Move to a corpus version, dropping the entries of an older one
+
+        Returns False for a version older than the current one: a request that
+        read it is racing a change to the corpus and must not use the cache.
+        """
+        if self._version is not None and version < self._version:
+            return False
+        if version != self._version:
+            if self._size:
+                self.invalidations += 1
+                logger.info(f"Corpus changed; dropped {self._size} cached answers")
+            self._reset()
+            self._version = version
+        return True
+
+    def _normalize(self, embedding):
+        """The unit-length float32 query vector, or None if it can't be compared"""
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        if self._vectors is not None and self._vectors.shape[1] != vector.shape[0]:
+            # The embedding model changed; nothing cached is comparable any more
+            self._reset()
+        return vector / norm
+
+    def _keep(self, keep):
+        """Compact the arrays down to the entries selected by a boolean mask of the live rows"""
+        size = int(keep.sum())
+        self._vectors[:size] = self._vectors[:self._size][keep]
+        self._filter_ids[:size] = self._filter_ids[:self._size][keep]
+        self._expires[:size] = self._expires[:self._size][keep]
+        self._last_used[:size] = self._last_used[:self._size][keep]
+        self._entries = [entry for entry, kept in zip(self._entries, keep) if kept]
+        self._size = size
+
+    def _make_room(self, now):
+        """Remove expired entries, then the least recently used one if the cache is still full"""
+        expired = self._expires[:self._size] <= now
+        if expired.any():
+            self.expirations += int(expired.sum())
+            self._keep(~expired)
+        if self._size >= self.max_entries:
+            keep = np.ones(self._size, dtype=bool)
+            keep[np.argmin(self._last_used[:self._size])] = False
+            self.evictions += 1
+            self._keep(keep)
+
+    def _grow(self, dimension):
+        """Make room for one more row, doubling the arrays up to max_entries"""
+        if self._vectors is None:
+            capacity = min(self.max_entries, _INITIAL_CAPACITY)
+            self._vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        elif self._size == len(self._vectors):
+            capacity = min(self.max_entries, 2 * len(self._vectors))
+            vectors = np.zeros((capacity, dimension), dtype=np.float32)
+            vectors[:self._size] = self._vectors[:self._size]
+            self._vectors = vectors
+        else:
+            return
+        for name in ("_filter_ids", "_expires", "_last_used"):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self._size] = array[:self._size]
+            setattr(self, name, grown)
+
+    def lookup(self, embedding, version, search_filter=None):
+        """Find the answer to the most similar cached query
+
+        Returns (answer, sources, similarity), or None if no cached query under
+        the same filter and corpus version is similar enough.
+        """
+        with self._lock:
+            if not self._check_version(version):
+                self.misses += 1
+                return None
+            vector = self._normalize(embedding)
+            filter_id = self._filter_keys.get(filter_cache_key(search_filter))
+            if vector is None or filter_id is None or not self._size:
+                self.misses += 1
+                return None
+
+            now = time.time()
+            scores = self._vectors[:self._size] @ vector
+            scores[(self._filter_ids[:self._size] != filter_id) | (self._expires[:self._size] <= now)] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._last_used[best] = now
+            answer, sources = self._entries[best]
+            return answer, sources, float(scores[best])
+
+    def store(self, embedding, answer, sources, version, search_filter=None):
+        """Cache an answer and its sources, given the corpus version read before retrieval
+
+        Answers retrieved under a version that has since been replaced are not stored.
+        """
+        with self._lock:
+            if not self._check_version(version):
+                return
+            vector = self._normalize(embedding)
+            if vector is None:
+                return
+
+            now = time.time()
+            self._make_room(now)
+            self._grow(len(vector))
+            filter_id = self._filter_keys.setdefault(filter_cache_key(search_filter), len(self._filter_keys))
+            row = self._size
+            self._vectors[row] = vector
+            self._filter_ids[row] = filter_id
+            self._expires[row] = now + self.ttl_seconds if self.ttl_seconds else np.inf
+            self._last_used[row] = now
+            self._entries.append((answer, sources))
+            self._size += 1
+
+    def clear(self):
+        """Remove every entry"""
+        with self._lock:
+            self._reset()
+
+    def get_stats(self):
+        """Get hit/miss counters and size information"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "max_entries": self.max_entries,
+                "similarity": self.similarity,
+                "ttl_seconds": self.ttl_seconds,
+                "corpus_version": self._version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
+
+# Singleton pattern so every query in the process shares one cache
+_cache_instance = None
+_cache_lock = threading.Lock()
+
+def get_answer_cache() -> AnswerCache:
+    """Get the shared answer cache instance"""
+    global _cache_instance
+    with _cache_lock:
+        if _cache_instance is None:
+            _cache_instance = AnswerCache()
+    return _cache_instance
@@ -13,8 +13,128 @@ logger = logging.getLogger(__name__)
 # Vector store configuration
 VECTOR_STORE_TYPE_KEY = "VECTOR_STORE_TYPE"
 DEFAULT_VECTOR_STORE_TYPE = "faiss"
+VECTOR_STORE_TYPES = ("faiss", "ann", "pinecone")
 PINECONE_INDEX_NAME = "marketmatch"
 
+# Pinecone data-plane host of the index; when set the index is opened directly
+# instead of being looked up (and created if missing) through the control plane
+PINECONE_INDEX_HOST_KEY = "PINECONE_INDEX_HOST"
+
+# Incremental sync of chunk vectors to Pinecone
+PINECONE_SYNC_BATCH_SIZE_KEY = "PINECONE_SYNC_BATCH_SIZE"
+DEFAULT_PINECONE_SYNC_BATCH_SIZE = 100
+PINECONE_SYNC_WORKERS_KEY = "PINECONE_SYNC_WORKERS"
+DEFAULT_PINECONE_SYNC_WORKERS = 4
+
+# Approximate nearest neighbour index used when VECTOR_STORE_TYPE is "ann"
+ANN_INDEX_TYPE_KEY = "ANN_INDEX_TYPE"
+DEFAULT_ANN_INDEX_TYPE = "hnsw"
+ANN_INDEX_TYPES = ("hnsw", "ivf")
+ANN_HNSW_M_KEY = "ANN_HNSW_M"
+DEFAULT_ANN_HNSW_M = 32
+ANN_HNSW_EF_CONSTRUCTION_KEY = "ANN_HNSW_EF_CONSTRUCTION"
+DEFAULT_ANN_HNSW_EF_CONSTRUCTION = 100
+ANN_HNSW_EF_SEARCH_KEY = "ANN_HNSW_EF_SEARCH"
+DEFAULT_ANN_HNSW_EF_SEARCH = 64
+ANN_IVF_NLIST_KEY = "ANN_IVF_NLIST"
+DEFAULT_ANN_IVF_NLIST = 256
+ANN_IVF_NPROBE_KEY = "ANN_IVF_NPROBE"
+DEFAULT_ANN_IVF_NPROBE = 16
+
+# Compressed storage of the flat FAISS index, re-scored against full-precision vectors
+VECTOR_QUANTIZATION_KEY = "VECTOR_QUANTIZATION"
+DEFAULT_VECTOR_QUANTIZATION = "none"
+VECTOR_QUANTIZATIONS = ("none", "sq8", "fp16", "pq")
+VECTOR_PQ_BYTES_KEY = "VECTOR_PQ_BYTES"
+DEFAULT_VECTOR_PQ_BYTES = 96
+VECTOR_RESCORE_FACTOR_KEY = "VECTOR_RESCORE_FACTOR"
+DEFAULT_VECTOR_RESCORE_FACTOR = 8
+
+# Two-stage flat search: candidates from a PCA-reduced copy of the index, re-ranked at full dimension
+VECTOR_PREFILTER_DIMENSION_KEY = "VECTOR_PREFILTER_DIMENSION"
+DEFAULT_VECTOR_PREFILTER_DIMENSION = 0
+VECTOR_PREFILTER_CANDIDATES_KEY = "VECTOR_PREFILTER_CANDIDATES"
+DEFAULT_VECTOR_PREFILTER_CANDIDATES = 20
+
+# Semantic cache of answers to /api/query, invalidated whenever the corpus changes
+ANSWER_CACHE_ENABLED_KEY = "ANSWER_CACHE_ENABLED"
+ANSWER_CACHE_SIMILARITY_KEY = "ANSWER_CACHE_SIMILARITY"
+DEFAULT_ANSWER_CACHE_SIMILARITY = 0.95
+ANSWER_CACHE_MAX_ENTRIES_KEY = "ANSWER_CACHE_MAX_ENTRIES"
+DEFAULT_ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL_SECONDS_KEY = "ANSWER_CACHE_TTL_SECONDS"
+DEFAULT_ANSWER_CACHE_TTL_SECONDS = 3600
+
+# Batch queries: answers generated at once, and the largest batch accepted
+QUERY_BATCH_CONCURRENCY_KEY = "QUERY_BATCH_CONCURRENCY"
+DEFAULT_QUERY_BATCH_CONCURRENCY = 4
+QUERY_BATCH_MAX_QUERIES_KEY = "QUERY_BATCH_MAX_QUERIES"
+DEFAULT_QUERY_BATCH_MAX_QUERIES = 500
+
+# Retrieval: vector search, BM25 search over chunk text, or both fused
+SEARCH_MODE_KEY = "SEARCH_MODE"
+DEFAULT_SEARCH_MODE = "vector"
+SEARCH_MODES = ("hybrid", "vector", "lexical")
+LEXICAL_INDEX_DIR_KEY = "LEXICAL_INDEX_DIR"
+DEFAULT_LEXICAL_INDEX_DIR = "lexical_index"
+
+# Ingestion job queue configuration
+INGESTION_QUEUE_ENABLED_KEY = "INGESTION_QUEUE_ENABLED"
+INGESTION_WORKERS_KEY = "INGESTION_WORKERS"
+DEFAULT_INGESTION_WORKERS = 2
+INGESTION_MAX_ATTEMPTS_KEY = "INGESTION_MAX_ATTEMPTS"
+DEFAULT_INGESTION_MAX_ATTEMPTS = 3
+INGESTION_JOB_STALE_SECONDS_KEY = "INGESTION_JOB_STALE_SECONDS"
+DEFAULT_INGESTION_JOB_STALE_SECONDS = 900
+INGESTION_BATCH_SIZE_KEY = "INGESTION_BATCH_SIZE"
+DEFAULT_INGESTION_BATCH_SIZE = 256
+
+# Embeddings API client
+OPENAI_BASE_URL_KEY = "OPENAI_BASE_URL"
+DEFAULT_OPENAI_BASE_URL = "https://api.openai.com/v1"
+EMBEDDING_API_TIMEOUT_KEY = "EMBEDDING_API_TIMEOUT"
+DEFAULT_EMBEDDING_API_TIMEOUT = 60
+EMBEDDING_BATCH_TOKENS_KEY = "EMBEDDING_BATCH_TOKENS"
+DEFAULT_EMBEDDING_BATCH_TOKENS = 100000
+EMBEDDING_CONCURRENCY_KEY = "EMBEDDING_CONCURRENCY"
+DEFAULT_EMBEDDING_CONCURRENCY = 4
+EMBEDDING_MAX_RETRIES_KEY = "EMBEDDING_MAX_RETRIES"
+DEFAULT_EMBEDDING_MAX_RETRIES = 6
+
+# FAISS index snapshots
+FAISS_SNAPSHOT_DIR_KEY = "FAISS_SNAPSHOT_DIR"
+DEFAULT_FAISS_SNAPSHOT_DIR = "faiss_index"
+FAISS_SNAPSHOT_INTERVAL_KEY = "FAISS_SNAPSHOT_INTERVAL_SECONDS"
+DEFAULT_FAISS_SNAPSHOT_INTERVAL = 10
+
+# Flat FAISS index shared between processes as memory-mapped segments
+FAISS_SHARED_INDEX_KEY = "FAISS_SHARED_INDEX"
+FAISS_SEGMENT_DIR_KEY = "FAISS_SEGMENT_DIR"
+DEFAULT_FAISS_SEGMENT_DIR = "faiss_segments"
+FAISS_MAX_SEGMENTS_KEY = "FAISS_MAX_SEGMENTS"
+DEFAULT_FAISS_MAX_SEGMENTS = 8
+
+# Flat FAISS index partitioned across shards, each searched by its own process
+VECTOR_SHARDS_KEY = "VECTOR_SHARDS"
+DEFAULT_VECTOR_SHARDS = 1
+VECTOR_SHARD_KEY_KEY = "VECTOR_SHARD_KEY"
+DEFAULT_VECTOR_SHARD_KEY = "chunk"
+VECTOR_SHARD_KEYS = ("chunk", "document")
+FAISS_SHARD_DIR_KEY = "FAISS_SHARD_DIR"
+DEFAULT_FAISS_SHARD_DIR = "faiss_shards"
+
+# Share of the FAISS index taken by deleted vectors at which it is compacted
+VECTOR_COMPACTION_THRESHOLD_KEY = "VECTOR_COMPACTION_THRESHOLD_PERCENT"
+DEFAULT_VECTOR_COMPACTION_THRESHOLD = 20
+
+# Raw embeddings, kept so indexes can be rebuilt without the embedding API
+VECTOR_FILE_DIR_KEY = "VECTOR_FILE_DIR"
+DEFAULT_VECTOR_FILE_DIR = "vector_data"
+
+# Upload limits
+MAX_DOCUMENT_SIZE_MB_KEY = "MAX_DOCUMENT_SIZE_MB"
+DEFAULT_MAX_DOCUMENT_SIZE_MB = 10
+
 # Configuration file path
 CONFIG_FILE = Path("config.json")
 
@@ -38,6 +158,34 @@ def _save_config(config):
         logger.error(f"Error saving configuration: {str(e)}")
         return False
 
+def _get_int_setting(key, default):
+    """Get an integer setting from the environment, then the config file, then the default"""
+    value = os.environ.get(key)
+    if value is None:
+        value = _load_config().get(key)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        logger.error(f"Invalid value for {key}: {value}. Using default {default}")
+        return default
+
+def _get_float_setting(key, default):
+    """Get a float setting from the environment, then the config file, then the default"""
+    value = os.environ.get(key)
+    if value is None:
+        value = _load_config().get(key)
+    if value is None:
+        return default
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        logger.error(f"Invalid value for {key}: {value}. Using default {default}")
+        return default
+
 def get_vector_store_type():
     """Get the configured vector store type"""
     # Check environment variable first
@@ -55,8 +203,8 @@ def get_vector_store_type():
 
 def set_vector_store_type(store_type):
     """Set the vector store type in both environment variables and config file"""
-    if store_type not in ['pinecone', 'faiss']:
-        logger.error(f"Invalid vector store type: {store_type}. Must be 'pinecone' or 'faiss'")
+    if store_type not in VECTOR_STORE_TYPES:
+        logger.error(f"Invalid vector store type: {store_type}. Must be one of {', '.join(VECTOR_STORE_TYPES)}")
         return False
     
     # Set in environment
@@ -70,6 +218,227 @@ def set_vector_store_type(store_type):
     logger.info(f"Vector store type set to: {store_type}")
     return success
 
+def is_ingestion_queue_enabled():
+    """Check whether this process should run background ingestion jobs"""
+    value = os.environ.get(INGESTION_QUEUE_ENABLED_KEY, "1")
+    return value.lower() not in ("0", "false", "no")
+
+def get_ingestion_worker_count():
+    """Get the number of background ingestion workers per process"""
+    return max(1, _get_int_setting(INGESTION_WORKERS_KEY, DEFAULT_INGESTION_WORKERS))
+
+def get_ingestion_max_attempts():
+    """Get how many times an ingestion job is attempted before it is marked failed"""
+    return max(1, _get_int_setting(INGESTION_MAX_ATTEMPTS_KEY, DEFAULT_INGESTION_MAX_ATTEMPTS))
+
+def get_ingestion_job_stale_seconds():
+    """Get how long a running job may go without progress before another process takes it over"""
+    return _get_int_setting(INGESTION_JOB_STALE_SECONDS_KEY, DEFAULT_INGESTION_JOB_STALE_SECONDS)
+
+def get_ingestion_batch_size():
+    """Get how many chunks are embedded and committed together during ingestion"""
+    return max(1, _get_int_setting(INGESTION_BATCH_SIZE_KEY, DEFAULT_INGESTION_BATCH_SIZE))
+
+def get_max_document_size_mb():
+    """Get the largest accepted upload in megabytes"""
+    return _get_int_setting(MAX_DOCUMENT_SIZE_MB_KEY, DEFAULT_MAX_DOCUMENT_SIZE_MB)
+
+def get_faiss_snapshot_dir():
+    """Get the directory the FAISS index snapshot is saved in"""
+    return os.environ.get(FAISS_SNAPSHOT_DIR_KEY) or _load_config().get(FAISS_SNAPSHOT_DIR_KEY) or DEFAULT_FAISS_SNAPSHOT_DIR
+
+def is_faiss_shared_index_enabled():
+    """Check whether the flat FAISS index is shared between processes as memory-mapped segments"""
+    value = os.environ.get(FAISS_SHARED_INDEX_KEY) or str(_load_config().get(FAISS_SHARED_INDEX_KEY, "0"))
+    return value.lower() not in ("0", "false", "no")
+
+def get_faiss_segment_dir():
+    """Get the directory of the shared FAISS index segments"""
+    return os.environ.get(FAISS_SEGMENT_DIR_KEY) or _load_config().get(FAISS_SEGMENT_DIR_KEY) or DEFAULT_FAISS_SEGMENT_DIR
+
+def get_faiss_max_segments():
+    """Get the number of shared index segments at which they are merged into one"""
+    return max(2, _get_int_setting(FAISS_MAX_SEGMENTS_KEY, DEFAULT_FAISS_MAX_SEGMENTS))
+
+def get_vector_shards():
+    """Get the number of shards the flat FAISS index is partitioned into (1 is unsharded)"""
+    return max(1, _get_int_setting(VECTOR_SHARDS_KEY, DEFAULT_VECTOR_SHARDS))
+
+def get_vector_shard_key():
+    """Get what decides a vector's shard: the hash of its chunk id or of its document id"""
+    shard_key = (os.environ.get(VECTOR_SHARD_KEY_KEY) or _load_config().get(VECTOR_SHARD_KEY_KEY) or DEFAULT_VECTOR_SHARD_KEY).lower()
+    if shard_key not in VECTOR_SHARD_KEYS:
+        logger.error(f"Invalid value for {VECTOR_SHARD_KEY_KEY}: {shard_key}. Using default {DEFAULT_VECTOR_SHARD_KEY}")
+        return DEFAULT_VECTOR_SHARD_KEY
+    return shard_key
+
+def set_vector_sharding(shards, shard_key):
+    """Set the shard count and shard key in both environment variables and config file"""
+    if shards < 1 or shard_key not in VECTOR_SHARD_KEYS:
+        logger.error(f"Invalid sharding: {shards} shards by {shard_key}. Need at least 1 shard by one of {', '.join(VECTOR_SHARD_KEYS)}")
+        return False
+
+    os.environ[VECTOR_SHARDS_KEY] = str(shards)
+    os.environ[VECTOR_SHARD_KEY_KEY] = shard_key
+    config = _load_config()
+    config[VECTOR_SHARDS_KEY] = shards
+    config[VECTOR_SHARD_KEY_KEY] = shard_key
+    success = _save_config(config)
+
+    logger.info(f"Vector sharding set to: {shards} shards by {shard_key}")
+    return success
+
+def get_faiss_shard_dir():
+    """Get the directory of the FAISS index shards"""
+    return os.environ.get(FAISS_SHARD_DIR_KEY) or _load_config().get(FAISS_SHARD_DIR_KEY) or DEFAULT_FAISS_SHARD_DIR
+
+def get_faiss_snapshot_interval():
+    """Get the minimum seconds between FAISS snapshots taken after write batches"""
+    return max(0, _get_int_setting(FAISS_SNAPSHOT_INTERVAL_KEY, DEFAULT_FAISS_SNAPSHOT_INTERVAL))
+
+def get_vector_compaction_threshold():
+    """Get the fraction of deleted vectors at which the FAISS index is compacted"""
+    return min(100, max(1, _get_int_setting(VECTOR_COMPACTION_THRESHOLD_KEY, DEFAULT_VECTOR_COMPACTION_THRESHOLD))) / 100
+
+def get_ann_index_type():
+    """Get the kind of approximate index used by the ann vector store: hnsw or ivf"""
+    index_type = (os.environ.get(ANN_INDEX_TYPE_KEY) or _load_config().get(ANN_INDEX_TYPE_KEY) or DEFAULT_ANN_INDEX_TYPE).lower()
+    if index_type not in ANN_INDEX_TYPES:
+        logger.error(f"Invalid value for {ANN_INDEX_TYPE_KEY}: {index_type}. Using default {DEFAULT_ANN_INDEX_TYPE}")
+        return DEFAULT_ANN_INDEX_TYPE
+    return index_type
+
+def set_ann_index_type(index_type):
+    """Set the approximate index type in both environment variables and config file"""
+    if index_type not in ANN_INDEX_TYPES:
+        logger.error(f"Invalid ANN index type: {index_type}. Must be one of {', '.join(ANN_INDEX_TYPES)}")
+        return False
+
+    os.environ[ANN_INDEX_TYPE_KEY] = index_type
+    config = _load_config()
+    config[ANN_INDEX_TYPE_KEY] = index_type
+    success = _save_config(config)
+
+    logger.info(f"ANN index type set to: {index_type}")
+    return success
+
+def get_vector_quantization():
+    """Get how the flat FAISS index stores vectors: none, sq8, fp16 or pq"""
+    quantization = (os.environ.get(VECTOR_QUANTIZATION_KEY) or _load_config().get(VECTOR_QUANTIZATION_KEY) or DEFAULT_VECTOR_QUANTIZATION).lower()
+    if quantization not in VECTOR_QUANTIZATIONS:
+        logger.error(f"Invalid value for {VECTOR_QUANTIZATION_KEY}: {quantization}. Using default {DEFAULT_VECTOR_QUANTIZATION}")
+        return DEFAULT_VECTOR_QUANTIZATION
+    return quantization
+
+def get_vector_pq_bytes():
+    """Get the code size in bytes of a product-quantized vector (set at build time)"""
+    return max(1, _get_int_setting(VECTOR_PQ_BYTES_KEY, DEFAULT_VECTOR_PQ_BYTES))
+
+def get_vector_rescore_factor():
+    """Get how many candidates per result a quantized search re-scores at full precision (1 turns it off)"""
+    return max(1, _get_int_setting(VECTOR_RESCORE_FACTOR_KEY, DEFAULT_VECTOR_RESCORE_FACTOR))
+
+def get_vector_prefilter_dimension():
+    """Get the dimension of the reduced copy of the flat FAISS index searched first (0 turns two-stage search off)"""
+    return max(0, _get_int_setting(VECTOR_PREFILTER_DIMENSION_KEY, DEFAULT_VECTOR_PREFILTER_DIMENSION))
+
+def get_vector_prefilter_candidates():
+    """Get how many candidates per result the reduced copy returns for re-ranking at full dimension"""
+    return max(1, _get_int_setting(VECTOR_PREFILTER_CANDIDATES_KEY, DEFAULT_VECTOR_PREFILTER_CANDIDATES))
+
+def get_ann_hnsw_m():
+    """Get the number of graph neighbours per vector in the HNSW index (set at build time)"""
+    return max(4, _get_int_setting(ANN_HNSW_M_KEY, DEFAULT_ANN_HNSW_M))
+
+def get_ann_hnsw_ef_construction():
+    """Get the HNSW candidate list size while inserting; higher builds a better graph, slower"""
+    return max(1, _get_int_setting(ANN_HNSW_EF_CONSTRUCTION_KEY, DEFAULT_ANN_HNSW_EF_CONSTRUCTION))
+
+def get_ann_hnsw_ef_search():
+    """Get the HNSW candidate list size while searching; higher gives better recall, slower"""
+    return max(1, _get_int_setting(ANN_HNSW_EF_SEARCH_KEY, DEFAULT_ANN_HNSW_EF_SEARCH))
+
+def get_ann_ivf_nlist():
+    """Get the number of IVF clusters (set when the index is trained)"""
+    return max(1, _get_int_setting(ANN_IVF_NLIST_KEY, DEFAULT_ANN_IVF_NLIST))
+
+def get_ann_ivf_nprobe():
+    """Get the number of IVF clusters scanned per search; higher gives better recall, slower"""
+    return max(1, _get_int_setting(ANN_IVF_NPROBE_KEY, DEFAULT_ANN_IVF_NPROBE))
+
+def is_answer_cache_enabled():
+    """Check whether query answers are served from the semantic answer cache"""
+    value = os.environ.get(ANSWER_CACHE_ENABLED_KEY) or str(_load_config().get(ANSWER_CACHE_ENABLED_KEY, "1"))
+    return value.lower() not in ("0", "false", "no")
+
+def get_answer_cache_similarity():
+    """Get the cosine similarity to a cached query at which its answer is reused"""
+    return min(1.0, max(0.0, _get_float_setting(ANSWER_CACHE_SIMILARITY_KEY, DEFAULT_ANSWER_CACHE_SIMILARITY)))
+
+def get_answer_cache_max_entries():
+    """Get the number of answers the cache holds before evicting the least recently used"""
+    return max(1, _get_int_setting(ANSWER_CACHE_MAX_ENTRIES_KEY, DEFAULT_ANSWER_CACHE_MAX_ENTRIES))
+
+def get_answer_cache_ttl_seconds():
+    """Get how long a cached answer is served for (0 keeps it until evicted or invalidated)"""
+    return max(0, _get_int_setting(ANSWER_CACHE_TTL_SECONDS_KEY, DEFAULT_ANSWER_CACHE_TTL_SECONDS))
+
+def get_query_batch_concurrency():
+    """Get how many answers of a batch query are generated at once"""
+    return max(1, _get_int_setting(QUERY_BATCH_CONCURRENCY_KEY, DEFAULT_QUERY_BATCH_CONCURRENCY))
+
+def get_query_batch_max_queries():
+    """Get the largest number of queries accepted in one batch"""
+    return max(1, _get_int_setting(QUERY_BATCH_MAX_QUERIES_KEY, DEFAULT_QUERY_BATCH_MAX_QUERIES))
+
+def get_search_mode():
+    """Get how queries find chunks: hybrid (vector and lexical, fused), vector or lexical"""
+    search_mode = (os.environ.get(SEARCH_MODE_KEY) or _load_config().get(SEARCH_MODE_KEY) or DEFAULT_SEARCH_MODE).lower()
+    if search_mode not in SEARCH_MODES:
+        logger.error(f"Invalid value for {SEARCH_MODE_KEY}: {search_mode}. Using default {DEFAULT_SEARCH_MODE}")
+        return DEFAULT_SEARCH_MODE
+    return search_mode
+
+def get_lexical_index_dir():
+    """Get the directory the lexical (BM25) index is saved in"""
+    return os.environ.get(LEXICAL_INDEX_DIR_KEY) or _load_config().get(LEXICAL_INDEX_DIR_KEY) or DEFAULT_LEXICAL_INDEX_DIR
+
+def get_vector_file_dir():
+    """Get the directory of the append-only raw embedding file"""
+    return os.environ.get(VECTOR_FILE_DIR_KEY) or _load_config().get(VECTOR_FILE_DIR_KEY) or DEFAULT_VECTOR_FILE_DIR
+
+def get_openai_base_url():
+    """Get the base URL of the OpenAI-compatible API used for embeddings"""
+    return os.environ.get(OPENAI_BASE_URL_KEY) or _load_config().get(OPENAI_BASE_URL_KEY) or DEFAULT_OPENAI_BASE_URL
+
+def get_embedding_api_timeout():
+    """Get the seconds an embeddings request may take, including retries"""
+    return max(1, _get_int_setting(EMBEDDING_API_TIMEOUT_KEY, DEFAULT_EMBEDDING_API_TIMEOUT))
+
+def get_embedding_batch_tokens():
+    """Get the token budget of one embeddings request"""
+    return max(1, _get_int_setting(EMBEDDING_BATCH_TOKENS_KEY, DEFAULT_EMBEDDING_BATCH_TOKENS))
+
+def get_embedding_concurrency():
+    """Get how many embeddings requests may be in flight at once per process"""
+    return max(1, _get_int_setting(EMBEDDING_CONCURRENCY_KEY, DEFAULT_EMBEDDING_CONCURRENCY))
+
+def get_embedding_max_retries():
+    """Get how many times a rate-limited or failed embeddings request is retried"""
+    return max(0, _get_int_setting(EMBEDDING_MAX_RETRIES_KEY, DEFAULT_EMBEDDING_MAX_RETRIES))
+
+def get_pinecone_index_host():
+    """Get the Pinecone index host to connect to directly, or None to look the index up by name"""
+    return os.environ.get(PINECONE_INDEX_HOST_KEY) or _load_config().get(PINECONE_INDEX_HOST_KEY) or None
+
+def get_pinecone_sync_batch_size():
+    """Get how many vectors are sent per Pinecone upsert request"""
+    return max(1, _get_int_setting(PINECONE_SYNC_BATCH_SIZE_KEY, DEFAULT_PINECONE_SYNC_BATCH_SIZE))
+
+def get_pinecone_sync_workers():
+    """Get how many Pinecone upsert requests a sync keeps in flight"""
+    return max(1, _get_int_setting(PINECONE_SYNC_WORKERS_KEY, DEFAULT_PINECONE_SYNC_WORKERS))
+
 def is_pinecone_available():
     """Check if Pinecone is available (credentials are set)"""
     pinecone_api_key = os.environ.get("PINECONE_API_KEY")
@@ -95,6 +464,8 @@ def get_system_status():
     """Get the status of all system components"""
     return {
         "vector_store_type": get_vector_store_type(),
+        "search_mode": get_search_mode(),
         "pinecone_available": is_pinecone_available(),
         "openai_available": is_openai_available(),
+        "ingestion_workers": get_ingestion_worker_count(),
     }
\ No newline at end of file
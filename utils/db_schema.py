@@ -0,0 +1,92 @@
+"""
+Lightweight schema upgrades.
+
+db.create_all() only creates missing tables, so columns and indexes added to
+existing models are created here for databases made by an older version.
+SQLite tables whose model asks for AUTOINCREMENT are rebuilt with it, since
+SQLite can't add it to an existing table.
+"""
+
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateTable
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Ids a table may have handed out before it had AUTOINCREMENT and that are still
+# referred to elsewhere; its id sequence starts above the largest of them
+RETIRED_ID_QUERIES = {
+    "document_chunk": {
+        "document_chunk": "SELECT MAX(CAST(embedding_id AS INTEGER)) FROM document_chunk",
+        "vector_sync_state": "SELECT MAX(high_water_mark) FROM vector_sync_state"
+    }
+}
+
+def _has_autoincrement(connection, table):
+    """Whether an existing SQLite table was created with AUTOINCREMENT"""
+    sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}
+    ).scalar()
+    return sql is not None and "AUTOINCREMENT" in sql.upper()
+
+def _rebuild_with_autoincrement(connection, inspector, table):
+    """Copy a SQLite table into one created with AUTOINCREMENT, keeping its name and ids
+
+    A plain INTEGER PRIMARY KEY hands out the ids of deleted rows again.
+    Foreign keys in other tables refer to the table by name, so they refer to
+    the rebuilt one. Its indexes are created again by upgrade_schema.
+    """
+    preparer = connection.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    rebuild_name = preparer.quote(f"{table.name}_rebuild")
+    create = str(CreateTable(table).compile(dialect=connection.dialect)).strip()
+    connection.execute(text(create.replace(f"CREATE TABLE {name} ", f"CREATE TABLE {rebuild_name} ", 1)))
+
+    existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+    columns = ", ".join(preparer.quote(column.name) for column in table.columns if column.name in existing_columns)
+    connection.execute(text(f"INSERT INTO {rebuild_name} ({columns}) SELECT {columns} FROM {name}"))
+    connection.execute(text(f"DROP TABLE {name}"))
+    connection.execute(text(f"ALTER TABLE {rebuild_name} RENAME TO {name}"))
+
+    # The copied rows set the sequence to the largest id still in the table
+    floor = 0
+    for source_table, query in RETIRED_ID_QUERIES.get(table.name, {}).items():
+        if inspector.has_table(source_table):
+            floor = max(floor, connection.execute(text(query)).scalar() or 0)
+    connection.execute(
+        text("UPDATE sqlite_sequence SET seq = MAX(seq, :floor) WHERE name = :name"),
+        {"floor": floor, "name": table.name}
+    )
+    connection.execute(
+        text("INSERT INTO sqlite_sequence (name, seq) SELECT :name, :floor "
+             "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"),
+        {"floor": floor, "name": table.name}
+    )
+    next_after = connection.execute(text("SELECT seq FROM sqlite_sequence WHERE name = :name"), {"name": table.name}).scalar()
+    logger.info(f"Rebuilt table {table.name} with AUTOINCREMENT, new ids start after {next_after}")
+
+def upgrade_schema():
+    """Add any model columns and indexes that are missing from existing tables"""
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            if connection.dialect.name == "sqlite" and table.dialect_options["sqlite"]["autoincrement"] \
+                    and not _has_autoincrement(connection, table):
+                _rebuild_with_autoincrement(connection, inspector, table)
+                inspector.clear_cache()
+
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                logger.info(f"Added column {table.name}.{column.name}")
+
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
@@ -1,71 +1,505 @@
+import os
+import math
+import hashlib
 import logging
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import uuid
+import time
+from datetime import datetime
+from itertools import islice
+from collections import defaultdict, deque
+from sqlalchemy import func
 
 from app import db
-from models import Document, DocumentChunk
-from utils.embedding import embed_text
-from utils.vector_store import add_text_to_vector_store
+from models import Document, DocumentChunk, ResponseSourceChunk, IngestionJob, CorpusVersion, VectorDeletion
+from utils.config import get_ingestion_batch_size
+from utils.embedding import embed_documents_array, EMBEDDING_DIMENSION
+from utils.text_splitter import get_text_splitter, read_text_blocks, split_text_stream, CHUNK_SIZE, CHUNK_OVERLAP
+from utils.vector_file import store_vectors
+from utils.lexical_index import add_to_lexical_index, delete_from_lexical_index, save_lexical_index
+from utils.vector_store import (
+    get_vector_store,
+    add_embeddings_to_vector_store,
+    record_committed_chunks,
+    record_corpus_version,
+    delete_from_vector_store,
+    save_vector_store_snapshot,
+    batched
+)
 
 logger = logging.getLogger(__name__)
 
-def process_document(document_id):
-    """Process a document: split into chunks, generate embeddings, and store in vector database"""
+# Size of the blocks an upload is copied to disk in
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Number of characters of a file-backed document returned as its preview
+DOCUMENT_PREVIEW_CHARS = 100000
+
+class DocumentTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured size limit"""
+
+def save_upload(stream, file_path, max_bytes):
+    """Copy an upload stream to disk in fixed-size blocks, enforcing a size limit"""
+    written = 0
+    try:
+        with open(file_path, 'wb') as f:
+            while True:
+                block = stream.read(UPLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                written += len(block)
+                if written > max_bytes:
+                    raise DocumentTooLargeError(
+                        f"File too large (limit is {max_bytes // (1024 * 1024)} MB)"
+                    )
+                f.write(block)
+    except Exception:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    return written
+
+def get_document_preview(document, max_chars=DOCUMENT_PREVIEW_CHARS):
+    """Get the start of a document's text without loading the whole file"""
+    if document.content is not None:
+        return document.content
+    if document.content_type == 'text' and document.source_path and os.path.exists(document.source_path):
+        with open(document.source_path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.read(max_chars)
+    # Binary formats have no text preview; show the start of their chunks instead
+    chunks = DocumentChunk.query.filter_by(document_id=document.id).order_by(DocumentChunk.chunk_index).limit(5).all()
+    return "\n\n".join(chunk.content for chunk in chunks)[:max_chars]
+
+def _iter_document_chunks(document):
+    """Yield the chunk texts of a document, streaming from its file when there is one"""
+    text_splitter = get_text_splitter()
+    if document.source_path:
+        return split_text_stream(read_text_blocks(document.source_path), text_splitter)
+    return text_splitter.split_pages([document.content or ""])
+
+def _estimate_chunk_count(document):
+    """Estimate how many chunks a document will produce, for progress reporting"""
+    if document.source_path and os.path.exists(document.source_path):
+        size = os.path.getsize(document.source_path)
+    else:
+        size = len(document.content or "")
+    return math.ceil(size / (CHUNK_SIZE - CHUNK_OVERLAP))
+
+def hash_chunk_content(text):
+    """Content hash used to recognise chunks that have already been embedded"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _find_existing_vectors(content_hashes):
+    """Map each content hash that is already indexed to its vector id"""
+    if not content_hashes:
+        return {}
+    rows = db.session.query(DocumentChunk.content_hash, DocumentChunk.embedding_id).filter(
+        DocumentChunk.content_hash.in_(content_hashes),
+        DocumentChunk.embedding_id.isnot(None)
+    ).all()
+    return {content_hash: embedding_id for content_hash, embedding_id in rows}
+
+def get_corpus_version():
+    """Get the corpus version, which grows with every ingest or delete of chunks"""
+    return db.session.query(CorpusVersion.version).filter_by(id=1).scalar() or 0
+
+def bump_corpus_version():
+    """Increment the corpus version in the current transaction and return the new version
+
+    Cached answers of older versions are dropped, and indexes kept in step with
+    the corpus know which version a change brings them to.
+    """
+    updated = CorpusVersion.query.filter_by(id=1).update(
+        {CorpusVersion.version: CorpusVersion.version + 1, CorpusVersion.updated_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+    if not updated:
+        db.session.add(CorpusVersion(id=1, version=1))
+        return 1
+    # The update holds the database's write lock until commit, so this is our version
+    return get_corpus_version()
+
+def index_chunks(items):
+    """Embed, store and index one batch of (document, chunk_index, text) items in a single transaction
+
+    The items may come from several documents, so bulk ingestion can fill large
+    batches from many small files.
+
+    Chunks whose content hash is already indexed (in this batch or any earlier
+    document) reuse that vector instead of being embedded and indexed again.
+    Returns the number of chunks embedded and the number that reused a vector.
+    """
+    content_hashes = [hash_chunk_content(chunk_text) for _, _, chunk_text in items]
+    existing_vectors = _find_existing_vectors(set(content_hashes))
+
+    # The first occurrence of each unseen hash is the one that gets embedded
+    new_positions = {}
+    for position, content_hash in enumerate(content_hashes):
+        if content_hash not in existing_vectors and content_hash not in new_positions:
+            new_positions[content_hash] = position
+    new_texts = [items[position][2] for position in new_positions.values()]
+
+    # Embed the new chunks in one call before writing any rows, so no write
+    # transaction is held open while we wait on the embedding model
+    embeddings = embed_documents_array(new_texts) if new_texts else []
+
+    # Flush assigns chunk ids without committing
+    chunks = [
+        DocumentChunk(
+            content=chunk_text,
+            chunk_index=chunk_index,
+            content_hash=content_hash,
+            document_id=document.id
+        )
+        for (document, chunk_index, chunk_text), content_hash in zip(items, content_hashes)
+    ]
+    db.session.add_all(chunks)
+    db.session.flush()
+
+    # The id of the first chunk with a given content doubles as the vector id;
+    # duplicates point at that vector so attribution can map back to every copy
+    new_positions = list(new_positions.values())
+    new_chunks = [chunks[position] for position in new_positions]
+    for chunk in new_chunks:
+        existing_vectors[chunk.content_hash] = str(chunk.id)
+    for chunk in chunks:
+        chunk.embedding_id = existing_vectors[chunk.content_hash]
+
+    if new_chunks:
+        # Add the precomputed vectors to the vector store in one call
+        metadatas = [{
+            "chunk_id": chunk.id,
+            "document_id": items[position][0].id,
+            "document_title": items[position][0].title,
+            "chunk_index": chunk.chunk_index,
+            "content_hash": chunk.content_hash
+        } for position, chunk in zip(new_positions, new_chunks)]
+        add_embeddings_to_vector_store(
+            new_texts,
+            embeddings,
+            metadatas,
+            ids=[chunk.embedding_id for chunk in new_chunks]
+        )
+
+    chunk_ids = [chunk.id for chunk in chunks]
+    vector_ids = [chunk.embedding_id for chunk in new_chunks]
+    # Committed with the chunks, after their vectors became searchable
+    corpus_version = bump_corpus_version()
+    db.session.commit()
+    if new_chunks:
+        # Keep the raw vectors so indexes can be rebuilt without embedding again
+        store_vectors(vector_ids, embeddings, [chunk.content_hash for chunk in new_chunks])
+    # Called even without new vectors, to move the index to the new corpus version
+    add_to_lexical_index(vector_ids, new_texts, corpus_version, [chunk.content_hash for chunk in new_chunks])
+    record_corpus_version(corpus_version)
+    record_committed_chunks(chunk_ids)
+    save_vector_store_snapshot()
+    save_lexical_index()
+    return len(new_chunks), len(chunks) - len(new_chunks)
+
+def get_chunks_sharing_vector(chunk):
+    """Get every chunk that shares a chunk's vector, i.e. all copies of its content"""
+    if not chunk.embedding_id:
+        return [chunk]
+    return DocumentChunk.query.filter_by(embedding_id=chunk.embedding_id).order_by(DocumentChunk.id).all()
+
+def resolve_source_chunk(chunk_id):
+    """Get the chunk a search hit refers to
+
+    A hit carries the id of the chunk its vector was created for. If that chunk
+    has since been removed while other copies of its content remain, one of
+    those copies is returned instead.
+    """
+    chunk = DocumentChunk.query.get(chunk_id)
+    if chunk is None:
+        chunk = DocumentChunk.query.filter_by(embedding_id=str(chunk_id)).order_by(DocumentChunk.id).first()
+    return chunk
+
+def get_dedup_stats():
+    """Report how many embeddings and how much index memory chunk deduplication saves"""
+    total_chunks = db.session.query(func.count(DocumentChunk.id)).filter(
+        DocumentChunk.embedding_id.isnot(None)
+    ).scalar()
+    unique_vectors = db.session.query(func.count(func.distinct(DocumentChunk.embedding_id))).scalar()
+    embeddings_saved = total_chunks - unique_vectors
+    return {
+        "indexed_chunks": total_chunks,
+        "unique_vectors": unique_vectors,
+        "embeddings_saved": embeddings_saved,
+        "index_bytes_saved": embeddings_saved * EMBEDDING_DIMENSION * 4
+    }
+
+def process_document(document_id, progress_callback=None, raise_errors=False):
+    """Process a document: split into chunks, generate embeddings, and store in vector database
+
+    Chunks are produced as a stream (read block by block when the document is backed
+    by a file) and handled in batches of INGESTION_BATCH_SIZE. Each batch is embedded
+    with one embedding call, so every chunk is embedded at most once (chunks whose
+    content was indexed before reuse the existing vector), its rows
+    are committed in one transaction and its vectors are pushed to the vector store
+    in one call. Memory use is bounded by the batch size, not the document size.
+    A retried document resumes after the batches committed by the previous attempt.
+
+    progress_callback, if given, is called as progress_callback(stage, chunks_done, chunks_total)
+    between batches, never while a transaction is open, so it may commit its own changes.
+    chunks_total is an estimate until the document is complete.
+
+    Returns a dict of ingestion stats on success, or False on failure
+    (the exception is re-raised instead when raise_errors is set).
+    """
+    def report(stage, chunks_done, chunks_total):
+        if progress_callback:
+            progress_callback(stage, chunks_done, chunks_total)
+
     try:
+        start_time = time.perf_counter()
+
         # Get the document from the database
         document = Document.query.get(document_id)
         if not document:
             logger.error(f"Document with ID {document_id} not found")
+            if raise_errors:
+                raise ValueError(f"Document with ID {document_id} not found")
             return False
-        
-        # Split the document into chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
-        
-        chunks = text_splitter.split_text(document.content)
-        
-        # Create document chunks in the database and generate embeddings
-        for i, chunk_text in enumerate(chunks):
-            # Create document chunk
-            chunk = DocumentChunk(
-                content=chunk_text,
-                chunk_index=i,
-                document_id=document.id
-            )
-            db.session.add(chunk)
-            db.session.commit()
-            
-            # Generate embedding for the chunk
-            try:
-                embedding = embed_text(chunk_text)
-                
-                # Store the embedding ID reference
-                chunk.embedding_id = str(uuid.uuid4())
-                db.session.commit()
-                
-                # Add to vector store
-                metadata = {
-                    "chunk_id": chunk.id,
-                    "document_id": document.id,
-                    "document_title": document.title,
-                    "chunk_index": i
-                }
-                add_text_to_vector_store(chunk_text, metadata)
-                
-            except Exception as e:
-                logger.error(f"Error generating embedding for chunk {chunk.id}: {str(e)}")
-                continue
-        
+
+        # Initialize the vector store before adding rows, otherwise a first-time
+        # initialization would index the new chunks and we would add them again
+        get_vector_store()
+
+        # Chunks committed by an earlier attempt are kept; splitting is deterministic,
+        # so we skip that many chunks and carry on from there
+        resume_from = db.session.query(func.count(DocumentChunk.id)).filter_by(document_id=document.id).scalar()
+        if resume_from:
+            logger.info(f"Resuming document {document_id} after {resume_from} committed chunks")
+
+        estimated_total = _estimate_chunk_count(document)
+        report("splitting", resume_from, max(estimated_total, resume_from))
+
+        chunk_count = resume_from
+        embed_calls = 0
+        embedded_chunks = 0
+        reused_chunks = 0
+        chunk_stream = islice(enumerate(_iter_document_chunks(document)), resume_from, None)
+
+        for batch in batched(chunk_stream, get_ingestion_batch_size()):
+            embedded, reused = index_chunks([(document, chunk_index, chunk_text) for chunk_index, chunk_text in batch])
+            embed_calls += 1 if embedded else 0
+            embedded_chunks += embedded
+            reused_chunks += reused
+            chunk_count += len(batch)
+            report("indexing", chunk_count, max(estimated_total, chunk_count))
+
         # Mark the document as processed
         document.processed = True
         db.session.commit()
-        
-        logger.info(f"Document {document_id} processed successfully with {len(chunks)} chunks")
-        return True
-        
+        save_vector_store_snapshot(force=True)
+        save_lexical_index(force=True)
+
+        elapsed = time.perf_counter() - start_time
+        new_chunks = chunk_count - resume_from
+        stats = {
+            "document_id": document.id,
+            "chunk_count": chunk_count,
+            "resumed_chunks": resume_from,
+            "embed_calls": embed_calls,
+            "embedded_chunks": embedded_chunks,
+            "embeddings_saved": reused_chunks,
+            "index_bytes_saved": reused_chunks * EMBEDDING_DIMENSION * 4,
+            "elapsed_seconds": round(elapsed, 3),
+            "chunks_per_second": round(new_chunks / elapsed, 1) if elapsed > 0 else 0.0
+        }
+        report("completed", chunk_count, chunk_count)
+
+        logger.info(
+            f"Document {document_id} processed successfully with {chunk_count} chunks "
+            f"({stats['chunks_per_second']} chunks/sec, {embed_calls} embed calls, "
+            f"{reused_chunks} duplicate chunks reused)"
+        )
+        return stats
+
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error processing document {document_id}: {str(e)}")
+        if raise_errors:
+            raise
+        return False
+
+def _load_chunk_hashes(document):
+    """Map each content hash of a document's existing chunks to its (chunk id, chunk index) pairs"""
+    rows = db.session.query(
+        DocumentChunk.id, DocumentChunk.chunk_index, DocumentChunk.content_hash
+    ).filter_by(document_id=document.id).order_by(DocumentChunk.chunk_index, DocumentChunk.id).all()
+
+    chunks_by_hash = defaultdict(deque)
+    for chunk_id, chunk_index, content_hash in rows:
+        if content_hash is None:
+            # Chunk stored before content hashes were recorded
+            chunk = DocumentChunk.query.get(chunk_id)
+            content_hash = chunk.content_hash = hash_chunk_content(chunk.content)
+        chunks_by_hash[content_hash].append((chunk_id, chunk_index))
+    db.session.commit()
+    return chunks_by_hash
+
+def delete_chunks(chunk_ids):
+    """Delete chunks, and the vectors that no remaining chunk shares
+
+    The vectors' deletion is logged in the vector_deletion table in the same
+    transaction as the chunks', for stores other than the active one (Pinecone
+    while FAISS is active, say) to apply when they are next synced.
+    Returns the number of vectors deleted.
+    """
+    vector_ids = set()
+    for batch in batched(chunk_ids, 500):
+        rows = db.session.query(DocumentChunk.id, DocumentChunk.embedding_id).filter(DocumentChunk.id.in_(batch)).all()
+        vector_ids.update(embedding_id or str(chunk_id) for chunk_id, embedding_id in rows)
+        ResponseSourceChunk.query.filter(ResponseSourceChunk.document_chunk_id.in_(batch)).delete(synchronize_session=False)
+        DocumentChunk.query.filter(DocumentChunk.id.in_(batch)).delete(synchronize_session=False)
+
+    orphaned = []
+    for batch in batched(sorted(vector_ids), 500):
+        still_used = {
+            embedding_id for (embedding_id,) in db.session.query(DocumentChunk.embedding_id).filter(
+                DocumentChunk.embedding_id.in_(batch)
+            ).distinct()
+        }
+        orphaned.extend(vector_id for vector_id in batch if vector_id not in still_used)
+    db.session.add_all(VectorDeletion(vector_id=vector_id) for vector_id in orphaned)
+    db.session.commit()
+
+    # Vectors are only removed once their rows are gone, so a failure here leaves
+    # an unused vector behind rather than a chunk without one
+    deleted = delete_from_vector_store(orphaned)
+
+    # Bumped once the vectors are gone, so no answer cached under the new version can cite them
+    corpus_version = bump_corpus_version()
+    db.session.commit()
+    # Lexical hits are read back from the chunks, so until this runs the deleted ones are just skipped
+    delete_from_lexical_index(orphaned, corpus_version)
+    record_corpus_version(corpus_version)
+    save_vector_store_snapshot()
+    save_lexical_index()
+    return deleted
+
+def delete_document(document):
+    """Delete a document with its chunks, ingestion jobs and uploaded file
+
+    Vectors are deleted along with the chunks, except ones another document's
+    chunks still share. Returns the number of chunks and vectors deleted.
+    """
+    chunk_ids = [chunk_id for (chunk_id,) in db.session.query(DocumentChunk.id).filter_by(document_id=document.id)]
+    vectors_deleted = delete_chunks(chunk_ids) if chunk_ids else 0
+
+    source_path = document.source_path
+    IngestionJob.query.filter_by(document_id=document.id).delete(synchronize_session=False)
+    db.session.delete(document)
+    db.session.commit()
+    if source_path and os.path.exists(source_path):
+        os.remove(source_path)
+
+    logger.info(f"Deleted document {document.id}: {len(chunk_ids)} chunks, {vectors_deleted} vectors")
+    return {"chunks_deleted": len(chunk_ids), "vectors_deleted": vectors_deleted}
+
+def reingest_document(document_id, progress_callback=None, raise_errors=False):
+    """Re-ingest a document whose file was replaced, diffing the new chunks against the old ones
+
+    New chunks are matched to the document's existing chunks by content hash.
+    Matched chunks keep their rows, ids and vectors (only their chunk_index is
+    updated); unmatched new chunks are indexed as in process_document; old chunks
+    with no match are deleted, along with any vector no other chunk shares.
+
+    Re-running after a failure is safe: chunks added by the failed attempt are
+    matched like any other existing chunk.
+
+    Returns a dict of ingestion stats (including chunks_reused, chunks_added and
+    chunks_deleted) on success, or False on failure.
+    """
+    def report(stage, chunks_done, chunks_total):
+        if progress_callback:
+            progress_callback(stage, chunks_done, chunks_total)
+
+    try:
+        start_time = time.perf_counter()
+
+        document = Document.query.get(document_id)
+        if not document:
+            logger.error(f"Document with ID {document_id} not found")
+            if raise_errors:
+                raise ValueError(f"Document with ID {document_id} not found")
+            return False
+
+        get_vector_store()
+
+        old_chunks = _load_chunk_hashes(document)
+        estimated_total = _estimate_chunk_count(document)
+        report("diffing", 0, estimated_total)
+
+        chunk_count = 0
+        reused_chunks = 0
+        added_chunks = 0
+        embedded_chunks = 0
+        embed_calls = 0
+
+        for batch in batched(enumerate(_iter_document_chunks(document)), get_ingestion_batch_size()):
+            new_items = []
+            moved_chunks = []
+            for chunk_index, chunk_text in batch:
+                content_hash = hash_chunk_content(chunk_text)
+                matches = old_chunks.get(content_hash)
+                if matches:
+                    chunk_id, old_index = matches.popleft()
+                    if not matches:
+                        del old_chunks[content_hash]
+                    if old_index != chunk_index:
+                        moved_chunks.append({"id": chunk_id, "chunk_index": chunk_index})
+                    reused_chunks += 1
+                else:
+                    new_items.append((document, chunk_index, chunk_text))
+
+            if moved_chunks:
+                db.session.bulk_update_mappings(DocumentChunk, moved_chunks)
+            if new_items:
+                # Commits the index updates along with the new chunks
+                embedded, _ = index_chunks(new_items)
+                embed_calls += 1 if embedded else 0
+                embedded_chunks += embedded
+                added_chunks += len(new_items)
+            else:
+                db.session.commit()
+
+            chunk_count += len(batch)
+            report("indexing", chunk_count, max(estimated_total, chunk_count))
+
+        # Whatever was not matched is no longer in the document
+        removed_ids = [chunk_id for matches in old_chunks.values() for chunk_id, _ in matches]
+        report("deleting", chunk_count, chunk_count)
+        deleted_vectors = delete_chunks(removed_ids) if removed_ids else 0
+
+        document.processed = True
+        db.session.commit()
+        save_vector_store_snapshot(force=True)
+        save_lexical_index(force=True)
+
+        elapsed = time.perf_counter() - start_time
+        stats = {
+            "document_id": document.id,
+            "chunk_count": chunk_count,
+            "chunks_reused": reused_chunks,
+            "chunks_added": added_chunks,
+            "chunks_deleted": len(removed_ids),
+            "vectors_deleted": deleted_vectors,
+            "embed_calls": embed_calls,
+            "embedded_chunks": embedded_chunks,
+            "elapsed_seconds": round(elapsed, 3)
+        }
+        report("completed", chunk_count, chunk_count)
+
+        logger.info(
+            f"Document {document_id} re-ingested: {reused_chunks} chunks reused, "
+            f"{added_chunks} added, {len(removed_ids)} deleted ({embedded_chunks} embedded)"
+        )
+        return stats
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error re-ingesting document {document_id}: {str(e)}")
+        if raise_errors:
+            raise
         return False
@@ -1,43 +1,97 @@
 import os
+import hashlib
 import logging
 import numpy as np
 from typing import List
-from langchain_community.embeddings import OpenAIEmbeddings, FakeEmbeddings
+from langchain_community.embeddings import FakeEmbeddings
 from langchain.embeddings.base import Embeddings
 
+from utils.embedding_cache import CachedEmbeddings, EMBEDDING_CACHE_ENABLED
+from utils.embedding_client import OpenAIEmbeddingClient
+
 logger = logging.getLogger(__name__)
 
+# Dimension of the vectors produced by every embedding backend
+EMBEDDING_DIMENSION = 1536
+OPENAI_EMBEDDING_MODEL = "text-embedding-ada-002"
+
 # Singleton pattern for embeddings to avoid recreating them
 _embedding_instance = None
 
+# Constants of the splitmix64 mixing function
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+def _splitmix64(values):
+    """Mix an array of uint64 values into well-distributed pseudo-random bits"""
+    with np.errstate(over='ignore'):
+        values = values + _GOLDEN_GAMMA
+        values = (values ^ (values >> np.uint64(30))) * _MIX_1
+        values = (values ^ (values >> np.uint64(27))) * _MIX_2
+        return values ^ (values >> np.uint64(31))
+
+# Texts hashed per block, bounding the temporary arrays to a few tens of MB
+_HASH_BLOCK_ROWS = 1024
+
+def hash_vectors(texts, dimension, distribution="uniform"):
+    """Deterministic unit vectors for a batch of texts, as a float32 matrix
+
+    Each component is a hash of (text, component index), so the result depends only
+    on the text: no RNG state is shared, and any thread gets the same vectors.
+    distribution is "uniform" (components in [0, 1)) or "normal" (standard normal
+    components, via the Box-Muller transform).
+    """
+    seeds = np.array(
+        [int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little') for text in texts],
+        dtype=np.uint64
+    )
+    vectors = np.empty((len(texts), dimension), dtype=np.float32)
+
+    with np.errstate(over='ignore'):
+        counters = np.arange(dimension, dtype=np.uint64) * _GOLDEN_GAMMA
+        for start in range(0, len(texts), _HASH_BLOCK_ROWS):
+            bits = _splitmix64(seeds[start:start + _HASH_BLOCK_ROWS, None] + counters[None, :])
+
+            if distribution == "normal":
+                # Two 32-bit uniforms per component, strictly inside (0, 1)
+                u1 = ((bits >> np.uint64(32)).astype(np.float64) + 0.5) / 2.0 ** 32
+                u2 = ((bits & np.uint64(0xFFFFFFFF)).astype(np.float64) + 0.5) / 2.0 ** 32
+                block = np.sqrt(-2.0 * np.log(u1)) * np.cos(2.0 * np.pi * u2)
+            else:
+                # The top 53 bits give a uniform double in [0, 1)
+                block = (bits >> np.uint64(11)).astype(np.float64) * (1.0 / 2.0 ** 53)
+
+            vectors[start:start + len(block)] = block
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors /= norms
+    return vectors
+
 class SimpleEmbeddings(Embeddings):
-    """Simple embeddings class that produces deterministic embeddings based on text hash"""
+    """Simple embeddings class that produces deterministic embeddings based on text hash
+
+    Vectors are computed a batch at a time without touching numpy's global RNG,
+    so the class is safe to share between threads.
+    """
     
-    def __init__(self, embedding_size=1536):
+    def __init__(self, embedding_size=EMBEDDING_DIMENSION):
         self.embedding_size = embedding_size
     
-    def _hash_text(self, text):
-        """Create a simple hash of text within numpy's random seed range (0 to 2^32-1)"""
-        import hashlib
-        # Use only the first 8 characters of the hash and convert to int
-        # This ensures the value is within the required range for np.random.seed
-        return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
-    
-    def _text_to_vector(self, text):
-        """Convert text to a deterministic embedding vector"""
-        # Use the hash of the text as a seed for random number generation
-        np.random.seed(self._hash_text(text))
-        # Generate a random vector and normalize it
-        vec = np.random.rand(self.embedding_size)
-        return vec / np.linalg.norm(vec)
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Generate embeddings for multiple texts as a (len(texts), embedding_size) float32 matrix"""
+        if not texts:
+            return np.zeros((0, self.embedding_size), dtype=np.float32)
+        return hash_vectors(texts, self.embedding_size)
     
     def embed_query(self, text: str) -> List[float]:
         """Generate an embedding for a single text"""
-        return self._text_to_vector(text).tolist()
+        return self.embed_documents_array([text])[0].tolist()
     
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Generate embeddings for multiple texts"""
-        return [self._text_to_vector(text).tolist() for text in texts]
+        return self.embed_documents_array(texts).tolist()
 
 def get_embeddings():
     """Get or create an embedding model instance"""
@@ -51,15 +105,22 @@ def get_embeddings():
         openai_api_key = os.environ.get("OPENAI_API_KEY")
         if openai_api_key:
             logger.info("Using OpenAI embeddings")
-            # Use api_key parameter as it works correctly
-            _embedding_instance = OpenAIEmbeddings(
+            # Batches by token budget and keeps several requests in flight
+            _embedding_instance = OpenAIEmbeddingClient(
                 api_key=openai_api_key,
-                model="text-embedding-ada-002"
+                model=OPENAI_EMBEDDING_MODEL
             )
+            if EMBEDDING_CACHE_ENABLED:
+                # Serve texts embedded before (re-ingests, rebuilds, repeated queries) from the cache
+                _embedding_instance = CachedEmbeddings(
+                    _embedding_instance,
+                    model_name=OPENAI_EMBEDDING_MODEL,
+                    dimension=EMBEDDING_DIMENSION
+                )
         # Fall back to simple embeddings when OpenAI is not available
         else:
             logger.info("Using simple deterministic embeddings as fallback")
-            _embedding_instance = SimpleEmbeddings(embedding_size=1536)
+            _embedding_instance = SimpleEmbeddings(embedding_size=EMBEDDING_DIMENSION)
         
         return _embedding_instance
     
@@ -67,7 +128,7 @@ def get_embeddings():
         logger.error(f"Error initializing embeddings: {str(e)}")
         # Ultimate fallback to fake embeddings
         logger.info("Using fake embeddings as last resort")
-        _embedding_instance = FakeEmbeddings(size=1536)
+        _embedding_instance = FakeEmbeddings(size=EMBEDDING_DIMENSION)
         return _embedding_instance
 
 def embed_text(text):
@@ -79,3 +140,38 @@ def embed_documents(texts):
     """Generate embeddings for multiple documents"""
     embeddings = get_embeddings()
     return embeddings.embed_documents(texts)
+
+def embed_documents_array(texts):
+    """Generate embeddings for multiple documents as a float32 matrix"""
+    embeddings = get_embeddings()
+    if hasattr(embeddings, "embed_documents_array"):
+        return embeddings.embed_documents_array(texts)
+    return np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+def has_embedding_provider(embeddings=None):
+    """Check whether embeddings come from a real model, not the hash-based or fake fallbacks whose vectors carry no meaning"""
+    embeddings = embeddings or get_embeddings()
+    return not isinstance(embeddings, (SimpleEmbeddings, FakeEmbeddings))
+
+def get_embedding_dimension(embeddings=None):
+    """Get the length of the vectors an embeddings model produces"""
+    embeddings = embeddings or get_embeddings()
+    for attribute in ("embedding_size", "dimension", "size"):
+        value = getattr(embeddings, attribute, None)
+        if isinstance(value, int):
+            return value
+    return EMBEDDING_DIMENSION
+
+def get_embedding_signature(embeddings=None):
+    """Identify an embeddings model and its dimension
+
+    Stored vectors are only reused by a model with the same signature.
+    """
+    embeddings = embeddings or get_embeddings()
+    if isinstance(embeddings, CachedEmbeddings):
+        return f"{embeddings.model_name}:{embeddings.dimension}"
+    if isinstance(embeddings, OpenAIEmbeddingClient):
+        return f"{embeddings.model}:{EMBEDDING_DIMENSION}"
+    if isinstance(embeddings, SimpleEmbeddings):
+        return f"simple-hash:{embeddings.embedding_size}"
+    return f"{type(embeddings).__name__}:{get_embedding_dimension(embeddings)}"
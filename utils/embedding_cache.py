@@ -0,0 +1,264 @@
+"""
+Persistent embedding cache.
+
+Embeddings from remote providers are cached in two tiers: an in-memory LRU per
+process, holding float32 arrays up to a size in bytes, and an on-disk SQLite
+table shared by all processes. Entries are keyed
+by (model name, dimension, text hash) so switching models never returns stale
+vectors. Re-ingests, index rebuilds and repeated queries are served from the
+cache instead of the provider.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Cache configuration
+EMBEDDING_CACHE_ENABLED = os.environ.get("EMBEDDING_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite")
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", 1024))
+EMBEDDING_CACHE_MEMORY_MB = int(os.environ.get("EMBEDDING_CACHE_MEMORY_MB", 64))
+
+# When the disk tier is over its limit, evict down to this fraction of it
+_EVICTION_TARGET = 0.9
+
+def hash_text(text):
+    """Hash of the text part of a cache key"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    """Two-tier (memory LRU + SQLite) store of embedding vectors"""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+                 max_memory_bytes=EMBEDDING_CACHE_MEMORY_MB * 1024 * 1024):
+        """Initialize the cache, creating the SQLite table if needed"""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                model TEXT NOT NULL,
+                dimension INTEGER NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, dimension, text_hash)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embedding_cache_last_used ON embedding_cache (last_used)")
+        self._conn.commit()
+
+        # Running estimate of the disk tier size; recomputed exactly before evicting
+        self._disk_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embedding_cache").fetchone()[0]
+
+    def _remember(self, key, vector):
+        """Put a float32 vector in the memory tier, evicting least recently used entries to stay under its size"""
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= previous.nbytes
+        self._memory[key] = vector
+        self._memory_bytes += vector.nbytes
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            self._memory_bytes -= self._memory.popitem(last=False)[1].nbytes
+
+    def get_many(self, model, dimension, text_hashes):
+        """Look up vectors; returns a dict of text hash to float32 vector for the hits"""
+        found = {}
+        with self._lock:
+            missing = []
+            for text_hash in text_hashes:
+                key = (model, dimension, text_hash)
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[text_hash] = self._memory[key]
+                    self.memory_hits += 1
+                else:
+                    missing.append(text_hash)
+
+            if missing:
+                now = time.time()
+                # Stay under SQLite's bound-parameter limit
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, vector FROM embedding_cache "
+                        f"WHERE model = ? AND dimension = ? AND text_hash IN ({placeholders})",
+                        [model, dimension, *batch]
+                    ).fetchall()
+                    for text_hash, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        found[text_hash] = vector
+                        self._remember((model, dimension, text_hash), vector)
+                    if rows:
+                        self._conn.executemany(
+                            "UPDATE embedding_cache SET last_used = ? WHERE model = ? AND dimension = ? AND text_hash = ?",
+                            [(now, model, dimension, text_hash) for text_hash, _ in rows]
+                        )
+                        self._conn.commit()
+                    self.disk_hits += len(rows)
+
+            self.misses += len(text_hashes) - len(found)
+        return found
+
+    def put_many(self, model, dimension, items):
+        """Store (text hash, vector) pairs in both tiers"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            rows = []
+            for text_hash, vector in items:
+                # A copy, so the cached vector doesn't keep a caller's whole matrix alive
+                vector = np.array(vector, dtype=np.float32)
+                self._remember((model, dimension, text_hash), vector)
+                blob = vector.tobytes()
+                rows.append((model, dimension, text_hash, blob, len(blob), now))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (model, dimension, text_hash, vector, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            self._disk_bytes += sum(row[4] for row in rows)
+            if self._disk_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used disk entries until the disk tier is back under its size limit"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embedding_cache").fetchone()[0]
+        target = int(self.max_bytes * _EVICTION_TARGET)
+        evicted = 0
+        while total > target:
+            rows = self._conn.execute(
+                "SELECT rowid, size FROM embedding_cache ORDER BY last_used ASC LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            doomed = []
+            for rowid, size in rows:
+                if total <= target:
+                    break
+                doomed.append((rowid,))
+                total -= size
+            self._conn.executemany("DELETE FROM embedding_cache WHERE rowid = ?", doomed)
+            evicted += len(doomed)
+        self._conn.commit()
+        self._disk_bytes = total
+        self.evictions += evicted
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from the embedding cache")
+
+    def clear(self):
+        """Remove every entry from both tiers"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._conn.execute("DELETE FROM embedding_cache")
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+            self._disk_bytes = 0
+
+    def get_stats(self):
+        """Get hit/miss counters and size information"""
+        with self._lock:
+            entries, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embedding_cache"
+            ).fetchone()
+            models = [
+                {"model": model, "dimension": dimension, "entries": count}
+                for model, dimension, count in self._conn.execute(
+                    "SELECT model, dimension, COUNT(*) FROM embedding_cache GROUP BY model, dimension"
+                ).fetchall()
+            ]
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "path": self.path,
+            "disk_entries": entries,
+            "disk_bytes": total_bytes,
+            "max_disk_bytes": self.max_bytes,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "max_memory_bytes": self.max_memory_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "models": models
+        }
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that serves previously seen texts from the embedding cache"""
+
+    def __init__(self, embeddings: Embeddings, model_name: str, dimension: int, cache: EmbeddingCache = None):
+        """Wrap an embeddings model; model_name and dimension become part of the cache key"""
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.dimension = dimension
+        self.cache = cache or get_embedding_cache()
+
+    def _embed(self, texts: List[str], embed_missing) -> np.ndarray:
+        """Embed texts as a float32 matrix, calling embed_missing only for the unique texts not in the cache"""
+        text_hashes = [hash_text(text) for text in texts]
+        found = self.cache.get_many(self.model_name, self.dimension, list(dict.fromkeys(text_hashes)))
+
+        missing = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in found and text_hash not in missing:
+                missing[text_hash] = text
+
+        if missing:
+            vectors = np.asarray(embed_missing(list(missing.values())), dtype=np.float32)
+            new_items = list(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model_name, self.dimension, new_items)
+            found.update(new_items)
+
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.stack([found[text_hash] for text_hash in text_hashes])
+
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Generate embeddings for multiple texts as a float32 matrix, using the cache where possible"""
+        return self._embed(texts, self.embeddings.embed_documents)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for multiple texts, using the cache where possible"""
+        return self.embed_documents_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        """Generate an embedding for a single text, using the cache where possible"""
+        return self._embed([text], lambda missing: [self.embeddings.embed_query(missing[0])])[0].tolist()
+
+# Singleton pattern so every embeddings wrapper in the process shares one cache
+_cache_instance = None
+_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Get the shared embedding cache instance"""
+    global _cache_instance
+    with _cache_lock:
+        if _cache_instance is None:
+            _cache_instance = EmbeddingCache()
+    return _cache_instance
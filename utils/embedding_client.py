@@ -0,0 +1,248 @@
+"""
+Batching client for the OpenAI embeddings API.
+
+Texts are packed into requests by token budget (not by a fixed count), the
+requests are sent through a thread pool so several are in flight at once, and
+rate limits (429) and server errors (5xx) are retried with exponential backoff,
+honouring Retry-After, within the configured timeout.
+"""
+
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import requests
+from langchain.embeddings.base import Embeddings
+
+from utils.config import (
+    get_openai_base_url,
+    get_embedding_api_timeout,
+    get_embedding_batch_tokens,
+    get_embedding_concurrency,
+    get_embedding_max_retries
+)
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# The embeddings API accepts at most this many inputs per request
+MAX_TEXTS_PER_REQUEST = 2048
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Exponential backoff (with full jitter) when the server gives no Retry-After
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+class EmbeddingAPIError(RuntimeError):
+    """Raised when an embeddings request fails and cannot be retried"""
+
+def _load_encoding(model):
+    """Get the tokenizer for a model, or None to fall back to estimating"""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The encoding files are downloaded on first use, which can fail offline
+        logger.warning(f"Could not load tokenizer for {model}, estimating token counts: {str(e)}")
+        return None
+
+def _parse_retry_after(headers):
+    """Get the delay the server asked for, in seconds, or None"""
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            # An HTTP date; fall back to our own backoff
+            return None
+    return None
+
+class OpenAIEmbeddingClient(Embeddings):
+    """LangChain-compatible embeddings backed by a concurrent, token-budgeted API client"""
+
+    def __init__(self, api_key: str, model: str = "text-embedding-ada-002", base_url: str = None,
+                 timeout: float = None, batch_tokens: int = None, concurrency: int = None,
+                 max_retries: int = None, max_texts_per_request: int = MAX_TEXTS_PER_REQUEST):
+        """Initialize the client; unset options come from the configuration"""
+        self.api_key = api_key
+        self.model = model
+        self.base_url = (base_url or get_openai_base_url()).rstrip("/")
+        self.timeout = timeout or get_embedding_api_timeout()
+        self.batch_tokens = batch_tokens or get_embedding_batch_tokens()
+        self.concurrency = concurrency or get_embedding_concurrency()
+        self.max_retries = get_embedding_max_retries() if max_retries is None else max_retries
+        self.max_texts_per_request = max_texts_per_request
+
+        self._encoding = _load_encoding(model)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embedding")
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        # When rate limited, every request waits until this time so they don't all retry at once
+        self._resume_at = 0.0
+        self._stats = {"requests": 0, "retries": 0, "rate_limited": 0, "server_errors": 0, "texts": 0, "tokens": 0}
+
+    def _session(self):
+        """Get this thread's HTTP session, so connections are reused"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            })
+            self._local.session = session
+        return session
+
+    def _count(self, **increments):
+        """Add to the request counters"""
+        with self._stats_lock:
+            for key, value in increments.items():
+                self._stats[key] += value
+
+    def count_tokens(self, text: str) -> int:
+        """Count (or conservatively estimate) the tokens in a text"""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        # Roughly 4 characters per token for English; stay on the safe side
+        return len(text) // 3 + 1
+
+    def make_batches(self, texts: List[str], token_counts: List[int] = None) -> List[List[int]]:
+        """Pack text positions into batches that fit the token budget and request size limit"""
+        if token_counts is None:
+            token_counts = [self.count_tokens(text) for text in texts]
+        batches = []
+        current = []
+        current_tokens = 0
+        for position, tokens in enumerate(token_counts):
+            if current and (current_tokens + tokens > self.batch_tokens or len(current) >= self.max_texts_per_request):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(position)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _backoff_delay(self, attempt, retry_after):
+        """How long to wait before the next attempt"""
+        if retry_after is not None:
+            # A little jitter so the waiting requests don't all resume at the same instant
+            return min(retry_after, BACKOFF_MAX_SECONDS) * random.uniform(1.0, 1.2)
+        return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+    def _wait_for_rate_limit(self, deadline):
+        """Sleep until a rate limit seen by any request has passed"""
+        with self._stats_lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+
+    def _pause_requests(self, delay):
+        """Hold back every request for a while after a rate limit"""
+        with self._stats_lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Send one embeddings request, retrying rate limits and server errors
+
+        The whole call, including retries and waits, is bounded by the timeout.
+        """
+        deadline = time.monotonic() + self.timeout
+        payload = {"model": self.model, "input": texts}
+        attempt = 0
+
+        while True:
+            self._wait_for_rate_limit(deadline)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise EmbeddingAPIError(f"Embeddings request timed out after {self.timeout}s ({attempt} attempts)")
+
+            retry_after = None
+            rate_limited = False
+            try:
+                self._count(requests=1)
+                response = self._session().post(f"{self.base_url}/embeddings", json=payload, timeout=remaining)
+                if response.status_code == 200:
+                    data = sorted(response.json()["data"], key=lambda item: item["index"])
+                    self._count(texts=len(texts))
+                    return [item["embedding"] for item in data]
+
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    raise EmbeddingAPIError(
+                        f"Embeddings request failed with status {response.status_code}: {response.text[:500]}"
+                    )
+                if response.status_code == 429:
+                    rate_limited = True
+                    self._count(rate_limited=1)
+                else:
+                    self._count(server_errors=1)
+                retry_after = _parse_retry_after(response.headers)
+                error = f"status {response.status_code}"
+            except (requests.Timeout, requests.ConnectionError) as e:
+                error = str(e)
+
+            if attempt >= self.max_retries:
+                raise EmbeddingAPIError(f"Embeddings request failed after {attempt + 1} attempts: {error}")
+
+            delay = self._backoff_delay(attempt, retry_after)
+            if time.monotonic() + delay >= deadline:
+                raise EmbeddingAPIError(f"Embeddings request timed out after {self.timeout}s: {error}")
+            self._count(retries=1)
+            if rate_limited:
+                logger.info(f"Embeddings request rate limited, retrying in {delay:.2f}s")
+                self._pause_requests(delay)
+            else:
+                logger.warning(f"Embeddings request failed ({error}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+            attempt += 1
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for multiple texts, sending batches concurrently"""
+        if not texts:
+            return []
+
+        token_counts = [self.count_tokens(text) for text in texts]
+        batches = self.make_batches(texts, token_counts)
+        self._count(tokens=sum(token_counts))
+        if len(batches) == 1:
+            return self._embed_batch(list(texts))
+
+        futures = [self._executor.submit(self._embed_batch, [texts[position] for position in batch]) for batch in batches]
+        embeddings = [None] * len(texts)
+        try:
+            for batch, future in zip(batches, futures):
+                for position, embedding in zip(batch, future.result()):
+                    embeddings[position] = embedding
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        """Generate an embedding for a single text"""
+        return self._embed_batch([text])[0]
+
+    def get_stats(self):
+        """Get request, retry and throughput counters"""
+        with self._stats_lock:
+            return dict(self._stats)
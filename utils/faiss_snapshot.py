@@ -0,0 +1,98 @@
+"""
+On-disk snapshots of the FAISS index.
+
+A snapshot is what FAISS.save_local writes (the index, its docstore and the
+index-to-id mapping) plus a manifest recording the embedding model, the kind of
+index, and the corpus version the index reflected when it was saved. At startup the
+manifest is checked against the database so only chunks missing from the snapshot
+need to be embedded.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+from langchain_community.vectorstores import FAISS
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+SNAPSHOT_VERSION = 1
+
+def save_snapshot(vector_store, directory, manifest):
+    """Write a snapshot, replacing the previous one only once it is complete"""
+    directory = os.path.abspath(directory)
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=".faiss_snapshot_", dir=parent)
+    try:
+        vector_store.save_local(temp_dir)
+        manifest = {
+            **manifest,
+            "version": SNAPSHOT_VERSION,
+            "vector_count": vector_store.index.ntotal,
+            "saved_at": time.time()
+        }
+        with open(os.path.join(temp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+
+        old_dir = None
+        if os.path.exists(directory):
+            old_dir = f"{temp_dir}.old"
+            os.rename(directory, old_dir)
+        os.rename(temp_dir, directory)
+        if old_dir:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return manifest
+
+def read_manifest(directory):
+    """Read a snapshot's manifest, or None if there is no snapshot"""
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def load_snapshot(directory, embeddings, embedding_signature, index_description="flat", store_class=FAISS):
+    """Load a snapshot made with the given embedding model and kind of index
+
+    Returns (vector_store, manifest), or (None, None) if there is no usable snapshot.
+    """
+    try:
+        manifest = read_manifest(directory)
+        if manifest is None:
+            return None, None
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            logger.info(f"Ignoring FAISS snapshot with version {manifest.get('version')}")
+            return None, None
+        if manifest.get("embedding_signature") != embedding_signature:
+            logger.info(
+                f"Ignoring FAISS snapshot made with {manifest.get('embedding_signature')} "
+                f"(current embeddings are {embedding_signature})"
+            )
+            return None, None
+        if manifest.get("index_description", "flat") != index_description:
+            logger.info(
+                f"Ignoring FAISS snapshot of a {manifest.get('index_description', 'flat')} index "
+                f"(configured index is {index_description})"
+            )
+            return None, None
+
+        # The snapshot is our own file, so unpickling its docstore is safe
+        vector_store = store_class.load_local(directory, embeddings, allow_dangerous_deserialization=True)
+        vector_count = vector_store.index.ntotal
+        # Deleted vectors stay in the index as tombstones, so it may hold more than it maps
+        if vector_count != manifest.get("vector_count") or vector_count < len(vector_store.index_to_docstore_id):
+            logger.warning("FAISS snapshot is inconsistent with its manifest, ignoring it")
+            return None, None
+        return vector_store, manifest
+
+    except Exception as e:
+        logger.error(f"Error loading FAISS snapshot: {str(e)}")
+        return None, None
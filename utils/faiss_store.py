@@ -0,0 +1,290 @@
+"""
+FAISS store with tombstoned deletes and compaction.
+
+TombstoneFAISS is LangChain's FAISS store with two changes. Deleting a vector
+drops its position from the id mapping and excludes it from searches with an ID
+selector, instead of removing it from the index, which costs time in proportion
+to the whole index (and which HNSW graphs can't do at all). Compaction rebuilds
+the index from its live vectors once tombstones take up too much of it.
+
+Compaction is split in two so that the slow part, building the new index, can
+run without blocking writers: begin_compaction reads the live vectors, and
+finish_compaction adds whatever was written in the meantime and swaps the new
+index in. Searches read the index and its mapping together under a lock, so they
+never see one without the other.
+"""
+
+import uuid
+import logging
+import operator
+import threading
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain.docstore.document import Document as LangchainDocument
+
+logger = logging.getLogger(__name__)
+
+def empty_index_like(index):
+    """Create an empty index with the same kind and build settings as index
+
+    A trained IVF or quantized index keeps its centroids or encoding, so it doesn't
+    need training again.
+    """
+    import faiss
+    if isinstance(index, faiss.IndexHNSWFlat):
+        empty = faiss.IndexHNSWFlat(index.d, index.hnsw.nb_neighbors(1), index.metric_type)
+        empty.hnsw.efConstruction = index.hnsw.efConstruction
+        return empty
+    if isinstance(index, faiss.IndexIVFFlat):
+        empty = faiss.IndexIVFFlat(faiss.clone_index(index.quantizer), index.d, index.nlist, index.metric_type)
+        empty.make_direct_map()
+        return empty
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        empty = faiss.IndexScalarQuantizer(index.d, index.sq.qtype, index.metric_type)
+        empty.sq = index.sq
+        empty.is_trained = True
+        return empty
+    if isinstance(index, faiss.IndexPQ):
+        empty = faiss.IndexPQ(index.d, index.pq.M, index.pq.nbits, index.metric_type)
+        empty.pq = index.pq
+        empty.is_trained = True
+        return empty
+    if isinstance(index, faiss.IndexFlat):
+        return faiss.IndexFlat(index.d, index.metric_type)
+    raise ValueError(f"Can't compact a {type(index).__name__} index")
+
+class TombstoneFAISS(FAISS):
+    """LangChain FAISS store with incremental inserts, tombstoned deletes and compaction"""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the store; positions missing from the id mapping are tombstones"""
+        super().__init__(*args, **kwargs)
+        self._deleted = set(range(self.index.ntotal)).difference(self.index_to_docstore_id)
+        self._positions_by_id = {id_: position for position, id_ in self.index_to_docstore_id.items()}
+        self._selector = None
+        self._swap_lock = threading.Lock()
+        # Corpus version the index reflects, recorded in its snapshot; None if unknown
+        self.corpus_version = None
+
+    @classmethod
+    def create(cls, embeddings, index):
+        """Create an empty store over an empty index"""
+        return cls(
+            embedding_function=embeddings,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={}
+        )
+
+    @property
+    def positions_by_id(self):
+        """Map of vector ids to their positions in the index, kept up to date by writes"""
+        return self._positions_by_id
+
+    @property
+    def deleted_count(self):
+        """Number of tombstoned positions still taking space in the index"""
+        return len(self._deleted)
+
+    @property
+    def deleted_ratio(self):
+        """Share of the index taken up by tombstones"""
+        return len(self._deleted) / self.index.ntotal if self.index.ntotal else 0.0
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        """Embed texts and add them to the store"""
+        texts = list(texts)
+        embeddings = self._embed_documents(texts)
+        return self.add_embeddings(list(zip(texts, embeddings)), metadatas=metadatas, ids=ids)
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        """Add texts with precomputed embeddings after the last position in the index"""
+        import faiss
+        text_embeddings = list(text_embeddings)
+        if not text_embeddings:
+            return []
+        texts = [text for text, _ in text_embeddings]
+        vectors = np.asarray([embedding for _, embedding in text_embeddings], dtype=np.float32)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        if len(ids) != len(set(ids)):
+            raise ValueError("Duplicate ids found in the ids list.")
+        metadatas = metadatas or [{} for _ in texts]
+
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+
+        # Positions are never reused, so new vectors go after any tombstones
+        start = self.index.ntotal
+        self.index.add(vectors)
+        self.docstore.add({
+            id_: LangchainDocument(id=id_, page_content=text, metadata=metadata)
+            for id_, text, metadata in zip(ids, texts, metadatas)
+        })
+        self.index_to_docstore_id.update({start + j: id_ for j, id_ in enumerate(ids)})
+        self._positions_by_id.update({id_: start + j for j, id_ in enumerate(ids)})
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        """Delete by id, leaving a tombstone in the index"""
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        missing_ids = set(ids).difference(self._positions_by_id)
+        if missing_ids:
+            raise ValueError(
+                f"Some specified ids do not exist in the current store. Ids not found: {missing_ids}"
+            )
+
+        for id_ in ids:
+            position = self._positions_by_id.pop(id_)
+            del self.index_to_docstore_id[position]
+            self._deleted.add(position)
+        self.docstore.delete(ids)
+        self._selector = None
+        return True
+
+    def _excluded_selector(self):
+        """ID selector that skips tombstoned positions, or None if there are none"""
+        import faiss
+        if not self._deleted:
+            return None
+        if self._selector is None:
+            deleted = faiss.IDSelectorBatch(np.fromiter(self._deleted, dtype=np.int64))
+            self._selector = faiss.IDSelectorNot(deleted)
+            # The Python wrapper doesn't keep the wrapped selector alive by itself
+            self._selector.referenced_selector = deleted
+        return self._selector
+
+    def _search_parameters(self, index, selector):
+        """Search-time parameters for the index, with a selector skipping tombstones"""
+        import faiss
+        params = faiss.SearchParameters()
+        if selector is not None:
+            params.sel = selector
+        return params
+
+    def read_vectors(self, positions, index, index_to_docstore_id):
+        """Read the vectors at some positions of index (whose id mapping is given)"""
+        return index.reconstruct_batch(positions)
+
+    def search_index(self, index, index_to_docstore_id, vector, k, params):
+        """Search index for the k nearest positions to each query row; returns (distances, positions)"""
+        return index.search(vector, k, params=params)
+
+    def _docs_for_hits(self, index_to_docstore_id, scores, positions):
+        """Pair one query's hit positions with their documents, skipping unused and deleted positions"""
+        docs = []
+        for score, position in zip(scores, positions):
+            _id = index_to_docstore_id.get(int(position))
+            if _id is None:
+                # -1 when fewer than k vectors were found
+                continue
+            doc = self.docstore.search(_id)
+            if not isinstance(doc, LangchainDocument):
+                # Deleted since the search started
+                continue
+            docs.append((doc, score))
+        return docs
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        """Return docs most similar to the embedding and their L2 distances, skipping deleted vectors"""
+        import faiss
+        vector = np.array([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vector)
+
+        with self._swap_lock:
+            index, index_to_docstore_id = self.index, self.index_to_docstore_id
+            params = self._search_parameters(index, self._excluded_selector())
+        scores, indices = self.search_index(index, index_to_docstore_id, vector, k if filter is None else fetch_k, params)
+
+        docs = self._docs_for_hits(index_to_docstore_id, scores[0], indices[0])
+        if filter is not None:
+            filter_func = self._create_filter_func(filter)
+            docs = [(doc, score) for doc, score in docs if filter_func(doc.metadata)]
+
+        score_threshold = kwargs.get("score_threshold")
+        if score_threshold is not None:
+            cmp = (
+                operator.ge
+                if self.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD)
+                else operator.le
+            )
+            docs = [(doc, score) for doc, score in docs if cmp(score, score_threshold)]
+        return docs[:k]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4):
+        """Return the docs most similar to each of several embeddings, searching them as one matrix"""
+        import faiss
+        if not len(embeddings):
+            return []
+        vectors = np.array(embeddings, dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+
+        with self._swap_lock:
+            index, index_to_docstore_id = self.index, self.index_to_docstore_id
+            params = self._search_parameters(index, self._excluded_selector())
+        scores, indices = self.search_index(index, index_to_docstore_id, vectors, k, params)
+        return [self._docs_for_hits(index_to_docstore_id, scores[row], indices[row]) for row in range(len(vectors))]
+
+    def begin_compaction(self):
+        """Read the live vectors for a compaction; call while writes are held off
+
+        Returns the state finish_compaction needs: the index being compacted, its
+        size, and the live positions with their vectors.
+        """
+        positions = np.fromiter(sorted(self.index_to_docstore_id), dtype=np.int64, count=len(self.index_to_docstore_id))
+        vectors = self.read_vectors(positions, self.index, self.index_to_docstore_id) if len(positions) else \
+            np.empty((0, self.index.d), dtype=np.float32)
+        return {"index": self.index, "ntotal": self.index.ntotal, "positions": positions, "vectors": vectors}
+
+    def build_compacted_index(self, state):
+        """Build the compacted index from begin_compaction's state; needs no lock"""
+        index = empty_index_like(state["index"])
+        if len(state["vectors"]):
+            index.add(state["vectors"])
+        return index
+
+    def finish_compaction(self, state, index):
+        """Swap in a compacted index; call while writes are held off
+
+        Vectors added since begin_compaction are copied over, and ones deleted since
+        become tombstones in the new index. Returns the number of tombstones
+        removed, or None if the index was replaced in the meantime (e.g. an IVF
+        index was trained) and the compaction was dropped.
+        """
+        if self.index is not state["index"]:
+            return None
+
+        added = np.arange(state["ntotal"], self.index.ntotal, dtype=np.int64)
+        if len(added):
+            index.add(self.read_vectors(added, self.index, self.index_to_docstore_id))
+
+        # A position keeps its id until it is deleted, so the current mapping tells
+        # which of the copied vectors are still live
+        mapping = {}
+        deleted = set()
+        for position, old_position in enumerate(np.concatenate([state["positions"], added]).tolist()):
+            id_ = self.index_to_docstore_id.get(old_position)
+            if id_ is None:
+                deleted.add(position)
+            else:
+                mapping[position] = id_
+
+        positions_by_id = {id_: position for position, id_ in mapping.items()}
+        removed = self.index.ntotal - index.ntotal
+        with self._swap_lock:
+            self.index = index
+            self.index_to_docstore_id = mapping
+            self._positions_by_id = positions_by_id
+            self._deleted = deleted
+            self._selector = None
+        return removed
+
+    def compact(self):
+        """Rebuild the index without its tombstones in one go; returns the number removed"""
+        state = self.begin_compaction()
+        return self.finish_compaction(state, self.build_compacted_index(state))
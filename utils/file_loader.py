@@ -0,0 +1,72 @@
+"""
+File parsing for bulk ingestion.
+
+These functions run inside worker processes, so this module must not import the
+Flask app or the database models.
+"""
+
+import os
+import logging
+
+from utils.text_splitter import get_text_splitter, read_text_blocks, split_text_stream
+
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = ['.txt', '.md', '.csv']
+PDF_EXTENSIONS = ['.pdf']
+WORD_EXTENSIONS = ['.docx', '.doc']
+SUPPORTED_EXTENSIONS = TEXT_EXTENSIONS + PDF_EXTENSIONS + WORD_EXTENSIONS
+
+def get_content_type(file_path):
+    """Get the Document.content_type for a file, or None if it isn't supported"""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in TEXT_EXTENSIONS:
+        return 'text'
+    if extension in PDF_EXTENSIONS:
+        return 'pdf'
+    if extension in WORD_EXTENSIONS:
+        return 'docx'
+    return None
+
+def _load_pages(file_path, content_type):
+    """Yield the page texts of a PDF or Word document"""
+    if content_type == 'pdf':
+        from langchain_community.document_loaders import PyPDFLoader
+        loader = PyPDFLoader(file_path)
+    else:
+        from langchain_community.document_loaders import Docx2txtLoader
+        loader = Docx2txtLoader(file_path)
+    return (page.page_content for page in loader.lazy_load())
+
+def parse_file(file_path):
+    """Parse and split a file
+
+    Returns a dict with the file path, size, content type, chunk texts and
+    an error message (None on success). Errors are reported, not raised, so one
+    bad file doesn't stop a bulk run.
+    """
+    result = {
+        "path": file_path,
+        "size": 0,
+        "content_type": get_content_type(file_path),
+        "chunks": [],
+        "error": None
+    }
+
+    try:
+        result["size"] = os.path.getsize(file_path)
+
+        if result["content_type"] is None:
+            raise ValueError(f"Unsupported file type: {os.path.splitext(file_path)[1]}")
+
+        text_splitter = get_text_splitter()
+        if result["content_type"] == 'text':
+            result["chunks"] = list(split_text_stream(read_text_blocks(file_path), text_splitter))
+        else:
+            # Split each page separately, as the RAG document processors do
+            result["chunks"] = list(text_splitter.split_pages(_load_pages(file_path, result["content_type"])))
+
+    except Exception as e:
+        result["error"] = str(e)
+
+    return result
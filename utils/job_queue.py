@@ -0,0 +1,231 @@
+"""
+Background ingestion job queue.
+
+Uploads are recorded as IngestionJob rows and processed by a local thread pool,
+so HTTP requests return immediately. Because the jobs live in the database they
+survive restarts: queued jobs and jobs orphaned by a dead process are picked up
+again when the queue starts.
+"""
+
+import os
+import socket
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from app import db
+from models import IngestionJob
+from utils.config import (
+    get_ingestion_worker_count,
+    get_ingestion_max_attempts,
+    get_ingestion_job_stale_seconds
+)
+from utils.document_processor import process_document, reingest_document
+
+logger = logging.getLogger(__name__)
+
+# Worker pool and the Flask app it runs jobs for
+_executor = None
+_app = None
+
+def _worker_name():
+    """Identify this process so orphaned jobs can be recognised after a restart"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _is_worker_alive(worker):
+    """Check whether the process that claimed a job is still running on this host"""
+    if not worker or ":" not in worker:
+        return False
+    hostname, pid = worker.rsplit(":", 1)
+    if hostname != socket.gethostname():
+        # We can't check processes on other hosts; rely on the stale timeout instead
+        return True
+    try:
+        os.kill(int(pid), 0)
+        return True
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+
+def init_job_queue(app):
+    """Start the worker pool and resume any jobs left over from a previous run"""
+    global _executor, _app
+    if _executor is not None:
+        return
+
+    _app = app
+    worker_count = get_ingestion_worker_count()
+    _executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="ingestion")
+    logger.info(f"Started ingestion job queue with {worker_count} workers")
+
+    try:
+        _recover_jobs()
+    except Exception as e:
+        logger.error(f"Error recovering ingestion jobs: {str(e)}")
+
+def _recover_jobs():
+    """Requeue jobs that are waiting or whose worker died, and submit them to the pool"""
+    stale_before = datetime.utcnow() - timedelta(seconds=get_ingestion_job_stale_seconds())
+
+    for job in IngestionJob.query.filter_by(status='running').all():
+        if not _is_worker_alive(job.worker) or job.updated_at < stale_before:
+            logger.info(f"Requeueing orphaned ingestion job {job.id}")
+            job.status = 'queued'
+            job.stage = 'queued'
+            job.worker = None
+    db.session.commit()
+
+    queued_ids = [job.id for job in IngestionJob.query.filter_by(status='queued').order_by(IngestionJob.id).all()]
+    for job_id in queued_ids:
+        _submit(job_id)
+
+    if queued_ids:
+        logger.info(f"Resumed {len(queued_ids)} queued ingestion jobs")
+
+def _submit(job_id):
+    """Hand a job to the worker pool"""
+    if _executor is None:
+        raise RuntimeError("Ingestion job queue has not been initialized")
+    _executor.submit(_run_job, job_id)
+
+def enqueue_ingestion(document_id, mode='ingest'):
+    """Create an ingestion job for a document and queue it for processing
+
+    mode is 'ingest' for a new document or 'reingest' for a document whose file
+    was replaced, which only embeds the chunks that changed.
+    """
+    job = IngestionJob(document_id=document_id, mode=mode, status='queued', stage='queued')
+    db.session.add(job)
+    db.session.commit()
+
+    _submit(job.id)
+    logger.info(f"Queued ingestion job {job.id} for document {document_id}")
+    return job
+
+def has_active_job(document_id):
+    """Check whether a document has an ingestion job that is queued or running"""
+    return IngestionJob.query.filter(
+        IngestionJob.document_id == document_id,
+        IngestionJob.status.in_(['queued', 'running'])
+    ).first() is not None
+
+def retry_job(job_id):
+    """Requeue a failed job. Returns the job, or None if it does not exist"""
+    job = IngestionJob.query.get(job_id)
+    if not job:
+        return None
+
+    if job.status != 'failed':
+        raise ValueError(f"Only failed jobs can be retried (job {job_id} is {job.status})")
+
+    job.status = 'queued'
+    job.stage = 'queued'
+    job.error = None
+    job.attempts = 0
+    db.session.commit()
+
+    _submit(job.id)
+    logger.info(f"Retrying ingestion job {job.id}")
+    return job
+
+def _claim_job(job_id):
+    """Atomically move a queued job to running so only one worker processes it"""
+    claimed = IngestionJob.query.filter_by(id=job_id, status='queued').update({
+        'status': 'running',
+        'stage': 'starting',
+        'worker': _worker_name(),
+        'attempts': IngestionJob.attempts + 1,
+        'updated_at': datetime.utcnow()
+    })
+    db.session.commit()
+    return claimed == 1
+
+def _update_progress(job_id, stage, chunks_done, chunks_total):
+    """Record job progress"""
+    IngestionJob.query.filter_by(id=job_id).update({
+        'stage': stage,
+        'chunks_done': chunks_done,
+        'chunks_total': chunks_total,
+        'updated_at': datetime.utcnow()
+    })
+    db.session.commit()
+
+def _run_job(job_id):
+    """Run a single ingestion job in a worker thread"""
+    with _app.app_context():
+        try:
+            if not _claim_job(job_id):
+                logger.debug(f"Ingestion job {job_id} was already claimed")
+                return
+
+            job = IngestionJob.query.get(job_id)
+            document = job.document
+
+            if document is not None and document.processed:
+                # A previous attempt committed but died before recording it
+                job.status = 'completed'
+                job.stage = 'completed'
+                db.session.commit()
+                return
+
+            ingest = reingest_document if job.mode == 'reingest' else process_document
+            stats = ingest(
+                job.document_id,
+                progress_callback=lambda stage, done, total: _update_progress(job_id, stage, done, total),
+                raise_errors=True
+            )
+
+            job = IngestionJob.query.get(job_id)
+            if job.mode == 'reingest':
+                job.chunks_reused = stats['chunks_reused']
+                job.chunks_added = stats['chunks_added']
+                job.chunks_deleted = stats['chunks_deleted']
+            job.status = 'completed'
+            job.stage = 'completed'
+            job.error = None
+            db.session.commit()
+            logger.info(f"Ingestion job {job_id} completed")
+
+        except Exception as e:
+            db.session.rollback()
+            job = IngestionJob.query.get(job_id)
+            if job is None:
+                return
+
+            job.error = str(e)
+            job.worker = None
+            if job.attempts < get_ingestion_max_attempts():
+                logger.warning(f"Ingestion job {job_id} failed (attempt {job.attempts}), retrying: {str(e)}")
+                job.status = 'queued'
+                job.stage = 'queued'
+                db.session.commit()
+                _submit(job_id)
+            else:
+                logger.error(f"Ingestion job {job_id} failed after {job.attempts} attempts: {str(e)}")
+                job.status = 'failed'
+                job.stage = 'failed'
+                db.session.commit()
+
+def job_to_dict(job):
+    """Serialize a job for the API"""
+    job_data = {
+        'id': job.id,
+        'document_id': job.document_id,
+        'mode': job.mode or 'ingest',
+        'status': job.status,
+        'stage': job.stage,
+        'chunks_done': job.chunks_done or 0,
+        'chunks_total': job.chunks_total or 0,
+        'attempts': job.attempts or 0,
+        'error': job.error,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else None,
+        'updated_at': job.updated_at.strftime('%Y-%m-%d %H:%M:%S') if job.updated_at else None
+    }
+    if job.mode == 'reingest':
+        job_data['diff'] = {
+            'chunks_reused': job.chunks_reused or 0,
+            'chunks_added': job.chunks_added or 0,
+            'chunks_deleted': job.chunks_deleted or 0
+        }
+    return job_data
@@ -0,0 +1,547 @@
+"""
+BM25 inverted index over chunk text.
+
+Embedding search often misses exact terms such as HS codes, SKUs, region and
+certification names. This index finds them by the terms themselves. Text is
+lowercased and split into terms. A term joined by dots, dashes, underscores or
+slashes (0902.10, AB-1234) is indexed whole and also as each of its parts. Like
+the vector store, the index holds one document per vector id, so chunks with the
+same content share an entry. Each entry keeps the content hash of its text.
+
+Posting lists are compact. For every term they hold the positions of the
+documents that contain it (uint32) and the term's count in each (uint16). All
+terms share two flat arrays, and an offsets array marks where each term's list
+starts. Documents added since the last merge go to small per-term tails, so an
+add never rewrites the large arrays. The tails are merged in linear time when
+the index is saved, and the same merge drops deleted documents, which searches
+skip until then.
+
+The index is saved to LEXICAL_INDEX_DIR along with the corpus version it
+reflects. When the database's corpus version differs, the index is caught up by
+adding and removing the vectors that differ, by id or by content hash. That happens when another process
+ingested or deleted chunks, or when a change was missed here.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from utils.config import get_search_mode, get_lexical_index_dir, get_faiss_snapshot_interval
+from utils.vector_store import (
+    _iter_vector_rows,
+    _get_vector_hashes,
+    _changed_vector_ids,
+    _load_vector_documents,
+    _restrict_to_documents,
+    batched,
+    VECTOR_ROW_BATCH_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+VOCABULARY_FILE = "vocabulary.json"
+DOCUMENTS_FILE = "documents.json"
+HASHES_FILE = "hashes.json"
+OFFSETS_FILE = "offsets.i64"
+POSTINGS_FILE = "postings.u32"
+FREQUENCIES_FILE = "frequencies.u16"
+LENGTHS_FILE = "lengths.u32"
+
+# Bumped when the saved layout or the tokenizer changes, so older indexes are rebuilt
+# (version 2 added content hashes)
+INDEX_VERSION = 2
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Counts of a term in one document are capped at what a posting can hold
+MAX_TERM_FREQUENCY = np.iinfo(np.uint16).max
+
+# Bytes of one posting: a uint32 document position and a uint16 term frequency
+POSTING_BYTES = 6
+
+# Words too common to help find anything
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+_TOKEN_PATTERN = re.compile(r"\w+(?:[.\-/]\w+)*")
+_PART_PATTERN = re.compile(r"[._\-/]")
+
+def tokenize(text):
+    """Split text into lowercase index terms; a compound term is followed by its parts"""
+    terms = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        if token in STOP_WORDS:
+            continue
+        terms.append(token)
+        parts = _PART_PATTERN.split(token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in STOP_WORDS)
+    return terms
+
+class LexicalIndex:
+    """BM25 index of texts keyed by vector id, with compact posting lists
+
+    Writes take the lock. A search copies what it needs under the lock and
+    scores outside it. Merges replace the arrays rather than modifying them, so
+    a search that has started keeps reading a consistent set.
+    """
+
+    def __init__(self):
+        """Create an empty index"""
+        self.corpus_version = None
+        self._lock = threading.Lock()
+        # Term ids are positions in the vocabulary
+        self._terms = {}
+        self._vocabulary = []
+        # Merged posting lists: those of term t are postings[offsets[t]:offsets[t + 1]]
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._postings = np.zeros(0, dtype=np.uint32)
+        self._frequencies = np.zeros(0, dtype=np.uint16)
+        # Postings added since the last merge, per term id
+        self._tails = {}
+        # Documents by position; rows 0..size-1 of the arrays are in use
+        self._doc_ids = []
+        self._hashes = []
+        self._positions = {}
+        self._lengths = np.zeros(0, dtype=np.uint32)
+        self._deleted = np.zeros(0, dtype=bool)
+        self._size = 0
+        self._total_length = 0
+        self._deleted_count = 0
+
+    def __len__(self):
+        """Number of documents in the index, not counting deleted ones"""
+        return len(self._positions)
+
+    def _advance(self, corpus_version):
+        """Record that the index reflects corpus_version if it reflected the version before it
+
+        Versions are assigned in commit order, so a change that skips ahead
+        leaves the index on its older version, to be caught up when next used.
+        """
+        if corpus_version is not None and self.corpus_version is not None and self.corpus_version == corpus_version - 1:
+            self.corpus_version = corpus_version
+
+    def _grow(self, size):
+        """Make room for size documents, doubling the per-document arrays"""
+        if size <= len(self._lengths):
+            return
+        capacity = max(size, 2 * len(self._lengths), 1024)
+        lengths = np.zeros(capacity, dtype=np.uint32)
+        lengths[:self._size] = self._lengths[:self._size]
+        deleted = np.zeros(capacity, dtype=bool)
+        deleted[:self._size] = self._deleted[:self._size]
+        self._lengths, self._deleted = lengths, deleted
+
+    def content_hashes(self):
+        """Map the vector ids in the index onto the content hashes of their texts (None where unknown)"""
+        with self._lock:
+            return {vector_id: self._hashes[position] for vector_id, position in self._positions.items()}
+
+    def add(self, vector_ids, texts, corpus_version=None, content_hashes=None):
+        """Index texts under their vector ids
+
+        An id already in the index is skipped, unless content_hashes gives it a
+        hash other than the one it was indexed with: then its entry is replaced.
+        corpus_version, if given, is the version of the corpus these texts were
+        committed in. Returns the number of documents added.
+        """
+        if content_hashes is None:
+            content_hashes = [None] * len(vector_ids)
+        # Tokenized before taking the lock, so searches aren't held up
+        documents = [
+            (str(vector_id), content_hash, Counter(tokenize(text)))
+            for vector_id, text, content_hash in zip(vector_ids, texts, content_hashes) if text
+        ]
+        with self._lock:
+            added = 0
+            for vector_id, content_hash, counts in documents:
+                if vector_id in self._positions:
+                    if content_hash is None or self._hashes[self._positions[vector_id]] == content_hash:
+                        continue
+                    self._delete(vector_id)
+                position = self._size
+                self._grow(position + 1)
+                for term, count in counts.items():
+                    term_id = self._terms.get(term)
+                    if term_id is None:
+                        term_id = self._terms[term] = len(self._vocabulary)
+                        self._vocabulary.append(term)
+                    tail = self._tails.get(term_id)
+                    if tail is None:
+                        tail = self._tails[term_id] = (array('I'), array('H'))
+                    tail[0].append(position)
+                    tail[1].append(min(count, MAX_TERM_FREQUENCY))
+                length = sum(counts.values())
+                self._lengths[position] = length
+                self._doc_ids.append(vector_id)
+                self._hashes.append(content_hash)
+                self._positions[vector_id] = position
+                self._size += 1
+                self._total_length += length
+                added += 1
+            self._advance(corpus_version)
+            return added
+
+    def delete(self, vector_ids, corpus_version=None):
+        """Remove documents by vector id; ids not in the index are ignored
+
+        corpus_version is as for add. Returns the number of documents removed.
+        """
+        with self._lock:
+            removed = sum(self._delete(str(vector_id)) for vector_id in vector_ids)
+            self._advance(corpus_version)
+            return removed
+
+    def _delete(self, vector_id):
+        """Mark a document deleted; returns False if it isn't in the index. Call with the lock held"""
+        position = self._positions.pop(vector_id, None)
+        if position is None:
+            return False
+        self._deleted[position] = True
+        self._total_length -= int(self._lengths[position])
+        self._deleted_count += 1
+        return True
+
+    def _merge(self):
+        """Fold the tails into the merged posting lists and drop deleted documents; call with the lock held"""
+        offsets, postings, frequencies = self._offsets, self._postings, self._frequencies
+        term_count = len(self._vocabulary)
+        merged_terms = len(offsets) - 1
+        counts = np.zeros(term_count, dtype=np.int64)
+        counts[:merged_terms] = np.diff(offsets)
+
+        if self._tails:
+            tail_term_ids = sorted(self._tails)
+            tails = [self._tails[term_id] for term_id in tail_term_ids]
+            tail_terms = np.repeat(np.array(tail_term_ids, dtype=np.int64), [len(documents) for documents, _ in tails])
+            # A tail's documents come after its term's merged ones; a new term's list goes at the end
+            insert_at = offsets[np.minimum(tail_terms + 1, merged_terms)]
+            tail_postings = np.concatenate([np.array(documents, dtype=np.uint32) for documents, _ in tails])
+            tail_frequencies = np.concatenate([np.array(term_counts, dtype=np.uint16) for _, term_counts in tails])
+            postings = np.insert(postings, insert_at, tail_postings)
+            frequencies = np.insert(frequencies, insert_at, tail_frequencies)
+            counts += np.bincount(tail_terms, minlength=term_count)
+            self._tails = {}
+
+        if self._deleted_count:
+            live = ~self._deleted[:self._size]
+            new_positions = np.cumsum(live) - 1
+            posting_terms = np.repeat(np.arange(term_count), counts)
+            keep = live[postings]
+            postings = new_positions[postings[keep]].astype(np.uint32)
+            frequencies = frequencies[keep]
+            counts = np.bincount(posting_terms[keep], minlength=term_count)
+
+            # Terms no document holds any more leave the vocabulary
+            used = counts > 0
+            self._vocabulary = [term for term, in_use in zip(self._vocabulary, used) if in_use]
+            self._terms = {term: term_id for term_id, term in enumerate(self._vocabulary)}
+            counts = counts[used]
+
+            self._doc_ids = [self._doc_ids[position] for position in np.flatnonzero(live)]
+            self._hashes = [self._hashes[position] for position in np.flatnonzero(live)]
+            self._positions = {vector_id: position for position, vector_id in enumerate(self._doc_ids)}
+            self._lengths = self._lengths[:self._size][live]
+            self._deleted = np.zeros(len(self._doc_ids), dtype=bool)
+            self._size = len(self._doc_ids)
+            self._deleted_count = 0
+
+        self._offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._postings, self._frequencies = postings, frequencies
+
+    def search(self, query, k, allowed_vector_ids=None):
+        """Return the k best BM25 matches of a query as (vector id, score), best first
+
+        With allowed_vector_ids only those documents are ranked. Documents that
+        share no term with the query are never returned.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            document_count = len(self._positions)
+            if not terms or not document_count:
+                return []
+            offsets, postings, frequencies = self._offsets, self._postings, self._frequencies
+            lengths, deleted, doc_ids, size = self._lengths, self._deleted, self._doc_ids, self._size
+            average_length = max(self._total_length / document_count, 1.0)
+            term_postings = []
+            for term in terms:
+                term_id = self._terms.get(term)
+                if term_id is None:
+                    continue
+                tail = self._tails.get(term_id)
+                if tail is not None:
+                    tail = (np.array(tail[0], dtype=np.uint32), np.array(tail[1], dtype=np.uint16))
+                term_postings.append((term_id, tail))
+            allowed = None
+            if allowed_vector_ids is not None:
+                positions = self._positions
+                allowed = np.fromiter(
+                    (positions[vector_id] for vector_id in allowed_vector_ids if vector_id in positions), dtype=np.int64
+                )
+
+        merged_terms = len(offsets) - 1
+        scores = np.zeros(size, dtype=np.float32)
+        for term_id, tail in term_postings:
+            if term_id < merged_terms:
+                documents = postings[offsets[term_id]:offsets[term_id + 1]]
+                counts = frequencies[offsets[term_id]:offsets[term_id + 1]]
+                if tail is not None:
+                    documents, counts = np.concatenate([documents, tail[0]]), np.concatenate([counts, tail[1]])
+            else:
+                documents, counts = tail
+            live = ~deleted[documents]
+            documents, counts = documents[live], counts[live].astype(np.float32)
+            if not len(documents):
+                continue
+            idf = math.log(1 + (document_count - len(documents) + 0.5) / (len(documents) + 0.5))
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths[documents].astype(np.float32) / average_length)
+            scores[documents] += idf * counts * (BM25_K1 + 1) / (counts + norms)
+
+        candidates = np.flatnonzero(scores) if allowed is None else allowed[scores[allowed] > 0]
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(doc_ids[position], float(scores[position])) for position in candidates]
+
+    def get_stats(self):
+        """Get document, term and posting counts and the size of the posting lists"""
+        with self._lock:
+            postings = len(self._postings) + sum(len(documents) for documents, _ in self._tails.values())
+            return {
+                "documents": len(self._positions),
+                "deleted_documents": self._deleted_count,
+                "terms": len(self._vocabulary),
+                "postings": postings,
+                "index_bytes": postings * POSTING_BYTES + self._offsets.nbytes + self._size * self._lengths.itemsize,
+                "corpus_version": self.corpus_version
+            }
+
+    def save(self, directory):
+        """Merge the index and write it to a directory, replacing the saved one only once it is complete"""
+        with self._lock:
+            self._merge()
+            vocabulary, doc_ids, hashes = list(self._vocabulary), list(self._doc_ids), list(self._hashes)
+            offsets, postings, frequencies = self._offsets, self._postings, self._frequencies
+            lengths = self._lengths[:self._size]
+            corpus_version = self.corpus_version
+
+        directory = os.path.abspath(directory)
+        parent = os.path.dirname(directory)
+        os.makedirs(parent, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=".lexical_index_", dir=parent)
+        try:
+            for name, values in ((OFFSETS_FILE, offsets), (POSTINGS_FILE, postings),
+                                 (FREQUENCIES_FILE, frequencies), (LENGTHS_FILE, lengths)):
+                values.tofile(os.path.join(temp_dir, name))
+            for name, values in ((VOCABULARY_FILE, vocabulary), (DOCUMENTS_FILE, doc_ids), (HASHES_FILE, hashes)):
+                with open(os.path.join(temp_dir, name), 'w') as f:
+                    json.dump(values, f)
+            with open(os.path.join(temp_dir, MANIFEST_FILE), 'w') as f:
+                json.dump({
+                    "version": INDEX_VERSION,
+                    "corpus_version": corpus_version,
+                    "documents": len(doc_ids),
+                    "terms": len(vocabulary),
+                    "postings": len(postings),
+                    "saved_at": time.time()
+                }, f)
+
+            old_dir = None
+            if os.path.exists(directory):
+                old_dir = f"{temp_dir}.old"
+                os.rename(directory, old_dir)
+            os.rename(temp_dir, directory)
+            if old_dir:
+                shutil.rmtree(old_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, directory):
+        """Load an index saved to a directory, or return None if there is no usable one"""
+        manifest_path = os.path.join(directory, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get("version") != INDEX_VERSION:
+            logger.info(f"Ignoring lexical index with version {manifest.get('version')}")
+            return None
+
+        index = cls()
+        with open(os.path.join(directory, VOCABULARY_FILE), 'r') as f:
+            index._vocabulary = json.load(f)
+        with open(os.path.join(directory, DOCUMENTS_FILE), 'r') as f:
+            index._doc_ids = json.load(f)
+        with open(os.path.join(directory, HASHES_FILE), 'r') as f:
+            index._hashes = json.load(f)
+        index._offsets = np.fromfile(os.path.join(directory, OFFSETS_FILE), dtype=np.int64)
+        index._postings = np.fromfile(os.path.join(directory, POSTINGS_FILE), dtype=np.uint32)
+        index._frequencies = np.fromfile(os.path.join(directory, FREQUENCIES_FILE), dtype=np.uint16)
+        index._lengths = np.fromfile(os.path.join(directory, LENGTHS_FILE), dtype=np.uint32)
+        if (len(index._offsets) != len(index._vocabulary) + 1 or index._offsets[-1] != len(index._postings)
+                or len(index._frequencies) != len(index._postings) or len(index._lengths) != len(index._doc_ids)
+                or len(index._hashes) != len(index._doc_ids)):
+            logger.warning("Lexical index files are inconsistent with each other, ignoring them")
+            return None
+
+        index._terms = {term: term_id for term_id, term in enumerate(index._vocabulary)}
+        index._positions = {vector_id: position for position, vector_id in enumerate(index._doc_ids)}
+        index._deleted = np.zeros(len(index._doc_ids), dtype=bool)
+        index._size = len(index._doc_ids)
+        index._total_length = int(index._lengths.sum())
+        index.corpus_version = manifest.get("corpus_version")
+        return index
+
+# Singleton pattern so every search in the process shares one index
+_lexical_index = None
+_lexical_index_lock = threading.Lock()
+_save_lock = threading.Lock()
+_last_save_time = 0.0
+
+def _load_lexical_index():
+    """Load the saved lexical index, or start an empty one"""
+    start_time = time.perf_counter()
+    try:
+        index = LexicalIndex.load(get_lexical_index_dir())
+        if index is not None:
+            logger.info(f"Loaded lexical index with {len(index)} documents in {time.perf_counter() - start_time:.2f}s")
+            return index
+    except Exception as e:
+        logger.error(f"Error loading lexical index: {str(e)}")
+    return LexicalIndex()
+
+def _catch_up(index, corpus_version):
+    """Bring an index up to date with the database
+
+    Vectors it lacks are added, those no chunk refers to are removed, and those
+    indexed with another content hash than their chunk's are indexed again.
+    """
+    start_time = time.perf_counter()
+    stored_hashes = index.content_hashes()
+    database_hashes = _get_vector_hashes()
+    changed_ids = _changed_vector_ids(stored_hashes, database_hashes)
+    removed = index.delete(set(stored_hashes) - set(database_hashes))
+    missing_ids = (set(database_hashes) - set(stored_hashes)) | changed_ids
+    added = 0
+    if missing_ids:
+        # An empty index streams every chunk rather than looking the ids up in batches
+        rows = _iter_vector_rows(missing_ids) if stored_hashes else _iter_vector_rows()
+        for batch in batched(rows, VECTOR_ROW_BATCH_SIZE):
+            vector_ids, texts, metadatas = zip(*batch)
+            added += index.add(vector_ids, texts, content_hashes=[metadata["content_hash"] for metadata in metadatas])
+    index.corpus_version = corpus_version
+    logger.info(
+        f"Caught the lexical index up with corpus version {corpus_version} ({added} documents added, "
+        f"{len(changed_ids)} of them replacing changed ones, {removed} removed) in {time.perf_counter() - start_time:.2f}s"
+    )
+    return added + removed
+
+def get_lexical_index():
+    """Get the lexical index, loaded from LEXICAL_INDEX_DIR and caught up with the database if the corpus changed"""
+    global _lexical_index
+    from utils.document_processor import get_corpus_version
+    corpus_version = get_corpus_version()
+    with _lexical_index_lock:
+        loaded = _lexical_index is None
+        if loaded:
+            _lexical_index = _load_lexical_index()
+        index = _lexical_index
+        changed = index.corpus_version != corpus_version and _catch_up(index, corpus_version)
+    if changed:
+        # Saved straight away after a load, so the next start has less to catch up on
+        save_lexical_index(force=loaded)
+    return index
+
+def _get_lexical_index_for_write():
+    """The lexical index to apply a committed change to, loading it if this process hasn't yet
+
+    A loaded index isn't caught up first: the change itself moves it to the new
+    corpus version if it was on the one before.
+    """
+    index = _lexical_index
+    return index if index is not None else get_lexical_index()
+
+def add_to_lexical_index(vector_ids, texts, corpus_version=None, content_hashes=None):
+    """Index the texts of newly committed vectors, with the content hashes of the texts
+
+    corpus_version is the version the commit moved the corpus to. Nothing is
+    done in vector search mode. A failure is logged rather than raised: the index
+    is caught up with the database when it is next used.
+    """
+    if get_search_mode() == "vector":
+        return
+    try:
+        _get_lexical_index_for_write().add(vector_ids, texts, corpus_version, content_hashes)
+    except Exception as e:
+        logger.error(f"Error adding to lexical index: {str(e)}")
+
+def delete_from_lexical_index(vector_ids, corpus_version=None):
+    """Remove deleted vectors from the lexical index (see add_to_lexical_index)"""
+    if get_search_mode() == "vector":
+        return
+    try:
+        _get_lexical_index_for_write().delete(vector_ids, corpus_version)
+    except Exception as e:
+        logger.error(f"Error deleting from lexical index: {str(e)}")
+
+def save_lexical_index(force=False):
+    """Save the lexical index to LEXICAL_INDEX_DIR
+
+    Like the FAISS snapshot, this is called after each committed write batch and,
+    unless forced, skipped when the last save was less than
+    FAISS_SNAPSHOT_INTERVAL_SECONDS ago. Returns True if the index was saved.
+    """
+    global _last_save_time
+    index = _lexical_index
+    if index is None:
+        return False
+
+    try:
+        with _save_lock:
+            if not force and time.monotonic() - _last_save_time < get_faiss_snapshot_interval():
+                return False
+            index.save(get_lexical_index_dir())
+            _last_save_time = time.monotonic()
+        return True
+    except Exception as e:
+        # The index can always be rebuilt from the database, so this must not fail the write
+        logger.error(f"Error saving lexical index: {str(e)}")
+        return False
+
+def lexical_results(hit_lists, search_filter=None):
+    """Turn lists of lexical index hits into lists of (document, score) results, reading the chunks once
+
+    Hits whose chunks have been deleted are skipped. With a search filter (see
+    utils.search_filter) each hit is reported as its chunk in a matching document.
+    """
+    documents = _load_vector_documents({vector_id for hits in hit_lists for vector_id, _ in hits})
+    result_lists = []
+    for hits in hit_lists:
+        results = [(documents[vector_id], score) for vector_id, score in hits if vector_id in documents]
+        result_lists.append(_restrict_to_documents(results, search_filter) if search_filter else results)
+    return result_lists
+
+def get_lexical_index_stats():
+    """Report the lexical index's size, or that this process hasn't loaded it"""
+    index = _lexical_index
+    stats = {"loaded": index is not None}
+    if index is not None:
+        stats.update(index.get_stats())
+    return stats
@@ -0,0 +1,313 @@
+"""
+Incremental sync of chunk vectors to Pinecone.
+
+Vectors are upserted under their stable vector id (the id of the first chunk with
+their content), so sending one again overwrites it instead of adding a duplicate.
+A high-water mark per index and embedding model records the highest chunk id whose
+vector is known to be in the index. A vector belongs to the lowest-id chunk still
+referring to it, which is a later copy of its content once the chunk it was stored
+for is deleted. A sync sends only the vectors of chunks above the mark, in parallel batches, and raises the mark as batches complete in
+order, so an interrupted sync resumes where it stopped. This relies on chunk ids
+never being handed out twice (see utils.db_schema): a reused id at or below the
+mark would never be sent again.
+
+Deleting chunks logs the vectors no chunk refers to any more in the
+vector_deletion table, and every sync deletes those logged since its target's
+deletion mark, so vectors deleted while another store was active are removed
+too. A full sync, and the first sync to a target, also lists the ids in the
+index and deletes the vectors no chunk refers to.
+
+Chunks indexed while Pinecone is the active store are upserted as they are added,
+and the mark is moved past them once they are committed, if no other chunk lies
+between it and them.
+"""
+
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import func
+
+from app import db
+from models import Document, DocumentChunk, VectorDeletion, VectorSyncState
+from utils.config import get_pinecone_index_host, get_pinecone_sync_batch_size, get_pinecone_sync_workers, PINECONE_INDEX_NAME
+from utils.embedding import get_embedding_signature
+from utils.vector_file import load_or_embed_vectors
+from utils.vector_store import _has_vector_id, _iter_vector_rows, _is_first_chunk_of_vector, _upsert_pinecone, batched
+
+logger = logging.getLogger(__name__)
+
+# Seconds between saves of the high-water mark during a long sync
+HIGH_WATER_MARK_SAVE_INTERVAL = 5
+
+# Chunk ids read from the database at a time during a sync
+SYNC_WINDOW_CHUNKS = 10000
+
+# Logged vector deletions sent to Pinecone at a time (its limit per delete request)
+DELETION_BATCH_SIZE = 1000
+
+# Bumped when the metadata upserted with each vector changes, which makes the sync
+# target new and so sends every vector again (version 2 added vector_id; version 3
+# resends vectors synced while chunk ids could be reused, which may be another chunk's)
+METADATA_VERSION = 3
+
+def get_sync_target():
+    """Name the index, embedding model and metadata version the vectors are synced to"""
+    return f"pinecone:{get_pinecone_index_host() or PINECONE_INDEX_NAME}:{get_embedding_signature()}:m{METADATA_VERSION}"
+
+def get_high_water_mark(target=None):
+    """Get the highest chunk id whose vector has been synced to the target"""
+    state = VectorSyncState.query.filter_by(target=target or get_sync_target()).first()
+    return state.high_water_mark if state else 0
+
+def _get_or_create_sync_state(target):
+    """Get the target's sync state, adding a fresh one to the session if there is none"""
+    state = VectorSyncState.query.filter_by(target=target).first()
+    if state is None:
+        state = VectorSyncState(target=target, high_water_mark=0, vectors_synced=0, deletion_mark=0)
+        db.session.add(state)
+    return state
+
+def _save_high_water_mark(target, chunk_id, vectors_synced=0):
+    """Raise the target's high-water mark to chunk_id (it never moves down)"""
+    state = _get_or_create_sync_state(target)
+    state.high_water_mark = max(state.high_water_mark or 0, chunk_id)
+    state.vectors_synced = (state.vectors_synced or 0) + vectors_synced
+    state.synced_at = datetime.utcnow()
+    db.session.commit()
+
+def _save_deletion_mark(target, deletion_id):
+    """Record that logged vector deletions up to deletion_id are applied to the target"""
+    state = _get_or_create_sync_state(target)
+    state.deletion_mark = max(state.deletion_mark or 0, deletion_id)
+    db.session.commit()
+
+def advance_high_water_mark(chunk_ids):
+    """Record that vectors of the chunks just committed are in Pinecone
+
+    Called after chunks indexed straight into Pinecone are committed. The mark
+    only moves if every chunk between it and these is one of them: chunks
+    committed by another process (the bulk ingest CLI, or one not using
+    Pinecone) or missed by a failed sync stay above it for the next sync to
+    send. A failure is logged rather than raised: the next sync sends those
+    vectors again.
+    """
+    try:
+        target = get_sync_target()
+        high_water_mark = get_high_water_mark(target)
+        max_chunk_id = max(chunk_ids)
+        chunks_between = db.session.query(func.count(DocumentChunk.id)).filter(
+            DocumentChunk.id > high_water_mark,
+            DocumentChunk.id <= max_chunk_id
+        ).scalar()
+        if chunks_between != sum(1 for chunk_id in chunk_ids if chunk_id > high_water_mark):
+            return
+        _save_high_water_mark(target, max_chunk_id)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error saving Pinecone sync high-water mark: {str(e)}")
+
+def _pending_vector_query(after_chunk_id, up_to_chunk_id):
+    """Query of the chunks in a range that are the first to refer to their vector"""
+    return db.session.query(DocumentChunk.id).filter(
+        DocumentChunk.id > after_chunk_id,
+        DocumentChunk.id <= up_to_chunk_id,
+        _is_first_chunk_of_vector()
+    )
+
+def get_sync_status(target=None):
+    """Report how far the target lags behind the database"""
+    target = target or get_sync_target()
+    state = VectorSyncState.query.filter_by(target=target).first()
+    high_water_mark = state.high_water_mark if state else 0
+    deletion_mark = (state.deletion_mark or 0) if state else 0
+    max_chunk_id = db.session.query(func.max(DocumentChunk.id)).scalar() or 0
+
+    pending_vectors = _pending_vector_query(high_water_mark, max_chunk_id).count()
+    # Age of the oldest document with chunks waiting to be synced
+    oldest_pending = db.session.query(func.min(Document.upload_date))\
+        .join(DocumentChunk, DocumentChunk.document_id == Document.id)\
+        .filter(DocumentChunk.id > high_water_mark)\
+        .scalar()
+    return {
+        "target": target,
+        "high_water_mark": high_water_mark,
+        "max_chunk_id": max_chunk_id,
+        "pending_chunks": db.session.query(func.count(DocumentChunk.id)).filter(DocumentChunk.id > high_water_mark).scalar(),
+        "pending_vectors": pending_vectors,
+        "deletion_mark": deletion_mark,
+        "pending_deletions": db.session.query(func.count(VectorDeletion.id)).filter(VectorDeletion.id > deletion_mark).scalar(),
+        "lag_seconds": round((datetime.utcnow() - oldest_pending).total_seconds(), 1) if oldest_pending else 0,
+        "vectors_synced": state.vectors_synced if state else 0,
+        "synced_at": state.synced_at.isoformat() if state and state.synced_at else None
+    }
+
+def _find_orphaned_vectors(vector_store, up_to_chunk_id):
+    """Ids of the vectors in Pinecone that no chunk refers to, or None if the index can't list them
+
+    Vectors of chunks above up_to_chunk_id may be upserted before their chunks
+    are committed, so their ids are left alone. Only serverless indexes can
+    list their ids.
+    """
+    namespace = {"namespace": vector_store._namespace} if vector_store._namespace else {}
+    orphaned = []
+    try:
+        for page in vector_store._index.list(**namespace):
+            # Older clients yield lists of ids, newer ones pages of vectors
+            vector_ids = [getattr(vector, "id", vector) for vector in getattr(page, "vectors", page)]
+            known_ids = {
+                row[0] for row in db.session.query(DocumentChunk.vector_id).filter(_has_vector_id(vector_ids)).distinct()
+            }
+            orphaned.extend(
+                vector_id for vector_id in vector_ids
+                if vector_id not in known_ids and not (vector_id.isdigit() and int(vector_id) > up_to_chunk_id)
+            )
+    except Exception as e:
+        logger.warning(f"Could not list the vectors in Pinecone, so orphaned ones were not looked for: {str(e)}")
+        return None
+    return orphaned
+
+def _apply_deletions(vector_store, target, deletion_mark):
+    """Delete the vectors logged as deleted since deletion_mark from Pinecone; returns how many
+
+    The mark is saved after each batch, so an interrupted sync resumes there.
+    Ids Pinecone doesn't hold are ignored.
+    """
+    applied = 0
+    while True:
+        rows = db.session.query(VectorDeletion.id, VectorDeletion.vector_id)\
+            .filter(VectorDeletion.id > deletion_mark)\
+            .order_by(VectorDeletion.id)\
+            .limit(DELETION_BATCH_SIZE)\
+            .all()
+        if not rows:
+            return applied
+        vector_store.delete(ids=[vector_id for _, vector_id in rows], namespace=vector_store._namespace)
+        deletion_mark = rows[-1][0]
+        _save_deletion_mark(target, deletion_mark)
+        applied += len(rows)
+
+def _send_batch(vector_store, batch):
+    """Upsert one batch of vector rows, reading stored vectors and embedding the rest"""
+    vector_ids, texts, metadatas = zip(*batch)
+    vectors, embedded = load_or_embed_vectors(vector_ids, texts, [metadata["content_hash"] for metadata in metadatas])
+    _upsert_pinecone(vector_store, vector_ids, texts, vectors, metadatas)
+    return len(batch), embedded
+
+def _iter_batches(after_chunk_id, up_to_chunk_id, batch_size):
+    """Yield (chunk id synced through, batch of vector rows) for the vectors of a chunk range
+
+    Each window of chunk ids is read in full before its batches are yielded, so no
+    query is open while the high-water mark is saved.
+    """
+    for window_start in range(after_chunk_id, up_to_chunk_id, SYNC_WINDOW_CHUNKS):
+        window_end = min(window_start + SYNC_WINDOW_CHUNKS, up_to_chunk_id)
+        batches = list(batched(_iter_vector_rows(chunk_id_range=(window_start, window_end)), batch_size))
+        for position, batch in enumerate(batches):
+            # Once the window's last batch is in, so are the vectors of all its chunks
+            yield window_end if position == len(batches) - 1 else batch[-1][2]["chunk_id"], batch
+
+def sync_pinecone(vector_store, dry_run=False, full=False, batch_size=None, workers=None):
+    """Send the vectors Pinecone is missing, in parallel batches
+
+    Only vectors belonging to chunks above the high-water mark are sent (all of
+    them with full). Vectors logged as deleted since the target's deletion mark
+    are deleted first and, with full or if nothing was synced to the target yet,
+    so are any other vectors in the index that no chunk refers to. With dry_run
+    nothing is sent or deleted. Returns a report with the pending work, what was
+    sent and deleted, throughput and lag.
+    """
+    target = get_sync_target()
+    batch_size = batch_size or get_pinecone_sync_batch_size()
+    workers = workers or get_pinecone_sync_workers()
+
+    status = get_sync_status(target)
+    start_mark = 0 if full else status["high_water_mark"]
+    # Chunks committed after this point are left for the next sync
+    end_mark = status["max_chunk_id"]
+    pending_vectors = status["pending_vectors"] if not full else _pending_vector_query(0, end_mark).count()
+    report = {
+        "target": target,
+        "dry_run": dry_run,
+        "full": full,
+        "previous_high_water_mark": status["high_water_mark"],
+        "high_water_mark": status["high_water_mark"],
+        "max_chunk_id": end_mark,
+        "pending_vectors": pending_vectors,
+        "lag_seconds": status["lag_seconds"],
+        "pending_deletions": status["pending_deletions"],
+        "deletions_applied": 0,
+        "orphaned": None,
+        "deleted": 0,
+        "upserted": 0,
+        "embedded": 0,
+        "batches": 0,
+        "elapsed_seconds": 0.0,
+        "vectors_per_second": 0.0
+    }
+    if status["pending_deletions"] and not dry_run:
+        report["deletions_applied"] = _apply_deletions(vector_store, target, status["deletion_mark"])
+        logger.info(f"Applied {report['deletions_applied']} logged vector deletions to {target}")
+
+    if full or not status["high_water_mark"]:
+        orphaned = _find_orphaned_vectors(vector_store, end_mark)
+        if orphaned is not None:
+            report["orphaned"] = len(orphaned)
+            if orphaned and not dry_run:
+                vector_store.delete(ids=orphaned, namespace=vector_store._namespace)
+                report["deleted"] = len(orphaned)
+                logger.info(f"Deleted {len(orphaned)} vectors no chunk refers to from {target}")
+
+    if dry_run or end_mark <= start_mark:
+        return report
+
+    logger.info(f"Syncing {pending_vectors} vectors to {target} (chunks {start_mark + 1}-{end_mark}, "
+                f"batches of {batch_size}, {workers} workers)")
+    started = time.time()
+    last_save = started
+    completed_mark = start_mark
+    unsaved_vectors = 0
+    in_flight = deque()
+
+    def finish_oldest():
+        # Batches are finished in the order they were sent, so every chunk up to this
+        # batch's mark is synced
+        nonlocal completed_mark, unsaved_vectors, last_save
+        synced_through, future = in_flight.popleft()
+        upserted, embedded = future.result()
+        report["upserted"] += upserted
+        report["embedded"] += embedded
+        report["batches"] += 1
+        unsaved_vectors += upserted
+        completed_mark = synced_through
+        if time.time() - last_save >= HIGH_WATER_MARK_SAVE_INTERVAL:
+            _save_high_water_mark(target, completed_mark, unsaved_vectors)
+            unsaved_vectors = 0
+            last_save = time.time()
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pinecone-sync")
+    try:
+        # Rows are read on this thread (the database session isn't shared); at most
+        # two batches per worker are in flight
+        for synced_through, batch in _iter_batches(start_mark, end_mark, batch_size):
+            if len(in_flight) >= 2 * workers:
+                finish_oldest()
+            in_flight.append((synced_through, executor.submit(_send_batch, vector_store, batch)))
+        while in_flight:
+            finish_oldest()
+        # Chunks after the last vector only reuse vectors that are already synced
+        completed_mark = end_mark
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if completed_mark > start_mark or unsaved_vectors:
+            _save_high_water_mark(target, completed_mark, unsaved_vectors)
+
+    elapsed = time.time() - started
+    report["high_water_mark"] = max(completed_mark, status["high_water_mark"])
+    report["elapsed_seconds"] = round(elapsed, 2)
+    report["vectors_per_second"] = round(report["upserted"] / elapsed, 1) if elapsed > 0 else 0.0
+    logger.info(f"Synced {report['upserted']} vectors to {target} in {elapsed:.1f}s "
+                f"({report['vectors_per_second']} vectors/s)")
+    return report
@@ -0,0 +1,208 @@
+"""
+Compressed (quantized) flat vector store.
+
+QuantizedFAISS is the flat FAISS store with its vectors held in compressed form:
+int8 scalar quantization (sq8, 4x smaller than float32), float16 (fp16, 2x) or
+product quantization (pq, VECTOR_PQ_BYTES per vector). Distances computed on
+compressed vectors are approximate, so a search fetches VECTOR_RESCORE_FACTOR
+candidates per result and re-scores them exactly against the full-precision
+vectors in the vector file (utils.vector_file), which stay on disk and are read
+through its memory map.
+
+sq8 and pq learn their encoding from the data. Until there are enough vectors to
+train on, the index stays an exact flat index, and it is converted in place once
+there are (as an IVF index is in utils.ann_index).
+"""
+
+import logging
+
+import numpy as np
+
+from utils.config import get_vector_quantization, get_vector_pq_bytes, get_vector_rescore_factor
+from utils.ann_index import get_search_parameters
+from utils.faiss_store import TombstoneFAISS
+
+logger = logging.getLogger(__name__)
+
+# Vectors needed before sq8 learns each dimension's value range
+SQ8_TRAINING_POINTS = 1000
+
+# faiss wants at least this many training vectors per PQ centroid (256 per sub-quantizer)
+PQ_TRAINING_POINTS_PER_CENTROID = 39
+
+# Training samples at most this many vectors
+MAX_TRAINING_POINTS = 65536
+
+def get_pq_subquantizers(dimension, pq_bytes=None):
+    """Number of 8-bit sub-quantizers for a PQ code of about pq_bytes that divides the dimension"""
+    pq_bytes = min(pq_bytes or get_vector_pq_bytes(), dimension)
+    return max(m for m in range(1, pq_bytes + 1) if dimension % m == 0)
+
+def get_quantization_description(quantization=None):
+    """Describe how the flat index stores vectors, for the snapshot manifest
+
+    A saved index is only reused by a configuration with the same description.
+    """
+    quantization = quantization or get_vector_quantization()
+    if quantization == "pq":
+        return f"pq:bytes={get_vector_pq_bytes()}"
+    return "flat" if quantization == "none" else quantization
+
+def _training_points(quantization):
+    """Vectors needed before the index can be trained"""
+    if quantization == "pq":
+        return 256 * PQ_TRAINING_POINTS_PER_CENTROID
+    if quantization == "sq8":
+        return SQ8_TRAINING_POINTS
+    return 0
+
+def create_quantized_index(dimension, quantization=None):
+    """Create an empty compressed index, or a flat one if the encoding must be trained first"""
+    import faiss
+    quantization = quantization or get_vector_quantization()
+    if quantization == "fp16":
+        return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16)
+    return faiss.IndexFlatL2(dimension)
+
+def train_quantized_index(vectors, quantization=None):
+    """Build a trained compressed index holding vectors, in their current order"""
+    import faiss
+    quantization = quantization or get_vector_quantization()
+    dimension = vectors.shape[1]
+    if quantization == "pq":
+        index = faiss.IndexPQ(dimension, get_pq_subquantizers(dimension), 8)
+    else:
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+    index.train(vectors[:MAX_TRAINING_POINTS])
+    index.add(vectors)
+    return index
+
+def _read_vector_file(vector_ids):
+    """Read full-precision vectors from the vector file; returns (vectors, found mask)"""
+    from utils.vector_file import get_vector_file, _chunk_ids
+    return get_vector_file().get(_chunk_ids(vector_ids))
+
+class QuantizedFAISS(TombstoneFAISS):
+    """Flat FAISS store over compressed vectors, re-scoring candidates at full precision"""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the store; full-precision vectors are read from the vector file"""
+        super().__init__(*args, **kwargs)
+        self.full_precision_source = _read_vector_file
+        # The encoding an untrained flat index gets once there are enough vectors
+        self._pending_quantization = get_vector_quantization()
+
+    @classmethod
+    def create(cls, embeddings, dimension, quantization=None):
+        """Create an empty store"""
+        store = super().create(embeddings, create_quantized_index(dimension, quantization))
+        store._pending_quantization = quantization or store._pending_quantization
+        return store
+
+    @property
+    def quantization(self):
+        """sq8, fp16 or pq (a flat index is a quantized index that hasn't been trained yet)"""
+        import faiss
+        if isinstance(self.index, faiss.IndexPQ):
+            return "pq"
+        if isinstance(self.index, faiss.IndexScalarQuantizer):
+            return "fp16" if self.index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+        return self._pending_quantization
+
+    @property
+    def is_compressed(self):
+        """Whether the index holds compressed vectors yet"""
+        import faiss
+        return not isinstance(self.index, faiss.IndexFlat)
+
+    @property
+    def bytes_per_vector(self):
+        """Bytes the index holds per vector"""
+        return self.index.sa_code_size()
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        """Add texts with precomputed embeddings, training the encoding once there are enough"""
+        ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+        self._train_when_ready()
+        return ids
+
+    def _train_when_ready(self):
+        """Convert a flat index to its compressed form once there are enough vectors to train on"""
+        if self.is_compressed:
+            return
+        quantization = self.quantization
+        if quantization == "none" or self.index.ntotal < _training_points(quantization):
+            return
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        self.index = train_quantized_index(vectors, quantization)
+        logger.info(
+            f"Trained {quantization} index on {len(vectors)} vectors "
+            f"({self.bytes_per_vector} bytes per vector instead of {4 * self.index.d})"
+        )
+
+    def _search_parameters(self, index, selector):
+        """Search-time parameters for the index, with a selector skipping tombstones"""
+        return get_search_parameters(index, selector)
+
+    def read_vectors(self, positions, index, index_to_docstore_id):
+        """Read full-precision vectors from the vector file, decoding any it doesn't have"""
+        import faiss
+        if isinstance(index, faiss.IndexFlat):
+            # Not trained yet, so it holds the full-precision vectors itself
+            return index.reconstruct_batch(positions)
+        vector_ids = [index_to_docstore_id.get(int(position), "") for position in positions]
+        stored, found = self.full_precision_source(vector_ids)
+        vectors = np.empty((len(positions), index.d), dtype=np.float32)
+        if stored.shape[1] == index.d:
+            vectors[found] = stored
+        else:
+            # Stored by another embedding model
+            found = np.zeros(len(positions), dtype=bool)
+        if not found.all():
+            # Added too recently to be in the file, or not a chunk's vector
+            vectors[~found] = index.reconstruct_batch(np.asarray(positions)[~found])
+        if self._normalize_L2 and found.any():
+            full = np.ascontiguousarray(vectors[found])
+            faiss.normalize_L2(full)
+            vectors[found] = full
+        return vectors
+
+    def search_index(self, index, index_to_docstore_id, vector, k, params):
+        """Search the compressed index for candidates and re-score them at full precision"""
+        import faiss
+        factor = get_vector_rescore_factor()
+        if isinstance(index, faiss.IndexFlat) or factor <= 1:
+            return index.search(vector, k, params=params)
+
+        _, candidates = index.search(vector, k * factor, params=params)
+        return self.rescore(index, index_to_docstore_id, vector, candidates, k)
+
+    def rescore(self, index, index_to_docstore_id, vector, candidates, k):
+        """Rank each query row's candidate positions by exact distance; returns the top k as index.search does
+
+        The candidates of all rows are read in one go. Rows with fewer than k
+        candidates are padded with -1 positions, as index.search pads them.
+        """
+        distances = np.full((len(vector), k), np.inf, dtype=np.float32)
+        positions = np.full((len(vector), k), -1, dtype=np.int64)
+        unique = np.unique(candidates[candidates >= 0])
+        if not len(unique):
+            return distances, positions
+        vectors = self.read_vectors(unique, index, index_to_docstore_id)
+        for row, row_candidates in enumerate(candidates):
+            row_candidates = row_candidates[row_candidates >= 0]
+            # Squared L2 distances, as the flat index reports them
+            row_distances = ((vectors[np.searchsorted(unique, row_candidates)] - vector[row]) ** 2).sum(axis=1)
+            top = np.argsort(row_distances)[:k]
+            distances[row, :len(top)] = row_distances[top]
+            positions[row, :len(top)] = row_candidates[top]
+        return distances, positions
+
+    def build_compacted_index(self, state):
+        """Build the compacted index, training it if the untrained flat index now has enough vectors"""
+        import faiss
+        quantization = self.quantization
+        if type(state["index"]) is faiss.IndexFlatL2 and quantization != "none" and \
+                len(state["vectors"]) >= _training_points(quantization):
+            return train_quantized_index(state["vectors"], quantization)
+        return super().build_compacted_index(state)
@@ -1,131 +1,408 @@
 import os
+import time
 import logging
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains import RetrievalQA
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from langchain.chains.question_answering import load_qa_chain
 from langchain_community.llms import OpenAI
 from langchain.prompts import PromptTemplate
 
-from app import db
-from models import Document, DocumentChunk, Query, Response
-from utils.embedding import get_embeddings
-from utils.vector_store import get_vector_store
+from utils.config import is_answer_cache_enabled, get_query_batch_concurrency
+from utils.answer_cache import get_answer_cache
+from utils.document_processor import get_corpus_version
+from utils.vector_store import (
+    embed_query,
+    embed_queries,
+    search_vector_store,
+    search_vector_store_batch,
+    get_search_mode_in_effect
+)
 
 logger = logging.getLogger(__name__)
 
-def initialize_rag_pipeline():
-    """Initialize the RAG pipeline with LangChain components"""
-    try:
-        # Get vector store client
-        vector_store = get_vector_store()
-        
-        # Initialize the language model from OpenAI
-        openai_api_key = os.environ.get("OPENAI_API_KEY")
-        if not openai_api_key:
-            logger.warning("OPENAI_API_KEY not found. RAG pipeline will not work properly.")
-            # We'll continue but it will fail when actually trying to use the LLM
-        
-        llm = OpenAI(temperature=0.5, api_key=openai_api_key, model_name="gpt-3.5-turbo-instruct")
-        
-        # Create a prompt template for market matching
-        prompt_template = """
+# Chunks retrieved for a query and passed to the LLM
+QUERY_TOP_K = 5
+
+# Prompt for market matching answers
+PROMPT_TEMPLATE = """
         You are an AI assistant specialized in market matching, helping businesses find opportunities.
         Use the following context from the knowledge base to answer the question thoroughly.
         If the information isn't in the context, say "I don't have enough information in my knowledge base to answer this question."
-        
+
         Context:
         {context}
-        
+
         Question:
         {question}
-        
+
         Please provide a detailed market-oriented answer with insights on:
         - Relevant market trends
         - Potential opportunities
         - Data-supported conclusions
         - Action recommendations where appropriate
         """
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["context", "question"]
-        )
-        
-        # Create the retrieval QA chain
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=vector_store.as_retriever(search_kwargs={"k": 5}),
-            chain_type_kwargs={"prompt": prompt}
-        )
-        
-        logger.info("RAG pipeline initialized successfully")
-        return qa_chain
-    
-    except Exception as e:
-        logger.error(f"Error initializing RAG pipeline: {str(e)}")
-        raise
 
-def query_rag_pipeline(query_text):
-    """Process a query through the RAG pipeline and return the response with sources"""
-    try:
-        # Validate input
-        if not query_text or not isinstance(query_text, str) or len(query_text.strip()) == 0:
-            return "Please provide a valid query.", []
-        
-        # Get vector store
-        vector_store = get_vector_store()
-        
-        # Search for relevant document chunks
-        logger.info(f"Searching for documents relevant to: '{query_text}'")
-        search_results = vector_store.similarity_search_with_score(query_text, k=5)
-        
-        # Extract document chunks and relevance scores
+NO_SOURCES_RESPONSE = "I don't have enough information in my knowledge base to answer this question."
+
+# Introductions of the fallback responses listing the retrieved chunks
+NO_API_KEY_INTRO = "API key for OpenAI not found. Here are the most relevant documents from our knowledge base:\n\n"
+LLM_ERROR_INTRO = "I encountered an issue processing your query with our AI model. Here are the most relevant documents I found:\n\n"
+
+def _elapsed_ms(start_time):
+    return round((time.perf_counter() - start_time) * 1000, 2)
+
+def _list_documents(intro, context_texts):
+    """Fallback response listing the retrieved chunks instead of an answer"""
+    formatted_response = intro
+    for i, text in enumerate(context_texts):
+        formatted_response += f"Document {i+1}:\n{text[:300]}...\n\n"
+    return formatted_response
+
+class QueryEngine:
+    """Answers queries from a single retrieval, with the LLM chain built once per process
+
+    The retrieved chunks are passed straight to a "stuff" documents chain, so a
+    query is embedded and searched once. The chain is built on first use and
+    again only if OPENAI_API_KEY changes. Generated answers are kept in the
+    semantic answer cache, which answers near-identical queries without a
+    search or generation until the corpus changes.
+    """
+
+    def __init__(self):
+        """Build the prompt; the LLM is created on first use"""
+        self.prompt = PromptTemplate(template=PROMPT_TEMPLATE, input_variables=["context", "question"])
+        self._llm = None
+        self._chain = None
+        self._chain_api_key = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        """Build the LLM and its documents chain if missing or made with another key; returns the API key"""
+        openai_api_key = os.environ.get("OPENAI_API_KEY")
+        if not openai_api_key:
+            return None
+        with self._lock:
+            if self._chain is None or self._chain_api_key != openai_api_key:
+                self._llm = OpenAI(temperature=0.5, api_key=openai_api_key, model_name="gpt-3.5-turbo-instruct")
+                self._chain = load_qa_chain(self._llm, chain_type="stuff", prompt=self.prompt)
+                self._chain_api_key = openai_api_key
+                logger.info("Query engine LLM chain initialized")
+        return openai_api_key
+
+    def get_chain(self):
+        """The documents chain over the LLM, or None without an OpenAI API key"""
+        return self._chain if self._build() else None
+
+    def get_llm(self):
+        """The LLM the chain runs, or None without an OpenAI API key"""
+        return self._llm if self._build() else None
+
+    def embed(self, query_text, timings=None):
+        """Embed a query, or return None if it can't be embedded
+
+        timings, if given, gets the embed time in milliseconds.
+        """
+        timings = {} if timings is None else timings
+        start_time = time.perf_counter()
+        try:
+            return embed_query(query_text)
+        except Exception as e:
+            logger.error(f"Error embedding query: {str(e)}")
+            return None
+        finally:
+            timings["embed"] = _elapsed_ms(start_time)
+
+    def retrieve(self, query_text, search_filter=None, k=QUERY_TOP_K, timings=None, embedding=None):
+        """Embed a query and search for its chunks; returns the (document, score) results
+
+        A lexical search needs no embedding. An embedding already computed for
+        the query can be passed in. timings, if given, gets the embed and search
+        times in milliseconds.
+        """
+        timings = {} if timings is None else timings
+        if embedding is None and get_search_mode_in_effect() != "lexical":
+            embedding = self.embed(query_text, timings)
+            if embedding is None:
+                return []
+
+        start_time = time.perf_counter()
+        results = search_vector_store(query_text, k=k, filter=search_filter, embedding=embedding)
+        timings["search"] = _elapsed_ms(start_time)
+        return results
+
+    def generate(self, query_text, documents, timings=None):
+        """Answer a query from retrieved documents; returns (response, whether the LLM answered)
+
+        Falls back to listing the documents without an API key or if the LLM fails.
+        timings, if given, gets the generate time in milliseconds.
+        """
+        timings = {} if timings is None else timings
+        context_texts = [doc.page_content for doc in documents]
+        start_time = time.perf_counter()
+        try:
+            chain = self.get_chain()
+            if chain is None:
+                return _list_documents(NO_API_KEY_INTRO, context_texts), False
+            logger.info("Generating answer from the retrieved chunks")
+            return chain.run(input_documents=documents, question=query_text), True
+        except Exception as e:
+            logger.error(f"Error in RAG chain execution: {str(e)}")
+            return _list_documents(LLM_ERROR_INTRO, context_texts), False
+        finally:
+            timings["generate"] = _elapsed_ms(start_time)
+
+    def stream_generate(self, query_text, documents, timings=None, on_complete=None):
+        """Yield the answer to a query from retrieved documents in pieces, as the LLM produces them
+
+        The prompt is the one the "stuff" chain of generate builds. Falls back to
+        listing the documents, as a single piece, without an API key or if the
+        LLM fails before producing anything. on_complete, if given, is called
+        with the whole answer once the LLM has finished it. timings, if given,
+        gets the generate time in milliseconds.
+        """
+        timings = {} if timings is None else timings
+        context_texts = [doc.page_content for doc in documents]
+        pieces = []
+        start_time = time.perf_counter()
+        try:
+            llm = self.get_llm()
+            if llm is None:
+                yield _list_documents(NO_API_KEY_INTRO, context_texts)
+                return
+            logger.info("Streaming answer from the retrieved chunks")
+            prompt = self.prompt.format(context="\n\n".join(context_texts), question=query_text)
+            for piece in llm.stream(prompt):
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+        except Exception as e:
+            logger.error(f"Error streaming RAG answer: {str(e)}")
+            if not pieces:
+                yield _list_documents(LLM_ERROR_INTRO, context_texts)
+            return
+        finally:
+            timings["generate"] = _elapsed_ms(start_time)
+
+        if on_complete:
+            on_complete("".join(pieces))
+
+    def _cache_lookup(self, query_text, embedding, search_filter, corpus_version, timings, cache_info):
+        """Look a query up in the answer cache; returns (response, source chunks) on a hit, else None"""
+        start_time = time.perf_counter()
+        cached = get_answer_cache().lookup(embedding, corpus_version, search_filter)
+        timings["cache"] = _elapsed_ms(start_time)
+        if cached is None:
+            return None
+        response, source_chunks, similarity = cached
+        cache_info.update(hit=True, similarity=round(similarity, 4))
+        logger.info(f"Answered '{query_text}' from the answer cache (similarity {similarity:.4f})")
+        return response, list(source_chunks)
+
+    def _cache_store(self, embedding, search_filter, corpus_version, source_chunks):
+        """Function caching a generated response to a query with its source chunks"""
+        def store(response):
+            get_answer_cache().store(embedding, response, tuple(source_chunks), corpus_version, search_filter)
+        return store
+
+    def _select_sources(self, search_results):
+        """Split search results into (source chunks, context documents), skipping placeholder vectors"""
         source_chunks = []
-        context_texts = []
-        
+        context_docs = []
         for doc, score in search_results:
-            # Get chunk ID from metadata
             chunk_id = doc.metadata.get('chunk_id')
             if chunk_id and chunk_id != "placeholder":
                 source_chunks.append((chunk_id, float(score)))
-                context_texts.append(doc.page_content)
+                context_docs.append(doc)
                 logger.debug(f"Found relevant chunk: {chunk_id} with score {score}")
-        
-        # If no source chunks were found, return a default response
+        return source_chunks, context_docs
+
+    def _prepare(self, query_text, search_filter, timings, cache_info):
+        """Embed a query, look it up in the answer cache and retrieve its chunks
+
+        Returns (response, source chunks, context documents, cache store). response
+        is set when there is nothing to generate: a cache hit or no sources.
+        cache store, if not None, caches a generated response for similar queries.
+        A lexical search embeds nothing, so it skips the cache.
+        """
+        cache_info["hit"] = False
+        embedding = None
+        if get_search_mode_in_effect() != "lexical":
+            embedding = self.embed(query_text, timings)
+            if embedding is None:
+                return NO_SOURCES_RESPONSE, [], [], None
+
+        # Read before retrieval, so an answer is never cached under a newer version than its sources
+        corpus_version = get_corpus_version() if embedding is not None and is_answer_cache_enabled() else None
+        if corpus_version is not None:
+            cached = self._cache_lookup(query_text, embedding, search_filter, corpus_version, timings, cache_info)
+            if cached is not None:
+                return cached[0], cached[1], [], None
+
+        logger.info(f"Searching for documents relevant to: '{query_text}'")
+        search_results = self.retrieve(query_text, search_filter, timings=timings, embedding=embedding)
+        source_chunks, context_docs = self._select_sources(search_results)
         if not source_chunks:
             logger.warning("No relevant documents found for query")
-            return "I don't have enough information in my knowledge base to answer this question.", []
-        
-        # Create context from the retrieved chunks
-        context = "\n\n---\n\n".join(context_texts)
-        
-        # Initialize the RAG chain
+            timings["generate"] = 0.0
+            return NO_SOURCES_RESPONSE, [], [], None
+
+        cache_store = None
+        if corpus_version is not None:
+            cache_store = self._cache_store(embedding, search_filter, corpus_version, source_chunks)
+        return None, source_chunks, context_docs, cache_store
+
+    def query(self, query_text, search_filter=None, timings=None, cache_info=None):
+        """Retrieve once and answer from the retrieved chunks; returns (response, source chunks)
+
+        source chunks are (chunk id, score) pairs. timings, if given, gets the
+        embed, cache, search and generate times in milliseconds; cache_info, if
+        given, gets whether the answer came from the answer cache.
+        """
+        timings = {} if timings is None else timings
+        cache_info = {} if cache_info is None else cache_info
+        response, source_chunks, context_docs, cache_store = self._prepare(query_text, search_filter, timings, cache_info)
+        if response is not None:
+            return response, source_chunks
+
+        response, generated = self.generate(query_text, context_docs, timings)
+        if cache_store and generated:
+            cache_store(response)
+        return response, source_chunks
+
+    def query_stream(self, query_text, search_filter=None, timings=None, cache_info=None):
+        """Retrieve once and stream the answer; returns (source chunks, iterator of answer pieces)
+
+        The sources are known before generation starts, so they can be sent
+        first. Cached and fallback answers come as a single piece. timings and
+        cache_info are filled in as by query, the generate time once the
+        iterator is exhausted.
+        """
+        timings = {} if timings is None else timings
+        cache_info = {} if cache_info is None else cache_info
+        response, source_chunks, context_docs, cache_store = self._prepare(query_text, search_filter, timings, cache_info)
+        if response is not None:
+            return source_chunks, iter([response])
+        return source_chunks, self.stream_generate(query_text, context_docs, timings, on_complete=cache_store)
+
+    def query_batch(self, query_texts, search_filter=None, timings=None, concurrency=None):
+        """Answer several queries, yielding (position, response, source chunks, timings, cache info) as each completes
+
+        The queries are embedded in one call (unless the search is lexical only)
+        and those not answered from the cache are searched as one query matrix,
+        with their lexical searches alongside. Answers are generated
+        concurrency at a time (QUERY_BATCH_CONCURRENCY by default) and yielded
+        in the order they finish. timings, if given, gets the batch's embed and
+        search times in milliseconds; each query's own timings have its cache
+        lookup and generate times.
+        """
+        timings = {} if timings is None else timings
+        query_timings = [{} for _ in query_texts]
+        cache_infos = [{"hit": False} for _ in query_texts]
+
+        embeddings = None
+        if get_search_mode_in_effect() != "lexical":
+            start_time = time.perf_counter()
+            try:
+                embeddings = embed_queries(query_texts)
+            except Exception as e:
+                logger.error(f"Error embedding queries: {str(e)}")
+            timings["embed"] = _elapsed_ms(start_time)
+            if embeddings is None:
+                for position in range(len(query_texts)):
+                    yield position, NO_SOURCES_RESPONSE, [], query_timings[position], cache_infos[position]
+                return
+
+        corpus_version = get_corpus_version() if embeddings is not None and is_answer_cache_enabled() else None
+        pending = []
+        for position in range(len(query_texts)):
+            if corpus_version is not None:
+                cached = self._cache_lookup(
+                    query_texts[position], embeddings[position], search_filter, corpus_version,
+                    query_timings[position], cache_infos[position]
+                )
+                if cached is not None:
+                    yield position, cached[0], cached[1], query_timings[position], cache_infos[position]
+                    continue
+            pending.append(position)
+        if not pending:
+            return
+
+        logger.info(f"Searching for documents relevant to {len(pending)} queries")
+        start_time = time.perf_counter()
+        search_results = search_vector_store_batch(
+            [query_texts[position] for position in pending], k=QUERY_TOP_K, filter=search_filter,
+            embeddings=None if embeddings is None else embeddings[pending]
+        )
+        timings["search"] = _elapsed_ms(start_time)
+
+        executor = ThreadPoolExecutor(max_workers=concurrency or get_query_batch_concurrency())
         try:
-            qa_chain = initialize_rag_pipeline()
-            
-            # Check if we have an OpenAI API key before proceeding
-            openai_api_key = os.environ.get("OPENAI_API_KEY")
-            if not openai_api_key:
-                # If no API key, return a formatted response with the context but no LLM processing
-                formatted_response = "API key for OpenAI not found. Here are the most relevant documents from our knowledge base:\n\n"
-                for i, text in enumerate(context_texts):
-                    formatted_response += f"Document {i+1}:\n{text[:300]}...\n\n"
-                return formatted_response, source_chunks
-            
-            # Run the query through the chain
-            logger.info("Processing query through RAG pipeline")
-            response = qa_chain({"query": query_text})
-            
-            return response['result'], source_chunks
-            
-        except Exception as e:
-            logger.error(f"Error in RAG chain execution: {str(e)}")
-            # Fallback to a simple response with contexts if the LLM fails
-            formatted_response = "I encountered an issue processing your query with our AI model. Here are the most relevant documents I found:\n\n"
-            for i, text in enumerate(context_texts):
-                formatted_response += f"Document {i+1}:\n{text[:300]}...\n\n"
-            return formatted_response, source_chunks
-    
+            futures = {}
+            for position, results in zip(pending, search_results):
+                source_chunks, context_docs = self._select_sources(results)
+                if not source_chunks:
+                    query_timings[position]["generate"] = 0.0
+                    yield position, NO_SOURCES_RESPONSE, [], query_timings[position], cache_infos[position]
+                    continue
+                future = executor.submit(self.generate, query_texts[position], context_docs, query_timings[position])
+                futures[future] = (position, source_chunks)
+
+            for future in as_completed(futures):
+                position, source_chunks = futures[future]
+                response, generated = future.result()
+                if generated and corpus_version is not None:
+                    self._cache_store(embeddings[position], search_filter, corpus_version, source_chunks)(response)
+                yield position, response, source_chunks, query_timings[position], cache_infos[position]
+        finally:
+            # Answers not yet started are dropped if the caller stops early
+            executor.shutdown(wait=False, cancel_futures=True)
+
+_query_engine = None
+_query_engine_lock = threading.Lock()
+
+def get_query_engine():
+    """Get the process's query engine, creating it on first use"""
+    global _query_engine
+    if _query_engine is None:
+        with _query_engine_lock:
+            if _query_engine is None:
+                _query_engine = QueryEngine()
+    return _query_engine
+
+def query_rag_pipeline(query_text, search_filter=None, timings=None, cache_info=None):
+    """Process a query through the RAG pipeline and return the response with sources
+
+    search_filter (see utils.search_filter) restricts retrieval to matching documents.
+    timings, if given, gets the time of each stage in milliseconds, and cache_info
+    whether the answer came from the answer cache.
+    """
+    try:
+        # Validate input
+        if not query_text or not isinstance(query_text, str) or len(query_text.strip()) == 0:
+            return "Please provide a valid query.", []
+        return get_query_engine().query(query_text, search_filter, timings, cache_info)
     except Exception as e:
         logger.error(f"Error in RAG pipeline query: {str(e)}")
         return f"An error occurred while processing your query: {str(e)}", []
+
+def query_rag_batch(query_texts, search_filter=None, timings=None):
+    """Process several queries through the RAG pipeline, yielding results as they complete
+
+    Yields (position, response, source chunks, timings, cache info) per query;
+    see QueryEngine.query_batch.
+    """
+    return get_query_engine().query_batch(query_texts, search_filter, timings)
+
+def stream_rag_pipeline(query_text, search_filter=None, timings=None, cache_info=None):
+    """Process a query through the RAG pipeline, streaming the response; returns (source chunks, answer pieces)
+
+    Takes the same arguments as query_rag_pipeline. The answer pieces are
+    produced as the LLM generates them.
+    """
+    try:
+        if not query_text or not isinstance(query_text, str) or len(query_text.strip()) == 0:
+            return [], iter(["Please provide a valid query."])
+        return get_query_engine().query_stream(query_text, search_filter, timings, cache_info)
+    except Exception as e:
+        logger.error(f"Error in RAG pipeline query: {str(e)}")
+        return [], iter([f"An error occurred while processing your query: {str(e)}"])
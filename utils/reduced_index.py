@@ -0,0 +1,210 @@
+"""
+Two-stage search over a reduced-dimension copy of the flat index.
+
+ReducedFAISS keeps, next to the full index, a copy of every vector projected onto
+its first VECTOR_PREFILTER_DIMENSION principal components, learned by PCA from the
+stored vectors. A search scans the small copy for VECTOR_PREFILTER_CANDIDATES
+candidates per result and re-ranks only those exactly against their full vectors.
+
+The copy keeps the index's positions, so tombstones and ID selectors apply to
+both. The projection is learned once there are enough vectors, and learned again
+in the background as the corpus grows. Until a copy lines up with the current
+index (e.g. right after startup without a saved copy) searches scan the full
+index as before.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from utils.config import get_vector_prefilter_dimension, get_vector_prefilter_candidates
+from utils.quantized_index import QuantizedFAISS
+
+logger = logging.getLogger(__name__)
+
+# Live vectors needed before the projection is learned (and at least the full dimension)
+PROJECTION_TRAINING_POINTS = 2000
+
+# The projection is learned from at most this many vectors
+MAX_PROJECTION_TRAINING_POINTS = 20000
+
+# The projection is learned again once the live vectors grow by this factor
+PROJECTION_RETRAIN_GROWTH = 2
+
+# Vectors projected at a time when building the copy
+PROJECTION_BATCH_SIZE = 10000
+
+def train_projection(vectors, dimension):
+    """Learn a PCA projection of vectors onto their first dimension components"""
+    import faiss
+    sample = vectors
+    if len(vectors) > MAX_PROJECTION_TRAINING_POINTS:
+        rng = np.random.default_rng(0)
+        sample = vectors[np.sort(rng.choice(len(vectors), MAX_PROJECTION_TRAINING_POINTS, replace=False))]
+    projection = faiss.PCAMatrix(vectors.shape[1], dimension)
+    projection.train(np.ascontiguousarray(sample))
+    return projection
+
+def project_into_index(projection, vectors, positions, ntotal):
+    """Build a flat index of ntotal projected vectors, vectors going at their positions
+
+    Positions without a vector (tombstones) hold zeros; searches skip them anyway.
+    """
+    import faiss
+    projected = np.zeros((ntotal, projection.d_out), dtype=np.float32)
+    for start in range(0, len(positions), PROJECTION_BATCH_SIZE):
+        end = start + PROJECTION_BATCH_SIZE
+        projected[positions[start:end]] = projection.apply(np.ascontiguousarray(vectors[start:end]))
+    reduced = faiss.IndexFlatL2(projection.d_out)
+    reduced.add(projected)
+    return reduced
+
+class ReducedFAISS(QuantizedFAISS):
+    """Flat FAISS store searched through a PCA-reduced copy, re-ranking candidates at full dimension
+
+    The full index may itself be compressed (VECTOR_QUANTIZATION); re-ranking then
+    reads full-precision vectors as QuantizedFAISS does.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the store without a reduced copy"""
+        super().__init__(*args, **kwargs)
+        self.prefilter_dimension = get_vector_prefilter_dimension()
+        # {"index": full index it lines up with, "projection": PCA matrix, "reduced": flat index}
+        self._reduced_copy = None
+        # Live vectors when the projection was learned
+        self._trained_vectors = 0
+
+    @property
+    def has_reduced_copy(self):
+        """Whether searches go through the reduced copy"""
+        copy = self._reduced_copy
+        return copy is not None and copy["index"] is self.index
+
+    def needs_projection(self):
+        """Whether the projection should be learned, for the first time or again after growth"""
+        dimension = self.prefilter_dimension
+        if not dimension or dimension >= self.index.d:
+            return False
+        live = len(self.index_to_docstore_id)
+        if live < max(PROJECTION_TRAINING_POINTS, self.index.d):
+            return False
+        return not self.has_reduced_copy or live >= PROJECTION_RETRAIN_GROWTH * self._trained_vectors
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        """Add texts with precomputed embeddings to the index and its reduced copy"""
+        text_embeddings = list(text_embeddings)
+        index = self.index
+        start = index.ntotal
+        ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+
+        copy = self._reduced_copy
+        if copy is not None and text_embeddings:
+            if copy["index"] is index and copy["reduced"].ntotal == start:
+                import faiss
+                vectors = np.asarray([embedding for _, embedding in text_embeddings], dtype=np.float32)
+                if self._normalize_L2:
+                    faiss.normalize_L2(vectors)
+                copy["reduced"].add(copy["projection"].apply(vectors))
+                # Training a compressed index keeps every vector at its position
+                copy["index"] = self.index
+            else:
+                self._reduced_copy = None
+        return ids
+
+    def search_index(self, index, index_to_docstore_id, vector, k, params):
+        """Search the reduced copy for candidates and re-rank them at full dimension"""
+        import faiss
+        copy = self._reduced_copy
+        if copy is None or copy["index"] is not index:
+            return super().search_index(index, index_to_docstore_id, vector, k, params)
+
+        # The copy is a plain flat index, whatever parameters the full index takes
+        reduced_params = faiss.SearchParameters()
+        if params is not None and params.sel is not None:
+            reduced_params.sel = params.sel
+        _, candidates = copy["reduced"].search(
+            copy["projection"].apply(vector), k * get_vector_prefilter_candidates(), params=reduced_params
+        )
+        return self.rescore(index, index_to_docstore_id, vector, candidates, k)
+
+    def begin_projection(self):
+        """Read the live vectors to learn the projection from; call while writes are held off"""
+        return self.begin_compaction()
+
+    def build_reduced_copy(self, state):
+        """Learn the projection and build the reduced copy from begin_projection's state; needs no lock"""
+        projection = train_projection(state["vectors"], self.prefilter_dimension)
+        return {
+            "index": state["index"],
+            "projection": projection,
+            "reduced": project_into_index(projection, state["vectors"], state["positions"], state["ntotal"])
+        }
+
+    def finish_projection(self, state, copy):
+        """Swap in a reduced copy; call while writes are held off
+
+        Vectors added since begin_projection are projected into it. Returns False
+        if the index was replaced in the meantime and the copy was dropped.
+        """
+        if self.index is not state["index"]:
+            return False
+        self._extend_copy(copy)
+        self._reduced_copy = copy
+        self._trained_vectors = len(self.index_to_docstore_id)
+        return True
+
+    def _extend_copy(self, copy):
+        """Project the vectors the index gained after the copy was built into it"""
+        added = np.arange(copy["reduced"].ntotal, self.index.ntotal, dtype=np.int64)
+        if len(added):
+            vectors = self.read_vectors(added, self.index, self.index_to_docstore_id)
+            copy["reduced"].add(copy["projection"].apply(np.ascontiguousarray(vectors)))
+
+    def build_compacted_index(self, state):
+        """Build the compacted index and, with the same projection, its reduced copy"""
+        index = super().build_compacted_index(state)
+        copy = self._reduced_copy
+        if copy is not None and copy["index"] is state["index"]:
+            count = len(state["positions"])
+            state["reduced_copy"] = {
+                "index": index,
+                "projection": copy["projection"],
+                "reduced": project_into_index(copy["projection"], state["vectors"], np.arange(count), count)
+            }
+        return index
+
+    def finish_compaction(self, state, index):
+        """Swap in a compacted index together with its reduced copy"""
+        removed = super().finish_compaction(state, index)
+        if removed is not None:
+            copy = state.get("reduced_copy")
+            if copy is not None:
+                self._extend_copy(copy)
+            self._reduced_copy = copy
+        return removed
+
+    def save_local(self, folder_path, index_name="index"):
+        """Save the store, with its reduced copy if it has one"""
+        import faiss
+        super().save_local(folder_path, index_name)
+        copy = self._reduced_copy
+        if copy is not None and copy["index"] is self.index:
+            faiss.write_VectorTransform(copy["projection"], os.path.join(folder_path, f"{index_name}.pca"))
+            faiss.write_index(copy["reduced"], os.path.join(folder_path, f"{index_name}.reduced.faiss"))
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index", **kwargs):
+        """Load a saved store, with its reduced copy if one was saved for the configured dimension"""
+        import faiss
+        store = super().load_local(folder_path, embeddings, index_name=index_name, **kwargs)
+        projection_path = os.path.join(folder_path, f"{index_name}.pca")
+        reduced_path = os.path.join(folder_path, f"{index_name}.reduced.faiss")
+        if store.prefilter_dimension and os.path.exists(projection_path) and os.path.exists(reduced_path):
+            projection = faiss.read_VectorTransform(projection_path)
+            reduced = faiss.read_index(reduced_path)
+            if projection.d_out == store.prefilter_dimension and reduced.ntotal == store.index.ntotal:
+                store._reduced_copy = {"index": store.index, "projection": projection, "reduced": reduced}
+                store._trained_vectors = len(store.index_to_docstore_id)
+        return store
@@ -0,0 +1,105 @@
+"""
+Structured search filters.
+
+A filter restricts a search to chunks of documents that match every field given:
+
+    {
+        "document_id": 3,                 # or a list of ids
+        "document_title": "report.pdf",   # or a list of titles (exact match)
+        "user_id": 1,                     # uploader, or a list of ids
+        "uploaded_after": "2024-01-01",   # ISO date or datetime, inclusive
+        "uploaded_before": "2024-07-01"   # ISO date or datetime, exclusive
+    }
+
+The vector store resolves a filter into an allow-list of vectors before
+searching, so a selective filter searches fewer vectors instead of
+over-fetching and discarding results.
+"""
+
+from datetime import datetime, timezone
+
+FILTER_FIELDS = ("document_id", "document_title", "user_id", "uploaded_after", "uploaded_before")
+
+def _as_list(value, convert, field):
+    """Normalize a single value or a list of values"""
+    values = value if isinstance(value, (list, tuple, set)) else [value]
+    if not values:
+        raise ValueError(f"{field} must not be an empty list")
+    try:
+        return sorted({convert(item) for item in values})
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid value for {field}: {value!r}")
+
+def _as_datetime(value, field):
+    """Parse an ISO date or datetime into a naive UTC datetime, like Document.upload_date"""
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value))
+        except ValueError:
+            raise ValueError(f"Invalid date for {field}: {value!r} (expected ISO format, e.g. 2024-01-31)")
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _timestamp(value):
+    """Unix timestamp of a naive UTC datetime"""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+def parse_search_filter(data):
+    """Validate and normalize a search filter, e.g. from a request body
+
+    Returns None when there is nothing to filter on. Raises ValueError for an
+    invalid filter.
+    """
+    if not data:
+        return None
+    if not isinstance(data, dict):
+        raise ValueError("filter must be an object")
+    unknown = set(data) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown))}")
+
+    search_filter = {}
+    if data.get("document_id") is not None:
+        search_filter["document_id"] = _as_list(data["document_id"], int, "document_id")
+    if data.get("document_title") is not None:
+        search_filter["document_title"] = _as_list(data["document_title"], str, "document_title")
+    if data.get("user_id") is not None:
+        search_filter["user_id"] = _as_list(data["user_id"], int, "user_id")
+    for field in ("uploaded_after", "uploaded_before"):
+        if data.get(field) is not None:
+            search_filter[field] = _as_datetime(data[field], field)
+    return search_filter or None
+
+def upload_bounds(search_filter):
+    """The (after, before) upload dates of a filter as Unix timestamps, None where not given"""
+    after, before = search_filter.get("uploaded_after"), search_filter.get("uploaded_before")
+    return (
+        _timestamp(after) if after is not None else None,
+        _timestamp(before) if before is not None else None
+    )
+
+def matches_metadata(search_filter, metadata, date_field="uploaded_at"):
+    """Whether one document's metadata matches a filter, for stores that keep
+    document fields with their chunks rather than in the database
+
+    Dates are compared as Unix timestamps stored under date_field. A field the
+    filter uses but the metadata lacks doesn't match.
+    """
+    for field, convert in (("document_id", int), ("document_title", str), ("user_id", int)):
+        if field in search_filter:
+            try:
+                if convert(metadata[field]) not in search_filter[field]:
+                    return False
+            except (KeyError, TypeError, ValueError):
+                return False
+    after, before = upload_bounds(search_filter)
+    if after is not None or before is not None:
+        uploaded_at = metadata.get(date_field)
+        if uploaded_at is None:
+            return False
+        if after is not None and uploaded_at < after:
+            return False
+        if before is not None and uploaded_at >= before:
+            return False
+    return True
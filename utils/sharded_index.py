@@ -0,0 +1,387 @@
+"""
+Flat FAISS index partitioned across shards, each searched by its own process.
+
+With VECTOR_SHARDS above 1 the flat index is split into that many shards. A
+vector's shard is the hash of its chunk id, or of its document id with
+VECTOR_SHARD_KEY=document. Each shard is a directory of immutable segments
+(utils.shared_index), so adds, deletes and merges work as they do for the shared
+index, one shard at a time.
+
+A shard is searched by its own server process, which maps the shard's segments
+and answers queries over a socket. A query is sent to every shard before any
+answer is read, so the shards search side by side. Their sorted top-k lists are
+then merged with a heap.
+
+FAISS_SHARD_DIR/layout.json names the shard count, the key, and the directory
+holding the current shards. Changing the count or the key means building a new
+layout from the database and the vector file. A process notices a new layout
+before its next query and restarts its shard servers. Writers hold the layout
+lock shared and a rebalance holds it exclusively to switch layouts, so no write
+lands in a layout that is being replaced.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import heapq
+import shutil
+import socket
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing.connection import Connection
+
+import numpy as np
+
+from utils.shared_index import ChunkVectorStore, SharedSegmentStore, publish_changes, read_manifest, count_vectors
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_FILE = "layout.json"
+LOCK_FILE = "layout.lock"
+LAYOUT_DIR_PREFIX = "layout-"
+
+# Root of the package, so shard servers can be started as `python -m utils.sharded_index`
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds a shard server gets to exit before it is killed
+SHARD_SERVER_STOP_TIMEOUT = 5
+
+def shard_of(value, shards):
+    """Shard a chunk or document id hashes to"""
+    return zlib.crc32(str(value).encode()) % shards
+
+def shard_router(layout):
+    """Function of (vector id, metadata) returning the vector's shard in a layout"""
+    shards = layout["shards"]
+    if layout["key"] == "document":
+        def route(vector_id, metadata):
+            document_id = (metadata or {}).get("document_id")
+            if document_id is None:
+                raise ValueError(f"Vector {vector_id} has no document_id to pick its shard by")
+            return shard_of(document_id, shards)
+        return route
+    return lambda vector_id, metadata: shard_of(vector_id, shards)
+
+@contextmanager
+def layout_lock(directory, exclusive=True):
+    """Hold the layout lock: shared to write to the current shards, exclusive to replace them
+
+    flock conflicts between separate opens of the file, so threads of one process
+    exclude each other too.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_layout(directory):
+    """Read the current layout, or None if there are no shards yet"""
+    path = os.path.join(directory, LAYOUT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def new_layout(shards, shard_key, embedding_signature, dimension):
+    """Layout of a new, empty set of shards, to be filled in and committed"""
+    return {
+        "shards": shards,
+        "key": shard_key,
+        "embedding_signature": embedding_signature,
+        "dimension": dimension,
+        "path": f"{LAYOUT_DIR_PREFIX}{uuid.uuid4().hex}"
+    }
+
+def layout_matches(layout, shards, shard_key, embedding_signature):
+    """Whether a layout has the given shard count and key over the given embeddings"""
+    return layout is not None and layout["shards"] == shards and layout["key"] == shard_key and \
+        layout["embedding_signature"] == embedding_signature
+
+def layout_shard_directories(directory, layout):
+    """Segment directory of each shard of a layout"""
+    return [os.path.join(directory, layout["path"], f"shard-{shard}") for shard in range(layout["shards"])]
+
+def commit_layout(directory, layout):
+    """Switch to a layout and remove the shards of every other one
+
+    Call while holding layout_lock exclusively. Shard servers still mapping
+    removed segments keep reading them until their process restarts.
+    """
+    layout = {**layout, "committed_at": time.time()}
+    path = os.path.join(directory, LAYOUT_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(layout, f)
+    os.replace(temp_path, path)
+
+    for name in os.listdir(directory):
+        if name.startswith(LAYOUT_DIR_PREFIX) and name != layout["path"]:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return layout
+
+def serve_shard(directory, dimension, connection):
+    """Answer (embedding, k, allowed chunk ids) search requests for one shard until the connection closes
+
+    A request with a matrix of embeddings is answered with a list of hits per row.
+    """
+    import faiss
+    # The shards of a query are searched side by side, one thread each
+    faiss.omp_set_num_threads(1)
+    store = SharedSegmentStore(None, directory, None, None, dimension)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        embedding, k, allowed_chunk_ids = request
+        try:
+            if np.ndim(embedding) == 2:
+                result = store.search_vector_ids_batch(embedding, k, allowed_chunk_ids)
+            else:
+                result = store.search_vector_ids(embedding, k, allowed_chunk_ids)
+        except Exception as e:
+            result = RuntimeError(f"Error searching shard {directory}: {str(e)}")
+        connection.send(result)
+
+class ShardServer:
+    """A process searching one shard, spoken to over a socket pair"""
+
+    def __init__(self, directory, dimension):
+        """Start the server process; it maps the shard's segments before answering its first query"""
+        parent, child = socket.socketpair()
+        # A fresh interpreter rather than a fork, which would copy the web app's threads and connections
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "utils.sharded_index", os.path.abspath(directory), str(dimension), str(child.fileno())],
+            pass_fds=[child.fileno()],
+            cwd=PACKAGE_ROOT
+        )
+        child.close()
+        self.directory = directory
+        self.connection = Connection(parent.detach())
+        # Held from sending a request until its answer is read
+        self.lock = threading.Lock()
+
+    def stop(self):
+        """Stop the server once any query in flight is answered"""
+        with self.lock:
+            try:
+                self.connection.send(None)
+                self.connection.close()
+                self.process.wait(timeout=SHARD_SERVER_STOP_TIMEOUT)
+            except Exception:
+                self.process.kill()
+
+class ShardedStore(ChunkVectorStore):
+    """Flat FAISS store partitioned across shards, searched by scatter-gather over their server processes"""
+
+    def __init__(self, embeddings, directory, load_documents, embedding_signature, dimension):
+        """Create a store over the shards in directory; servers start at the first refresh"""
+        self.embedding_function = embeddings
+        self.directory = directory
+        self.embedding_signature = embedding_signature
+        self.dimension = dimension
+        self._load_documents = load_documents
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._layout = None
+        self._servers = ()
+
+    @property
+    def layout(self):
+        """Layout of the shards being searched"""
+        self.refresh()
+        return self._layout
+
+    @property
+    def shard_directories(self):
+        """Segment directory of each shard"""
+        layout = self.layout
+        return layout_shard_directories(self.directory, layout) if layout else []
+
+    def manifests(self):
+        """Latest manifest of each shard (None for a shard nothing was published to)"""
+        return [read_manifest(directory) for directory in self.shard_directories]
+
+    @property
+    def vector_count(self):
+        """Live vectors across the shards"""
+        return sum(count_vectors(manifest)[0] for manifest in self.manifests() if manifest)
+
+    def refresh(self):
+        """Restart the shard servers on the current layout if it changed; returns True if it did"""
+        path = os.path.join(self.directory, LAYOUT_FILE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return False
+        with self._lock:
+            if stamp == self._stamp:
+                return False
+            layout = read_layout(self.directory)
+            old_servers = self._servers
+            self._servers = tuple(
+                ShardServer(directory, self.dimension) for directory in layout_shard_directories(self.directory, layout)
+            )
+            self._layout = layout
+            self._stamp = stamp
+        for server in old_servers:
+            server.stop()
+        logger.info(f"Started {layout['shards']} FAISS shard servers (sharded by {layout['key']})")
+        return True
+
+    def close(self):
+        """Stop the shard servers"""
+        with self._lock:
+            servers, self._servers, self._stamp = self._servers, (), None
+        for server in servers:
+            server.stop()
+
+    def _scatter(self, request):
+        """Send a search request to every shard server; returns their answers in shard order"""
+        self.refresh()
+        servers = self._servers
+        # Locks are taken in shard order, so concurrent queries follow each other
+        # through the shards without deadlocking
+        sent = []
+        results = []
+        try:
+            for server in servers:
+                server.lock.acquire()
+                sent.append(server)
+                server.connection.send(request)
+            while sent:
+                server = sent[0]
+                try:
+                    results.append(server.connection.recv())
+                finally:
+                    sent.pop(0)
+                    server.lock.release()
+        except (EOFError, OSError) as e:
+            # A server died; start them again for the next query. Servers that were
+            # sent this query are closed, so no other query reads its answer.
+            self._stamp = None
+            for server in sent:
+                server.connection.close()
+            raise RuntimeError(f"Lost a FAISS shard server: {str(e)}")
+        finally:
+            for server in sent:
+                server.lock.release()
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def search_vector_ids(self, embedding, k, allowed_chunk_ids=None):
+        """Search every shard for an embedding; returns the k nearest (vector id, L2 distance)
+
+        With allowed_chunk_ids only those vectors are searched.
+        """
+        results = self._scatter((np.asarray(embedding, dtype=np.float32), k, allowed_chunk_ids))
+        # Each shard's hits are sorted by distance already
+        return list(islice(heapq.merge(*results, key=lambda hit: hit[1]), k))
+
+    def search_vector_ids_batch(self, embeddings, k, allowed_chunk_ids=None):
+        """Search every shard for several embeddings, sending each shard the whole query matrix at once"""
+        if not len(embeddings):
+            return []
+        results = self._scatter((np.asarray(embeddings, dtype=np.float32), k, allowed_chunk_ids))
+        return [
+            list(islice(heapq.merge(*row_results, key=lambda hit: hit[1]), k))
+            for row_results in zip(*results)
+        ]
+
+    def _publish_to_shards(self, plan_changes, **fields):
+        """Publish changes to the shards under the shared layout lock
+
+        plan_changes maps the current layout to a dict of shard to publish_changes
+        arguments. It is called under the lock, so a rebalance can't change the
+        layout between routing the changes and publishing them.
+        """
+        with layout_lock(self.directory, exclusive=False):
+            self.refresh()
+            changes = plan_changes(self._layout)
+            for shard, directory in enumerate(layout_shard_directories(self.directory, self._layout)):
+                if shard in changes or fields:
+                    publish_changes(directory, self.embedding_signature, self.dimension, **changes.get(shard, {}), **fields)
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        """Publish precomputed embeddings as a new segment of each shard they go to
+
+        ids must be chunk ids. With the document shard key, metadatas must hold
+        each vector's document_id. Their content hashes are stored with the vectors.
+        """
+        import faiss
+        text_embeddings = list(text_embeddings)
+        if not text_embeddings:
+            return []
+        if not ids or not all(str(vector_id).isdigit() for vector_id in ids):
+            raise ValueError("The sharded index needs chunk ids as vector ids")
+        metadatas = metadatas or [{} for _ in ids]
+        vectors = np.asarray([embedding for _, embedding in text_embeddings], dtype=np.float32)
+
+        def plan_changes(layout):
+            route = shard_router(layout)
+            positions = {}
+            for position, (vector_id, metadata) in enumerate(zip(ids, metadatas)):
+                positions.setdefault(route(vector_id, metadata), []).append(position)
+            changes = {}
+            for shard, shard_positions in positions.items():
+                index = faiss.IndexFlatL2(self.dimension)
+                index.add(vectors[shard_positions])
+                changes[shard] = {
+                    "index": index,
+                    "chunk_ids": [int(ids[position]) for position in shard_positions],
+                    "content_hashes": [metadatas[position].get("content_hash") for position in shard_positions]
+                }
+            return changes
+
+        self._publish_to_shards(plan_changes)
+        return list(ids)
+
+    def delete(self, ids=None, **kwargs):
+        """Publish the deletion of vectors by id to the shards holding them"""
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        chunk_ids = [int(vector_id) for vector_id in ids if str(vector_id).isdigit()]
+
+        def plan_changes(layout):
+            if layout["key"] == "document":
+                # A vector's document isn't known from its id; shards skip ids they don't hold
+                return {shard: {"deleted_chunk_ids": chunk_ids} for shard in range(layout["shards"])}
+            changes = {}
+            for chunk_id in chunk_ids:
+                changes.setdefault(shard_of(chunk_id, layout["shards"]), {"deleted_chunk_ids": []})["deleted_chunk_ids"].append(chunk_id)
+            return changes
+
+        self._publish_to_shards(plan_changes)
+        return True
+
+    def publish_fields(self, **fields):
+        """Record fields in every shard's manifest"""
+        self._publish_to_shards(lambda layout: {}, **fields)
+
+if __name__ == "__main__":
+    serve_shard(sys.argv[1], int(sys.argv[2]), Connection(int(sys.argv[3])))
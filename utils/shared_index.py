@@ -0,0 +1,516 @@
+"""
+Flat FAISS index shared between processes as immutable memory-mapped segments.
+
+With FAISS_SHARED_INDEX on, each gunicorn worker stops building and holding its
+own copy of the index. The vectors live in segment files under FAISS_SEGMENT_DIR,
+and every worker maps them read-only. The OS page cache then holds one copy of
+them however many workers there are. A worker's own memory doesn't grow with the
+corpus, because the texts of results are read from the database instead of being
+kept in a docstore.
+
+A segment is a flat FAISS index file plus the chunk ids of its vectors and the
+content hashes of the texts they were embedded from, and it is never modified. A write publishes a new generation instead: manifest.json lists
+the segments and the positions deleted from each, and is replaced atomically. A
+new segment holds any added vectors. Workers check the manifest before each
+search and map only the segments they don't have yet. Segment files a generation
+no longer lists are removed; workers that still map them keep reading them until
+they move on.
+
+Once there are FAISS_MAX_SEGMENTS segments, or deleted vectors take up
+VECTOR_COMPACTION_THRESHOLD_PERCENT of them, the segments are merged into one.
+The merge reads the current segments and writes the merged one without holding
+the publish lock. Anything published in the meantime is carried over when the
+merged segment is swapped in.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores import FAISS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "publish.lock"
+SEGMENTS_DIR = "segments"
+INDEX_SUFFIX = ".faiss"
+IDS_SUFFIX = ".ids.npy"
+HASHES_SUFFIX = ".hashes.npy"
+SEGMENT_SUFFIXES = (INDEX_SUFFIX, IDS_SUFFIX, HASHES_SUFFIX)
+
+# Hex sha256 digests; an empty one stands for an unknown hash
+HASH_DTYPE = "S64"
+
+# Vectors copied at a time when merging segments
+MERGE_BATCH_SIZE = 50000
+
+# Threads of one process are serialized per directory, since flock doesn't tell them apart
+_publish_thread_locks = {}
+_publish_thread_locks_guard = threading.Lock()
+
+def _segment_path(directory, name, suffix):
+    return os.path.join(directory, SEGMENTS_DIR, f"{name}{suffix}")
+
+@contextmanager
+def publish_lock(directory):
+    """Hold the lock that serializes publishing across threads and processes"""
+    os.makedirs(os.path.join(directory, SEGMENTS_DIR), exist_ok=True)
+    with _publish_thread_locks_guard:
+        thread_lock = _publish_thread_locks.setdefault(os.path.abspath(directory), threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(directory, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_manifest(directory):
+    """Read the latest generation's manifest, or None if nothing was published"""
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def new_manifest(embedding_signature, dimension):
+    """Manifest of an empty index, to be filled in and committed"""
+    return {
+        "generation": 0,
+        "embedding_signature": embedding_signature,
+        "dimension": dimension,
+        "segments": [],
+        "chunk_count": 0,
+        "max_chunk_id": 0,
+        # Segments of manifests without this were written before content hashes were kept
+        "content_hashes": True
+    }
+
+def commit_manifest(directory, manifest):
+    """Publish a manifest as the next generation and remove the segment files no longer listed
+
+    Call while holding publish_lock.
+    """
+    manifest = {**manifest, "generation": manifest["generation"] + 1, "published_at": time.time()}
+    path = os.path.join(directory, MANIFEST_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+
+    # Workers still mapping a removed file keep reading it until they refresh
+    listed = {segment["name"] for segment in manifest["segments"]}
+    for filename in os.listdir(os.path.join(directory, SEGMENTS_DIR)):
+        for suffix in SEGMENT_SUFFIXES:
+            if filename.endswith(suffix) and filename[:-len(suffix)] not in listed:
+                os.remove(os.path.join(directory, SEGMENTS_DIR, filename))
+    return manifest
+
+def _hash_array(content_hashes, count):
+    """Content hashes as a HASH_DTYPE array, empty where unknown"""
+    if content_hashes is None:
+        return np.zeros(count, dtype=HASH_DTYPE)
+    return np.array([content_hash or "" for content_hash in content_hashes], dtype=HASH_DTYPE).reshape(count)
+
+def write_segment(directory, index, chunk_ids, temporary=False, content_hashes=None):
+    """Write a flat index, the chunk ids at its positions and their content hashes as a new segment
+
+    Returns the segment's manifest entry. A temporary segment is written under
+    names commit_manifest leaves alone, for rename_segment to put in place once
+    it is listed.
+    """
+    import faiss
+    name = uuid.uuid4().hex
+    suffix = ".tmp" if temporary else ""
+    os.makedirs(os.path.join(directory, SEGMENTS_DIR), exist_ok=True)
+    faiss.write_index(index, _segment_path(directory, name, INDEX_SUFFIX + suffix))
+    with open(_segment_path(directory, name, HASHES_SUFFIX + suffix), 'wb') as f:
+        np.save(f, _hash_array(content_hashes, int(index.ntotal)))
+    with open(_segment_path(directory, name, IDS_SUFFIX + suffix), 'wb') as f:
+        np.save(f, np.asarray(chunk_ids, dtype=np.int64))
+    return {"name": name, "vectors": int(index.ntotal), "deleted": []}
+
+def rename_segment(directory, name):
+    """Put a temporary segment written by write_segment in place"""
+    for suffix in SEGMENT_SUFFIXES:
+        os.replace(_segment_path(directory, name, suffix + ".tmp"), _segment_path(directory, name, suffix))
+
+def remove_segment(directory, name, temporary=False):
+    """Remove a segment's files"""
+    suffix = ".tmp" if temporary else ""
+    for segment_suffix in SEGMENT_SUFFIXES:
+        path = _segment_path(directory, name, segment_suffix + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+def _load_hashes(directory, segment):
+    """Content hashes of a segment's vectors, all unknown for a segment written before they were kept"""
+    path = _segment_path(directory, segment["name"], HASHES_SUFFIX)
+    if not os.path.exists(path):
+        return np.zeros(segment["vectors"], dtype=HASH_DTYPE)
+    return np.load(path, mmap_mode='r')
+
+def map_segment(directory, name):
+    """Map a segment read-only; returns (index, chunk ids)"""
+    import faiss
+    index = faiss.read_index(_segment_path(directory, name, INDEX_SUFFIX), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    return index, np.load(_segment_path(directory, name, IDS_SUFFIX), mmap_mode='r')
+
+def mark_deleted(directory, manifest, chunk_ids):
+    """Add the positions of chunk ids to the deleted positions of the segments holding them
+
+    Returns the number of vectors newly deleted. Call while holding publish_lock.
+    """
+    chunk_ids = np.asarray(sorted(chunk_ids), dtype=np.int64)
+    deleted = 0
+    for segment in manifest["segments"]:
+        ids = np.load(_segment_path(directory, segment["name"], IDS_SUFFIX), mmap_mode='r')
+        positions = np.flatnonzero(np.isin(ids, chunk_ids))
+        if len(positions):
+            merged = np.union1d(segment["deleted"], positions).astype(np.int64)
+            deleted += len(merged) - len(segment["deleted"])
+            segment["deleted"] = merged.tolist()
+    return deleted
+
+def live_chunk_ids(directory, manifest):
+    """Chunk ids of the vectors a manifest's segments hold and haven't deleted"""
+    live = []
+    for segment in manifest["segments"]:
+        ids = np.load(_segment_path(directory, segment["name"], IDS_SUFFIX), mmap_mode='r')
+        live.append(np.delete(np.asarray(ids), segment["deleted"]))
+    return np.concatenate(live) if live else np.empty(0, dtype=np.int64)
+
+def live_content_hashes(directory, manifest):
+    """Content hashes of the vectors live_chunk_ids returns, in the same order, None where unknown"""
+    live = [np.delete(np.asarray(_load_hashes(directory, segment)), segment["deleted"]) for segment in manifest["segments"]]
+    hashes = np.concatenate(live) if live else np.empty(0, dtype=HASH_DTYPE)
+    return [content_hash.decode() or None for content_hash in hashes.tolist()]
+
+def count_vectors(manifest):
+    """(live vectors, deleted vectors) of a manifest's segments"""
+    deleted = sum(len(segment["deleted"]) for segment in manifest["segments"])
+    return sum(segment["vectors"] for segment in manifest["segments"]) - deleted, deleted
+
+def needs_merge(manifest, max_segments, deleted_threshold):
+    """Whether a manifest's segments are many or deleted enough to be merged"""
+    if manifest is None or (len(manifest["segments"]) < 2 and not any(segment["deleted"] for segment in manifest["segments"])):
+        return False
+    live, deleted = count_vectors(manifest)
+    return len(manifest["segments"]) >= max_segments or (live + deleted and deleted / (live + deleted) >= deleted_threshold)
+
+def publish_changes(directory, embedding_signature, dimension, index=None, chunk_ids=(), deleted_chunk_ids=(),
+                    content_hashes=None, **fields):
+    """Publish a generation with an added segment (a flat index, its chunk ids and content hashes) and deleted chunk ids
+
+    fields are recorded in the manifest. Returns the new manifest.
+    """
+    with publish_lock(directory):
+        manifest = read_manifest(directory)
+        if manifest is None or manifest["embedding_signature"] != embedding_signature:
+            manifest = new_manifest(embedding_signature, dimension)
+        if len(deleted_chunk_ids):
+            mark_deleted(directory, manifest, deleted_chunk_ids)
+        if index is not None and index.ntotal:
+            manifest["segments"].append(write_segment(directory, index, chunk_ids, content_hashes=content_hashes))
+        manifest.update(fields)
+        return commit_manifest(directory, manifest)
+
+def begin_merge(directory, force=False, max_segments=None, deleted_threshold=None):
+    """Take the current manifest as the segments to merge, or None if they don't need merging"""
+    with publish_lock(directory):
+        manifest = read_manifest(directory)
+        if manifest is None or not manifest["segments"]:
+            return None
+        if not force and not needs_merge(manifest, max_segments, deleted_threshold):
+            return None
+        return manifest
+
+def build_merged_segment(directory, state):
+    """Write the live vectors of begin_merge's segments as one temporary segment; needs no lock
+
+    Returns (manifest entry, live positions of each source segment).
+    """
+    import faiss
+    merged = faiss.IndexFlatL2(state["dimension"])
+    chunk_ids = []
+    content_hashes = []
+    sources = {}
+    for segment in state["segments"]:
+        index, ids = map_segment(directory, segment["name"])
+        live = np.setdiff1d(np.arange(index.ntotal, dtype=np.int64), segment["deleted"])
+        for start in range(0, len(live), MERGE_BATCH_SIZE):
+            merged.add(index.reconstruct_batch(live[start:start + MERGE_BATCH_SIZE]))
+        chunk_ids.append(np.asarray(ids)[live])
+        content_hashes.append(np.asarray(_load_hashes(directory, segment))[live])
+        sources[segment["name"]] = live
+        del index, ids
+    entry = write_segment(
+        directory, merged, np.concatenate(chunk_ids) if chunk_ids else [], temporary=True,
+        content_hashes=np.concatenate(content_hashes) if content_hashes else None
+    )
+    return entry, sources
+
+def finish_merge(directory, state, merged):
+    """Swap the merged segment in for its sources; returns the vectors removed, or None if dropped
+
+    Deletes published since begin_merge are carried over to the merged segment, and
+    segments published since are kept after it. The merge is dropped if a source
+    segment is gone (e.g. the index was rebuilt in the meantime).
+    """
+    entry, sources = merged
+    with publish_lock(directory):
+        manifest = read_manifest(directory)
+        current = {segment["name"]: segment for segment in manifest["segments"]} if manifest else {}
+        if manifest is None or manifest["embedding_signature"] != state["embedding_signature"] or \
+                any(name not in current for name in sources):
+            remove_segment(directory, entry["name"], temporary=True)
+            return None
+
+        deleted = []
+        offset = 0
+        for segment in state["segments"]:
+            live = sources[segment["name"]]
+            # Positions deleted since the merge began, found among the live ones it copied
+            newly_deleted = np.setdiff1d(current[segment["name"]]["deleted"], segment["deleted"])
+            deleted.extend((offset + np.searchsorted(live, newly_deleted)).tolist())
+            offset += len(live)
+        entry["deleted"] = sorted(deleted)
+
+        rename_segment(directory, entry["name"])
+        removed = sum(segment["vectors"] for segment in state["segments"]) - entry["vectors"]
+        manifest["segments"] = [entry] + [segment for name, segment in current.items() if name not in sources]
+        commit_manifest(directory, manifest)
+        return removed
+
+class ChunkVectorStore(VectorStore):
+    """LangChain store over vectors keyed by chunk id, whose documents are read from the database
+
+    Subclasses implement search_vector_ids, add_embeddings and delete. Documents
+    come from load_documents, a function of vector ids returning a dict of
+    LangChain documents.
+    """
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def _embed_query(self, text):
+        return self.embedding_function.embed_query(text)
+
+    def _embed_documents(self, texts):
+        return self.embedding_function.embed_documents(texts)
+
+    def search_vector_ids(self, embedding, k, allowed_chunk_ids=None):
+        """Return the k nearest (vector id, L2 distance) to an embedding, only among allowed_chunk_ids if given"""
+        raise NotImplementedError
+
+    def search_vector_ids_batch(self, embeddings, k, allowed_chunk_ids=None):
+        """Return the k nearest (vector id, L2 distance) to each of several embeddings"""
+        return [self.search_vector_ids(embedding, k, allowed_chunk_ids) for embedding in embeddings]
+
+    def _with_documents(self, hits):
+        """Pair search hits with their documents, dropping vectors no chunk refers to any more"""
+        documents = self._load_documents([vector_id for vector_id, _ in hits])
+        return [(documents[vector_id], distance) for vector_id, distance in hits if vector_id in documents]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4):
+        """Return the docs most similar to each of several embeddings, searched together"""
+        hits = self.search_vector_ids_batch(embeddings, k)
+        documents = self._load_documents(list({vector_id for row in hits for vector_id, _ in row}))
+        return [
+            [(documents[vector_id], distance) for vector_id, distance in row if vector_id in documents]
+            for row in hits
+        ]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        """Return docs most similar to the embedding and their L2 distances"""
+        results = self._with_documents(self.search_vector_ids(embedding, k if filter is None else fetch_k))
+        if filter is not None:
+            filter_func = FAISS._create_filter_func(filter)
+            results = [(doc, score) for doc, score in results if filter_func(doc.metadata)]
+        score_threshold = kwargs.get("score_threshold")
+        if score_threshold is not None:
+            results = [(doc, score) for doc, score in results if score <= score_threshold]
+        return results[:k]
+
+    def similarity_search_allowed(self, embedding, k, vector_ids):
+        """Return the docs most similar to the embedding among the allowed vector ids"""
+        chunk_ids = np.array(sorted(int(vector_id) for vector_id in vector_ids if str(vector_id).isdigit()), dtype=np.int64)
+        if not len(chunk_ids):
+            return []
+        return self._with_documents(self.search_vector_ids(embedding, k, chunk_ids))
+
+    def similarity_search_with_score(self, query, k=4, filter=None, fetch_k=20, **kwargs):
+        """Return docs most similar to the query and their L2 distances"""
+        return self.similarity_search_with_score_by_vector(self._embed_query(query), k, filter=filter, fetch_k=fetch_k, **kwargs)
+
+    def similarity_search(self, query, k=4, filter=None, fetch_k=20, **kwargs):
+        """Return docs most similar to the query"""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter=filter, fetch_k=fetch_k, **kwargs)]
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        """Embed texts and add them"""
+        texts = list(texts)
+        embeddings = self.embedding_function.embed_documents(texts)
+        return self.add_embeddings(list(zip(texts, embeddings)), metadatas=metadatas, ids=ids)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError(f"{cls.__name__} is built by utils.vector_store")
+
+class SharedSegmentStore(ChunkVectorStore):
+    """Read-only view of the shared segments, refreshed to the latest generation before each search
+
+    Writes publish a new generation.
+    """
+
+    def __init__(self, embeddings, directory, load_documents, embedding_signature, dimension):
+        """Create a view of the segments in directory; nothing is mapped until the first refresh"""
+        self.embedding_function = embeddings
+        self.directory = directory
+        self.embedding_signature = embedding_signature
+        self.dimension = dimension
+        self._load_documents = load_documents
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._manifest = None
+        # (index, chunk ids, deleted positions, selector skipping them) per segment
+        self._segments = ()
+        self._mapped = {}
+
+    @property
+    def manifest(self):
+        """Manifest of the generation being searched"""
+        self.refresh()
+        return self._manifest
+
+    @property
+    def vector_count(self):
+        """Live vectors in the generation being searched"""
+        return count_vectors(self.manifest)[0] if self.manifest else 0
+
+    def refresh(self):
+        """Map the latest generation if a newer one was published; returns True if it changed"""
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        for _ in range(3):
+            try:
+                # Reading the manifest through the handle that was checked keeps the two consistent
+                with open(path, 'r') as f:
+                    stat = os.fstat(f.fileno())
+                    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                    if stamp == self._stamp:
+                        return False
+                    manifest = json.load(f)
+                with self._lock:
+                    if stamp == self._stamp:
+                        return False
+                    self._map(manifest)
+                    self._stamp = stamp
+                return True
+            except FileNotFoundError:
+                # Nothing published yet, or a segment was merged away before it was mapped
+                if not os.path.exists(path):
+                    return False
+        raise RuntimeError(f"Could not map the shared FAISS segments in {self.directory}")
+
+    def _map(self, manifest):
+        """Map a manifest's segments, reusing the ones already mapped"""
+        import faiss
+        segments = []
+        mapped = {}
+        for segment in manifest["segments"]:
+            index, ids = self._mapped.get(segment["name"]) or map_segment(self.directory, segment["name"])
+            mapped[segment["name"]] = (index, ids)
+            deleted = np.asarray(segment["deleted"], dtype=np.int64)
+            selector = None
+            if len(deleted):
+                excluded = faiss.IDSelectorBatch(deleted)
+                selector = faiss.IDSelectorNot(excluded)
+                # The Python wrapper doesn't keep the wrapped selector alive by itself
+                selector.referenced_selector = excluded
+            segments.append((index, ids, deleted, selector))
+        self._segments = tuple(segments)
+        self._mapped = mapped
+        self._manifest = manifest
+
+    def search_vector_ids(self, embedding, k, allowed_chunk_ids=None):
+        """Search every segment for an embedding; returns the k nearest (vector id, L2 distance)
+
+        With allowed_chunk_ids only those vectors are searched.
+        """
+        return self.search_vector_ids_batch([embedding], k, allowed_chunk_ids)[0]
+
+    def search_vector_ids_batch(self, embeddings, k, allowed_chunk_ids=None):
+        """Search every segment for several embeddings at once, as one query matrix per segment"""
+        import faiss
+        self.refresh()
+        vectors = np.array(embeddings, dtype=np.float32)
+        hits = [[] for _ in range(len(vectors))]
+        for index, ids, deleted, selector in self._segments:
+            if not index.ntotal or not len(vectors):
+                continue
+            params = faiss.SearchParameters()
+            if allowed_chunk_ids is not None:
+                positions = np.setdiff1d(np.flatnonzero(np.isin(ids, allowed_chunk_ids)), deleted)
+                if not len(positions):
+                    continue
+                params.sel = faiss.IDSelectorBatch(positions)
+            elif selector is not None:
+                params.sel = selector
+            distances, positions = index.search(vectors, min(k, index.ntotal), params=params)
+            for row_hits, row_distances, row_positions in zip(hits, distances, positions):
+                row_hits.extend(
+                    (float(distance), str(int(ids[position])))
+                    for distance, position in zip(row_distances, row_positions) if position >= 0
+                )
+        results = []
+        for row_hits in hits:
+            row_hits.sort()
+            results.append([(vector_id, distance) for distance, vector_id in row_hits[:k]])
+        return results
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        """Publish precomputed embeddings as a new segment
+
+        ids must be chunk ids; texts and metadata are read from the database, so
+        only the metadata's content hashes are stored.
+        """
+        import faiss
+        text_embeddings = list(text_embeddings)
+        if not text_embeddings:
+            return []
+        if not ids or not all(str(vector_id).isdigit() for vector_id in ids):
+            raise ValueError("The shared index needs chunk ids as vector ids")
+        index = faiss.IndexFlatL2(self.dimension)
+        index.add(np.asarray([embedding for _, embedding in text_embeddings], dtype=np.float32))
+        publish_changes(
+            self.directory, self.embedding_signature, self.dimension,
+            index=index, chunk_ids=[int(vector_id) for vector_id in ids],
+            content_hashes=[metadata.get("content_hash") for metadata in metadatas] if metadatas else None
+        )
+        self.refresh()
+        return list(ids)
+
+    def delete(self, ids=None, **kwargs):
+        """Publish the deletion of vectors by id"""
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        chunk_ids = [int(vector_id) for vector_id in ids if str(vector_id).isdigit()]
+        publish_changes(self.directory, self.embedding_signature, self.dimension, deleted_chunk_ids=chunk_ids)
+        self.refresh()
+        return True
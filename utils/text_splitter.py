@@ -0,0 +1,189 @@
+"""
+Text splitting for document ingestion.
+
+RecursiveTextSplitter produces the same chunks as LangChain's
+RecursiveCharacterTextSplitter (same separator hierarchy, separators kept at the
+start of the following piece, whitespace stripped), but works on (start, end)
+offsets into the source string instead of splitting and re-joining substrings.
+Only the final chunks are ever copied out of the text.
+
+Files are read in fixed-size blocks and split incrementally, so memory use stays
+flat no matter how large the document is.
+"""
+
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Chunking used for uploaded documents
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Separators tried in order, from paragraph breaks down to single characters
+DEFAULT_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+# Number of characters read from a file at a time
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+class RecursiveTextSplitter:
+    """Offset-based recursive character splitter
+
+    Instances hold no per-call state, so one splitter can be shared by every
+    caller and thread.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=None):
+        """Initialize the splitter"""
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"Chunk overlap ({chunk_overlap}) is larger than chunk size ({chunk_size})"
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators or DEFAULT_SEPARATORS)
+
+    def iter_offsets(self, text):
+        """Yield the (start, end) offsets of each chunk of text"""
+        return self._split(text, 0, len(text), self.separators)
+
+    def split_text(self, text):
+        """Split text into a list of chunk strings"""
+        return [text[start:end] for start, end in self.iter_offsets(text)]
+
+    def split_pages(self, pages):
+        """Split an iterable of page texts, yielding chunks as they are produced
+
+        Pages are split independently, so no chunk spans a page break.
+        """
+        for page in pages:
+            for start, end in self.iter_offsets(page):
+                yield page[start:end]
+
+    def _pieces(self, text, start, end, separator):
+        """Yield the offsets of text[start:end] split before each separator occurrence"""
+        if not separator:
+            for position in range(start, end):
+                yield position, position + 1
+            return
+
+        piece_start = start
+        position = text.find(separator, start, end)
+        while position != -1:
+            if position > piece_start:
+                yield piece_start, position
+            piece_start = position
+            position = text.find(separator, position + len(separator), end)
+        if end > piece_start:
+            yield piece_start, end
+
+    def _split(self, text, start, end, separators):
+        """Recursively split text[start:end], yielding chunk offsets"""
+        # Use the first separator that occurs in this span
+        separator = separators[-1]
+        remaining_separators = []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator = candidate
+                remaining_separators = separators[i + 1:]
+                break
+
+        # Merge runs of small pieces; split oversized pieces with the next separator
+        small_pieces = []
+        for piece_start, piece_end in self._pieces(text, start, end, separator):
+            if piece_end - piece_start < self.chunk_size:
+                small_pieces.append((piece_start, piece_end))
+                continue
+            if small_pieces:
+                yield from self._merge(text, small_pieces)
+                small_pieces = []
+            if remaining_separators:
+                yield from self._split(text, piece_start, piece_end, remaining_separators)
+            else:
+                yield piece_start, piece_end
+        if small_pieces:
+            yield from self._merge(text, small_pieces)
+
+    def _merge(self, text, pieces):
+        """Merge consecutive pieces into chunks of up to chunk_size with chunk_overlap"""
+        window = deque()
+        total = 0
+        for piece_start, piece_end in pieces:
+            length = piece_end - piece_start
+            if total + length > self.chunk_size and window:
+                chunk = self._strip(text, window[0][0], window[-1][1])
+                if chunk:
+                    yield chunk
+                # Drop pieces from the front until what is left fits as the overlap
+                while total > self.chunk_overlap or (total + length > self.chunk_size and total > 0):
+                    dropped_start, dropped_end = window.popleft()
+                    total -= dropped_end - dropped_start
+            window.append((piece_start, piece_end))
+            total += length
+        if window:
+            chunk = self._strip(text, window[0][0], window[-1][1])
+            if chunk:
+                yield chunk
+
+    @staticmethod
+    def _strip(text, start, end):
+        """Offsets of text[start:end] without surrounding whitespace, or None if it is all whitespace"""
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start == end:
+            return None
+        return start, end
+
+# Splitters are stateless, so each configuration is built once and shared
+_splitters = {}
+
+def get_text_splitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=None):
+    """Get the shared text splitter for a chunking configuration"""
+    key = (chunk_size, chunk_overlap, tuple(separators or DEFAULT_SEPARATORS))
+    splitter = _splitters.get(key)
+    if splitter is None:
+        splitter = _splitters.setdefault(key, RecursiveTextSplitter(chunk_size, chunk_overlap, separators))
+    return splitter
+
+def read_text_blocks(file_path, block_size=STREAM_BLOCK_SIZE):
+    """Yield the text of a file in blocks of at most block_size characters"""
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            yield block
+
+def split_text_stream(blocks, text_splitter=None):
+    """Split a stream of text blocks into chunks, yielding each chunk as soon as it is final
+
+    The last chunk of every buffer might continue into the next block, so it is held
+    back and the buffer restarts at that chunk's start. Because that chunk already
+    begins with the overlap from the chunk before it, chunks that straddle a block
+    boundary keep the same overlap as any other pair of neighbouring chunks.
+    """
+    text_splitter = text_splitter or get_text_splitter()
+    buffer = ""
+
+    for block in blocks:
+        buffer += block
+
+        held_back = None
+        final_chunks = 0
+        for offsets in text_splitter.iter_offsets(buffer):
+            if held_back is not None:
+                yield buffer[held_back[0]:held_back[1]]
+                final_chunks += 1
+            held_back = offsets
+
+        if final_chunks:
+            buffer = buffer[held_back[0]:]
+
+
+    # Whatever is left is the end of the document
+    yield from text_splitter.split_text(buffer)
@@ -0,0 +1,301 @@
+"""
+Append-only file of raw chunk embeddings.
+
+Every vector is written once, as a float32 row of vectors-<model>.f32, and the id
+of the chunk it was embedded for is written to the matching row of
+ids-<model>.i64, with the sha256 of the text it was embedded from in the
+matching row of hashes-<model>.sha256. Each embedding model has its own pair of files, named after its
+signature, so processes using different models (say the CLI without an API key
+and the web app with one) never overwrite each other's vectors. Both files are
+read through numpy memory maps, so rebuilding an index, switching vector store
+backend or changing index type reads vectors from local disk instead of calling
+the embedding API again, and processes reading the same file share its pages
+through the OS cache.
+
+Rows are never rewritten. If a chunk id is appended more than once, its last row
+wins. A lookup that gives the content hash it expects skips a row embedded from
+other text, so a vector is never served for text it wasn't made from.
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils.config import get_vector_file_dir
+from utils.embedding import get_embeddings, get_embedding_dimension, get_embedding_signature, embed_documents_array
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+VECTORS_FILE = "vectors-{}.f32"
+IDS_FILE = "ids-{}.i64"
+HASHES_FILE = "hashes-{}.sha256"
+META_FILE = "meta-{}.json"
+LOCK_FILE = "append.lock"
+
+# Files of the single vector file kept before they were named per model
+LEGACY_FILES = {"vectors.f32": VECTORS_FILE, "ids.i64": IDS_FILE, "meta.json": META_FILE}
+
+ID_BYTES = np.dtype(np.int64).itemsize
+# A row of zeros stands for an unknown hash, as in rows written before hashes were kept
+HASH_BYTES = 32
+
+def _digests(content_hashes, count):
+    """Content hashes as a (count, HASH_BYTES) uint8 matrix, with zero rows for missing ones"""
+    digests = np.zeros((count, HASH_BYTES), dtype=np.uint8)
+    if content_hashes is not None:
+        for position, content_hash in enumerate(content_hashes):
+            if content_hash:
+                digests[position] = np.frombuffer(bytes.fromhex(content_hash), dtype=np.uint8)
+    return digests
+
+class VectorFile:
+    """Append-only float32 matrix of embeddings with row-to-chunk-id and row-to-content-hash maps"""
+
+    def __init__(self, directory, dimension, signature):
+        """Open (or create) the vector file for an embedding model
+
+        Vectors stored by other models are in files of their own and left alone.
+        """
+        self.directory = directory
+        self.dimension = dimension
+        self.signature = signature
+        # The signature as a file name part, e.g. "text-embedding-3-small-1536"
+        self.file_key = re.sub(r"[^A-Za-z0-9._-]+", "-", signature)
+        self.row_bytes = dimension * np.dtype(np.float32).itemsize
+        self._lock = threading.Lock()
+
+        # Memory maps of the rows seen so far, and a sorted id index over them
+        self._rows = 0
+        self._matrix = np.empty((0, dimension), dtype=np.float32)
+        self._hashes = np.empty((0, HASH_BYTES), dtype=np.uint8)
+        self._sorted_ids = np.empty(0, dtype=np.int64)
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+
+        os.makedirs(directory, exist_ok=True)
+        with self._append_lock():
+            self._adopt_legacy_files()
+            self._check_meta()
+            self._drop_partial_rows()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name.format(self.file_key))
+
+    @contextmanager
+    def _append_lock(self):
+        """Hold the lock that serializes appends across threads and processes"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._path(LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _adopt_legacy_files(self):
+        """Rename the vector file kept before files were named per model, if this model wrote it"""
+        legacy_meta = os.path.join(self.directory, "meta.json")
+        if not os.path.exists(legacy_meta) or os.path.exists(self._path(META_FILE)):
+            return
+        with open(legacy_meta, 'r') as f:
+            if json.load(f) != {"dimension": self.dimension, "signature": self.signature}:
+                return
+        # The metadata goes last, so an interrupted rename is picked up again next time
+        for legacy_name in ("vectors.f32", "ids.i64", "meta.json"):
+            legacy_path = os.path.join(self.directory, legacy_name)
+            if os.path.exists(legacy_path):
+                os.replace(legacy_path, self._path(LEGACY_FILES[legacy_name]))
+        logger.info(f"Renamed the vector file of {self.signature} to its per-model name")
+
+    def _check_meta(self):
+        """Start new files if there are none for this model, or the ones named after it hold another model's vectors"""
+        meta = {"dimension": self.dimension, "signature": self.signature}
+        meta_path = self._path(META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                if json.load(f) == meta:
+                    return
+            logger.info(f"Vector file {self.file_key} was written by another model, starting a new one for {self.signature}")
+
+        for name in (VECTORS_FILE, HASHES_FILE, IDS_FILE):
+            open(self._path(name), 'wb').close()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def _drop_partial_rows(self):
+        """Truncate what an interrupted append left behind
+
+        Vectors and hashes are written before their ids, so the id count is the
+        number of complete rows. Rows without a hash (written before hashes were
+        kept) get an unknown one.
+        """
+        rows = os.path.getsize(self._path(IDS_FILE)) // ID_BYTES
+        for name, size in ((IDS_FILE, rows * ID_BYTES), (VECTORS_FILE, rows * self.row_bytes)):
+            path = self._path(name)
+            if os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+        hashes_path = self._path(HASHES_FILE)
+        open(hashes_path, 'ab').close()
+        hashed_rows = os.path.getsize(hashes_path) // HASH_BYTES
+        if hashed_rows != rows:
+            os.truncate(hashes_path, min(hashed_rows, rows) * HASH_BYTES)
+            if hashed_rows < rows:
+                with open(hashes_path, 'ab') as f:
+                    f.write(bytes((rows - hashed_rows) * HASH_BYTES))
+
+    def _refresh(self):
+        """Map rows appended since the last look, by this or any other process"""
+        rows = os.path.getsize(self._path(IDS_FILE)) // ID_BYTES
+        if rows == self._rows:
+            return
+        if rows < self._rows:
+            # The file was started again by a process that found another model's vectors in it
+            self._rows = 0
+            self._matrix = np.empty((0, self.dimension), dtype=np.float32)
+            self._hashes = np.empty((0, HASH_BYTES), dtype=np.uint8)
+            self._sorted_ids = np.empty(0, dtype=np.int64)
+            self._sorted_rows = np.empty(0, dtype=np.int64)
+            if rows == 0:
+                return
+
+        self._matrix = np.memmap(self._path(VECTORS_FILE), dtype=np.float32, mode='r', shape=(rows, self.dimension))
+        ids = np.memmap(self._path(IDS_FILE), dtype=np.int64, mode='r', shape=(rows,))
+        # A process of an older version may have appended rows without hashes since the last append
+        hashed_rows = min(rows, os.path.getsize(self._path(HASHES_FILE)) // HASH_BYTES)
+        self._hashes = np.memmap(self._path(HASHES_FILE), dtype=np.uint8, mode='r', shape=(hashed_rows, HASH_BYTES)) \
+            if hashed_rows else np.empty((0, HASH_BYTES), dtype=np.uint8)
+
+        # Keep the last row of each id
+        order = np.argsort(ids, kind='stable')
+        sorted_ids = ids[order]
+        last = np.append(sorted_ids[1:] != sorted_ids[:-1], True)
+        self._sorted_ids = sorted_ids[last]
+        self._sorted_rows = order[last]
+        self._rows = rows
+
+    def __len__(self):
+        """Number of rows in the file"""
+        with self._lock:
+            self._refresh()
+            return self._rows
+
+    def append(self, ids, vectors, content_hashes=None):
+        """Append vectors for the given chunk ids, embedded from text with the given content hashes"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        if vectors.shape != (len(ids), self.dimension):
+            raise ValueError(f"Expected {len(ids)} vectors of dimension {self.dimension}, got shape {vectors.shape}")
+        digests = _digests(content_hashes, len(ids))
+
+        with self._append_lock():
+            self._drop_partial_rows()
+            with open(self._path(VECTORS_FILE), 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self._path(HASHES_FILE), 'ab') as f:
+                f.write(digests.tobytes())
+            with open(self._path(IDS_FILE), 'ab') as f:
+                f.write(ids.tobytes())
+
+    def get(self, ids, content_hashes=None):
+        """Look up vectors by chunk id
+
+        With content_hashes, a stored vector only counts as found if it was
+        embedded from text with that hash (or either hash is unknown).
+        Returns (vectors, found): the stored vectors, in the order of the ids that
+        were found, and a boolean mask over ids marking those found.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            self._refresh()
+            if not len(self._sorted_ids):
+                return np.empty((0, self.dimension), dtype=np.float32), np.zeros(len(ids), dtype=bool)
+            positions = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+            found = self._sorted_ids[positions] == ids
+            if content_hashes is not None:
+                found[found] = self._hash_matches(self._sorted_rows[positions[found]], _digests(content_hashes, len(ids))[found])
+            rows = self._sorted_rows[positions[found]]
+            # Reading sorted rows keeps the access pattern sequential through the map
+            order = np.argsort(rows)
+            vectors = np.empty((len(rows), self.dimension), dtype=np.float32)
+            vectors[order] = self._matrix[rows[order]]
+            return vectors, found
+
+    def _hash_matches(self, rows, digests):
+        """Whether the hashes stored for rows match digests, counting unknown hashes as a match"""
+        stored = np.zeros((len(rows), HASH_BYTES), dtype=np.uint8)
+        hashed = rows < len(self._hashes)
+        stored[hashed] = self._hashes[rows[hashed]]
+        unknown = ~stored.any(axis=1) | ~digests.any(axis=1)
+        return unknown | (stored == digests).all(axis=1)
+
+_vector_file = None
+_vector_file_lock = threading.Lock()
+
+def get_vector_file():
+    """Get the vector file for the current embedding model"""
+    global _vector_file
+    embeddings = get_embeddings()
+    signature = get_embedding_signature(embeddings)
+    directory = get_vector_file_dir()
+    with _vector_file_lock:
+        if _vector_file is None or _vector_file.signature != signature or _vector_file.directory != directory:
+            _vector_file = VectorFile(directory, get_embedding_dimension(embeddings), signature)
+        return _vector_file
+
+def _chunk_ids(vector_ids):
+    """Chunk ids of vector ids, or -1 for an id that isn't one"""
+    return np.array([int(vector_id) if str(vector_id).isdigit() else -1 for vector_id in vector_ids], dtype=np.int64)
+
+def store_vectors(vector_ids, vectors, content_hashes=None):
+    """Append newly embedded vectors, and the content hashes of their texts, to the vector file
+
+    A failure is logged rather than raised: anything missing from the file is
+    embedded again when it is next needed.
+    """
+    try:
+        chunk_ids = _chunk_ids(vector_ids)
+        keep = chunk_ids >= 0
+        if content_hashes is not None:
+            content_hashes = [content_hash for content_hash, kept in zip(content_hashes, keep) if kept]
+        get_vector_file().append(chunk_ids[keep], np.asarray(vectors, dtype=np.float32)[keep], content_hashes)
+    except Exception as e:
+        logger.error(f"Error writing to vector file: {str(e)}")
+
+def load_or_embed_vectors(vector_ids, texts, content_hashes=None):
+    """Get vectors for chunks, reading stored ones from the vector file and embedding the rest
+
+    With content_hashes (of texts, None where unknown), a stored vector embedded
+    from other text is embedded again too.
+    Returns (vectors, embedded): a float32 matrix in the order of vector_ids and
+    the number of texts that had to be embedded.
+    """
+    vector_file = get_vector_file()
+    vectors = np.empty((len(vector_ids), vector_file.dimension), dtype=np.float32)
+    stored, found = vector_file.get(_chunk_ids(vector_ids), content_hashes)
+    vectors[found] = stored
+
+    missing = np.flatnonzero(~found)
+    if len(missing):
+        embedded = embed_documents_array([texts[position] for position in missing])
+        vectors[missing] = embedded
+        store_vectors(
+            [vector_ids[position] for position in missing],
+            embedded,
+            None if content_hashes is None else [content_hashes[position] for position in missing]
+        )
+    return vectors, len(missing)
@@ -1,6 +1,13 @@
+import time
 import uuid
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
 import numpy as np
+from sqlalchemy import func, or_, and_, exists
+from sqlalchemy.orm import aliased
 from langchain_community.vectorstores import FAISS
 from langchain_community.vectorstores import Pinecone as LangchainPinecone
 from langchain.docstore.document import Document as LangchainDocument
@@ -8,17 +15,127 @@ import pinecone
 
 from app import db
 from models import Document, DocumentChunk
-from utils.embedding import get_embeddings
-from utils.config import get_vector_store_type, is_pinecone_available, PINECONE_INDEX_NAME
+from utils.embedding import get_embeddings, get_embedding_dimension, get_embedding_signature, has_embedding_provider
+from utils.config import (
+    get_vector_store_type,
+    is_pinecone_available,
+    get_faiss_snapshot_dir,
+    get_faiss_snapshot_interval,
+    get_pinecone_index_host,
+    get_pinecone_sync_batch_size,
+    get_vector_compaction_threshold,
+    get_vector_quantization,
+    get_vector_prefilter_dimension,
+    is_faiss_shared_index_enabled,
+    get_faiss_segment_dir,
+    get_faiss_max_segments,
+    get_vector_shards,
+    get_vector_shard_key,
+    get_faiss_shard_dir,
+    get_search_mode,
+    PINECONE_INDEX_NAME
+)
+from utils.faiss_snapshot import save_snapshot, load_snapshot
+from utils.ann_index import AnnFAISS, get_index_description, get_search_parameters
+from utils.faiss_store import TombstoneFAISS
+from utils.quantized_index import QuantizedFAISS, get_quantization_description
+from utils.reduced_index import ReducedFAISS
+from utils.shared_index import (
+    ChunkVectorStore,
+    SharedSegmentStore,
+    publish_lock,
+    read_manifest,
+    new_manifest,
+    commit_manifest,
+    write_segment,
+    mark_deleted,
+    live_chunk_ids,
+    live_content_hashes,
+    count_vectors,
+    needs_merge,
+    publish_changes,
+    begin_merge,
+    build_merged_segment,
+    finish_merge
+)
+from utils.sharded_index import (
+    ShardedStore,
+    layout_lock,
+    read_layout,
+    new_layout,
+    layout_matches,
+    layout_shard_directories,
+    commit_layout,
+    shard_router
+)
+from utils.vector_file import load_or_embed_vectors
 from utils.vector_store_reset import get_vector_store_instance, set_vector_store_instance
 
 logger = logging.getLogger(__name__)
 
+# Chunks embedded per call when (re)building the index from the database
+VECTOR_ROW_BATCH_SIZE = 1000
+
+# Vectors per segment written when building shared segments or shards from the database
+SEGMENT_BUILD_SIZE = 100000
+
+# A filtered FAISS search builds an allow-list of vectors to search when the filter
+# allows at most this fraction of the index; a broader filter costs more to resolve
+# than it saves, so the search over-fetches and drops disallowed results instead
+FILTER_PREFILTER_FRACTION = 0.02
+
+# An allow-list of up to this many vectors is scored exactly; a larger one is passed
+# to the index search as an ID selector
+FILTER_EXACT_SEARCH_LIMIT = 20000
+
+# Cap on the HNSW candidate list of a search restricted by an allow-list
+FILTER_MAX_EF_SEARCH = 1024
+
+# Most values Pinecone accepts in one $in filter; a longer allow-list is split across queries
+PINECONE_FILTER_MAX_IDS = 10000
+
+# A hybrid search takes this many results per result it returns from each of the
+# vector and lexical searches, and fuses them
+HYBRID_FETCH_FACTOR = 4
+
+# Rank constant of reciprocal rank fusion: a result at rank r of a search scores 1 / (RRF_K + r)
+RRF_K = 60
+
+# Scores queries against the lexical index while the embedding and vector search run
+_lexical_search_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lexical-search")
+
+# Serializes initialization of, writes to and snapshots of the in-process index
+_write_lock = threading.RLock()
+_last_snapshot_time = 0.0
+
+# Background compaction of the FAISS index, one at a time per process
+_compaction_thread = None
+# Background learning of the two-stage search projection, one at a time per process
+_projection_thread = None
+_compaction_stats = {
+    "compactions": 0,
+    "last_duration_seconds": None,
+    "last_vectors_removed": 0,
+    "last_compacted_at": None
+}
+
+def batched(iterable, batch_size):
+    """Yield lists of up to batch_size items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
 def reset_vector_store():
     """Reset the vector store singleton to force reinitialization
     This is a compatibility function that calls the actual reset in vector_store_reset.py
     """
     from utils.vector_store_reset import reset_vector_store as _reset
+    vector_store = get_vector_store_instance()
+    if isinstance(vector_store, ShardedStore):
+        vector_store.close()
     _reset()
 
 def initialize_pinecone():
@@ -37,11 +154,11 @@ def initialize_pinecone():
         pc = pinecone.Pinecone(api_key=pinecone_api_key)
         
         try:
-            # Check if index exists
+            # Check if index exists (an index given by host is used as is)
             try:
-                index_list = [index.name for index in pc.list_indexes()]
-                
-                if PINECONE_INDEX_NAME not in index_list:
+                if get_pinecone_index_host():
+                    logger.info(f"Using Pinecone index at {get_pinecone_index_host()}")
+                elif PINECONE_INDEX_NAME not in [index.name for index in pc.list_indexes()]:
                     logger.info(f"Pinecone index '{PINECONE_INDEX_NAME}' doesn't exist yet, creating it...")
                     # Create the index
                     try:
@@ -64,7 +181,7 @@ def initialize_pinecone():
             
             # Try to access the index to verify it works
             try:
-                index = pc.Index(PINECONE_INDEX_NAME)
+                index = _get_pinecone_index(pc)
                 # Query the index stats to verify connection
                 stats = index.describe_index_stats()
                 logger.info(f"Successfully connected to Pinecone index: {PINECONE_INDEX_NAME}")
@@ -81,6 +198,530 @@ def initialize_pinecone():
         logger.error(f"Error initializing Pinecone: {str(e)}")
         return False
 
+def _get_pinecone_index(pc=None):
+    """Open the Pinecone index, by host if one is configured, otherwise by name"""
+    if pc is None:
+        import os
+        pc = pinecone.Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+    host = get_pinecone_index_host()
+    if host:
+        return pc.Index(host=host)
+    return pc.Index(PINECONE_INDEX_NAME)
+
+def get_pinecone_store(embeddings=None):
+    """Create a LangChain store over the Pinecone index, without syncing it"""
+    return LangchainPinecone(_get_pinecone_index(), embeddings or get_embeddings(), "text")
+
+def _get_chunk_stats():
+    """Get the number of chunks in the database and the highest chunk id"""
+    chunk_count, max_chunk_id = db.session.query(func.count(DocumentChunk.id), func.max(DocumentChunk.id)).one()
+    return chunk_count, max_chunk_id or 0
+
+def _get_vector_hashes():
+    """Map the id of every vector the database's chunks refer to onto the content hash of its text
+
+    The hash is None for chunks stored before content hashes were recorded.
+    """
+    return dict(db.session.query(DocumentChunk.vector_id, DocumentChunk.content_hash).distinct())
+
+def _changed_vector_ids(stored_hashes, database_hashes):
+    """Ids whose stored vector was embedded from other text than their chunk now has
+
+    Both arguments map vector ids onto content hashes. A vector stored without
+    a hash can't be checked against a chunk that has one, so it counts as changed.
+    """
+    return {
+        vector_id for vector_id, content_hash in stored_hashes.items()
+        if database_hashes.get(vector_id, content_hash) not in (None, content_hash)
+    }
+
+def _has_vector_id(vector_ids):
+    """Condition matching chunks whose vector id is one of vector_ids
+
+    Unlike DocumentChunk.vector_id.in_() this can use the embedding_id and
+    primary key indexes.
+    """
+    # Chunks stored before vector ids were recorded use their own id
+    legacy_ids = [int(vector_id) for vector_id in vector_ids if vector_id.isdigit()]
+    return or_(
+        DocumentChunk.embedding_id.in_(vector_ids),
+        and_(DocumentChunk.embedding_id.is_(None), DocumentChunk.id.in_(legacy_ids))
+    )
+
+def _is_first_chunk_of_vector():
+    """Condition matching the lowest-id chunk that refers to each vector
+
+    That is the chunk the vector was stored for or, if that chunk was deleted
+    while copies of its content remain, the earliest remaining copy.
+    """
+    earlier = aliased(DocumentChunk)
+    # Chunks stored before vector ids were recorded have a vector of their own
+    return or_(
+        DocumentChunk.embedding_id.is_(None),
+        ~exists().where(earlier.embedding_id == DocumentChunk.embedding_id, earlier.id < DocumentChunk.id)
+    )
+
+def _iter_vector_rows(vector_ids=None, chunk_id_range=None):
+    """Yield (vector id, text, metadata) once per vector id referred to by the database's chunks
+
+    With vector_ids, only those vectors are loaded. With chunk_id_range, an
+    (exclusive lower, inclusive upper) pair of chunk ids, only vectors whose
+    lowest-id chunk (see _is_first_chunk_of_vector) is in that range are
+    streamed. Otherwise every chunk is streamed.
+    """
+    query = db.session.query(
+        DocumentChunk.id,
+        DocumentChunk.content,
+        DocumentChunk.chunk_index,
+        DocumentChunk.content_hash,
+        DocumentChunk.embedding_id,
+        Document.id,
+        Document.title
+    ).join(Document, DocumentChunk.document_id == Document.id)
+
+    if chunk_id_range is not None:
+        after_chunk_id, up_to_chunk_id = chunk_id_range
+        # Chunks that reuse an earlier chunk's vector don't bring a vector of their own
+        query = query.filter(
+            DocumentChunk.id > after_chunk_id,
+            DocumentChunk.id <= up_to_chunk_id,
+            _is_first_chunk_of_vector()
+        )
+
+    if vector_ids is None:
+        queries = [query.order_by(DocumentChunk.id).yield_per(VECTOR_ROW_BATCH_SIZE)]
+    else:
+        queries = []
+        for batch in batched(sorted(vector_ids), 500):
+            queries.append(query.filter(_has_vector_id(batch)).order_by(DocumentChunk.id))
+
+    seen_vector_ids = set()
+    for rows in queries:
+        for chunk_id, content, chunk_index, content_hash, embedding_id, document_id, document_title in rows:
+            vector_id = embedding_id or str(chunk_id)
+            if vector_id in seen_vector_ids or not content:
+                continue
+            seen_vector_ids.add(vector_id)
+            yield vector_id, content, {
+                "chunk_id": chunk_id,
+                "document_id": document_id,
+                "document_title": document_title,
+                "chunk_index": chunk_index,
+                "content_hash": content_hash
+            }
+
+def _append_vectors(vector_store, rows):
+    """Add rows from _iter_vector_rows to a FAISS store, in batches
+
+    Vectors are read from the vector file; only rows missing from it, or stored
+    there for other text, are embedded.
+    Returns the number of vectors added and the number that had to be embedded.
+    """
+    added = 0
+    embedded = 0
+    for batch in batched(rows, VECTOR_ROW_BATCH_SIZE):
+        vector_ids, texts, metadatas = zip(*batch)
+        content_hashes = [metadata["content_hash"] for metadata in metadatas]
+        vectors, batch_embedded = load_or_embed_vectors(vector_ids, texts, content_hashes)
+        vector_store.add_embeddings(
+            text_embeddings=list(zip(texts, vectors)),
+            metadatas=list(metadatas),
+            ids=list(vector_ids)
+        )
+        added += len(batch)
+        embedded += batch_embedded
+    return added, embedded
+
+def _flat_store_class():
+    """Store class of the flat index: plain, compressed (VECTOR_QUANTIZATION) and/or two-stage (VECTOR_PREFILTER_DIMENSION)"""
+    if get_vector_prefilter_dimension():
+        return ReducedFAISS
+    return TombstoneFAISS if get_vector_quantization() == "none" else QuantizedFAISS
+
+def _create_empty_faiss(embeddings, approximate=False):
+    """Create an empty FAISS store for an embeddings model, flat (possibly compressed) or approximate"""
+    import faiss
+    dimension = get_embedding_dimension(embeddings)
+    if approximate:
+        return AnnFAISS.create(embeddings, dimension)
+    store_class = _flat_store_class()
+    if store_class is not TombstoneFAISS:
+        return store_class.create(embeddings, dimension)
+    return TombstoneFAISS.create(embeddings, faiss.IndexFlatL2(dimension))
+
+def _describe_index(vector_store):
+    """Describe the kind of index a FAISS store uses, for the snapshot manifest"""
+    if isinstance(vector_store, AnnFAISS):
+        return get_index_description(vector_store.index_type)
+    if isinstance(vector_store, QuantizedFAISS):
+        return get_quantization_description(vector_store.quantization)
+    return "flat"
+
+def _load_faiss(embeddings, approximate=False):
+    """Load the FAISS index from its snapshot, bringing it up to date with the database
+
+    The snapshot is used as is when the corpus version it reflects is the database's.
+    Otherwise only the vectors missing from it are added, vectors no chunk
+    refers to any more are dropped, and vectors whose content hash isn't their
+    chunk's (an id that came to name other text) are replaced. Without a usable snapshot (or with one of another
+    index type) the index is built from scratch. Either way vectors come from the
+    vector file where possible, and a fresh snapshot is saved afterwards.
+
+    With approximate set the store is an AnnFAISS over an HNSW or IVF index, and
+    otherwise a flat one, compressed if VECTOR_QUANTIZATION is set.
+    """
+    from utils.document_processor import get_corpus_version
+    start_time = time.perf_counter()
+    # Read before the index is caught up, so a write landing meanwhile is caught up again next time
+    corpus_version = get_corpus_version()
+    vector_store, manifest = load_snapshot(
+        get_faiss_snapshot_dir(),
+        embeddings,
+        get_embedding_signature(embeddings),
+        index_description=get_index_description() if approximate else get_quantization_description(),
+        store_class=AnnFAISS if approximate else _flat_store_class()
+    )
+
+    if vector_store is not None and manifest.get("corpus_version") == corpus_version:
+        vector_store.corpus_version = corpus_version
+        logger.info(
+            f"Loaded FAISS snapshot with {len(vector_store.index_to_docstore_id)} vectors "
+            f"in {time.perf_counter() - start_time:.2f}s"
+        )
+        if _compact_at_startup(vector_store):
+            _save_faiss_snapshot(vector_store)
+        return vector_store
+
+    if vector_store is None:
+        vector_store = _create_empty_faiss(embeddings, approximate)
+        added, embedded = _append_vectors(vector_store, _iter_vector_rows())
+        logger.info(
+            f"Built FAISS index with {added} vectors ({embedded} embedded, the rest read from "
+            f"the vector file) in {time.perf_counter() - start_time:.2f}s"
+        )
+    else:
+        stored_hashes = _stored_content_hashes(vector_store)
+        database_hashes = _get_vector_hashes()
+        changed_ids = _changed_vector_ids(stored_hashes, database_hashes)
+        stale_ids = (set(stored_hashes) - set(database_hashes)) | changed_ids
+        if stale_ids:
+            vector_store.delete(ids=list(stale_ids))
+        missing_ids = (set(database_hashes) - set(stored_hashes)) | changed_ids
+        added, embedded = _append_vectors(vector_store, _iter_vector_rows(missing_ids)) if missing_ids else (0, 0)
+        logger.info(
+            f"Loaded FAISS snapshot and caught up with the database ({added} vectors added, "
+            f"{embedded} of them embedded, {len(stale_ids) - len(changed_ids)} removed, {len(changed_ids)} "
+            f"re-added because their chunk's text changed) in {time.perf_counter() - start_time:.2f}s"
+        )
+        _compact_at_startup(vector_store)
+
+    vector_store.corpus_version = corpus_version
+    _save_faiss_snapshot(vector_store)
+    return vector_store
+
+def _stored_content_hashes(vector_store):
+    """Map the id of every vector in a FAISS store onto the content hash it was stored with"""
+    return {
+        vector_id: vector_store.docstore.search(vector_id).metadata.get("content_hash")
+        for vector_id in vector_store.index_to_docstore_id.values()
+    }
+
+def _compact_at_startup(vector_store):
+    """Compact a freshly loaded index if enough of it is deleted; returns True if it was
+
+    Nothing is searching it yet, so this is done in one go rather than in the background.
+    """
+    if vector_store.deleted_ratio < get_vector_compaction_threshold():
+        return False
+    start_time = time.perf_counter()
+    _record_compaction(vector_store.compact(), time.perf_counter() - start_time)
+    return True
+
+def _load_vector_documents(vector_ids):
+    """Build the LangChain documents of vectors from the chunks that hold them"""
+    return {
+        vector_id: LangchainDocument(id=vector_id, page_content=text, metadata=metadata)
+        for vector_id, text, metadata in _iter_vector_rows(set(vector_ids))
+    }
+
+def _write_row_segments(directories, manifests, route, rows, dimension):
+    """Write the vectors of rows from _iter_vector_rows as new segments of the directories route picks
+
+    route maps a (vector id, metadata) pair to a position in directories. Each
+    directory gets a segment per SEGMENT_BUILD_SIZE vectors, added to its entry in
+    manifests for the caller to commit. Returns (vectors written, vectors embedded).
+    """
+    import faiss
+    pending = [([], [], []) for _ in directories]
+    written = 0
+    embedded = 0
+
+    def flush(position):
+        vectors, chunk_ids, content_hashes = pending[position]
+        index = faiss.IndexFlatL2(dimension)
+        index.add(np.concatenate(vectors))
+        manifests[position]["segments"].append(
+            write_segment(directories[position], index, chunk_ids, content_hashes=content_hashes)
+        )
+        pending[position] = ([], [], [])
+
+    for batch in batched(rows, VECTOR_ROW_BATCH_SIZE):
+        vector_ids, texts, metadatas = zip(*batch)
+        content_hashes = [metadata["content_hash"] for metadata in metadatas]
+        vectors, batch_embedded = load_or_embed_vectors(vector_ids, texts, content_hashes)
+        positions = np.array([route(vector_id, metadata) for vector_id, metadata in zip(vector_ids, metadatas)])
+        for position in np.unique(positions):
+            selected = np.flatnonzero(positions == position)
+            pending[position][0].append(vectors[selected])
+            pending[position][1].extend(int(vector_ids[row]) for row in selected)
+            pending[position][2].extend(content_hashes[row] for row in selected)
+            if len(pending[position][1]) >= SEGMENT_BUILD_SIZE:
+                flush(position)
+        written += len(batch)
+        embedded += batch_embedded
+    for position, (_, chunk_ids, _) in enumerate(pending):
+        if chunk_ids:
+            flush(position)
+    return written, embedded
+
+def _catch_up_segments(directories, manifests, route, dimension):
+    """Bring segment directories up to date with the database's chunks
+
+    Vectors no chunk refers to any more are marked deleted, and vectors missing
+    from every directory are written as new segments where route puts them.
+    Vectors whose content hash isn't their chunk's (including those of segments
+    written before hashes were kept) are marked deleted and written again. The
+    caller commits manifests. Returns (vectors added, vectors embedded, vectors removed).
+    """
+    stored = {}
+    stored_hashes = {}
+    for position, (directory, manifest) in enumerate(zip(directories, manifests)):
+        chunk_ids = live_chunk_ids(directory, manifest).tolist()
+        stored.update((str(chunk_id), position) for chunk_id in chunk_ids)
+        stored_hashes.update(zip(map(str, chunk_ids), live_content_hashes(directory, manifest)))
+        manifest["content_hashes"] = True
+    database_hashes = _get_vector_hashes()
+    changed_ids = _changed_vector_ids(stored_hashes, database_hashes)
+
+    stale_ids = (set(stored) - set(database_hashes)) | changed_ids
+    for position, (directory, manifest) in enumerate(zip(directories, manifests)):
+        deleted = [int(vector_id) for vector_id in stale_ids if stored[vector_id] == position]
+        if deleted:
+            mark_deleted(directory, manifest, deleted)
+    missing_ids = (set(database_hashes) - set(stored)) | changed_ids
+    added, embedded = _write_row_segments(directories, manifests, route, _iter_vector_rows(missing_ids), dimension) \
+        if missing_ids else (0, 0)
+    return added, embedded, len(stale_ids) - len(changed_ids)
+
+def _load_shared_faiss(embeddings):
+    """Bring the shared FAISS segments up to date with the database and map them
+
+    The first process to get here builds or catches up the segments, under the
+    publish lock; the others wait for it and then only map what it published.
+    """
+    start_time = time.perf_counter()
+    directory = get_faiss_segment_dir()
+    signature = get_embedding_signature(embeddings)
+    dimension = get_embedding_dimension(embeddings)
+    single_directory = lambda vector_id, metadata: 0
+    with publish_lock(directory):
+        manifest = read_manifest(directory)
+        chunk_count, max_chunk_id = _get_chunk_stats()
+        if manifest is None or manifest["embedding_signature"] != signature:
+            manifest = new_manifest(signature, dimension)
+            added, embedded = _write_row_segments([directory], [manifest], single_directory, _iter_vector_rows(), dimension)
+            manifest.update(chunk_count=chunk_count, max_chunk_id=max_chunk_id)
+            commit_manifest(directory, manifest)
+            logger.info(
+                f"Built shared FAISS segments with {added} vectors ({embedded} embedded) "
+                f"in {time.perf_counter() - start_time:.2f}s"
+            )
+        elif manifest.get("chunk_count") != chunk_count or manifest.get("max_chunk_id") != max_chunk_id \
+                or not manifest.get("content_hashes"):
+            added, embedded, removed = _catch_up_segments([directory], [manifest], single_directory, dimension)
+            manifest.update(chunk_count=chunk_count, max_chunk_id=max_chunk_id)
+            commit_manifest(directory, manifest)
+            logger.info(
+                f"Caught up shared FAISS segments with the database ({added} vectors added, "
+                f"{embedded} of them embedded, {removed} removed) in {time.perf_counter() - start_time:.2f}s"
+            )
+
+    vector_store = SharedSegmentStore(embeddings, directory, _load_vector_documents, signature, dimension)
+    vector_store.refresh()
+    logger.info(
+        f"Mapped {len(vector_store.manifest['segments'])} shared FAISS segments with "
+        f"{vector_store.vector_count} vectors in {time.perf_counter() - start_time:.2f}s"
+    )
+    return vector_store
+
+def _build_shards(directory, shards, shard_key, signature, dimension):
+    """Partition every vector into the shards of a new layout, not yet committed; returns (layout, vectors, embedded)
+
+    Nothing else uses the new layout's directories, so this needs no lock.
+    """
+    layout = new_layout(shards, shard_key, signature, dimension)
+    directories = layout_shard_directories(directory, layout)
+    manifests = [new_manifest(signature, dimension) for _ in directories]
+    added, embedded = _write_row_segments(directories, manifests, shard_router(layout), _iter_vector_rows(), dimension)
+    chunk_count, max_chunk_id = _get_chunk_stats()
+    for shard_directory, manifest in zip(directories, manifests):
+        manifest.update(chunk_count=chunk_count, max_chunk_id=max_chunk_id)
+        with publish_lock(shard_directory):
+            commit_manifest(shard_directory, manifest)
+    return layout, added, embedded
+
+def _catch_up_shards(directory, layout, force=False):
+    """Bring a layout's shards up to date with the database; returns (added, embedded, removed) or None if they were
+
+    Unless forced, shards whose manifests record the database's chunk count and
+    highest chunk id (and content hashes) are taken to be up to date.
+    Call while holding layout_lock exclusively.
+    """
+    directories = layout_shard_directories(directory, layout)
+    chunk_count, max_chunk_id = _get_chunk_stats()
+    with ExitStack() as stack:
+        for shard_directory in directories:
+            stack.enter_context(publish_lock(shard_directory))
+        manifests = [
+            read_manifest(shard_directory) or new_manifest(layout["embedding_signature"], layout["dimension"])
+            for shard_directory in directories
+        ]
+        if not force and all(
+            manifest.get("chunk_count") == chunk_count and manifest.get("max_chunk_id") == max_chunk_id
+            and manifest.get("content_hashes") for manifest in manifests
+        ):
+            return None
+        caught_up = _catch_up_segments(directories, manifests, shard_router(layout), layout["dimension"])
+        for shard_directory, manifest in zip(directories, manifests):
+            manifest.update(chunk_count=chunk_count, max_chunk_id=max_chunk_id)
+            commit_manifest(shard_directory, manifest)
+    return caught_up
+
+def _load_sharded_faiss(embeddings):
+    """Bring the FAISS index shards up to date with the database and start their search servers
+
+    If VECTOR_SHARDS or VECTOR_SHARD_KEY changed since the shards were built, they
+    are built again first (see rebalance_vector_shards). The first process to get
+    here does the work under the layout lock; the others wait for it.
+    """
+    start_time = time.perf_counter()
+    directory = get_faiss_shard_dir()
+    signature = get_embedding_signature(embeddings)
+    dimension = get_embedding_dimension(embeddings)
+    shards, shard_key = get_vector_shards(), get_vector_shard_key()
+    with layout_lock(directory):
+        layout = read_layout(directory)
+        if not layout_matches(layout, shards, shard_key, signature):
+            layout, added, embedded = _build_shards(directory, shards, shard_key, signature, dimension)
+            commit_layout(directory, layout)
+            logger.info(
+                f"Built {shards} FAISS shards by {shard_key} with {added} vectors ({embedded} embedded) "
+                f"in {time.perf_counter() - start_time:.2f}s"
+            )
+        else:
+            caught_up = _catch_up_shards(directory, layout)
+            if caught_up is not None:
+                logger.info(
+                    f"Caught up FAISS shards with the database ({caught_up[0]} vectors added, "
+                    f"{caught_up[1]} of them embedded, {caught_up[2]} removed) in {time.perf_counter() - start_time:.2f}s"
+                )
+
+    vector_store = ShardedStore(embeddings, directory, _load_vector_documents, signature, dimension)
+    vector_store.refresh()
+    logger.info(
+        f"Opened {shards} FAISS shards with {vector_store.vector_count} vectors in {time.perf_counter() - start_time:.2f}s"
+    )
+    return vector_store
+
+def rebalance_vector_shards(shards, shard_key):
+    """Repartition the FAISS index into shards by shard_key ("chunk" or "document") and switch to them
+
+    The new shards are built from the database and the vector file while the
+    current ones keep serving; vectors are only taken from the vector file if
+    they were embedded from their chunk's current text. Writes are held off only
+    while the new shards are checked against the database by id and content
+    hash, catching up with what was written meanwhile, and the layout is switched. Processes
+    using the old shards switch before their next query. Returns a report.
+    """
+    start_time = time.perf_counter()
+    embeddings = get_embeddings()
+    directory = get_faiss_shard_dir()
+    previous = read_layout(directory)
+    layout, added, embedded = _build_shards(
+        directory, shards, shard_key, get_embedding_signature(embeddings), get_embedding_dimension(embeddings)
+    )
+    with layout_lock(directory):
+        caught_up = _catch_up_shards(directory, layout, force=True)
+        commit_layout(directory, layout)
+
+    sizes = []
+    for shard_directory in layout_shard_directories(directory, layout):
+        sizes.append(count_vectors(read_manifest(shard_directory))[0])
+    report = {
+        "previous_shards": previous["shards"] if previous else 0,
+        "previous_key": previous["key"] if previous else None,
+        "shards": shards,
+        "key": shard_key,
+        "vectors": sum(sizes),
+        "embedded": embedded + caught_up[1],
+        "shard_sizes": sizes,
+        "elapsed_seconds": round(time.perf_counter() - start_time, 2)
+    }
+    logger.info(f"Rebalanced FAISS index into {shards} shards by {shard_key}: {sizes} vectors")
+    return report
+
+def _save_faiss_snapshot(vector_store):
+    """Save a snapshot of a FAISS store with the corpus version its index reflects
+
+    That is the store's own version, not the database's: writes made by other
+    processes aren't in this index, so the next load catches them up.
+    """
+    global _last_snapshot_time
+    with _write_lock:
+        save_snapshot(vector_store, get_faiss_snapshot_dir(), {
+            "embedding_signature": get_embedding_signature(),
+            "index_description": _describe_index(vector_store),
+            "corpus_version": vector_store.corpus_version
+        })
+        _last_snapshot_time = time.monotonic()
+
+def save_vector_store_snapshot(force=False):
+    """Snapshot the FAISS index to disk
+
+    Called after each committed write batch. Writing the snapshot costs time in
+    proportion to the whole index, so unless forced it is skipped when the last one
+    was taken less than FAISS_SNAPSHOT_INTERVAL_SECONDS ago; anything a skipped
+    snapshot misses is caught up from the database at the next startup.
+    Returns True if a snapshot was written.
+    """
+    global _last_snapshot_time
+    vector_store = get_vector_store_instance()
+    if not isinstance(vector_store, (FAISS, ChunkVectorStore)):
+        return False
+
+    try:
+        with _write_lock:
+            if not force and time.monotonic() - _last_snapshot_time < get_faiss_snapshot_interval():
+                return False
+            if isinstance(vector_store, ChunkVectorStore):
+                # The segments are already on disk; record the chunks they cover for the next startup
+                chunk_count, max_chunk_id = _get_chunk_stats()
+                if isinstance(vector_store, ShardedStore):
+                    vector_store.publish_fields(chunk_count=chunk_count, max_chunk_id=max_chunk_id)
+                else:
+                    publish_changes(
+                        vector_store.directory, vector_store.embedding_signature, vector_store.dimension,
+                        chunk_count=chunk_count, max_chunk_id=max_chunk_id
+                    )
+                _last_snapshot_time = time.monotonic()
+            else:
+                _save_faiss_snapshot(vector_store)
+        return True
+    except Exception as e:
+        # The index can always be rebuilt from the database, so this must not fail the write
+        logger.error(f"Error saving FAISS snapshot: {str(e)}")
+        return False
+
 def get_vector_store():
     """Get or create a vector store instance (Pinecone or FAISS fallback)"""
     # Get the current vector store instance from the reset module
@@ -88,7 +729,16 @@ def get_vector_store():
     
     if vector_store is not None:
         return vector_store
-    
+
+    with _write_lock:
+        # Another thread may have finished initializing while we waited
+        vector_store = get_vector_store_instance()
+        if vector_store is not None:
+            return vector_store
+        return _initialize_vector_store()
+
+def _initialize_vector_store():
+    """Create the vector store from the database (or the FAISS snapshot)"""
     # Get the store type from the config
     vector_store_type = get_vector_store_type()
     logger.info(f"Initializing vector store, type={vector_store_type}")
@@ -97,66 +747,20 @@ def get_vector_store():
         # Get the embedding model
         embeddings = get_embeddings()
         
-        # Get all document chunks from the database
-        chunks = DocumentChunk.query.all()
-        
-        # Create LangChain documents from the database chunks
-        documents = []
-        for chunk in chunks:
-            document = Document.query.get(chunk.document_id)
-            if document and chunk.content:
-                doc = LangchainDocument(
-                    page_content=chunk.content,
-                    metadata={
-                        "chunk_id": str(chunk.id),  # Convert to string for Pinecone
-                        "document_id": str(chunk.document_id),
-                        "document_title": document.title,
-                        "chunk_index": chunk.chunk_index
-                    }
-                )
-                documents.append(doc)
-        
-        logger.info(f"Found {len(documents)} document chunks in database")
-        
         # Try to use Pinecone if credentials are available and it's enabled
         if vector_store_type == "pinecone" and initialize_pinecone():
             try:
-                # Get Pinecone credentials from environment
-                import os
-                pinecone_api_key = os.environ.get("PINECONE_API_KEY")
-                
-                if not documents:
-                    # Create an empty Pinecone vector store
-                    placeholder_doc = LangchainDocument(
-                        page_content="This is a placeholder document to initialize the vector store.",
-                        metadata={"chunk_id": "placeholder", "document_id": "placeholder"}
-                    )
-                    
-                    # Initialize Pinecone first
-                    import pinecone
-                    pc = pinecone.Pinecone(api_key=pinecone_api_key)
-                    index = pc.Index(PINECONE_INDEX_NAME)
-                    
-                    # Create a vector store using the index
-                    vector_store = LangchainPinecone.from_documents(
-                        documents=[placeholder_doc],
-                        embedding=embeddings,
-                        index_name=PINECONE_INDEX_NAME
-                    )
-                    set_vector_store_instance(vector_store)
-                else:
-                    # Initialize Pinecone first
-                    import pinecone
-                    pc = pinecone.Pinecone(api_key=pinecone_api_key)
-                    index = pc.Index(PINECONE_INDEX_NAME)
-                    
-                    # Create a vector store using the index
-                    vector_store = LangchainPinecone.from_documents(
-                        documents=documents,
-                        embedding=embeddings,
-                        index_name=PINECONE_INDEX_NAME
-                    )
-                    set_vector_store_instance(vector_store)
+                from utils.pinecone_sync import sync_pinecone
+                vector_store = get_pinecone_store(embeddings)
+
+                # Send only the vectors added since the last sync; they are upserted
+                # under stable vector ids, so a repeated sync overwrites rather than duplicates
+                report = sync_pinecone(vector_store)
+                logger.info(
+                    f"Synced {report['upserted']} vectors to Pinecone ({report['embedded']} embedded), "
+                    f"up to chunk {report['high_water_mark']}"
+                )
+                set_vector_store_instance(vector_store)
                 
                 logger.info("Successfully initialized Pinecone vector store")
                 return vector_store
@@ -165,22 +769,21 @@ def get_vector_store():
                 # Fall back to FAISS
                 logger.info("Falling back to FAISS vector store")
         
-        # Use FAISS if Pinecone is not available or fails
-        logger.info("Initializing FAISS vector store")
-        
-        if not documents:
-            # Create an empty FAISS vector store
-            vector_store = FAISS.from_texts(
-                texts=["This is a placeholder document to initialize the vector store."], 
-                embedding=embeddings,
-                metadatas=[{"chunk_id": "placeholder", "document_id": "placeholder"}]
-            )
+        # Use FAISS if Pinecone is not available or fails; "ann" is FAISS over an approximate index
+        approximate = vector_store_type == "ann"
+        if not approximate and _flat_store_class() is TombstoneFAISS and get_vector_shards() > 1:
+            logger.info(f"Initializing FAISS vector store (flat index in {get_vector_shards()} shards by {get_vector_shard_key()})")
+            vector_store = _load_sharded_faiss(embeddings)
+        elif not approximate and _flat_store_class() is TombstoneFAISS and is_faiss_shared_index_enabled():
+            logger.info(f"Initializing FAISS vector store (flat index shared through {get_faiss_segment_dir()})")
+            vector_store = _load_shared_faiss(embeddings)
         else:
-            # Create a FAISS vector store with existing documents
-            vector_store = FAISS.from_documents(documents=documents, embedding=embeddings)
+            logger.info(f"Initializing FAISS vector store ({get_index_description() if approximate else 'flat'} index)")
+            vector_store = _load_faiss(embeddings, approximate)
         
         # Store the instance
         set_vector_store_instance(vector_store)
+        schedule_projection_training()
         
         logger.info("Successfully initialized FAISS vector store")
         return vector_store
@@ -215,16 +818,663 @@ def add_documents_to_vector_store(texts, metadatas):
         logger.error(f"Error adding documents to vector store: {str(e)}")
         raise
 
-def search_vector_store(query, k=5):
-    """Search the vector store for relevant documents"""
+def _upsert_pinecone(vector_store, ids, texts, embeddings, metadatas):
+    """Upsert precomputed vectors to Pinecone, whose LangChain wrapper has no add_embeddings
+
+    The vector id is also stored as metadata, so searches can filter on it.
+    """
+    # Pinecone rejects null metadata values
+    vectors = [
+        (
+            vector_id,
+            np.asarray(embedding, dtype=np.float32).tolist(),
+            {
+                **{key: value for key, value in metadata.items() if value is not None},
+                "vector_id": vector_id,
+                vector_store._text_key: text
+            }
+        )
+        for vector_id, text, embedding, metadata in zip(ids, texts, embeddings, metadatas)
+    ]
+    for batch in batched(vectors, get_pinecone_sync_batch_size()):
+        vector_store._index.upsert(vectors=batch, namespace=vector_store._namespace)
+
+def add_embeddings_to_vector_store(texts, embeddings, metadatas, ids=None):
+    """Add texts with precomputed embeddings to the vector store in one call
+
+    Unlike add_texts this never calls the embedding model again.
+    """
+    vector_store = get_vector_store()
+
+    try:
+        if isinstance(vector_store, LangchainPinecone):
+            _upsert_pinecone(vector_store, ids or [str(uuid.uuid4()) for _ in texts], texts, embeddings, metadatas)
+        else:
+            with _write_lock:
+                vector_store.add_embeddings(
+                    text_embeddings=list(zip(texts, embeddings)),
+                    metadatas=metadatas,
+                    ids=ids
+                )
+            schedule_projection_training()
+            schedule_compaction()
+        logger.info(f"Added {len(texts)} precomputed embeddings to vector store")
+        return vector_store
+    except Exception as e:
+        logger.error(f"Error adding embeddings to vector store: {str(e)}")
+        raise
+
+def record_committed_chunks(chunk_ids):
+    """Note that chunks are committed with their vectors in the vector store
+
+    Pinecone only: vectors are upserted as chunks are indexed, so the next sync
+    doesn't need to send them again.
+    """
+    if isinstance(get_vector_store_instance(), LangchainPinecone):
+        from utils.pinecone_sync import advance_high_water_mark
+        advance_high_water_mark(chunk_ids)
+
+def record_corpus_version(corpus_version):
+    """Note that a committed change moved the corpus to corpus_version
+
+    Flat and approximate FAISS only: the in-memory index reflects the new
+    version if it reflected the one before, since this process applied the
+    change. A change made by another process leaves it behind, and its
+    snapshot then gets caught up at the next load.
+    """
+    vector_store = get_vector_store_instance()
+    if isinstance(vector_store, TombstoneFAISS):
+        with _write_lock:
+            if vector_store.corpus_version is not None and vector_store.corpus_version == corpus_version - 1:
+                vector_store.corpus_version = corpus_version
+
+def delete_from_vector_store(ids):
+    """Delete vectors by id; ids the vector store doesn't hold are ignored"""
+    if not ids:
+        return 0
+    vector_store = get_vector_store()
+
+    try:
+        if isinstance(vector_store, LangchainPinecone):
+            # Pinecone ignores ids it doesn't have
+            vector_store.delete(ids=ids, namespace=vector_store._namespace)
+        else:
+            with _write_lock:
+                if isinstance(vector_store, ChunkVectorStore):
+                    # Ids the segments don't hold are skipped when the deletion is published
+                    vector_store.delete(ids=ids)
+                else:
+                    stored_ids = set(vector_store.index_to_docstore_id.values())
+                    ids = [vector_id for vector_id in ids if vector_id in stored_ids]
+                    if ids:
+                        vector_store.delete(ids=ids)
+            schedule_compaction()
+        logger.info(f"Deleted {len(ids)} vectors from vector store")
+        return len(ids)
+    except Exception as e:
+        logger.error(f"Error deleting from vector store: {str(e)}")
+        raise
+
+def _record_compaction(removed, duration):
+    """Add a finished compaction to the stats"""
+    _compaction_stats["compactions"] += 1
+    _compaction_stats["last_duration_seconds"] = round(duration, 3)
+    _compaction_stats["last_vectors_removed"] = removed
+    _compaction_stats["last_compacted_at"] = time.time()
+    logger.info(f"Compacted FAISS index: {removed} deleted vectors removed in {duration:.2f}s")
+
+def compact_vector_store(force=False):
+    """Rebuild the FAISS index without its deleted vectors
+
+    Only runs once deleted vectors take up VECTOR_COMPACTION_THRESHOLD_PERCENT of
+    the index, unless forced. The live vectors are read and the new index is
+    swapped in under the write lock; the new index is built in between, while
+    writes and searches carry on against the old one. A snapshot is saved
+    afterwards. Returns the number of vectors removed, or None if nothing was done.
+
+    Shared segments, and the segments of each shard, are merged into one instead,
+    once there are FAISS_MAX_SEGMENTS of them or the same share of them is deleted.
+    """
+    vector_store = get_vector_store_instance()
+    if isinstance(vector_store, ChunkVectorStore):
+        return _merge_shared_segments(vector_store, force)
+    if not isinstance(vector_store, TombstoneFAISS):
+        return None
+
+    start_time = time.perf_counter()
+    with _write_lock:
+        if not vector_store.deleted_count or (not force and vector_store.deleted_ratio < get_vector_compaction_threshold()):
+            return None
+        state = vector_store.begin_compaction()
+    index = vector_store.build_compacted_index(state)
+    with _write_lock:
+        removed = vector_store.finish_compaction(state, index)
+        if removed is None:
+            logger.info("FAISS index changed during compaction, dropping the compacted copy")
+            return None
+        _record_compaction(removed, time.perf_counter() - start_time)
+        save_vector_store_snapshot(force=True)
+    return removed
+
+def _segment_directories(vector_store):
+    """Segment directories of a shared or sharded store"""
+    if isinstance(vector_store, ShardedStore):
+        return vector_store.shard_directories
+    return [vector_store.directory]
+
+def _merge_shared_segments(vector_store, force=False):
+    """Merge the shared segments (of each shard) into one; returns the number of vectors removed, or None if nothing was done
+
+    Other processes can keep publishing while the merged segment is written; only
+    reading the manifest and swapping the merged segment in hold the publish lock.
+    """
+    start_time = time.perf_counter()
+    merged = False
+    removed = 0
+    for directory in _segment_directories(vector_store):
+        state = begin_merge(directory, force, get_faiss_max_segments(), get_vector_compaction_threshold())
+        if state is None:
+            continue
+        directory_removed = finish_merge(directory, state, build_merged_segment(directory, state))
+        if directory_removed is None:
+            logger.info(f"FAISS segments in {directory} changed during the merge, dropping the merged segment")
+            continue
+        merged = True
+        removed += directory_removed
+    if not merged:
+        return None
+    vector_store.refresh()
+    _record_compaction(removed, time.perf_counter() - start_time)
+    return removed
+
+def _needs_compaction(vector_store):
+    """Whether a FAISS store is deleted (or, shared, split into segments) enough to compact"""
+    if isinstance(vector_store, ShardedStore):
+        return any(
+            needs_merge(manifest, get_faiss_max_segments(), get_vector_compaction_threshold())
+            for manifest in vector_store.manifests()
+        )
+    if isinstance(vector_store, SharedSegmentStore):
+        return needs_merge(vector_store.manifest, get_faiss_max_segments(), get_vector_compaction_threshold())
+    return isinstance(vector_store, TombstoneFAISS) and vector_store.deleted_ratio >= get_vector_compaction_threshold()
+
+def schedule_compaction():
+    """Compact the FAISS index in a background thread once enough of it is deleted"""
+    global _compaction_thread
+    from flask import current_app, has_app_context
+
+    vector_store = get_vector_store_instance()
+    if not _needs_compaction(vector_store):
+        return False
+    if not has_app_context():
+        # The snapshot saved afterwards needs the database; the next delete tries again
+        return False
+    with _write_lock:
+        if _compaction_thread is not None and _compaction_thread.is_alive():
+            return False
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                try:
+                    compact_vector_store()
+                except Exception as e:
+                    logger.error(f"Error compacting FAISS index: {str(e)}")
+
+        _compaction_thread = threading.Thread(target=run, name="vector-compaction", daemon=True)
+        _compaction_thread.start()
+    return True
+
+def train_vector_projection():
+    """Learn the two-stage search projection and build the reduced copy of the FAISS index
+
+    Only runs when the store needs one: enough vectors and no copy yet, or a corpus
+    grown by PROJECTION_RETRAIN_GROWTH since the projection was learned. As with
+    compaction, the live vectors are read and the copy is swapped in under the
+    write lock, and the projection is learned in between. A snapshot is saved
+    afterwards. Returns True if a new copy was swapped in.
+    """
+    vector_store = get_vector_store_instance()
+    if not isinstance(vector_store, ReducedFAISS):
+        return False
+
+    start_time = time.perf_counter()
+    with _write_lock:
+        if not vector_store.needs_projection():
+            return False
+        state = vector_store.begin_projection()
+    copy = vector_store.build_reduced_copy(state)
+    with _write_lock:
+        if not vector_store.finish_projection(state, copy):
+            logger.info("FAISS index changed while learning the projection, dropping the reduced copy")
+            return False
+        logger.info(
+            f"Learned {vector_store.prefilter_dimension}-dimension projection of {len(state['vectors'])} vectors "
+            f"in {time.perf_counter() - start_time:.2f}s"
+        )
+        save_vector_store_snapshot(force=True)
+    return True
+
+def schedule_projection_training():
+    """Learn the two-stage search projection in a background thread when the store needs one"""
+    global _projection_thread
+    from flask import current_app, has_app_context
+
+    vector_store = get_vector_store_instance()
+    if not isinstance(vector_store, ReducedFAISS) or not vector_store.needs_projection():
+        return False
+    if not has_app_context():
+        # The snapshot saved afterwards needs the database; the next write tries again
+        return False
+    with _write_lock:
+        if _projection_thread is not None and _projection_thread.is_alive():
+            return False
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                try:
+                    train_vector_projection()
+                except Exception as e:
+                    logger.error(f"Error learning the FAISS search projection: {str(e)}")
+
+        _projection_thread = threading.Thread(target=run, name="vector-projection", daemon=True)
+        _projection_thread.start()
+    return True
+
+def get_vector_store_stats():
+    """Report the vector store's size, deleted vectors and compactions"""
+    vector_store = get_vector_store_instance()
+    if vector_store is None:
+        store_type = get_vector_store_type()
+    elif isinstance(vector_store, LangchainPinecone):
+        store_type = "pinecone"
+    else:
+        # Pinecone may be configured but have fallen back to FAISS
+        store_type = "ann" if isinstance(vector_store, AnnFAISS) else "faiss"
+    stats = {"type": store_type, "initialized": vector_store is not None}
+    if isinstance(vector_store, TombstoneFAISS):
+        # Pinecone removes deleted vectors itself, so only FAISS has tombstones
+        stats.update({
+            "vectors": len(vector_store.index_to_docstore_id),
+            "index_size": vector_store.index.ntotal,
+            "deleted_vectors": vector_store.deleted_count,
+            "deleted_ratio": round(vector_store.deleted_ratio, 4),
+            "index_description": _describe_index(vector_store),
+            "compaction_threshold": get_vector_compaction_threshold(),
+            "compacting": _compaction_thread is not None and _compaction_thread.is_alive(),
+            **_compaction_stats
+        })
+    if isinstance(vector_store, QuantizedFAISS):
+        stats["bytes_per_vector"] = vector_store.bytes_per_vector
+    if isinstance(vector_store, ReducedFAISS):
+        stats["prefilter_dimension"] = vector_store.prefilter_dimension if vector_store.has_reduced_copy else 0
+    if isinstance(vector_store, ShardedStore):
+        manifests = [manifest or {"segments": []} for manifest in vector_store.manifests()]
+        counts = [count_vectors(manifest) for manifest in manifests]
+        live, deleted = sum(count[0] for count in counts), sum(count[1] for count in counts)
+        layout = vector_store.layout
+        stats.update({
+            "shards": layout["shards"],
+            "shard_key": layout["key"],
+            "shard_vectors": [count[0] for count in counts],
+            "vectors": live,
+            "index_size": live + deleted,
+            "deleted_vectors": deleted,
+            "deleted_ratio": round(deleted / (live + deleted), 4) if live + deleted else 0.0,
+            "segments": sum(len(manifest["segments"]) for manifest in manifests),
+            "compaction_threshold": get_vector_compaction_threshold(),
+            "compacting": _compaction_thread is not None and _compaction_thread.is_alive(),
+            **_compaction_stats
+        })
+    if isinstance(vector_store, SharedSegmentStore):
+        manifest = vector_store.manifest or {"segments": [], "generation": 0}
+        live, deleted = count_vectors(manifest)
+        stats.update({
+            "shared": True,
+            "vectors": live,
+            "index_size": live + deleted,
+            "deleted_vectors": deleted,
+            "deleted_ratio": round(deleted / (live + deleted), 4) if live + deleted else 0.0,
+            "segments": len(manifest["segments"]),
+            "generation": manifest["generation"],
+            "compaction_threshold": get_vector_compaction_threshold(),
+            "compacting": _compaction_thread is not None and _compaction_thread.is_alive(),
+            **_compaction_stats
+        })
+    return stats
+
+def _filter_documents(search_filter):
+    """Query of the ids of the documents a search filter (see utils.search_filter) matches"""
+    query = db.session.query(Document.id)
+    if "document_id" in search_filter:
+        query = query.filter(Document.id.in_(search_filter["document_id"]))
+    if "document_title" in search_filter:
+        query = query.filter(Document.title.in_(search_filter["document_title"]))
+    if "user_id" in search_filter:
+        query = query.filter(Document.user_id.in_(search_filter["user_id"]))
+    if "uploaded_after" in search_filter:
+        query = query.filter(Document.upload_date >= search_filter["uploaded_after"])
+    if "uploaded_before" in search_filter:
+        query = query.filter(Document.upload_date < search_filter["uploaded_before"])
+    return query
+
+def get_filter_allow_list(search_filter):
+    """Get the ids of the vectors of the documents a search filter matches"""
+    documents = _filter_documents(search_filter).subquery()
+    return {
+        row[0] for row in db.session.query(DocumentChunk.vector_id)
+        .filter(DocumentChunk.document_id.in_(db.select(documents.c.id)))
+        .distinct()
+    }
+
+def _count_filtered_chunks(search_filter, limit):
+    """Count the chunks of the documents a search filter matches, an upper bound on their vectors
+
+    Counting stops at limit.
+    """
+    documents = _filter_documents(search_filter).subquery()
+    chunks = db.session.query(DocumentChunk.id)\
+        .filter(DocumentChunk.document_id.in_(db.select(documents.c.id)))\
+        .limit(limit)\
+        .subquery()
+    return db.session.query(func.count()).select_from(chunks).scalar()
+
+def _search_allowed_by_vector(vector_store, embedding, k, vector_ids, exact_limit=FILTER_EXACT_SEARCH_LIMIT):
+    """Search a FAISS store for an embedding over only the allowed vector ids
+
+    Up to exact_limit allowed vectors are scored exactly against the vectors read
+    back from the index, which beats walking the whole index; a larger allow-list
+    is passed to the index search as an ID selector, so excluded vectors are
+    skipped during the search rather than fetched and discarded afterwards.
+    """
+    import faiss
+    if isinstance(vector_store, ChunkVectorStore):
+        return vector_store.similarity_search_allowed(embedding, k, vector_ids)
+    with _write_lock:
+        # A compaction swaps the index and its mapping under this lock
+        index, index_to_docstore_id = vector_store.index, vector_store.index_to_docstore_id
+        positions_by_id = vector_store.positions_by_id
+        positions = np.fromiter(
+            (positions_by_id[vector_id] for vector_id in vector_ids if vector_id in positions_by_id),
+            dtype=np.int64
+        )
+    if not len(positions):
+        return []
+
+    vector = np.array([embedding], dtype=np.float32)
+    if vector_store._normalize_L2:
+        faiss.normalize_L2(vector)
+
+    scores = None
+    if len(positions) <= exact_limit:
+        try:
+            # Full-precision vectors, even from a compressed index
+            vectors = vector_store.read_vectors(positions, index, index_to_docstore_id)
+            # Squared L2 distances, as IndexFlatL2 reports them
+            distances = (vectors * vectors).sum(axis=1) - 2 * (vectors @ vector[0]) + (vector[0] @ vector[0])
+            top = np.argsort(distances)[:k] if len(positions) <= k else np.argpartition(distances, k)[:k]
+            top = top[np.argsort(distances[top])]
+            scores, indices = distances[top], positions[top]
+        except RuntimeError:
+            # The index can't return stored vectors (e.g. an IVF index without a direct map)
+            scores = None
+    if scores is None:
+        selector = faiss.IDSelectorBatch(positions)
+        params = get_search_parameters(index, selector)
+        if isinstance(params, faiss.SearchParametersHNSW):
+            # HNSW only returns allowed vectors among those it visits, so visit more the fewer are allowed
+            params.efSearch = max(params.efSearch, min(4 * k * index.ntotal // len(positions), FILTER_MAX_EF_SEARCH))
+        scores, indices = vector_store.search_index(index, index_to_docstore_id, vector, min(k, len(positions)), params)
+        scores, indices = scores[0], indices[0]
+
+    results = []
+    for score, position in zip(scores, indices):
+        vector_id = index_to_docstore_id.get(int(position))
+        if vector_id is None:
+            continue
+        doc = vector_store.docstore.search(vector_id)
+        if isinstance(doc, LangchainDocument):
+            results.append((doc, float(score)))
+    return results
+
+def _restrict_to_documents(results, search_filter):
+    """Keep the results that have a chunk in the documents a search filter matches, reported as that chunk
+
+    Chunks with the same content share one vector, whose metadata names the first
+    such chunk, so a vector can be allowed through another document's chunk.
+    """
+    # Look up the results' chunks first and filter only their documents, rather
+    # than walking every chunk of every matching document
+    rows = []
+    for batch in batched([doc.id for doc, _ in results], 500):
+        rows.extend(
+            db.session.query(DocumentChunk.vector_id, DocumentChunk.id, DocumentChunk.chunk_index, Document.id, Document.title)
+            .join(Document, DocumentChunk.document_id == Document.id)
+            .filter(_has_vector_id(batch))
+        )
+    candidate_documents = {row[3] for row in rows}
+    allowed_documents = {
+        row[0] for row in _filter_documents(search_filter).filter(Document.id.in_(candidate_documents))
+    }
+
+    chunks = {}
+    for vector_id, chunk_id, chunk_index, document_id, document_title in sorted(rows, key=lambda row: row[1]):
+        if document_id in allowed_documents:
+            chunks.setdefault(vector_id, {
+                "chunk_id": chunk_id,
+                "chunk_index": chunk_index,
+                "document_id": document_id,
+                "document_title": document_title
+            })
+
+    return [
+        (LangchainDocument(id=doc.id, page_content=doc.page_content, metadata={**doc.metadata, **chunks[doc.id]}), score)
+        for doc, score in results if doc.id in chunks
+    ]
+
+def _search_filtered_by_vector(vector_store, embedding, k, search_filter, prefilter=None):
+    """Search a FAISS store for an embedding over the chunks of the documents a filter matches
+
+    A selective filter is resolved into an allow-list and only those vectors are
+    searched. A broad one over-fetches from the whole index and drops the results
+    it doesn't allow, falling back to the allow-list if too few are left.
+    prefilter forces either strategy.
+    """
+    if isinstance(vector_store, ChunkVectorStore):
+        vector_count = vector_store.vector_count
+    else:
+        vector_count = len(vector_store.index_to_docstore_id)
+    if prefilter is None:
+        prefilter_limit = int(vector_count * FILTER_PREFILTER_FRACTION)
+        allowed_count = _count_filtered_chunks(search_filter, prefilter_limit + 1)
+        if not allowed_count:
+            return []
+        prefilter = allowed_count <= prefilter_limit
+    if not prefilter:
+        # A filter allowing a large share of the index keeps enough of a few extra
+        # results; one allowing little more than FILTER_PREFILTER_FRACTION needs
+        # k / FILTER_PREFILTER_FRACTION of them
+        for fetch_k in (4 * k, int(k / FILTER_PREFILTER_FRACTION)):
+            results = _restrict_to_documents(
+                vector_store.similarity_search_with_score_by_vector(embedding, k=fetch_k), search_filter
+            )
+            if len(results) >= k or fetch_k >= vector_count:
+                return results[:k]
+
+    results = _search_allowed_by_vector(vector_store, embedding, k, get_filter_allow_list(search_filter))
+    return _restrict_to_documents(results, search_filter)
+
+def _search_pinecone_filtered_by_vector(vector_store, embedding, k, search_filter):
+    """Search Pinecone for an embedding over the chunks of the documents a filter matches
+
+    A shared vector's metadata names only one of the documents holding it, so the
+    filter is resolved into an allow-list of vector ids in the database, as for
+    FAISS, and Pinecone filters on the vector_id metadata, PINECONE_FILTER_MAX_IDS
+    ids per query. The queries' results are merged by cosine similarity.
+    """
+    vector_ids = sorted(get_filter_allow_list(search_filter))
+    if not vector_ids:
+        logger.info("No documents match the search filter")
+        return []
+
+    results = []
+    for batch in batched(vector_ids, PINECONE_FILTER_MAX_IDS):
+        for doc, score in vector_store.similarity_search_by_vector_with_score(
+            embedding, k=k, filter={"vector_id": {"$in": list(batch)}}
+        ):
+            # The LangChain wrapper doesn't set ids, which _restrict_to_documents matches on
+            results.append((LangchainDocument(id=doc.metadata.get("vector_id"), page_content=doc.page_content,
+                                              metadata=doc.metadata), score))
+    results.sort(key=lambda result: result[1], reverse=True)
+    return _restrict_to_documents(results[:k], search_filter)
+
+def embed_query(query):
+    """Embed a query with the vector store's embedding model"""
+    return get_vector_store()._embed_query(query)
+
+def embed_queries(queries):
+    """Embed several queries in one batched call; returns a float32 matrix"""
+    return np.asarray(get_vector_store()._embed_documents(list(queries)), dtype=np.float32)
+
+def get_search_mode_in_effect():
+    """Get the search mode queries run with
+
+    That is SEARCH_MODE, except that a hybrid search is lexical only without an
+    embedding provider: the fallback embeddings would only add noise to the fusion.
+    """
+    search_mode = get_search_mode()
+    if search_mode == "hybrid" and not has_embedding_provider(get_embeddings()):
+        return "lexical"
+    return search_mode
+
+def reciprocal_rank_fusion(result_lists, k):
+    """Fuse ranked lists of (document, score) results into the top k by reciprocal rank fusion
+
+    A document scores the sum of 1 / (RRF_K + rank) over the lists it is in, so
+    ranks are combined and the lists' own scores, which aren't comparable, are
+    not used. Documents are matched by vector id. Returns (document, fused score)
+    pairs, best first.
+    """
+    fused = {}
+    documents = {}
+    for results in result_lists:
+        for rank, (doc, _) in enumerate(results, start=1):
+            key = doc.id or str(doc.metadata.get("chunk_id"))
+            fused[key] = fused.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            documents.setdefault(key, doc)
+    best = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [(documents[key], fused[key]) for key in best]
+
+def search_vector_store(query, k=5, filter=None, embedding=None):
+    """Search for the chunks relevant to a query
+
+    The search mode (see get_search_mode_in_effect) decides how: the nearest
+    vectors, BM25 over the chunks' text, or both fused by reciprocal rank fusion.
+    An embedding already computed for the query can be passed in.
+
+    filter is a parsed search filter (see utils.search_filter.parse_search_filter);
+    only chunks of the documents it matches are searched.
+    """
+    logger.info(f"Searching vector store for: '{query}'")
+    if get_search_mode_in_effect() != "vector":
+        return search_vector_store_batch([query], k=k, filter=filter, embeddings=None if embedding is None else [embedding])[0]
+
+    if embedding is None:
+        try:
+            embedding = embed_query(query)
+        except Exception as e:
+            logger.error(f"Error embedding query: {str(e)}")
+            return []
+    return search_vector_store_by_vector(embedding, k=k, filter=filter)
+
+def search_vector_store_batch(queries, k=5, filter=None, embeddings=None):
+    """Search for the chunks relevant to several queries (see search_vector_store); returns a list of results per query
+
+    The queries' vector results come from one search with the whole query
+    matrix, and their lexical ones are scored in parallel with it, on another
+    thread. Embeddings already computed for the queries can be passed in.
+    """
+    from utils.lexical_index import get_lexical_index, lexical_results
+    search_mode = get_search_mode_in_effect()
+    fetch_k = k if search_mode != "hybrid" else k * HYBRID_FETCH_FACTOR
+
+    lexical_search = None
+    if search_mode != "vector":
+        try:
+            # The database is read here; the thread only scores the in-memory index
+            index = get_lexical_index()
+            allowed_vector_ids = get_filter_allow_list(filter) if filter else None
+            lexical_search = _lexical_search_executor.submit(
+                lambda: [index.search(query, fetch_k, allowed_vector_ids) for query in queries]
+            )
+        except Exception as e:
+            logger.error(f"Error searching lexical index: {str(e)}")
+
+    vector_results = None
+    if search_mode != "lexical":
+        if embeddings is None:
+            try:
+                embeddings = embed_queries(queries)
+            except Exception as e:
+                logger.error(f"Error embedding queries: {str(e)}")
+        if embeddings is None:
+            vector_results = [[] for _ in queries]
+        elif len(queries) == 1:
+            vector_results = [search_vector_store_by_vector(np.asarray(embeddings[0]).tolist(), k=fetch_k, filter=filter)]
+        else:
+            vector_results = search_vector_store_by_vectors(np.asarray(embeddings, dtype=np.float32), k=fetch_k, filter=filter)
+
+    lexical_lists = [[] for _ in queries]
+    if lexical_search is not None:
+        try:
+            lexical_lists = lexical_results(lexical_search.result(), filter)
+            logger.info(f"Found {sum(len(results) for results in lexical_lists)} lexical results")
+        except Exception as e:
+            logger.error(f"Error searching lexical index: {str(e)}")
+
+    if vector_results is None:
+        return lexical_lists
+    if search_mode == "vector":
+        return vector_results
+    return [reciprocal_rank_fusion([vector, lexical], k) for vector, lexical in zip(vector_results, lexical_lists)]
+
+def search_vector_store_by_vector(embedding, k=5, filter=None):
+    """Search the vector store for the documents nearest to a query embedding (see search_vector_store)"""
     vector_store = get_vector_store()
     
     try:
-        logger.info(f"Searching vector store for: '{query}'")
-        results = vector_store.similarity_search_with_score(query, k=k)
+        if not filter:
+            if isinstance(vector_store, LangchainPinecone):
+                results = vector_store.similarity_search_by_vector_with_score(embedding, k=k)
+            else:
+                results = vector_store.similarity_search_with_score_by_vector(embedding, k=k)
+        elif isinstance(vector_store, LangchainPinecone):
+            results = _search_pinecone_filtered_by_vector(vector_store, embedding, k, filter)
+        else:
+            results = _search_filtered_by_vector(vector_store, embedding, k, filter)
         logger.info(f"Found {len(results)} results")
         return results
     except Exception as e:
         logger.error(f"Error searching vector store: {str(e)}")
         # Return empty results in case of error
         return []
+
+def search_vector_store_by_vectors(embeddings, k=5, filter=None):
+    """Search the vector store for several query embeddings; returns a list of results per query
+
+    FAISS stores search the whole query matrix at once. Pinecone, which queries
+    one vector per request, and filtered searches are run per query.
+    """
+    vector_store = get_vector_store()
+    if filter or isinstance(vector_store, LangchainPinecone):
+        return [search_vector_store_by_vector(np.asarray(embedding).tolist(), k=k, filter=filter) for embedding in embeddings]
+
+    try:
+        results = vector_store.similarity_search_with_score_by_vectors(embeddings, k=k)
+        logger.info(f"Searched {len(embeddings)} queries, {sum(len(hits) for hits in results)} results")
+        return results
+    except Exception as e:
+        logger.error(f"Error searching vector store: {str(e)}")
+        # Return empty results in case of error
+        return [[] for _ in embeddings]